@@ -0,0 +1,188 @@
+"""
+Benchmark the 2D echelle wavelength fits on the line lists of ``json_files`` and ``sav_files``.
+
+Every line list is fit with :func:`pypeit.core.arc.fit2darc` and with the engine of
+:mod:`pypeitdev.arcs2d.fit2darc`, and the table of results records for both the median wall time of a fit, the
+number of rejected lines, the RMS of the fit and the largest difference between the two solutions. The line lists
+are:
+
+    - ``nires``: the NIRES identifications of ``json_files/nires_wavecalib.json``,
+    - ``gnirs``: the GNIRS identifications of ``sav_files/sv_lines_clean.txt``,
+    - ``gnirs_xidl``: the same GNIRS lines in the normalised coordinates of XIDL's ``x_fit2darc``
+      (``sav_files/data.xidl``, ``all_wv.sav`` and ``t.sav``). This one is fit without rejection with XIDL's
+      (nycoeff, nocoeff) = (3, 5) and also compared with the XIDL model ``wv_mod_2.sav``.
+    - ``synthetic``: optionally, a fake echelle line list with many lines (``--nsynth``) to check the scaling.
+
+Example::
+
+    python benchmark_fit2darc.py --nrepeat 50 --nsynth 20000 --outfile fit2darc_benchmark.ecsv
+"""
+import time
+import json
+import argparse
+from pathlib import Path
+
+import numpy as np
+from scipy.io import readsav
+from astropy.io import ascii
+from astropy.table import Table
+
+from pypeit import msgs
+from pypeit.core import arc
+from pypeit.core import fitting
+
+from pypeitdev.arcs2d import fit2darc
+
+ARCS2D = Path(__file__).resolve().parent
+
+
+def load_nires(json_file=ARCS2D / 'json_files' / 'nires_wavecalib.json'):
+    """
+    Read the NIRES line identifications, with pixels from the normalised xfit as in dev_arcs2d_test.py.
+    """
+    with open(json_file) as fjson:
+        nires_data = json.load(fjson)
+    slits = [key for key in nires_data.keys() if key not in ['arcparam', 'steps']]
+    all_pix = np.concatenate([np.array(nires_data[key]['xfit'])*(nires_data[key]['xnorm'] - 1.) for key in slits])
+    all_wv = np.concatenate([np.array(nires_data[key]['yfit']) for key in slits])
+    all_orders = np.concatenate([np.full(len(nires_data[key]['xfit']), float(nires_data[key]['norder']))
+                                 for key in slits])
+    return dict(name='nires', all_wv=all_wv, all_pix=all_pix, all_orders=all_orders,
+                nspec=int(nires_data[slits[0]]['xnorm']))
+
+
+def load_gnirs(lines_file=ARCS2D / 'sav_files' / 'sv_lines_clean.txt', orders=(3, 4, 5, 6, 7, 8)):
+    """
+    Read the GNIRS line identifications, alternating rows of pixels and wavelengths of every order.
+    """
+    with open(lines_file) as flines:
+        rows = [np.array(line.split(), dtype=float) for line in flines if line.strip()]
+    all_pix = [rows[2*iord][rows[2*iord] != 0.0] for iord in range(len(orders))]
+    all_wv = [rows[2*iord + 1][rows[2*iord + 1] != 0.0] for iord in range(len(orders))]
+    all_orders = [np.full(pix.size, float(order)) for pix, order in zip(all_pix, orders)]
+    all_pix = np.concatenate(all_pix)
+    # Not the real number of pixels but a good approximation, as in dev_arcs2d_test.py
+    return dict(name='gnirs', all_wv=np.concatenate(all_wv), all_pix=all_pix, all_orders=np.concatenate(all_orders),
+                nspec=int(np.max(all_pix)))
+
+
+def load_gnirs_xidl(sav_dir=ARCS2D / 'sav_files'):
+    """
+    Read the normalised inputs and the final model of XIDL's x_fit2darc for the GNIRS lines.
+    """
+    xidl = ascii.read(str(sav_dir / 'data.xidl'))
+    return dict(name='gnirs_xidl', pix_nrm=np.array(xidl['pix_nrm_xidl'], dtype=float),
+                t_nrm=np.array(xidl['t_nrm_xidl'], dtype=float),
+                all_orders=np.array(readsav(str(sav_dir / 't.sav'))['t'], dtype=float),
+                all_wv_order=np.array(readsav(str(sav_dir / 'all_wv.sav'))['all_wv'], dtype=float),
+                wv_mod=np.array(readsav(str(sav_dir / 'wv_mod_2.sav'))['wv_mod'], dtype=float))
+
+
+def synthetic_lines(nlines, norders=30, nspec=4096, seed=1234):
+    """
+    Fake echelle line list with grating-equation wavelengths, a 0.05 pixel scatter and 2% of outliers.
+    """
+    rng = np.random.default_rng(seed)
+    all_orders = rng.integers(40, 40 + norders, nlines).astype(float)
+    all_pix = rng.uniform(0.0, nspec - 1.0, nlines)
+    xx = all_pix/(nspec - 1.0) - 0.5
+    wv_order = 2.5e5*(1.0 + 0.03*xx + 2e-3*xx**2 - 4e-4*xx**3) + 20.0*(all_orders - 55.0)*xx
+    dispersion = 0.03*2.5e5/all_orders/(nspec - 1.0)
+    all_wv = wv_order/all_orders + rng.normal(0.0, 0.05, nlines)*dispersion
+    bad = rng.random(nlines) < 0.02
+    all_wv[bad] += rng.normal(0.0, 2.0, np.sum(bad))
+    return dict(name='synthetic', all_wv=all_wv, all_pix=all_pix, all_orders=all_orders, nspec=nspec)
+
+
+def time_fit(fitfunc, nrepeat):
+    """
+    Median wall time of nrepeat calls of fitfunc, and its last output.
+    """
+    times = np.zeros(nrepeat)
+    for irep in range(nrepeat):
+        tstart = time.perf_counter()
+        out = fitfunc()
+        times[irep] = time.perf_counter() - tstart
+    return float(np.median(times)), out
+
+
+def benchmark_lines(lines, nrepeat=10, nspec_coeff=4, norder_coeff=4, sigrej=3.0):
+    """
+    Fit a line list with pypeit.core.arc.fit2darc and with fit2darc.fit2darc.
+    """
+    all_wv, all_pix, all_orders, nspec = lines['all_wv'], lines['all_pix'], lines['all_orders'], lines['nspec']
+    kwargs = dict(nspec_coeff=nspec_coeff, norder_coeff=norder_coeff, sigrej=sigrej)
+    t_pypeit, fit_pypeit = time_fit(lambda: arc.fit2darc(all_wv, all_pix, all_orders, nspec, **kwargs), nrepeat)
+    t_new, fit_new = time_fit(lambda: fit2darc.fit2darc(all_wv, all_pix, all_orders, nspec, **kwargs), nrepeat)
+    pix_grid = np.linspace(0.0, 1.0, 101)
+    diff = 0.0
+    for order in np.unique(all_orders):
+        orders = np.full(pix_grid.size, order)
+        diff = max(diff, np.max(np.abs(fit_new.eval(pix_grid, x2=orders) - fit_pypeit.eval(pix_grid, x2=orders)))
+                   / order)
+    return dict(name=lines['name'], nlines=all_wv.size, t_pypeit=t_pypeit, t_new=t_new,
+                nrej_pypeit=int(np.sum(np.logical_not(fit_pypeit.bool_gpm))),
+                nrej_new=int(np.sum(np.logical_not(fit_new.bool_gpm))),
+                rms_pypeit=fit_pypeit.calc_fit_rms(x2=all_orders, apply_mask=True),
+                rms_new=fit_new.calc_fit_rms(x2=all_orders, apply_mask=True), max_dwave=diff, max_dwave_xidl=np.nan)
+
+
+def benchmark_xidl(lines, nrepeat=10):
+    """
+    Fit the normalised XIDL inputs without rejection and compare both fits with the XIDL model.
+    """
+    pix_nrm, t_nrm, all_wv_order = lines['pix_nrm'], lines['t_nrm'], lines['all_wv_order']
+    kwargs = dict(function='legendre2d', minx=-1.0, maxx=1.0, minx2=-1.0, maxx2=1.0, maxiter=0)
+    t_pypeit, fit_pypeit = time_fit(lambda: fitting.robust_fit(pix_nrm, all_wv_order, (2, 4), x2=t_nrm, **kwargs),
+                                    nrepeat)
+    t_new, fit_new = time_fit(lambda: fit2darc.robust_fit2d(pix_nrm, t_nrm, all_wv_order, (2, 4), **kwargs), nrepeat)
+    orders = lines['all_orders']
+    mod_pypeit, mod_new = fit_pypeit.eval(pix_nrm, x2=t_nrm), fit_new.eval(pix_nrm, x2=t_nrm)
+    return dict(name=lines['name'], nlines=all_wv_order.size, t_pypeit=t_pypeit, t_new=t_new, nrej_pypeit=0,
+                nrej_new=0, rms_pypeit=fit_pypeit.calc_fit_rms(x2=t_nrm), rms_new=fit_new.calc_fit_rms(x2=t_nrm),
+                max_dwave=float(np.max(np.abs(mod_new - mod_pypeit)/orders)),
+                max_dwave_xidl=float(np.max(np.abs(mod_new - lines['wv_mod'])/orders)))
+
+
+def run_benchmark(nrepeat=10, nsynth=0, nspec_coeff=4, norder_coeff=4, sigrej=3.0):
+    """
+    Benchmark all the line lists and return a table with one row per line list.
+    """
+    corpus = [load_nires(), load_gnirs()]
+    if nsynth > 0:
+        corpus.append(synthetic_lines(nsynth))
+    rows = [benchmark_lines(lines, nrepeat=nrepeat, nspec_coeff=nspec_coeff, norder_coeff=norder_coeff,
+                            sigrej=sigrej) for lines in corpus]
+    rows.append(benchmark_xidl(load_gnirs_xidl(), nrepeat=nrepeat))
+    results = Table(rows=[list(row.values()) for row in rows], names=list(rows[0].keys()))
+    results['speedup'] = results['t_pypeit']/results['t_new']
+    for key in ['t_pypeit', 't_new', 'rms_pypeit', 'rms_new', 'max_dwave', 'max_dwave_xidl', 'speedup']:
+        results[key].format = '.3g'
+    return results
+
+
+def parse_args(options=None):
+    parser = argparse.ArgumentParser(description='Benchmark the 2D echelle wavelength fits on the arcs2d line lists')
+    parser.add_argument('--nrepeat', default=10, type=int, help='Number of times every fit is timed')
+    parser.add_argument('--nsynth', default=0, type=int,
+                        help='Also benchmark a synthetic echelle line list with this number of lines')
+    parser.add_argument('--nspec_coeff', default=4, type=int, help='Order of the fits along the spectral direction')
+    parser.add_argument('--norder_coeff', default=4, type=int, help='Order of the fits along the order direction')
+    parser.add_argument('--sigrej', default=3.0, type=float, help='Rejection threshold of the fits')
+    parser.add_argument('--outfile', default=None, type=str, help='Write the results to this file')
+    return parser.parse_args(options)
+
+
+def main(args):
+    msgs.info('Benchmarking fit2darc with {0} repetitions'.format(args.nrepeat))
+    results = run_benchmark(nrepeat=args.nrepeat, nsynth=args.nsynth, nspec_coeff=args.nspec_coeff,
+                            norder_coeff=args.norder_coeff, sigrej=args.sigrej)
+    if args.outfile is not None:
+        results.write(args.outfile, overwrite=True)
+    print('==============================================================')
+    results.pprint_all()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main(parse_args()))
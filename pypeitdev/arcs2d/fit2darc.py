@@ -0,0 +1,277 @@
+"""
+Fast 2D wavelength solutions of echelle spectrographs.
+
+:func:`fit2darc` is a drop-in replacement of :func:`pypeit.core.arc.fit2darc`. The product of wavelength and order
+number of the identified arc lines is fit with a 2D Legendre polynomial of (pixel, order) with iterative sigma
+rejection, as :func:`pypeit.core.fitting.robust_fit` does, but:
+
+    - the tensor-product basis is evaluated once for all the lines, by broadcasting the two 1D Legendre bases,
+      instead of being rebuilt by ``legvander2d`` in every rejection iteration,
+    - the normal equations of all the lines are computed once, and every iteration only removes the contribution
+      of the masked lines and solves the column-normalised system, falling back to a QR decomposition of the good
+      rows of the design matrix when it is not well conditioned,
+    - the model of all the lines is a single matrix product with the precomputed basis.
+
+The output is the same :class:`~pypeit.core.fitting.PypeItFit` as the one of robust_fit, so it can be evaluated,
+written and passed to the QA plots of :mod:`pypeit.core.arc`.
+"""
+import numpy as np
+from scipy import linalg
+
+from pypeit import msgs
+from pypeit.core import arc
+from pypeit.core import fitting
+from pypeit.core import pydl
+
+
+def basis2d(x, x2, deg, function='legendre', minx=None, maxx=None, minx2=None, maxx2=None):
+    """
+    Tensor-product basis of a 2D fit.
+
+    Args:
+        x (`numpy.ndarray`_):
+            First independent variable, shape (npts,).
+        x2 (`numpy.ndarray`_):
+            Second independent variable, shape (npts,).
+        deg (:obj:`tuple`):
+            Degrees of the fit along x and x2.
+        function (:obj:`str`, optional):
+            'polynomial', 'legendre' or 'chebyshev'.
+        minx, maxx, minx2, maxx2 (:obj:`float`, optional):
+            Limits used to map x and x2 to [-1, 1] for the Legendre and Chebyshev fits. If not given, the range of
+            the data is used.
+
+    Returns:
+        `numpy.ndarray`_: The basis, shape (npts, (deg[0] + 1)*(deg[1] + 1)), with the columns in the order of
+        ``legvander2d``, i.e. of the flattened coefficients of :func:`pypeit.core.fitting.polyfit2d_general`.
+    """
+    if function == 'polynomial':
+        vanderfunc = np.polynomial.polynomial.polyvander
+    elif function in ['legendre', 'chebyshev']:
+        x, _, _ = fitting.scale_minmax(x, minx=minx, maxx=maxx)
+        x2, _, _ = fitting.scale_minmax(x2, minx=minx2, maxx=maxx2)
+        vanderfunc = np.polynomial.legendre.legvander if function == 'legendre' \
+            else np.polynomial.chebyshev.chebvander
+    else:
+        msgs.error("Function {0:s} has not yet been implemented for 2d fits".format(function))
+    vander = vanderfunc(x, deg[0])[:, :, np.newaxis]*vanderfunc(x2, deg[1])[:, np.newaxis, :]
+    return vander.reshape(x.size, -1)
+
+
+def solve_qr(vander, yval, gpm):
+    """
+    Least-squares solution of the good rows of a (weighted) design matrix with a QR decomposition.
+
+    The columns are normalised to unit length, like numpy's fitting routines do, and only the R factor of the matrix
+    augmented with the data is computed, since its last column holds Q^T y. If the good rows do not constrain all
+    the coefficients the minimum norm solution of ``numpy.linalg.lstsq`` is returned instead.
+
+    Args:
+        vander (`numpy.ndarray`_):
+            Design matrix, shape (npts, ncoeff).
+        yval (`numpy.ndarray`_):
+            Data, shape (npts,).
+        gpm (`numpy.ndarray`_):
+            Good pixel mask of the rows, shape (npts,).
+
+    Returns:
+        `numpy.ndarray`_: Coefficients, shape (ncoeff,).
+    """
+    lhs = vander[gpm]
+    ncoeff = vander.shape[1]
+    if lhs.shape[0] == 0:
+        return np.zeros(ncoeff)
+    scl = np.sqrt(np.sum(lhs**2, axis=0))
+    scl[scl == 0.0] = 1.0
+    lhs = lhs/scl
+    if lhs.shape[0] > ncoeff:
+        rr = linalg.qr(np.column_stack((lhs, yval[gpm])), mode='r', overwrite_a=True, check_finite=False)[0]
+        diag = np.abs(np.diag(rr)[:ncoeff])
+        if diag.min() > max(lhs.shape)*np.finfo(float).eps*diag.max():
+            return linalg.solve_triangular(rr[:ncoeff, :ncoeff], rr[:ncoeff, ncoeff], check_finite=False)/scl
+    return np.linalg.lstsq(lhs, yval[gpm], rcond=None)[0]/scl
+
+
+def solve_downdated(vander, yval, gram, rhs, gpm, cond_max=1e8):
+    """
+    Least-squares solution of the good rows of a design matrix from its precomputed normal equations.
+
+    The normal equations of the good rows are obtained by removing the contribution of the masked rows, which are
+    usually a few percent of the lines, from the normal equations of all the rows, so that the cost of a rejection
+    iteration scales with the number of masked lines. They are solved by a Cholesky decomposition after normalising
+    the columns. If the normalised system is not well conditioned, e.g. because the masked lines leave some
+    coefficients poorly constrained, :func:`solve_qr` is used instead.
+
+    Args:
+        vander (`numpy.ndarray`_):
+            Design matrix, shape (npts, ncoeff).
+        yval (`numpy.ndarray`_):
+            Data, shape (npts,).
+        gram (`numpy.ndarray`_):
+            vander.T @ vander, shape (ncoeff, ncoeff).
+        rhs (`numpy.ndarray`_):
+            vander.T @ yval, shape (ncoeff,).
+        gpm (`numpy.ndarray`_):
+            Good pixel mask of the rows, shape (npts,).
+        cond_max (:obj:`float`, optional):
+            Largest condition number of the normalised normal equations solved with the Cholesky decomposition.
+
+    Returns:
+        `numpy.ndarray`_: Coefficients, shape (ncoeff,).
+    """
+    bpm = np.logical_not(gpm)
+    if np.sum(bpm) < np.sum(gpm):
+        this_gram = gram - vander[bpm].T @ vander[bpm]
+        this_rhs = rhs - vander[bpm].T @ yval[bpm]
+    else:
+        this_gram = vander[gpm].T @ vander[gpm]
+        this_rhs = vander[gpm].T @ yval[gpm]
+    scl = np.sqrt(np.abs(np.diag(this_gram)))
+    scl[scl == 0.0] = 1.0
+    this_gram = this_gram/np.outer(scl, scl)
+    # The normal equations square the condition number of the design matrix, so their relative precision is about
+    # cond*eps. The system is tiny, computing its condition number is cheap compared to the downdate.
+    if not np.linalg.cond(this_gram) < cond_max:
+        return solve_qr(vander, yval, gpm)
+    try:
+        cho = linalg.cho_factor(this_gram, check_finite=False)
+    except linalg.LinAlgError:
+        return solve_qr(vander, yval, gpm)
+    return linalg.cho_solve(cho, this_rhs/scl, check_finite=False)/scl
+
+
+def robust_fit2d(xarray, x2, yarray, order, function='legendre2d', minx=None, maxx=None, minx2=None, maxx2=None,
+                 maxiter=10, in_gpm=None, weights=None, lower=None, upper=None, maxdev=None, maxrej=None,
+                 sticky=True, use_mad=True, verbose=True):
+    """
+    2D robust fit, equivalent to :func:`pypeit.core.fitting.robust_fit` with x2, without rebuilding the design
+    matrix in the rejection iterations.
+
+    The arguments are those of robust_fit. The rejection of every iteration is done by
+    :func:`pypeit.core.pydl.djs_reject`, so the rejected points are the same as the ones of robust_fit, up to
+    points sitting exactly on the rejection threshold.
+
+    Args:
+        xarray (`numpy.ndarray`_):
+            First independent variable, shape (npts,).
+        x2 (`numpy.ndarray`_):
+            Second independent variable, shape (npts,).
+        yarray (`numpy.ndarray`_):
+            Dependent variable, shape (npts,).
+        order (:obj:`tuple`):
+            Orders of the fit along x and x2.
+        function (:obj:`str`, optional):
+            'polynomial2d', 'legendre2d' or 'chebyshev2d'.
+        minx, maxx, minx2, maxx2 (:obj:`float`, optional):
+            Limits used to normalise x and x2. If not given, the range of the input data is used, whereas robust_fit
+            uses the range of the good points of every iteration, so give them to get the same fit.
+        maxiter (:obj:`int`, optional):
+            Maximum number of rejection iterations. Set to zero to do a single fit.
+        in_gpm (`numpy.ndarray`_, optional):
+            Input good pixel mask.
+        weights (`numpy.ndarray`_, optional):
+            Weights of the fit. As in :func:`pypeit.core.fitting.polyfit2d_general`, the rows of the design matrix
+            and the data are multiplied by the weights.
+        lower, upper (:obj:`float`, optional):
+            Rejection thresholds in units of the sigma of the residuals.
+        maxdev (:obj:`float`, optional):
+            Reject points with an absolute deviation larger than maxdev.
+        maxrej (:obj:`int`, optional):
+            Maximum number of points rejected per iteration.
+        sticky (:obj:`bool`, optional):
+            If True, rejected points stay rejected in the following iterations.
+        use_mad (:obj:`bool`, optional):
+            If True, sigma is estimated from the median absolute deviation.
+        verbose (:obj:`bool`, optional):
+            If True, warn when maxiter is reached.
+
+    Returns:
+        :class:`~pypeit.core.fitting.PypeItFit`: The fit.
+    """
+    if function not in ['polynomial2d', 'legendre2d', 'chebyshev2d']:
+        msgs.error("Function {0:s} has not yet been implemented for 2d fits".format(function))
+    xarray, x2, yarray = np.asarray(xarray, dtype=float), np.asarray(x2, dtype=float), np.asarray(yarray, dtype=float)
+    deg = np.atleast_1d(order).astype(int)
+    in_gpm = np.ones(xarray.size, dtype=bool) if in_gpm is None else np.asarray(in_gpm, dtype=bool)
+    weights = np.ones(xarray.size) if weights is None else np.asarray(weights, dtype=float)
+    # The same limits as polyfit2d_general, which takes them from the data if they are not given
+    if function != 'polynomial2d':
+        minx, maxx = (np.min(xarray) if minx is None else minx), (np.max(xarray) if maxx is None else maxx)
+        minx2, maxx2 = (np.min(x2) if minx2 is None else minx2), (np.max(x2) if maxx2 is None else maxx2)
+
+    # The basis is computed once, the iterations only change the masked rows
+    vander = basis2d(xarray, x2, deg, function=function[:-2], minx=minx, maxx=maxx, minx2=minx2, maxx2=maxx2)
+    # Like polyfit2d_general, the 2D fits multiply the design matrix and the data by the weights themselves, not by
+    # their square root as the 1D numpy fits do
+    vander_w, yarray_w = vander*weights[:, np.newaxis], yarray*weights
+    gram, rhs = vander_w.T @ vander_w, vander_w.T @ yarray_w
+
+    this_gpm = in_gpm.copy()
+    fitc = None
+    qdone = False
+    niter = 0
+    while not qdone and niter < maxiter:
+        if np.sum(this_gpm) <= np.sum(deg) + 1:
+            msgs.warn("More parameters than data points - fit might be undesirable")
+        fitc = solve_downdated(vander_w, yarray_w, gram, rhs, this_gpm)
+        this_gpm, qdone = pydl.djs_reject(yarray, vander @ fitc, outmask=this_gpm, inmask=in_gpm, lower=lower,
+                                          upper=upper, maxdev=maxdev, maxrej=maxrej, use_mad=use_mad,
+                                          sticky=sticky)
+        niter += 1
+    if niter == maxiter and maxiter != 0 and verbose:
+        msgs.warn(f'Maximum number of iterations maxiter={maxiter} reached in robust_fit2d')
+    # robust_fit always refits with the final mask, which is only needed if the mask changed in the last iteration
+    if not qdone:
+        fitc = solve_downdated(vander_w, yarray_w, gram, rhs, this_gpm)
+
+    return fitting.PypeItFit(xval=xarray, yval=yarray, func=function, order=deg, x2=x2, weights=weights,
+                             gpm=this_gpm.astype(int), fitc=fitc.reshape(deg + 1),
+                             minx=None if minx is None else float(minx), maxx=None if maxx is None else float(maxx),
+                             minx2=None if minx2 is None else float(minx2),
+                             maxx2=None if maxx2 is None else float(maxx2))
+
+
+def fit2darc(all_wv, all_pix, all_orders, nspec, nspec_coeff=4, norder_coeff=4, sigrej=3.0, func2d='legendre2d',
+             debug=False):
+    """
+    2D wavelength solution of an echelle spectrograph. Same inputs and outputs as
+    :func:`pypeit.core.arc.fit2darc`, with the fit done by :func:`robust_fit2d`.
+
+    Args:
+        all_wv (`numpy.ndarray`_):
+            Wavelengths of the identified lines.
+        all_pix (`numpy.ndarray`_):
+            Spectral direction centroids of the identified lines.
+        all_orders (`numpy.ndarray`_):
+            Echelle order number of each of the identified lines.
+        nspec (:obj:`int`):
+            Size of the image in the spectral direction.
+        nspec_coeff (:obj:`int`, optional):
+            Order of the fit along the spectral direction.
+        norder_coeff (:obj:`int`, optional):
+            Order of the fit along the order direction.
+        sigrej (:obj:`float`, optional):
+            Sigma level of the rejection.
+        func2d (:obj:`str`, optional):
+            2D function of the fit.
+        debug (:obj:`bool`, optional):
+            If True, show the QA plots of the fit.
+
+    Returns:
+        :class:`~pypeit.core.fitting.PypeItFit`: 2D wavelength solution fit.
+    """
+    all_wv, all_pix, all_orders = np.asarray(all_wv, dtype=float), np.asarray(all_pix, dtype=float), \
+        np.asarray(all_orders, dtype=float)
+    # Fits are performed in pixels/(nspec-1), as in pypeit, to deal with the binning
+    pypeitFit = robust_fit2d(all_pix/float(nspec - 1), all_orders, all_wv*all_orders, (nspec_coeff, norder_coeff),
+                             function=func2d, maxiter=100, lower=sigrej, upper=sigrej, minx=0.0, maxx=1.0,
+                             minx2=np.min(all_orders), maxx2=np.max(all_orders), use_mad=True, sticky=False)
+
+    fin_rms = pypeitFit.calc_fit_rms(x2=all_orders, apply_mask=True)
+    msgs.info("RMS: {0:.5f} Ang*Order#".format(fin_rms))
+
+    if debug:
+        arc.fit2darc_global_qa(pypeitFit, nspec)
+        arc.fit2darc_orders_qa(pypeitFit, nspec)
+
+    return pypeitFit
@@ -0,0 +1,60 @@
+"""
+Check the 2D fits of fit2darc against pypeit's robust_fit and arc.fit2darc.
+
+Run with::
+
+    pytest pypeitdev/arcs2d/test_fit2darc.py
+"""
+import numpy as np
+import pytest
+
+from pypeit.core import arc
+from pypeit.core import fitting
+
+from pypeitdev.arcs2d import fit2darc
+from pypeitdev.arcs2d import benchmark_fit2darc
+
+
+def fake_lines(npts=500, seed=3):
+    """
+    Smooth 2D surface sampled at random points, with noise, 5% of outliers and non-uniform weights.
+    """
+    rng = np.random.default_rng(seed)
+    x = rng.uniform(0.0, 1.0, npts)
+    x2 = rng.integers(3, 9, npts).astype(float)
+    y = 1e4*(1.0 + 0.3*x - 0.05*x**2 + 0.01*x**3) + 50.0*x*(x2 - 5.0) + 2.0*(x2 - 5.0)**2 \
+        + rng.normal(0.0, 1.0, npts)
+    bad = rng.random(npts) < 0.05
+    y[bad] += rng.normal(0.0, 20.0, np.sum(bad))
+    return x, x2, y, rng.uniform(0.2, 5.0, npts)
+
+
+@pytest.mark.parametrize('function', ['legendre2d', 'chebyshev2d', 'polynomial2d'])
+def test_robust_fit2d_weighted(function):
+    x, x2, y, weights = fake_lines()
+    kwargs = dict(function=function, maxiter=25, lower=3.0, upper=3.0, use_mad=True, sticky=False,
+                  weights=weights, verbose=False)
+    if function != 'polynomial2d':
+        kwargs.update(minx=0.0, maxx=1.0, minx2=3.0, maxx2=8.0)
+    pypeitFit = fitting.robust_fit(x, y, (3, 3), x2=x2, **kwargs)
+    newFit = fit2darc.robust_fit2d(x, x2, y, (3, 3), **kwargs)
+    assert np.sum(np.logical_not(pypeitFit.bool_gpm)) > 0
+    assert np.array_equal(newFit.bool_gpm, pypeitFit.bool_gpm)
+    scale = np.max(np.abs(y))
+    assert np.allclose(newFit.eval(x, x2=x2), pypeitFit.eval(x, x2=x2), rtol=0.0, atol=1e-9*scale)
+
+    # Refitting the returned PypeItFit, which stores the weights, gives the same solution
+    fitc = newFit.fitc.copy()
+    newFit.fit()
+    assert np.allclose(newFit.fitc, fitc, rtol=1e-8, atol=1e-9*scale)
+
+
+def test_fit2darc_nires():
+    lines = benchmark_fit2darc.load_nires()
+    all_wv, all_pix, all_orders, nspec = lines['all_wv'], lines['all_pix'], lines['all_orders'], lines['nspec']
+    pypeitFit = arc.fit2darc(all_wv, all_pix, all_orders, nspec)
+    newFit = fit2darc.fit2darc(all_wv, all_pix, all_orders, nspec)
+    assert np.array_equal(newFit.bool_gpm, pypeitFit.bool_gpm)
+    pix = all_pix/float(nspec - 1)
+    assert np.allclose(newFit.eval(pix, x2=all_orders)/all_orders, pypeitFit.eval(pix, x2=all_orders)/all_orders,
+                       rtol=0.0, atol=1e-5)
@@ -0,0 +1,624 @@
+"""
+Compare the calibration and science products of two dev-suite runs.
+
+Every product found under the two REDUX_OUT folders is reduced to a small summary per slit, order, object or image:
+
+    - Slits: left and right edges sampled at a few spectral positions,
+    - Tilts: RMS of the 2D tilt fit about the traced tilts, number of fitted and fraction of rejected points,
+    - Flat: illumination profile (median, 5th percentile and scatter) and pixel-to-pixel scatter within every slit,
+    - WaveCalib: the :meth:`~pypeit.wavecalib.WaveCalib.wave_diagnostics` of every slit/order,
+    - spec1d: S/N and extracted flux of every object,
+    - sensfunc: zero-point of every detector/order.
+
+The summaries are computed by a pool of worker processes and cached in an HDF5 file in each REDUX_OUT folder, keyed by
+the path, the size and the modification time of the products, so only new or modified products are read again. The
+slits, orders and objects of the two runs are matched by position and every change is scored by dividing it by a
+typical tolerance (:data:`SCALES`). The changes are returned in a table sorted by score, largest first, so that the
+most significant science-level changes of a PR are at the top.
+
+Example::
+
+    python compare_runs.py /path/to/old/REDUX_OUT /path/to/new/REDUX_OUT --nproc 8 --outfile redux_diff.ecsv
+"""
+import os
+import shutil
+import argparse
+import traceback
+import multiprocessing
+from pathlib import Path
+
+import numpy as np
+import h5py
+from scipy import ndimage
+from astropy.table import Table
+
+from pypeit import msgs
+from pypeit import slittrace, wavetilts, flatfield, wavecalib, specobjs, sensfunc
+from pypeit.pypmsgs import PypeItError
+
+from pypeitdev.fileio import atomic_write
+
+
+# Glob patterns of the products, relative to the spectrograph/dataset folders
+PRODUCTS = {'slits': '**/Calibrations/Slits_*.fits*',
+            'tilts': '**/Calibrations/Tilts_*.fits*',
+            'flat': '**/Calibrations/Flat_*.fits*',
+            'wavecalib': '**/Calibrations/WaveCalib_*.fits*',
+            'spec1d': '**/Science/spec1d_*.fits',
+            'sensfunc': '**/sens_*.fits'}
+
+# Typical tolerance of every metric. The score of a change is the change divided by this value.
+SCALES = {'edge_shift': 0.5,          # pixels
+          'fit_rms': 0.02,            # pixels
+          'nfit': 0.1,                # fractional change
+          'frac_rej': 0.05,
+          'illum_median': 0.01,
+          'illum_p05': 0.02,
+          'illum_scatter': 0.005,
+          'pixel_scatter': 0.002,
+          'RMS': 0.05,                # pixels, same binning as check_wave_changes
+          'Nlin': 5,
+          'dWave': 0.05,              # Angstrom
+          'Wave_cen': 1.0,            # Angstrom
+          'measured_fwhm': 0.5,       # pixels
+          's2n': 0.05,                # fractional change
+          'flux_ratio': 0.02,         # fractional change
+          'zeropoint': 0.02,          # mag, median over wavelength
+          'zeropoint_p95': 0.05,      # mag, 95th percentile over wavelength
+          'masked': 0.1}
+
+# Maximum distance in pixels (or orders) when matching the slits, orders and objects of the two runs
+MATCH_TOL = 5.0
+
+# Number of spectral positions at which the slit edges are compared
+NSAMP_EDGES = 9
+
+# Bump this when the summaries change, so that the caches are rebuilt
+CACHE_VERSION = 1
+
+CACHE_NAME = 'compare_runs_cache.h5'
+
+
+def summarize_slits(path):
+    """
+    Summary of a Slits file: the left and right edges of every slit at :data:`NSAMP_EDGES` spectral positions.
+    """
+    slits = slittrace.SlitTraceSet.from_file(path, chk_version=False)
+    left, right, _ = slits.select_edges()
+    ispec = np.linspace(0, left.shape[0] - 1, NSAMP_EDGES).astype(int)
+    return {str(spat_id): dict(group='', pos=float(spat_id), left=left[ispec, islit], right=right[ispec, islit],
+                               masked=int(slits.mask[islit] != 0))
+            for islit, spat_id in enumerate(slits.spat_id)}
+
+
+def _match_traced_tilts(goodpix_spat, goodpix_tilt, fit_spat, fit_tilt):
+    """
+    Traced tilts at the points of the 2D fit.
+
+    The points of the 2D fit are a subset of the traced points, at the same spatial positions, but the traced points
+    are not saved with their line IDs. Every fitted point is matched to the traced point at the same spatial position
+    that is nearest in the spectral direction, with a single searchsorted over the (spat, tilt) sorted traced points.
+    """
+    big = 2.0*max(np.abs(goodpix_tilt).max(), np.abs(fit_tilt).max()) + 1.0
+    key = goodpix_spat*big + goodpix_tilt
+    isort = np.argsort(key)
+    key = key[isort]
+    fit_key = fit_spat*big + fit_tilt
+    ihi = np.clip(np.searchsorted(key, fit_key), 1, key.size - 1)
+    ilo = ihi - 1
+    inear = np.where(np.abs(key[ilo] - fit_key) <= np.abs(key[ihi] - fit_key), ilo, ihi)
+    traced = goodpix_tilt[isort][inear]
+    same_spat = goodpix_spat[isort][inear] == fit_spat
+    return np.where(same_spat, traced, np.nan)
+
+
+def summarize_tilts(path):
+    """
+    Summary of a Tilts file: RMS of the 2D fit about the traced tilts, number of fitted points and fraction of rejected
+    points of every slit.
+    """
+    tilts = wavetilts.WaveTilts.from_file(path, chk_version=False)
+    summary = {str(spat_id): dict(group='', pos=float(spat_id), fit_rms=np.nan, nfit=0, frac_rej=np.nan)
+               for spat_id in tilts.spat_id}
+    traces = tilts.tilt_traces
+    if traces is None or 'good2dfit_lid' not in traces.colnames or 'goodpix_tilt' not in traces.colnames:
+        return summary
+
+    fit_slit = np.array([lid.split('_')[0] for lid in traces['good2dfit_lid'][0]])
+    resid = traces['good2dfit_tilt'][0] - _match_traced_tilts(traces['goodpix_spat'][0], traces['goodpix_tilt'][0],
+                                                              traces['good2dfit_spat'][0], traces['good2dfit_tilt'][0])
+    rej_slit = np.array([lid.split('_')[0] for lid in traces['bad2dfit_lid'][0]]) \
+        if 'bad2dfit_lid' in traces.colnames else np.array([])
+    for key, item in summary.items():
+        this_resid = resid[fit_slit == key]
+        nrej = np.sum(rej_slit == key)
+        item['nfit'] = this_resid.size
+        if this_resid.size > 0:
+            item['fit_rms'] = np.sqrt(np.nanmean(this_resid**2))
+            item['frac_rej'] = nrej/(this_resid.size + nrej)
+    return summary
+
+
+def summarize_flat(path):
+    """
+    Summary of a Flat file: median, 5th percentile and scatter of the spatial illumination, and pixel-to-pixel scatter of
+    the normalized pixel flat, within every slit.
+
+    The slits are read from the Slits file with the same calibration key. If it cannot be found, or the flat has no
+    spatial illumination, the statistics of the normalized pixel flat are computed over the whole image.
+    """
+    flat = flatfield.FlatImages.from_file(path, chk_version=False)
+    pixelflat = flat.pixelflat_norm
+    gpm = np.ones(pixelflat.shape, dtype=bool) if flat.pixelflat_bpm is None else flat.pixelflat_bpm == 0
+    gpm &= np.isfinite(pixelflat)
+
+    slits_file = Path(path).parent / Path(path).name.replace('Flat_', 'Slits_', 1)
+    slits_file = slits_file if slits_file.is_file() else slits_file.with_suffix(slits_file.suffix + '.gz')
+    try:
+        slits = slittrace.SlitTraceSet.from_file(str(slits_file), chk_version=False)
+        illum = flat.fit2illumflat(slits)
+        slitimg = slits.slit_img()
+    except (PypeItError, FileNotFoundError, OSError) as e:
+        msgs.warn(f'Cannot build the illumination of {path} per slit ({e}). Using the whole image.')
+        pix = pixelflat[gpm]
+        return {'all': dict(group='', pos=0.0, illum_median=np.nan, illum_p05=np.nan, illum_scatter=np.nan,
+                            pixel_scatter=1.4826*np.median(np.abs(pix - np.median(pix))) if pix.size > 0 else np.nan)}
+
+    labels = np.where(gpm, slitimg, -1)
+    index = np.asarray(slits.spat_id)
+    illum_median = ndimage.median(illum, labels, index)
+    illum_p05 = ndimage.labeled_comprehension(illum, labels, index, lambda x: np.percentile(x, 5.0), float, np.nan)
+    illum_scatter = ndimage.labeled_comprehension(
+        illum, labels, index, lambda x: 1.4826*np.median(np.abs(x - np.median(x))), float, np.nan)
+    pixel_scatter = ndimage.labeled_comprehension(
+        pixelflat, labels, index, lambda x: 1.4826*np.median(np.abs(x - np.median(x))), float, np.nan)
+    return {str(spat_id): dict(group='', pos=float(spat_id), illum_median=illum_median[islit],
+                               illum_p05=illum_p05[islit], illum_scatter=illum_scatter[islit],
+                               pixel_scatter=pixel_scatter[islit], masked=int(slits.mask[islit] != 0))
+            for islit, spat_id in enumerate(slits.spat_id)}
+
+
+def summarize_wavecalib(path):
+    """
+    Summary of a WaveCalib file: the wavelength diagnostics of every slit/order.
+    """
+    diag = wavecalib.WaveCalib.from_file(path, chk_version=False).wave_diagnostics()
+    return {str(row['SpatOrderID']): dict(group='', pos=float(row['SpatOrderID']), RMS=float(row['RMS']),
+                                          Nlin=int(row['Nlin']), dWave=float(row['dWave']),
+                                          Wave_cen=float(row['Wave_cen']),
+                                          measured_fwhm=float(row['measured_fwhm']))
+            for row in diag}
+
+
+def summarize_spec1d(path):
+    """
+    Summary of a spec1d file: S/N and extracted flux of every object. The optimal extraction is used if available,
+    and the fluxed spectrum if the file has been flux calibrated.
+    """
+    summary = {}
+    for sobj in specobjs.SpecObjs.from_fitsfile(path, chk_version=False):
+        ext = 'OPT' if sobj['OPT_COUNTS'] is not None else 'BOX'
+        flux_key = f'{ext}_FLAM' if sobj[f'{ext}_FLAM'] is not None else f'{ext}_COUNTS'
+        if sobj[flux_key] is None:
+            continue
+        flux = np.asarray(sobj[flux_key], dtype=float)
+        gpm = np.ones(flux.size, dtype=bool) if sobj[f'{ext}_MASK'] is None else np.asarray(sobj[f'{ext}_MASK'])
+        group = f'{sobj.DET}' if sobj['ECH_ORDER'] is None else f'{sobj.DET}_{sobj.ECH_ORDER}'
+        summary[sobj.NAME] = dict(group=group, pos=float(sobj.SPAT_PIXPOS),
+                                  s2n=np.nan if sobj['S2N'] is None else float(sobj.S2N),
+                                  flux=flux, flux_gpm=gpm & np.isfinite(flux), flux_type=flux_key)
+    return summary
+
+
+def summarize_sensfunc(path):
+    """
+    Summary of a sensfunc file: the fitted zero-point of every detector/order.
+    """
+    sens = sensfunc.SensFunc.from_file(path, chk_version=False).sens
+    summary = {}
+    for irow, row in enumerate(sens):
+        pos = float(row['ECH_ORDERS']) if 'ECH_ORDERS' in sens.colnames and row['ECH_ORDERS'] > 0 else float(irow)
+        summary[str(int(pos))] = dict(group='', pos=pos, wave=np.asarray(row['SENS_WAVE'], dtype=float),
+                                      zeropoint=np.asarray(row['SENS_ZEROPOINT_FIT'], dtype=float),
+                                      zeropoint_gpm=np.asarray(row['SENS_ZEROPOINT_FIT_GPM'], dtype=bool))
+    return summary
+
+
+SUMMARIZE = {'slits': summarize_slits, 'tilts': summarize_tilts, 'flat': summarize_flat,
+             'wavecalib': summarize_wavecalib, 'spec1d': summarize_spec1d, 'sensfunc': summarize_sensfunc}
+
+
+def _summarize_worker(kind, path):
+    """
+    Compute the summary of a product. This is run in the process pool of :func:`compare_runs`.
+
+    Returns
+    -------
+    path : str
+        Path of the product.
+    summary : dict
+        Summary of the product, None if it could not be read.
+    tb : str
+        Traceback of the error, None if the summary was computed.
+    """
+    try:
+        return path, SUMMARIZE[kind](path), None
+    except Exception:
+        return path, None, traceback.format_exc()
+
+
+def diff_items(kind, old, new):
+    """
+    Changes between the summaries of a matched slit, order or object of the two runs.
+
+    Returns
+    -------
+    changes : list
+        List of (metric, old value, new value, change) tuples. The change is the difference of the values, except for
+        the fractional metrics ('nfit', 's2n', 'flux_ratio'), and for the metrics comparing arrays ('edge_shift',
+        'zeropoint', 'zeropoint_p95'), for which the old and new values are representative scalars.
+    """
+    changes = []
+    if 'masked' in old:
+        changes.append(('masked', old['masked'], new['masked'], float(old['masked'] != new['masked'])))
+    if kind == 'slits':
+        shift = np.max(np.abs(np.concatenate((new['left'] - old['left'], new['right'] - old['right']))))
+        changes.append(('edge_shift', np.mean(old['left'] + old['right'])/2, np.mean(new['left'] + new['right'])/2,
+                        shift))
+    elif kind == 'spec1d':
+        changes.append(('s2n', old['s2n'], new['s2n'], new['s2n']/old['s2n'] - 1 if old['s2n'] != 0 else np.nan))
+        gpm = old['flux_gpm'] & new['flux_gpm'] if old['flux'].size == new['flux'].size else None
+        if gpm is not None and np.any(gpm) and old['flux_type'] == new['flux_type']:
+            old_sum, new_sum = np.sum(old['flux'][gpm]), np.sum(new['flux'][gpm])
+            changes.append(('flux_ratio', old_sum, new_sum, new_sum/old_sum - 1 if old_sum != 0 else np.nan))
+    elif kind == 'sensfunc':
+        gpm_old = old['zeropoint_gpm'] & (old['wave'] > 0)
+        gpm_new = new['zeropoint_gpm'] & (new['wave'] > 0)
+        if np.any(gpm_old) and np.any(gpm_new):
+            wave_new = new['wave'][gpm_new]
+            isort = np.argsort(wave_new)
+            overlap = gpm_old & (old['wave'] >= wave_new.min()) & (old['wave'] <= wave_new.max())
+            dzp = np.interp(old['wave'][overlap], wave_new[isort], new['zeropoint'][gpm_new][isort]) \
+                - old['zeropoint'][overlap]
+            if dzp.size > 0:
+                old_zp, new_zp = np.median(old['zeropoint'][gpm_old]), np.median(new['zeropoint'][gpm_new])
+                changes.append(('zeropoint', old_zp, new_zp, np.median(np.abs(dzp))))
+                changes.append(('zeropoint_p95', old_zp, new_zp, np.percentile(np.abs(dzp), 95.0)))
+    else:
+        for metric, value in old.items():
+            if metric in ['group', 'pos', 'masked'] or metric not in SCALES:
+                continue
+            if metric == 'nfit':
+                change = new[metric]/value - 1 if value != 0 else float(new[metric] != 0)
+            else:
+                change = new[metric] - value
+            changes.append((metric, value, new[metric], change))
+    return changes
+
+
+def match_items(old, new, tol=MATCH_TOL):
+    """
+    Match the slits, orders or objects of two summaries by group and position.
+
+    The closest pairs within the same group are matched first, and every item is matched at most once.
+
+    Returns
+    -------
+    pairs : list
+        Matched (old key, new key) pairs.
+    old_only : list
+        Keys only in the old summary.
+    new_only : list
+        Keys only in the new summary.
+    """
+    pairs = []
+    old_keys, new_keys = list(old.keys()), list(new.keys())
+    old_group = np.array([old[key]['group'] for key in old_keys])
+    new_group = np.array([new[key]['group'] for key in new_keys])
+    old_pos = np.array([old[key]['pos'] for key in old_keys])
+    new_pos = np.array([new[key]['pos'] for key in new_keys])
+    if len(old_keys) > 0 and len(new_keys) > 0:
+        dist = np.abs(old_pos[:, np.newaxis] - new_pos[np.newaxis, :])
+        dist[old_group[:, np.newaxis] != new_group[np.newaxis, :]] = np.inf
+        iold, inew = np.unravel_index(np.argsort(dist, axis=None), dist.shape)
+        used_old, used_new = set(), set()
+        for io, jn in zip(iold, inew):
+            if dist[io, jn] > tol:
+                break
+            if io in used_old or jn in used_new:
+                continue
+            used_old.add(io)
+            used_new.add(jn)
+            pairs.append((old_keys[io], new_keys[jn]))
+    matched_old = set(key for key, _ in pairs)
+    matched_new = set(key for _, key in pairs)
+    return pairs, [key for key in old_keys if key not in matched_old], \
+        [key for key in new_keys if key not in matched_new]
+
+
+def find_products(redux, input_spec=None, kinds=None):
+    """
+    Find the products of a dev-suite run.
+
+    Parameters
+    ----------
+    redux : str
+        Path to the REDUX_OUT folder.
+    input_spec : str, optional
+        Only look at this spectrograph.
+    kinds : list, optional
+        Kinds of products to look for, keys of :data:`PRODUCTS`. All of them by default.
+
+    Returns
+    -------
+    products : dict
+        Kind of every product, keyed by its path relative to redux.
+    """
+    redux_path = Path(redux).resolve()
+    kinds = list(PRODUCTS.keys()) if kinds is None else kinds
+    spectrographs = sorted(redux_path.glob('*')) if input_spec is None else sorted(redux_path.glob(input_spec))
+    products = {}
+    for spec in spectrographs:
+        if spec.name in ['QL_CALIB'] or not spec.is_dir():
+            continue
+        for kind in kinds:
+            for path in sorted(spec.glob(PRODUCTS[kind])):
+                products[str(path.relative_to(redux_path))] = kind
+    return products
+
+
+def _cache_key(rel_path):
+    return rel_path.replace('/', '|')
+
+
+def _write_summary(group, summary):
+    for iitem, (item, values) in enumerate(summary.items()):
+        igroup = group.create_group(str(iitem))
+        igroup.attrs['item'] = item
+        for key, value in values.items():
+            if np.ndim(value) == 0:
+                igroup.attrs[key] = value
+            else:
+                igroup.create_dataset(key, data=value)
+
+
+def _read_summary(group):
+    summary = {}
+    for igroup in group.values():
+        values = {key: (value.decode() if isinstance(value, bytes) else value) for key, value in igroup.attrs.items()
+                  if key != 'item'}
+        values.update({key: dset[()] for key, dset in igroup.items()})
+        summary[igroup.attrs['item']] = values
+    return summary
+
+
+def read_cache(cache_file, redux, products):
+    """
+    Read the cached summaries of the products that have not changed since they were cached.
+
+    Parameters
+    ----------
+    cache_file : str
+        The HDF5 cache file.
+    redux : str
+        Path to the REDUX_OUT folder.
+    products : dict
+        Products of the run, see :func:`find_products`.
+
+    Returns
+    -------
+    summaries : dict
+        Summaries keyed by the relative paths of the products.
+    """
+    summaries = {}
+    if cache_file is None or not os.path.isfile(cache_file):
+        return summaries
+    try:
+        with h5py.File(cache_file, 'r') as f:
+            if f.attrs.get('version', -1) != CACHE_VERSION:
+                return summaries
+            for rel_path in products:
+                key = _cache_key(rel_path)
+                if key not in f:
+                    continue
+                stat = os.stat(os.path.join(redux, rel_path))
+                if f[key].attrs['mtime_ns'] == stat.st_mtime_ns and f[key].attrs['size'] == stat.st_size:
+                    summaries[rel_path] = _read_summary(f[key])
+    except Exception as e:
+        msgs.warn('Could not read the cache file {0}: {1}'.format(cache_file, e))
+        return {}
+    return summaries
+
+
+def write_cache(cache_file, redux, products, summaries):
+    """
+    Add summaries to the cache. A copy of the cache is updated and moved into place with
+    :func:`~pypeitdev.fileio.atomic_write`.
+
+    Parameters
+    ----------
+    cache_file : str
+        The HDF5 cache file.
+    redux : str
+        Path to the REDUX_OUT folder.
+    products : dict
+        Products of the run, see :func:`find_products`.
+    summaries : dict
+        New summaries, keyed by the relative paths of the products.
+    """
+    with atomic_write(cache_file) as tmp_file:
+        # The temporary file is empty, so it is only opened for appending if the cache was copied into it
+        append = os.path.isfile(cache_file)
+        if append:
+            shutil.copyfile(cache_file, tmp_file)
+        with h5py.File(tmp_file, 'a' if append else 'w') as f:
+            if f.attrs.get('version', -1) != CACHE_VERSION:
+                for key in list(f.keys()):
+                    del f[key]
+                f.attrs['version'] = CACHE_VERSION
+            for rel_path, summary in summaries.items():
+                key = _cache_key(rel_path)
+                if key in f:
+                    del f[key]
+                stat = os.stat(os.path.join(redux, rel_path))
+                group = f.create_group(key)
+                group.attrs['kind'] = products[rel_path]
+                group.attrs['mtime_ns'] = stat.st_mtime_ns
+                group.attrs['size'] = stat.st_size
+                _write_summary(group, summary)
+
+
+def summarize_runs(redux_dirs, products, nproc=1, use_cache=True):
+    """
+    Summaries of the products of several runs, read from the caches or computed in a process pool.
+
+    Parameters
+    ----------
+    redux_dirs : list
+        Paths to the REDUX_OUT folders.
+    products : list
+        Products of every run, see :func:`find_products`.
+    nproc : int, optional
+        Number of processes used to compute the summaries.
+    use_cache : bool, optional
+        Read and update the cache file of every run. A cache file that cannot be written, e.g. in a read-only run,
+        is skipped with a warning.
+
+    Returns
+    -------
+    summaries : list
+        Summaries of the products of every run, keyed by their relative paths. Products that could not be read are
+        missing.
+    """
+    summaries, tasks = [], []
+    for irun, (redux, run_products) in enumerate(zip(redux_dirs, products)):
+        cache_file = os.path.join(redux, CACHE_NAME) if use_cache else None
+        cached = read_cache(cache_file, redux, run_products)
+        summaries.append(cached)
+        # The run and relative path of every product are kept with the task, since the runs may share folders
+        tasks += [(irun, rel_path, kind, os.path.join(redux, rel_path)) for rel_path, kind in run_products.items()
+                  if rel_path not in cached]
+    msgs.info('{0} products to read, {1} found in the caches'.format(
+        len(tasks), sum(len(run_products) for run_products in products) - len(tasks)))
+
+    if nproc > 1 and len(tasks) > 1:
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(processes=min(nproc, len(tasks))) as pool:
+            results = pool.starmap(_summarize_worker, [task[2:] for task in tasks], chunksize=1)
+    else:
+        results = [_summarize_worker(*task[2:]) for task in tasks]
+
+    new_summaries = [{} for _ in redux_dirs]
+    for (irun, rel_path, _, _), (path, summary, tb) in zip(tasks, results):
+        if summary is None:
+            msgs.warn('Could not read {0}:\n{1}'.format(path, tb))
+            continue
+        new_summaries[irun][rel_path] = summary
+        summaries[irun][rel_path] = summary
+
+    if use_cache:
+        for redux, run_products, run_new in zip(redux_dirs, products, new_summaries):
+            if len(run_new) == 0:
+                continue
+            # The cache is only a speed-up, e.g. a read-only reference run must not stop the comparison
+            cache_file = os.path.join(redux, CACHE_NAME)
+            try:
+                write_cache(cache_file, redux, run_products, run_new)
+            except OSError as e:
+                msgs.warn('Could not write the cache file {0}: {1}'.format(cache_file, e))
+    return summaries
+
+
+def compare_runs(old_redux, new_redux, input_spec=None, kinds=None, nproc=1, use_cache=True):
+    """
+    Compare the products of two dev-suite runs.
+
+    Parameters
+    ----------
+    old_redux, new_redux : str
+        Paths to the old and new REDUX_OUT folders.
+    input_spec : str, optional
+        Only compare this spectrograph.
+    kinds : list, optional
+        Kinds of products to compare, keys of :data:`PRODUCTS`. All of them by default.
+    nproc : int, optional
+        Number of processes used to read the products.
+    use_cache : bool, optional
+        Read and update the cache file of every run.
+
+    Returns
+    -------
+    diff : `astropy.table.Table`_
+        One row per metric of every matched slit, order or object, with the kind and path of the product, the item
+        (old and new keys), the metric, the old and new values, the change (see :func:`diff_items`) and the score, sorted
+        by decreasing score. Products, slits, orders or objects found in only one of the runs have the metric
+        'missing_in_new' or 'missing_in_old' and an infinite score.
+    """
+    redux_dirs = [str(Path(old_redux).resolve()), str(Path(new_redux).resolve())]
+    products = [find_products(redux, input_spec=input_spec, kinds=kinds) for redux in redux_dirs]
+    old_summaries, new_summaries = summarize_runs(redux_dirs, products, nproc=nproc, use_cache=use_cache)
+
+    rows = []
+    for rel_path in sorted(set(products[0]) | set(products[1])):
+        kind = products[0].get(rel_path, products[1].get(rel_path))
+        if rel_path not in products[1]:
+            rows.append((kind, rel_path, '', 'missing_in_new', np.nan, np.nan, np.nan, np.inf))
+            continue
+        if rel_path not in products[0]:
+            rows.append((kind, rel_path, '', 'missing_in_old', np.nan, np.nan, np.nan, np.inf))
+            continue
+        if rel_path not in old_summaries or rel_path not in new_summaries:
+            # Could not be read, already reported
+            continue
+        old, new = old_summaries[rel_path], new_summaries[rel_path]
+        pairs, old_only, new_only = match_items(old, new)
+        rows += [(kind, rel_path, key, 'missing_in_new', np.nan, np.nan, np.nan, np.inf) for key in old_only]
+        rows += [(kind, rel_path, key, 'missing_in_old', np.nan, np.nan, np.nan, np.inf) for key in new_only]
+        for old_key, new_key in pairs:
+            item = old_key if old_key == new_key else '{0} -> {1}'.format(old_key, new_key)
+            for metric, old_value, new_value, change in diff_items(kind, old[old_key], new[new_key]):
+                score = np.abs(change)/SCALES[metric] if np.isfinite(change) else 0.0
+                rows.append((kind, rel_path, item, metric, float(old_value), float(new_value), float(change), score))
+
+    diff = Table(rows=rows if len(rows) > 0 else None,
+                 names=('kind', 'file', 'item', 'metric', 'old', 'new', 'change', 'score'),
+                 dtype=(str, str, str, str, float, float, float, float))
+    diff = diff[np.argsort(-diff['score'], kind='stable')]
+    for name, fmt in zip(['old', 'new', 'change', 'score'], ['.4g', '.4g', '.3g', '.1f']):
+        diff[name].format = fmt
+    return diff
+
+
+def parse_args(options=None):
+    parser = argparse.ArgumentParser(description='Compare the calibration and science products of two dev-suite '
+                                                 'runs, and rank the changes')
+    parser.add_argument('old_redux', type=str, help='Path to the old REDUX_OUT folder')
+    parser.add_argument('new_redux', type=str, help='Path to the new REDUX_OUT folder')
+    parser.add_argument('--spec', default=None, type=str, help='Name of the spectrograph to be compared')
+    parser.add_argument('--kinds', default=None, nargs='+', choices=list(PRODUCTS.keys()),
+                        help='Kinds of products to compare. All of them by default.')
+    parser.add_argument('--nproc', default=1, type=int, help='Number of processes used to read the products')
+    parser.add_argument('--no_cache', default=False, action='store_true',
+                        help='Do not read or write the {0} file of each REDUX_OUT folder'.format(CACHE_NAME))
+    parser.add_argument('--ntop', default=30, type=int, help='Number of changes printed, largest first')
+    parser.add_argument('--outfile', default=None, type=str, help='Write the full table of changes to this file')
+    return parser.parse_args(options)
+
+
+def main(args):
+    for redux in [args.old_redux, args.new_redux]:
+        if not Path(redux).is_dir():
+            msgs.error('Folder "{0}" does not exist'.format(redux))
+
+    diff = compare_runs(args.old_redux, args.new_redux, input_spec=args.spec, kinds=args.kinds, nproc=args.nproc,
+                        use_cache=not args.no_cache)
+    nchanged = np.sum(diff['score'] >= 1.0)
+    msgs.info('{0} of {1} metrics changed by more than their tolerance'.format(nchanged, len(diff)))
+    diff[:args.ntop].pprint_all()
+    if args.outfile is not None:
+        diff.write(args.outfile, overwrite=True)
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main(parse_args()))
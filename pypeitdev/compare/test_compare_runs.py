@@ -0,0 +1,253 @@
+"""
+Check the diff engine of compare_runs on two synthetic REDUX_OUT folders.
+
+The products are small JSON files named like the PypeIt products, read by a fake WaveCalib summarizer, so that the
+matching, scoring, missing products and caches are tested without running PypeIt. The summarizers of the other
+products are tested on in-memory PypeIt objects returned in place of the files.
+
+Run with::
+
+    pytest pypeitdev/compare/test_compare_runs.py
+"""
+import os
+import json
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from astropy.table import Table
+
+from pypeit import slittrace
+from pypeitdev.compare import compare_runs
+
+
+def write_run(redux, wavecalibs):
+    """
+    Write a fake run with the diagnostics of every slit of every WaveCalib file.
+    """
+    for name, slits in wavecalibs.items():
+        path = redux / 'keck_deimos' / '600ZD' / 'Calibrations' / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(slits))
+
+
+def fake_summarize_wavecalib(path):
+    with open(path) as f:
+        slits = json.load(f)
+    return {key: dict(group='', pos=float(values['pos']), RMS=values['RMS'], Nlin=values['Nlin'])
+            for key, values in slits.items()}
+
+
+@pytest.fixture
+def runs(tmp_path, monkeypatch):
+    calls = []
+    def summarize(path):
+        calls.append(path)
+        return fake_summarize_wavecalib(path)
+    monkeypatch.setitem(compare_runs.SUMMARIZE, 'wavecalib', summarize)
+
+    old, new = tmp_path / 'old', tmp_path / 'new'
+    write_run(old, {'WaveCalib_A_0_DET03.fits': {'100': dict(pos=100, RMS=0.10, Nlin=40),
+                                                 '250': dict(pos=250, RMS=0.12, Nlin=35),
+                                                 '400': dict(pos=400, RMS=0.08, Nlin=50)},
+                    'WaveCalib_A_0_DET07.fits': {'120': dict(pos=120, RMS=0.10, Nlin=40)}})
+    # Slit 250 moved by 2 pixels and got worse, slit 400 was lost, and the DET07 calibration is missing
+    write_run(new, {'WaveCalib_A_0_DET03.fits': {'100': dict(pos=100, RMS=0.10, Nlin=41),
+                                                 '252': dict(pos=252, RMS=0.32, Nlin=35)}})
+    return old, new, calls
+
+
+def test_compare_runs(runs):
+    old, new, calls = runs
+    diff = compare_runs.compare_runs(str(old), str(new), kinds=['wavecalib'])
+    assert len(calls) == 3
+
+    rows = {(os.path.basename(row['file']), row['item'], row['metric']): row for row in diff}
+    assert ('WaveCalib_A_0_DET07.fits', '', 'missing_in_new') in rows
+    assert ('WaveCalib_A_0_DET03.fits', '400', 'missing_in_new') in rows
+    moved = rows[('WaveCalib_A_0_DET03.fits', '250 -> 252', 'RMS')]
+    assert np.isclose(moved['change'], 0.2)
+    assert np.isclose(moved['score'], 0.2/compare_runs.SCALES['RMS'])
+    assert np.isclose(rows[('WaveCalib_A_0_DET03.fits', '100', 'Nlin')]['score'], 1/compare_runs.SCALES['Nlin'])
+    assert rows[('WaveCalib_A_0_DET03.fits', '100', 'RMS')]['score'] == 0.0
+
+    # Missing products and slits first, then the changes by decreasing score
+    assert np.all(np.isinf(diff['score'][:2]))
+    assert np.all(np.diff(diff['score'][2:]) <= 0.0)
+    assert diff['metric'][2] == 'RMS' and diff['item'][2] == '250 -> 252'
+
+    # The second comparison reads the summaries from the caches
+    assert (old / compare_runs.CACHE_NAME).is_file() and (new / compare_runs.CACHE_NAME).is_file()
+    cached_diff = compare_runs.compare_runs(str(old), str(new), kinds=['wavecalib'])
+    assert len(calls) == 3
+    assert np.array_equal(cached_diff['score'], diff['score'])
+
+
+def test_compare_runs_unwritable_cache(runs, monkeypatch):
+    old, new, calls = runs
+    def write_cache(cache_file, *args):
+        raise PermissionError(13, 'Permission denied', cache_file)
+    monkeypatch.setattr(compare_runs, 'write_cache', write_cache)
+
+    # A run whose cache cannot be written is still compared
+    diff = compare_runs.compare_runs(str(old), str(new), kinds=['wavecalib'])
+    assert len(diff) > 0
+    assert not (old / compare_runs.CACHE_NAME).exists()
+
+
+def test_compare_runs_nested(runs):
+    old, new, calls = runs
+    # The new run is inside the old one, and the same run is compared with itself
+    nested = old / 'rerun'
+    write_run(nested, {'WaveCalib_A_0_DET03.fits': {'100': dict(pos=100, RMS=0.20, Nlin=30)}})
+    rel_path = os.path.join('keck_deimos', '600ZD', 'Calibrations', 'WaveCalib_A_0_DET03.fits')
+    products = [{rel_path: 'wavecalib'}]*2
+    summaries = compare_runs.summarize_runs([str(old), str(nested)], products, use_cache=False)
+    assert list(summaries[0][rel_path]) == ['100', '250', '400']
+    assert summaries[1][rel_path]['100']['RMS'] == 0.20
+
+    summaries = compare_runs.summarize_runs([str(new), str(new)], products, use_cache=False)
+    assert summaries[0] == summaries[1] and list(summaries[0][rel_path]) == ['100', '252']
+
+
+def fake_slits():
+    """
+    Two slits on a 100x200 detector, with spat_id 35 and 105.
+    """
+    left = np.tile(np.array([10.0, 80.0]), (100, 1))
+    return slittrace.SlitTraceSet(left, left + 50.0, 'MultiSlit', nspec=100, nspat=200, binspec=1, binspat=1)
+
+
+def test_summarize_slits(monkeypatch):
+    monkeypatch.setattr(compare_runs.slittrace.SlitTraceSet, 'from_file', lambda *args, **kwargs: fake_slits())
+    summary = compare_runs.summarize_slits('Slits_A_0_DET01.fits.gz')
+    assert list(summary) == ['35', '105']
+    assert summary['35']['left'].shape == (compare_runs.NSAMP_EDGES,)
+    assert np.all(summary['105']['right'] == 130.0) and summary['105']['masked'] == 0
+
+    new = dict(summary['35'], left=summary['35']['left'] + 0.3, right=summary['35']['right'] - 1.2)
+    changes = {c[0]: c for c in compare_runs.diff_items('slits', summary['35'], new)}
+    assert changes['masked'][3] == 0.0
+    assert np.isclose(changes['edge_shift'][3], 1.2)
+    assert np.isclose(changes['edge_shift'][1], 35.0) and np.isclose(changes['edge_shift'][2], 34.55)
+
+
+def test_summarize_tilts(monkeypatch):
+    # Slit 35 has 4 fitted points with residuals of 0.1 and 1 rejected point, slit 105 has no fitted points
+    traces = Table({'goodpix_spat': [np.array([20, 20, 30, 30, 40])],
+                    'goodpix_tilt': [np.array([10.0, 50.0, 10.0, 50.0, 70.0])],
+                    'good2dfit_lid': [np.array(['35_0', '35_1', '35_0', '35_1'])],
+                    'good2dfit_spat': [np.array([20, 20, 30, 30])],
+                    'good2dfit_tilt': [np.array([10.1, 49.9, 10.1, 49.9])],
+                    'bad2dfit_lid': [np.array(['35_2'])]})
+    tilts = SimpleNamespace(spat_id=np.array([35, 105]), tilt_traces=traces)
+    monkeypatch.setattr(compare_runs.wavetilts.WaveTilts, 'from_file', lambda *args, **kwargs: tilts)
+    summary = compare_runs.summarize_tilts('Tilts_A_0_DET01.fits')
+    assert np.isclose(summary['35']['fit_rms'], 0.1)
+    assert summary['35']['nfit'] == 4 and np.isclose(summary['35']['frac_rej'], 0.2)
+    assert summary['105']['nfit'] == 0 and np.isnan(summary['105']['fit_rms'])
+
+    # Without the traced tilts only the slits are listed
+    tilts.tilt_traces = None
+    assert compare_runs.summarize_tilts('Tilts_A_0_DET01.fits')['35']['nfit'] == 0
+
+    new = dict(summary['35'], nfit=5, fit_rms=0.15)
+    changes = {c[0]: c[3] for c in compare_runs.diff_items('tilts', summary['35'], new)}
+    assert np.isclose(changes['nfit'], 0.25) and np.isclose(changes['fit_rms'], 0.05)
+    assert changes['frac_rej'] == 0.0
+    # A slit without fitted points in the old run
+    changes = {c[0]: c[3] for c in compare_runs.diff_items('tilts', summary['105'], summary['35'])}
+    assert changes['nfit'] == 1.0 and 'masked' not in changes
+
+
+def test_summarize_flat(tmp_path, monkeypatch):
+    rng = np.random.default_rng(5)
+    pixelflat = 1.0 + 0.01*rng.standard_normal((100, 200))
+    bpm = np.zeros(pixelflat.shape, dtype=int)
+    bpm[:, 120:] = 1
+    illum = np.ones(pixelflat.shape)
+    illum[:, 80:131] = 0.9
+    flat = SimpleNamespace(pixelflat_norm=pixelflat, pixelflat_bpm=bpm, fit2illumflat=lambda slits: illum)
+    monkeypatch.setattr(compare_runs.flatfield.FlatImages, 'from_file', lambda *args, **kwargs: flat)
+    def read_slits(path, **kwargs):
+        if not os.path.isfile(path):
+            raise FileNotFoundError(path)
+        return fake_slits()
+    monkeypatch.setattr(compare_runs.slittrace.SlitTraceSet, 'from_file', read_slits)
+
+    # Without a Slits file the whole image is summarized
+    flat_file = tmp_path / 'Flat_A_0_DET01.fits'
+    summary = compare_runs.summarize_flat(str(flat_file))
+    assert list(summary) == ['all'] and np.isnan(summary['all']['illum_median'])
+    assert np.isclose(summary['all']['pixel_scatter'], 0.01, rtol=0.1)
+
+    (tmp_path / 'Slits_A_0_DET01.fits.gz').touch()
+    summary = compare_runs.summarize_flat(str(flat_file))
+    assert list(summary) == ['35', '105']
+    assert summary['35']['illum_median'] == 1.0 and summary['105']['illum_median'] == 0.9
+    assert np.isclose(summary['35']['pixel_scatter'], 0.01, rtol=0.1)
+
+    new = dict(summary['105'], illum_median=0.88, masked=1)
+    changes = {c[0]: c for c in compare_runs.diff_items('flat', summary['105'], new)}
+    assert np.isclose(changes['illum_median'][3], -0.02)
+    assert changes['masked'][1:] == (0, 1, 1.0)
+
+
+class FakeSpecObj(SimpleNamespace):
+    def __getitem__(self, key):
+        return getattr(self, key, None)
+
+
+def test_summarize_spec1d(monkeypatch):
+    flux = np.full(50, 2.0)
+    mask = np.ones(50, dtype=bool)
+    mask[:10] = False
+    sobjs = [FakeSpecObj(NAME='SPAT0035-SLIT0035-DET01', DET='DET01', SPAT_PIXPOS=35.2, S2N=10.0,
+                         OPT_COUNTS=flux, OPT_MASK=mask),
+             FakeSpecObj(NAME='SPAT0100-SLIT0105-DET01', DET='DET01', SPAT_PIXPOS=100.0, BOX_COUNTS=flux,
+                         BOX_FLAM=flux/2),
+             FakeSpecObj(NAME='SPAT0120-SLIT0105-DET01', DET='DET01', SPAT_PIXPOS=120.0)]
+    monkeypatch.setattr(compare_runs.specobjs.SpecObjs, 'from_fitsfile', lambda *args, **kwargs: sobjs)
+    summary = compare_runs.summarize_spec1d('spec1d_A.fits')
+    assert list(summary) == ['SPAT0035-SLIT0035-DET01', 'SPAT0100-SLIT0105-DET01']
+    opt, box = summary['SPAT0035-SLIT0035-DET01'], summary['SPAT0100-SLIT0105-DET01']
+    assert opt['flux_type'] == 'OPT_COUNTS' and np.sum(opt['flux_gpm']) == 40 and opt['group'] == 'DET01'
+    assert box['flux_type'] == 'BOX_FLAM' and np.isnan(box['s2n']) and np.all(box['flux_gpm'])
+
+    new = dict(opt, s2n=11.0, flux=1.1*opt['flux'])
+    changes = {c[0]: c for c in compare_runs.diff_items('spec1d', opt, new)}
+    assert np.isclose(changes['s2n'][3], 0.1)
+    assert np.isclose(changes['flux_ratio'][1], 80.0) and np.isclose(changes['flux_ratio'][3], 0.1)
+    # The flux is not compared between different extractions or sizes, and a zero S/N has no fractional change
+    assert [c[0] for c in compare_runs.diff_items('spec1d', opt, dict(new, flux_type='BOX_COUNTS'))] == ['s2n']
+    assert [c[0] for c in compare_runs.diff_items('spec1d', opt, dict(new, flux=new['flux'][:20],
+                                                                      flux_gpm=new['flux_gpm'][:20]))] == ['s2n']
+    assert np.isnan(compare_runs.diff_items('spec1d', dict(opt, s2n=0.0), new)[0][3])
+
+
+def test_summarize_sensfunc(monkeypatch):
+    wave = np.linspace(4000.0, 9000.0, 101)
+    zeropoint = 20.0 + 1e-4*(wave - 4000.0)
+    gpm = np.ones(wave.size, dtype=bool)
+    gpm[-5:] = False
+    sens = Table({'SENS_WAVE': [wave, wave], 'SENS_ZEROPOINT_FIT': [zeropoint, zeropoint + 0.1],
+                  'SENS_ZEROPOINT_FIT_GPM': [gpm, gpm], 'ECH_ORDERS': [0, 0]})
+    monkeypatch.setattr(compare_runs.sensfunc.SensFunc, 'from_file',
+                        lambda *args, **kwargs: SimpleNamespace(sens=sens))
+    summary = compare_runs.summarize_sensfunc('sens_A.fits')
+    assert list(summary) == ['0', '1'] and summary['1']['pos'] == 1.0
+    sens['ECH_ORDERS'] = [35, 36]
+    summary = compare_runs.summarize_sensfunc('sens_A.fits')
+    assert list(summary) == ['35', '36']
+
+    # A shift of 0.1 mag, except over the last tenth of the wavelengths
+    new = dict(summary['35'], zeropoint=summary['35']['zeropoint'] + np.where(wave < 8500.0, 0.1, 0.5))
+    changes = {c[0]: c for c in compare_runs.diff_items('sensfunc', summary['35'], new)}
+    assert np.isclose(changes['zeropoint'][3], 0.1)
+    assert np.isclose(changes['zeropoint_p95'][3], 0.5)
+    assert np.isclose(changes['zeropoint'][2] - changes['zeropoint'][1], 0.1)
+    # Only the overlapping wavelengths are compared, and nothing is compared without overlap
+    new = dict(summary['35'], wave=wave + 2600.0, zeropoint=summary['35']['zeropoint'] + 0.2)
+    assert np.isclose(compare_runs.diff_items('sensfunc', summary['35'], new)[0][3], 0.06)
+    new = dict(summary['35'], wave=wave + 6000.0)
+    assert compare_runs.diff_items('sensfunc', summary['35'], new) == []
@@ -0,0 +1,56 @@
+"""
+File utilities shared by the scripts of the dev suite.
+"""
+from contextlib import contextmanager
+import os
+import tempfile
+
+
+@contextmanager
+def atomic_write(path, suffix=None):
+    """
+    Context manager that writes a file atomically.
+
+    The caller writes to the temporary file whose name is yielded, created with
+    :func:`tempfile.mkstemp` in the directory of ``path``. When the block exits
+    normally, the temporary file is renamed to ``path`` with :func:`os.replace`,
+    so that readers never see a partially written file and an interrupted write
+    leaves the previous version in place. Because the temporary name is unique,
+    concurrent writers of the same file don't interfere; the last one to finish
+    wins. If the block raises, the temporary file is removed.
+
+    The temporary file already exists when the block starts, so writers that
+    refuse to overwrite (e.g. ``astropy``'s ``writeto``) need ``overwrite=True``.
+
+    Parameters
+    ----------
+    path : str or pathlib.Path
+        The file to write.
+    suffix : str, optional
+        Suffix of the temporary file, for writers that use the extension to
+        choose the format (e.g. ``'.fits.gz'`` or ``'.npz'``). Default is the
+        extension of ``path``.
+
+    Yields
+    ------
+    tmp_file : str
+        Name of the temporary file.
+    """
+    path = os.fspath(path)
+    if suffix is None:
+        suffix = os.path.splitext(path)[1]
+    fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                    prefix='.' + os.path.basename(path) + '.', suffix=suffix)
+    os.close(fd)
+    try:
+        # mkstemp creates the file readable by the owner only; give it the
+        # permissions of a file created with open()
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_file, 0o666 & ~umask)
+        yield tmp_file
+        os.replace(tmp_file, path)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
@@ -1,17 +1,61 @@
+"""
+Run sensfunc on every spec1d file of a directory tree, e.g. to rebuild the DEIMOS/WMKO sensfunc archive.
+
+Every spec1d file matching the pattern below the source directory gets a sensfunc file of the same name (with
+``spec1d`` replaced by ``sens``) in the destination directory. The files are independent, so they are processed by a
+set of worker processes:
+
+    - The jobs are sorted by the size of their spec1d file, largest first, and packed into chunks of roughly equal
+      size, so that the many small files share a worker process (and its imports) and the large ones start early.
+    - Every job has a time limit. A worker that exceeds it is killed, the job is recorded as timed out and the
+      remaining jobs of its chunk are put back in the queue. A job that crashes its worker is handled the same way.
+    - The address space of the workers can be capped, so that a runaway job fails with a MemoryError instead of
+      taking the machine down.
+    - A JSON ledger of the jobs is kept in the destination directory and rewritten after every job. Re-runs skip the
+      spec1d files whose sensfunc was written by a previous run from the same input file, sensfunc configuration and
+      PypeIt version, so an interrupted run can simply be restarted.
+    - A CSV file with the status, run time and peak memory of the worker process of every job is written at the
+      end. The peak memory of a worker is its maximum so far, so for the jobs after the first one of a chunk it is
+      an upper limit of the memory used by the job.
+
+The sensfunc and .par files are written with :func:`pypeitdev.fileio.atomic_write`.
+
+Example::
+
+    python run_sensfunc_on_all_spec1d.py spec1d_archive 'spec1d_*.fits' sens_archive deimos.sens --nproc 8 \\
+        --timeout 3600 --max_memory 16
+"""
 from pathlib import Path
+import os
 import sys
+import json
+import time
+import hashlib
+import argparse
+import resource
+import traceback
+import multiprocessing
+from multiprocessing.connection import wait
+from collections import deque
+
+import numpy as np
+from astropy.table import Table
 
 from pypeit.sensfunc import SensFunc
-from multiprocessing import Pool
-import os
 from pypeit import io
+from pypeit import msgs
+from pypeit import __version__
 from pypeit.spectrographs.util import load_spectrograph
 from pypeit.par import pypeitpar
 from pypeit import inputfiles
 
+from pypeitdev.fileio import atomic_write
+
+LEDGER_VERSION = 1
+
 
 def get_primary_hdr(spectrograph, hdul):
-    
+
     # Construct a primary FITS header that includes the spectrograph's
     #   config keys for inclusion in the output sensfunc file
     primary_hdr = io.initialize_header()
@@ -26,58 +70,378 @@ def get_primary_hdr(spectrograph, hdul):
     return primary_hdr
 
 
-def run_sensfunc(options):
-    spec1d_file, config_lines, output_file = options
-    try:
-        pid = os.getpid()
-        with io.fits_open(str(spec1d_file)) as hdul:
-            spectrograph = load_spectrograph(hdul[0].header['PYP_SPEC'])
-            primary_hdr = get_primary_hdr(spectrograph, hdul)
-            config_specific_par = spectrograph.config_specific_par(hdul)
+def run_sensfunc(spec1d_file, config_lines, output_file):
+    """
+    Generate the sensfunc of a spec1d file and write it, with its parameters, next to output_file.
+
+    Parameters
+    ----------
+    spec1d_file : pathlib.Path
+        The spec1d file of the standard star.
+    config_lines : list
+        Configuration lines of the sensfunc file, merged with the spectrograph's configuration specific parameters.
+    output_file : pathlib.Path
+        The sensfunc file. The parameters are written to the same file name with a ``.par`` extension.
+    """
+    with io.fits_open(str(spec1d_file)) as hdul:
+        spectrograph = load_spectrograph(hdul[0].header['PYP_SPEC'])
+        primary_hdr = get_primary_hdr(spectrograph, hdul)
+        config_specific_par = spectrograph.config_specific_par(hdul)
 
-        par = pypeitpar.PypeItPar.from_cfg_lines(cfg_lines=config_specific_par.to_config(),
-                                                 merge_with=(config_lines,))
+    par = pypeitpar.PypeItPar.from_cfg_lines(cfg_lines=config_specific_par.to_config(),
+                                             merge_with=(config_lines,))
 
-        # SensFunc.run() will try to flux using the new sensfunc
-        # for QA purposes. Because we didn't want to extrapolate in the
-        # genreated sensfuncs we need to add this to prevent failures in this fluxing
-        par['fluxcalib']['extrap_sens'] = True
-        par_output = output_file.parent / (output_file.stem + ".par")
-        par['sensfunc'].to_config(str(par_output), section_name='sensfunc', include_descr=False)      
+    # SensFunc.run() will try to flux using the new sensfunc
+    # for QA purposes. Because we didn't want to extrapolate in the
+    # genreated sensfuncs we need to add this to prevent failures in this fluxing
+    par['fluxcalib']['extrap_sens'] = True
+    par_output = output_file.parent / (output_file.stem + ".par")
+    # The temporary files are removed if the sensfunc fails
+    with atomic_write(par_output) as tmp_par_output, atomic_write(output_file) as tmp_output:
+        par['sensfunc'].to_config(tmp_par_output, section_name='sensfunc', include_descr=False)
 
-        sensobj = SensFunc.get_instance(str(spec1d_file), str(output_file), par['sensfunc'],par_fluxcalib=par['fluxcalib'])
+        sensobj = SensFunc.get_instance(str(spec1d_file), str(output_file), par['sensfunc'],
+                                        par_fluxcalib=par['fluxcalib'])
 
         # Generate the sensfunc
         sensobj.run()
         # Write it out to a file, including the new primary FITS header
-        sensobj.to_file(str(output_file), primary_hdr=primary_hdr, overwrite=True)
-        
+        sensobj.to_file(tmp_output, primary_hdr=primary_hdr, overwrite=True)
 
-    except Exception as e:
-        print(f"Failed to run sensfunc on file {spec1d_file} to {output_file}, exception {e}")
-        with open(f"failures.{pid}.txt", "a") as f:
-            print(f"Failed to run sensfunc on file {spec1d_file} to {output_file}, exception {e}",file=f)
-        return "FAILED"
 
-    return "OK"
+def sensfunc_outfile(spec1d_file, dest_dir):
+    """
+    Name of the sensfunc file of a spec1d file, e.g. ``sens_DE.20170425.53065-dra11_DEIMOS_20170425T144424.fits``.
+    """
+    return Path(dest_dir) / spec1d_file.name.replace("spec1d", "sens", 1)
 
 
+def config_hash(config_lines):
+    """
+    Short SHA1 hash of the sensfunc configuration and the PypeIt version, used to decide if a sensfunc is reusable.
+    """
+    config = json.dumps(dict(config_lines=list(config_lines), pypeit_version=__version__))
+    return hashlib.sha1(config.encode()).hexdigest()[:16]
 
-if __name__ == '__main__':
 
-    src_dir = Path(sys.argv[1])
-    src_pattern = sys.argv[2]
-    dest_dir = Path(sys.argv[3])
-    sens_file = sys.argv[4]
-    jobs = []
+class SensfuncLedger:
+    """
+    Ledger of the sensfunc jobs of a batch, used to skip the finished ones when the batch is run again.
+
+    The ledger is a JSON file that maps each spec1d file to the entry of its last job: the status, the fingerprint
+    of the inputs (size and modification time of the spec1d file and hash of the configuration), the output file
+    with its size and modification time, the run time, the peak memory of the worker process and the error of a
+    failed job. It is
+    rewritten after every job, so that it is up to date when a batch is interrupted.
+
+    Parameters
+    ----------
+    ledger_file : str or pathlib.Path
+        The ledger file. It is read if it exists.
+    """
+
+    def __init__(self, ledger_file):
+        self.ledger_file = Path(ledger_file)
+        self.entries = {}
+        if self.ledger_file.is_file():
+            try:
+                with open(self.ledger_file) as fledger:
+                    ledger = json.load(fledger)
+                if ledger.get('version') == LEDGER_VERSION:
+                    self.entries = ledger['entries']
+            except (OSError, ValueError, KeyError):
+                # A corrupt ledger just means nothing can be skipped
+                msgs.warn('Could not read the ledger {0}, all the sensfuncs will be regenerated'.format(
+                    self.ledger_file))
+                self.entries = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def fingerprint(spec1d_file, cfg_hash):
+        """
+        Fingerprint of the inputs of a job.
+        """
+        stat = os.stat(spec1d_file)
+        return dict(size=stat.st_size, mtime_ns=stat.st_mtime_ns, config_hash=cfg_hash)
+
+    def is_done(self, spec1d_file, output_file, cfg_hash):
+        """
+        Check if the sensfunc of spec1d_file was written from the same inputs and is still there, unchanged.
+        """
+        entry = self.entries.get(str(spec1d_file))
+        if entry is None or entry['status'] != 'ok' or entry['output'] != str(output_file):
+            return False
+        if entry['fingerprint'] != self.fingerprint(spec1d_file, cfg_hash):
+            return False
+        try:
+            stat = os.stat(output_file)
+        except OSError:
+            return False
+        return entry['output_size'] == stat.st_size and entry['output_mtime_ns'] == stat.st_mtime_ns
+
+    def record(self, spec1d_file, output_file, cfg_hash, status, run_time, worker_peak_mem_mb, error=None):
+        """
+        Record the result of a job and rewrite the ledger.
+        """
+        entry = dict(status=status, fingerprint=self.fingerprint(spec1d_file, cfg_hash), output=str(output_file),
+                     output_size=None, output_mtime_ns=None, run_time=run_time,
+                     worker_peak_mem_mb=worker_peak_mem_mb, error=error, date=time.strftime('%Y-%m-%dT%H:%M:%S'))
+        if status == 'ok':
+            stat = os.stat(output_file)
+            entry['output_size'], entry['output_mtime_ns'] = stat.st_size, stat.st_mtime_ns
+        self.entries[str(spec1d_file)] = entry
+        self.write()
+
+    def write(self):
+        with atomic_write(self.ledger_file) as tmp_file:
+            with open(tmp_file, 'w') as fledger:
+                json.dump(dict(version=LEDGER_VERSION, entries=self.entries), fledger, indent=1)
+
+
+def build_chunks(jobs, nproc, max_chunk_jobs=8, chunks_per_proc=4):
+    """
+    Pack the jobs into chunks of roughly equal total spec1d size, largest files first.
+
+    Parameters
+    ----------
+    jobs : list
+        (spec1d_file, output_file) tuples.
+    nproc : int
+        Number of worker processes.
+    max_chunk_jobs : int, optional
+        Maximum number of jobs in a chunk.
+    chunks_per_proc : int, optional
+        Target number of chunks per worker process, to balance the load at the end of the batch.
 
-    config_lines = inputfiles.SensFile.from_file(sens_file).cfg_lines
+    Returns
+    -------
+    chunks : list
+        Lists of jobs. Files larger than the target size of a chunk get their own chunk.
+    """
+    sizes = np.array([os.path.getsize(spec1d_file) for spec1d_file, _ in jobs], dtype=float)
+    isort = np.argsort(-sizes, kind='stable')
+    target = np.sum(sizes)/max(nproc*chunks_per_proc, 1)
+    chunks, chunk, chunk_size = [], [], 0.0
+    for ijob in isort:
+        if len(chunk) > 0 and (chunk_size + sizes[ijob] > target or len(chunk) >= max_chunk_jobs):
+            chunks.append(chunk)
+            chunk, chunk_size = [], 0.0
+        chunk.append(jobs[ijob])
+        chunk_size += sizes[ijob]
+    if len(chunk) > 0:
+        chunks.append(chunk)
+    return chunks
 
-    for spec1d_file in src_dir.rglob(src_pattern):
-        dest_file = dest_dir / spec1d_file.name.replace("spec1d", "sens", 1)
+
+def peak_memory_mb():
+    """
+    Peak resident memory of this process in MB.
+    """
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return maxrss/1024.**2 if sys.platform == 'darwin' else maxrss/1024.
+
+
+def _sensfunc_chunk_worker(chunk, config_lines, max_memory, conn):
+    """
+    Run the jobs of a chunk in a worker process and send a message through conn when each job starts and ends.
+
+    Failures are caught, so that they only affect their job. The peak memory sent with each job is the peak of the
+    worker process so far, i.e. an upper limit for the jobs after the first one of a chunk.
+    """
+    try:
+        if max_memory is not None:
+            limit = int(max_memory*1024**3)
+            resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+        for ijob, (spec1d_file, output_file) in enumerate(chunk):
+            conn.send(('start', ijob))
+            t0 = time.perf_counter()
+            try:
+                run_sensfunc(spec1d_file, config_lines, output_file)
+                status, error = 'ok', None
+            except MemoryError:
+                status, error = 'memory', traceback.format_exc()
+            except Exception:
+                status, error = 'failed', traceback.format_exc()
+            conn.send(('done', ijob, status, time.perf_counter() - t0, peak_memory_mb(), error))
+    finally:
+        conn.close()
+
+
+def run_sensfunc_batch(jobs, config_lines, ledger, nproc=1, timeout=None, max_memory=None, max_chunk_jobs=8,
+                       overwrite=False):
+    """
+    Run sensfunc on a set of spec1d files with a pool of worker processes.
+
+    Parameters
+    ----------
+    jobs : list
+        (spec1d_file, output_file) tuples.
+    config_lines : list
+        Configuration lines of the sensfunc file.
+    ledger : SensfuncLedger
+        The ledger of the batch. Jobs that it lists as done are skipped, and every job is recorded in it.
+    nproc : int, optional
+        Number of worker processes.
+    timeout : float, optional
+        Time limit of a job in seconds.
+    max_memory : float, optional
+        Address space limit of the worker processes in GB.
+    max_chunk_jobs : int, optional
+        Maximum number of jobs run by a worker process.
+    overwrite : bool, optional
+        Run the jobs even if the ledger lists them as done.
+
+    Returns
+    -------
+    results : astropy.table.Table
+        One row per job with the spec1d and sensfunc files, the spec1d size in MB, the status ('ok', 'skipped',
+        'failed', 'memory', 'timeout' or 'crashed'), the run time in s, the peak memory of the worker process in MB
+        and the error.
+    """
+    cfg_hash = config_hash(config_lines)
+    rows = []
+
+    def add_row(spec1d_file, output_file, status, run_time, worker_peak_mem_mb, error=None):
+        rows.append([str(spec1d_file), str(output_file), os.path.getsize(spec1d_file)/1024.**2, status, run_time,
+                     worker_peak_mem_mb, '' if error is None else error.strip().splitlines()[-1]])
+        if status != 'skipped':
+            ledger.record(spec1d_file, output_file, cfg_hash, status, run_time, worker_peak_mem_mb, error=error)
+            log = msgs.info if status == 'ok' else msgs.warn
+            log('{0}: {1} in {2:.1f}s, peak memory of the worker {3:.0f} MB{4}'.format(
+                spec1d_file.name, status, run_time, worker_peak_mem_mb,
+                '' if error is None else '\n' + error))
+
+    todo = []
+    for spec1d_file, output_file in jobs:
+        if not overwrite and ledger.is_done(spec1d_file, output_file, cfg_hash):
+            entry = ledger.entries[str(spec1d_file)]
+            # Ledgers written before the column was renamed have 'peak_mem_mb'
+            worker_peak_mem_mb = entry.get('worker_peak_mem_mb', entry.get('peak_mem_mb'))
+            add_row(spec1d_file, output_file, 'skipped', entry['run_time'],
+                    np.nan if worker_peak_mem_mb is None else worker_peak_mem_mb)
+        else:
+            todo.append((spec1d_file, output_file))
+    msgs.info('Running sensfunc on {0} spec1d files, {1} are up to date'.format(len(todo), len(jobs) - len(todo)))
+
+    pending = deque(build_chunks(todo, nproc, max_chunk_jobs=max_chunk_jobs)) if len(todo) > 0 else deque()
+    ctx = multiprocessing.get_context('spawn')
+    # Maps the connection of each worker to its process, chunk, running job and start time of the running job
+    running = {}
+    try:
+        while len(pending) > 0 or len(running) > 0:
+            while len(pending) > 0 and len(running) < nproc:
+                chunk = pending.popleft()
+                conn_parent, conn_child = ctx.Pipe(duplex=False)
+                proc = ctx.Process(target=_sensfunc_chunk_worker, args=(chunk, config_lines, max_memory, conn_child))
+                proc.start()
+                conn_child.close()
+                running[conn_parent] = dict(proc=proc, chunk=chunk, ijob=None, tstart=None, ndone=0)
+
+            now = time.perf_counter()
+            wait_time = None
+            if timeout is not None:
+                deadlines = [worker['tstart'] + timeout for worker in running.values() if worker['tstart'] is not None]
+                wait_time = max(min(deadlines) - now, 0.0) if len(deadlines) > 0 else timeout
+            ready = wait(list(running.keys()), timeout=wait_time)
+
+            for conn in ready:
+                worker = running[conn]
+                try:
+                    while conn.poll():
+                        message = conn.recv()
+                        if message[0] == 'start':
+                            worker['ijob'], worker['tstart'] = message[1], time.perf_counter()
+                        else:
+                            _, ijob, status, run_time, worker_peak_mem_mb, error = message
+                            add_row(*worker['chunk'][ijob], status, run_time, worker_peak_mem_mb, error=error)
+                            worker['ijob'], worker['tstart'], worker['ndone'] = None, None, ijob + 1
+                except EOFError:
+                    # The worker is gone, either done or crashed
+                    worker['proc'].join()
+                    if worker['ijob'] is not None or (worker['ndone'] == 0 and worker['proc'].exitcode != 0):
+                        # Blame the running job, or the first one if the worker died before starting it, so that
+                        # every crash makes progress through the chunk
+                        ijob = worker['ndone'] if worker['ijob'] is None else worker['ijob']
+                        run_time = 0.0 if worker['tstart'] is None else time.perf_counter() - worker['tstart']
+                        add_row(*worker['chunk'][ijob], 'crashed', run_time, np.nan,
+                                error='Worker exited with code {0}'.format(worker['proc'].exitcode))
+                        worker['ndone'] = ijob + 1
+                    if worker['ndone'] < len(worker['chunk']):
+                        pending.appendleft(worker['chunk'][worker['ndone']:])
+                    conn.close()
+                    del running[conn]
+
+            now = time.perf_counter()
+            for conn, worker in list(running.items()):
+                if timeout is not None and worker['tstart'] is not None and now - worker['tstart'] > timeout:
+                    worker['proc'].kill()
+                    worker['proc'].join()
+                    add_row(*worker['chunk'][worker['ijob']], 'timeout', now - worker['tstart'], np.nan,
+                            error='Exceeded the time limit of {0:.0f}s'.format(timeout))
+                    if worker['ijob'] + 1 < len(worker['chunk']):
+                        pending.appendleft(worker['chunk'][worker['ijob'] + 1:])
+                    conn.close()
+                    del running[conn]
+    finally:
+        for worker in running.values():
+            worker['proc'].kill()
+            worker['proc'].join()
+
+    results = Table(rows=rows, names=('spec1d', 'sensfunc', 'size_mb', 'status', 'run_time', 'worker_peak_mem_mb',
+                                      'error'),
+                    dtype=(str, str, float, str, float, float, str))
+    nstatus = {status: np.sum(results['status'] == status) for status in np.unique(results['status'])}
+    msgs.info('Done: ' + ', '.join('{0} {1}'.format(n, status) for status, n in nstatus.items()))
+    return results
+
+
+def parse_args(options=None):
+    parser = argparse.ArgumentParser(description='Run sensfunc on all the spec1d files of a directory tree')
+    parser.add_argument('src_dir', type=str, help='Directory searched recursively for spec1d files')
+    parser.add_argument('src_pattern', type=str, help='Pattern of the spec1d files, e.g. "spec1d_*.fits"')
+    parser.add_argument('dest_dir', type=str, help='Directory of the sensfunc files')
+    parser.add_argument('sens_file', type=str, help='Sensfunc file with the configuration of the sensfuncs')
+    parser.add_argument('--nproc', type=int, default=8, help='Number of worker processes')
+    parser.add_argument('--timeout', type=float, default=3600.,
+                        help='Time limit of a sensfunc in seconds. Use 0 for no limit.')
+    parser.add_argument('--max_memory', type=float, default=None,
+                        help='Address space limit of each worker process in GB')
+    parser.add_argument('--max_chunk_jobs', type=int, default=8,
+                        help='Maximum number of spec1d files run by a worker process')
+    parser.add_argument('--ledger', type=str, default=None,
+                        help='Ledger of the batch. Default is sensfunc_ledger.json in dest_dir')
+    parser.add_argument('--csv', type=str, default=None,
+                        help='CSV file with the results of the batch. Default is sensfunc_batch.csv in dest_dir')
+    parser.add_argument('--overwrite', default=False, action='store_true',
+                        help='Regenerate the sensfuncs that the ledger lists as done')
+    return parser.parse_args(options)
+
+
+def main(args):
+    src_dir, dest_dir = Path(args.src_dir), Path(args.dest_dir)
+    config_lines = inputfiles.SensFile.from_file(args.sens_file).cfg_lines
+
+    jobs = []
+    for spec1d_file in sorted(src_dir.rglob(args.src_pattern)):
+        dest_file = sensfunc_outfile(spec1d_file, dest_dir)
         dest_file.parent.mkdir(parents=True, exist_ok=True)
-        options = [spec1d_file, config_lines, dest_file]
-        jobs.append(options)
+        jobs.append((spec1d_file, dest_file))
+    if len(jobs) == 0:
+        msgs.error('No spec1d files matching {0} in {1}'.format(args.src_pattern, src_dir))
 
-    with Pool(processes=8) as p:
-        p.map(run_sensfunc, jobs)
\ No newline at end of file
+    dest_dir.mkdir(parents=True, exist_ok=True)
+    ledger = SensfuncLedger(dest_dir / 'sensfunc_ledger.json' if args.ledger is None else args.ledger)
+    results = run_sensfunc_batch(jobs, config_lines, ledger, nproc=args.nproc,
+                                 timeout=args.timeout if args.timeout > 0 else None, max_memory=args.max_memory,
+                                 max_chunk_jobs=args.max_chunk_jobs, overwrite=args.overwrite)
+    csv_file = dest_dir / 'sensfunc_batch.csv' if args.csv is None else args.csv
+    results.write(csv_file, format='ascii.csv', overwrite=True)
+    msgs.info('Wrote {0}'.format(csv_file))
+    return 0 if np.all(np.isin(results['status'], ['ok', 'skipped'])) else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main(parse_args()))
@@ -0,0 +1,98 @@
+"""
+Check the ledger and the chunking of run_sensfunc_on_all_spec1d on small fake files.
+
+Run with::
+
+    pytest pypeitdev/fluxing/test_run_sensfunc_on_all_spec1d.py
+"""
+import os
+import json
+
+import pytest
+
+from pypeitdev.fluxing import run_sensfunc_on_all_spec1d as rs
+
+
+@pytest.fixture
+def job(tmp_path):
+    spec1d_file = tmp_path / 'spec1d_A.fits'
+    spec1d_file.write_bytes(b'spec1d')
+    output_file = tmp_path / 'sens_A.fits'
+    output_file.write_bytes(b'sensfunc')
+    return spec1d_file, output_file
+
+
+def test_ledger(tmp_path, job):
+    spec1d_file, output_file = job
+    ledger_file = tmp_path / 'ledger.json'
+    ledger = rs.SensfuncLedger(ledger_file)
+    assert len(ledger) == 0
+    assert not ledger.is_done(spec1d_file, output_file, 'abc')
+
+    ledger.record(spec1d_file, output_file, 'abc', 'ok', 1.0, 100.0)
+    assert ledger_file.is_file()
+    assert list(tmp_path.glob('.ledger.json*')) == []
+
+    # The ledger is read back by the next run
+    ledger = rs.SensfuncLedger(ledger_file)
+    assert len(ledger) == 1
+    assert ledger.is_done(spec1d_file, output_file, 'abc')
+    # A different configuration, output file or failed job is not done
+    assert not ledger.is_done(spec1d_file, output_file, 'def')
+    assert not ledger.is_done(spec1d_file, tmp_path / 'sens_B.fits', 'abc')
+    ledger.record(spec1d_file, output_file, 'abc', 'failed', 1.0, 100.0, error='Traceback')
+    assert not ledger.is_done(spec1d_file, output_file, 'abc')
+
+
+def test_ledger_changed_files(tmp_path, job):
+    spec1d_file, output_file = job
+    ledger = rs.SensfuncLedger(tmp_path / 'ledger.json')
+    ledger.record(spec1d_file, output_file, 'abc', 'ok', 1.0, 100.0)
+    assert ledger.is_done(spec1d_file, output_file, 'abc')
+
+    # A modified spec1d file must be processed again
+    stat = os.stat(spec1d_file)
+    os.utime(spec1d_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert not ledger.is_done(spec1d_file, output_file, 'abc')
+    ledger.record(spec1d_file, output_file, 'abc', 'ok', 1.0, 100.0)
+
+    # So must a modified or removed sensfunc
+    output_file.write_bytes(b'other sensfunc')
+    assert not ledger.is_done(spec1d_file, output_file, 'abc')
+    output_file.unlink()
+    assert not ledger.is_done(spec1d_file, output_file, 'abc')
+
+
+def test_ledger_corrupt(tmp_path):
+    ledger_file = tmp_path / 'ledger.json'
+    ledger_file.write_text('{"version": 1, "entr')
+    assert len(rs.SensfuncLedger(ledger_file)) == 0
+    # Entries of another ledger version are ignored
+    ledger_file.write_text(json.dumps(dict(version=rs.LEDGER_VERSION + 1, entries={'a': {}})))
+    assert len(rs.SensfuncLedger(ledger_file)) == 0
+
+
+def test_build_chunks(tmp_path):
+    sizes = [900, 100, 120, 80, 300, 310, 50, 60, 70, 90, 110]
+    jobs = []
+    for i, size in enumerate(sizes):
+        spec1d_file = tmp_path / 'spec1d_{0}.fits'.format(i)
+        spec1d_file.write_bytes(b'x'*size)
+        jobs.append((spec1d_file, tmp_path / 'sens_{0}.fits'.format(i)))
+
+    chunks = rs.build_chunks(jobs, 2, max_chunk_jobs=3, chunks_per_proc=2)
+    # Every job is in exactly one chunk
+    assert sorted(job for chunk in chunks for job in chunk) == sorted(jobs)
+    assert all(0 < len(chunk) <= 3 for chunk in chunks)
+    # Largest files first, and the file larger than the target size gets its own chunk
+    chunk_sizes = [[os.path.getsize(spec1d_file) for spec1d_file, _ in chunk] for chunk in chunks]
+    assert chunk_sizes[0] == [900]
+    flat = [size for chunk in chunk_sizes for size in chunk]
+    assert flat == sorted(sizes, reverse=True)
+    # Chunks with more than one job don't exceed the target size
+    target = sum(sizes)/4
+    assert all(sum(chunk) <= target for chunk in chunk_sizes if len(chunk) > 1)
+
+    # A single chunk holds everything, unless it has too many jobs
+    assert len(rs.build_chunks(jobs, 1, max_chunk_jobs=100, chunks_per_proc=1)) == 1
+    assert [len(chunk) for chunk in rs.build_chunks(jobs, 1, max_chunk_jobs=4, chunks_per_proc=1)] == [4, 4, 3]
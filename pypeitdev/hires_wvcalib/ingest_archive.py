@@ -2,6 +2,7 @@
 
 import os
 import sys
+import multiprocessing
 import numpy as np
 #import jax
 #from jax import numpy as jnp
@@ -26,8 +27,13 @@ from pypeit import utils
 from pypeit import msgs
 from pypeit import wavecalib
 from astropy import table
+from astropy import convolution
+from astropy.stats import sigma_clip
 from scipy import interpolate
+from scipy import ndimage
+from bottleneck import move_median
 from IPython import embed
+from pypeitdev.wavelengths.batch_fitting import robust_fit_batch, pad_series
 from astropy import constants as const
 
 c_kms = const.c.to('km/s').value
@@ -301,7 +307,193 @@ def empty_design_table(nrows, norders, n_final=4):
                                'xdisp', 'det', 'binspec','lambda_cen', 'coeff'))
 
 
-def ingest_xidl_archive(outfile, n_final=4, func='legendre'):
+def add_order_spectra(order_spectra, irow, orders, waves, arcs):
+    """
+    Add the wavelengths and arcs of the orders of one archive row to the per-order spectra of an archive.
+
+    Args:
+        order_spectra (:obj:`dict`):
+            Spectra of the archive, updated in place. The keys are the order numbers and the values are lists of
+            (row, wave, arcspec) tuples.
+        irow (:obj:`int`):
+            Row of the archive table.
+        orders (`numpy.ndarray`_):
+            Order numbers, shape (norders,).
+        waves, arcs (`numpy.ndarray`_):
+            Wavelengths and arcs of the orders, shape (norders, nspec).
+    """
+    for order, wave, arcspec in zip(orders, waves, arcs):
+        order_spectra.setdefault(int(order), []).append((irow, wave, arcspec))
+
+
+def write_hires_archive(outfile, params, arxiv, order_spectra):
+    """
+    Write a HIRES wavelength archive in the compact per-order layout read by HIRESArchive.
+
+    The file has the parameters in hdu=1 and the per-file and per-order information (without the spectra) in hdu=2,
+    as the dense archive did, followed by one binary table per populated order, named ORDERnnn, with the archive
+    ROW, the wavelengths (WAVE, float64) and the arc (ARCSPEC, float32) of every row populating the order. Only the
+    populated orders of every row are stored and the tables are not compressed, so that they can be memory mapped.
+
+    Args:
+        outfile (:obj:`str`):
+            Name of the output file
+        params (`astropy.table.Table`_):
+            Archive parameters.
+        arxiv (`astropy.table.Table`_):
+            Archive table, see empty_design_table.
+        order_spectra (:obj:`dict`):
+            Spectra of every order, see add_order_spectra.
+    """
+    nspec = params['nspec'][0]
+    hdulist = fits.HDUList()
+    hdulist.append(fits.BinTableHDU(params.as_array()))
+    hdulist.append(fits.BinTableHDU(arxiv.as_array()))
+    for order in sorted(order_spectra.keys()):
+        rows, waves, arcs = zip(*sorted(order_spectra[order], key=lambda spec: spec[0]))
+        hdu = fits.BinTableHDU.from_columns(
+            [fits.Column(name='ROW', format='J', array=np.array(rows)),
+             fits.Column(name='WAVE', format='{:d}D'.format(nspec), array=np.array(waves)),
+             fits.Column(name='ARCSPEC', format='{:d}E'.format(nspec), array=np.array(arcs, dtype=np.float32))],
+            name='ORDER{:03d}'.format(order))
+        hdu.header['ORDER'] = order
+        hdulist.append(hdu)
+    hdulist.writeto(outfile, overwrite=True)
+
+
+class HIRESArchive:
+    """
+    Reader of the HIRES wavelength archive that only loads the spectra of the orders that are requested.
+
+    Files in the compact layout written by write_hires_archive are memory mapped, so the spectra of an order are only
+    read from disk when they are requested. The original dense layout, with the wave and arcspec columns in the
+    archive table, is also supported.
+
+    Args:
+        arxiv_file (:obj:`str`):
+            File containing the archive.
+
+    Attributes:
+        params (`astropy.table.Row`_):
+            Archive parameters.
+        table (`astropy.table.Table`_):
+            Archive table, without the spectra.
+    """
+    def __init__(self, arxiv_file):
+        self.arxiv_file = arxiv_file
+        self.hdul = fits.open(arxiv_file, memmap=True)
+        self.params = Table.read(self.hdul[1])[0]
+        self.dense = 'wave' in [name.lower() for name in self.hdul[2].columns.names]
+        self.table = Table.read(self.hdul[2])
+        if self.dense:
+            self.dense_wave = self.table['wave']
+            self.dense_arcspec = self.table['arcspec']
+            self.table.remove_columns(['wave', 'arcspec'])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.hdul.close()
+
+    def order_spectra(self, order, good=True):
+        """
+        Wavelengths and arcs of the archive rows populating an order.
+
+        Args:
+            order (:obj:`int`):
+                Order number.
+            good (:obj:`bool`, optional):
+                Only return the rows flagged as populated_and_good, otherwise all the populated rows.
+
+        Returns:
+            :obj:`tuple`: The archive rows (nsolns,), the wavelengths (nsolns, nspec) and the arcs (nsolns, nspec), in
+            the order of the rows.
+        """
+        iord = order - self.params['order_min']
+        mask_name = 'populated_and_good' if good else 'populated'
+        if self.dense:
+            rows = np.where(self.table[mask_name][:, iord])[0]
+            return rows, np.array(self.dense_wave[rows, iord, :], dtype=float), \
+                   np.array(self.dense_arcspec[rows, iord, :], dtype=float)
+        extname = 'ORDER{:03d}'.format(order)
+        if extname not in self.hdul:
+            nspec = self.params['nspec']
+            return np.zeros(0, dtype=int), np.zeros((0, nspec)), np.zeros((0, nspec))
+        data = self.hdul[extname].data
+        rows = np.array(data['ROW'])
+        keep = np.where(self.table[mask_name][rows, iord])[0]
+        return rows[keep], np.array(data['WAVE'][keep], dtype=float), np.array(data['ARCSPEC'][keep], dtype=float)
+
+
+def fit_wave_orders(xvec, waves, n_final, func='legendre', minx=0.0, maxx=1.0):
+    """
+    Fit the wavelengths vs. pixel of many orders at once.
+
+    All the orders are fit with a single least-squares solve against the Vandermonde matrix of xvec, which they all
+    share. This is equivalent to calling fitting.robust_fit on every order without rejection (lower=upper=1e10,
+    maxrej=0), since robust_fit then performs a single unweighted fit. Orders with non-finite wavelengths are fit
+    with robust_fit.
+
+    Args:
+        xvec (`numpy.ndarray`_):
+            Normalized pixel coordinates, shape (nspec,).
+        waves (`numpy.ndarray`_):
+            Wavelengths of the orders, shape (norders, nspec).
+        n_final (:obj:`int`):
+            Order of the fits.
+        func (:obj:`str`, optional):
+            Fitting function, 'legendre', 'chebyshev' or 'polynomial'.
+        minx, maxx (:obj:`float`, optional):
+            Range of xvec used to normalize the Legendre and Chebyshev fits.
+
+    Returns:
+        `numpy.ndarray`_: Fit coefficients, shape (norders, n_final + 1).
+    """
+    waves = np.atleast_2d(waves)
+    coeff = np.zeros((waves.shape[0], n_final + 1))
+    finite = np.all(np.isfinite(waves), axis=1)
+    if np.any(finite):
+        if func == 'polynomial':
+            coeff[finite] = np.polynomial.polynomial.polyfit(xvec, waves[finite].T, n_final).T
+        elif func in ['legendre', 'chebyshev']:
+            xv, _, _ = fitting.scale_minmax(xvec, minx=minx, maxx=maxx)
+            fitfunc = np.polynomial.legendre.legfit if func == 'legendre' else np.polynomial.chebyshev.chebfit
+            coeff[finite] = fitfunc(xv, waves[finite].T, n_final).T
+        else:
+            msgs.error('Fitting function {:s} is not supported'.format(func))
+    for ii in np.where(np.logical_not(finite))[0]:
+        pypeitFit = fitting.robust_fit(xvec, waves[ii], n_final, function=func, maxiter=10,
+                                       lower=1e10, upper=1e10, maxrej=0, sticky=True,
+                                       minx=minx, maxx=maxx, weights=None)
+        coeff[ii] = pypeitFit.fitc
+    return coeff
+
+
+def read_xidl_archive_files(tbl, nproc=1):
+    """
+    Read the arcs and wavelengths of all the XIDL archive files of a template table.
+
+    Args:
+        tbl (`astropy.table.Table`_):
+            Table of XIDL archive files, see ingest_xidl_archive.
+        nproc (:obj:`int`, optional):
+            Number of processes used to read the files.
+
+    Returns:
+        :obj:`list`: The order vector, wavelengths and arcs of every file, as returned by templates.xidl_esihires.
+    """
+    args = [(os.path.join(os.getenv('HIRES_CALIBS'), 'ARCS', row['Name']), row['Rbin']) for row in tbl]
+    if nproc <= 1:
+        return [templates.xidl_esihires(xidl_file, specbin=specbin) for xidl_file, specbin in args]
+    with multiprocessing.get_context('spawn').Pool(processes=nproc) as pool:
+        return pool.starmap(templates.xidl_esihires, args, chunksize=max(len(args) // (4*nproc), 1))
+
+
+def ingest_xidl_archive(outfile, n_final=4, func='legendre', nproc=1):
     """
     Read the XIDL archive file and write a pypeit format archive file.
 
@@ -309,6 +501,12 @@ def ingest_xidl_archive(outfile, n_final=4, func='legendre'):
     -----
     outfile: str
         Name of the output file
+    n_final: int
+        Order of the fits of the wavelengths vs. pixel
+    func: str
+        Function of the fits of the wavelengths vs. pixel
+    nproc: int
+        Number of processes used to read the XIDL files
     """
 
     # Read template file
@@ -330,16 +528,17 @@ def ingest_xidl_archive(outfile, n_final=4, func='legendre'):
 
     table_xidl = empty_design_table(nrows, norders, n_final=n_final)
 
+    xidl_arcs = read_xidl_archive_files(tbl, nproc=nproc)
+    order_spectra = {}
+    # The good orders of all the files are fit together at the end
+    good_waves, good_rows, good_indx = [], [], []
     for irow in np.arange(nrows):
-        this_order_vec_raw, this_wave, this_arc = templates.xidl_esihires(
-            os.path.join(os.getenv('HIRES_CALIBS'), 'ARCS', tbl[irow]['Name']), specbin=tbl[irow]['Rbin'])
+        this_order_vec_raw, this_wave, this_arc = xidl_arcs[irow]
         if irow == 0:
             nspec = this_wave.shape[1]
             xnspecmin1 = float(nspec - 1)
             xvec = np.arange(nspec)/xnspecmin1
             params['nspec'] = nspec
-            table_xidl['wave'] = np.zeros((nrows, norders, nspec))
-            table_xidl['arcspec'] = np.zeros((nrows, norders, nspec))
         else:
             assert this_wave.shape[1] == nspec
 
@@ -372,26 +571,18 @@ def ingest_xidl_archive(outfile, n_final=4, func='legendre'):
         table_xidl['det'][irow, indx] = tbl[irow]['Chip']
         table_xidl['binspec'][irow, indx] = tbl[irow]['Rbin']
         table_xidl['lambda_cen'][irow, indx] = np.median(this_wave, axis=1)
-        table_xidl['wave'][irow, indx, :] = this_wave
-        table_xidl['arcspec'][irow, indx, :] = this_arc
-        # Fit the wavelengths
-        this_coeff_array = np.zeros((nsolns_good, n_final + 1))
-        for ii, iwave in enumerate(this_wave[igood, :]):
-            pypeitFit = fitting.robust_fit(xvec, iwave, n_final, function=func, maxiter=10,
-                                           lower=1e10, upper=1e10, maxrej=0, sticky=True,
-                                           minx=fmin, maxx=fmax, weights=None)
-            this_coeff_array[ii, :] = pypeitFit.fitc
-        table_xidl['coeff'][irow, indx_good, :] = this_coeff_array
+        add_order_spectra(order_spectra, irow, this_order_vec_raw, this_wave, this_arc)
+        good_waves.append(this_wave[igood, :])
+        good_rows.append(np.full(nsolns_good, irow))
+        good_indx.append(indx_good)
+
+    # Fit the wavelengths
+    table_xidl['coeff'][np.concatenate(good_rows), np.concatenate(good_indx), :] = fit_wave_orders(
+        xvec, np.concatenate(good_waves), n_final, func=func, minx=fmin, maxx=fmax)
 
     # Write out to multi-extension fits
     print(f'Writing HIRES xidl wv_calib archive to file: {outfile}')
-    hdu_param = fits.BinTableHDU(params.as_array())
-    hdu_table = fits.BinTableHDU(table_xidl.as_array())
-
-    hdulist = fits.HDUList()
-    hdulist.append(hdu_param)
-    hdulist.append(hdu_table)
-    hdulist.writeto(outfile, overwrite=True)
+    write_hires_archive(outfile, params, table_xidl, order_spectra)
 
     return
 
@@ -408,8 +599,16 @@ def append_pypeit_archive(outfile, xidl_arxiv_file):
     """
 
     # Load the XIDL format archive file
-    xidl_params = Table.read(xidl_arxiv_file, hdu=1)[0]
-    xidl_tab = Table.read(xidl_arxiv_file, hdu=2)
+    xidl_archive = HIRESArchive(xidl_arxiv_file)
+    xidl_params = xidl_archive.params
+    xidl_tab = xidl_archive.table
+    # The spectra are stored by order number, so those of the xidl archive are copied as they are
+    order_spectra = {}
+    for order in np.arange(xidl_params['order_min'], xidl_params['order_max'] + 1):
+        rows, waves, arcs = xidl_archive.order_spectra(order, good=False)
+        for irow, wave, arcspec in zip(rows, waves, arcs):
+            add_order_spectra(order_spectra, irow, [order], wave[None, :], arcspec[None, :])
+    xidl_archive.close()
 
     # load the list of pypeit templates
     ptempl_table_file = os.path.join(resource_filename('pypeit', 'data'), 'arc_lines',
@@ -432,8 +631,6 @@ def append_pypeit_archive(outfile, xidl_arxiv_file):
     # create new final table
     tot_nrows = len(xidl_tab) + p_nrows
     final_table = empty_design_table(tot_nrows, norders, n_final=xidl_params['n_final'])
-    final_table['wave'] = np.zeros((tot_nrows, norders, xidl_params['nspec']))
-    final_table['arcspec'] = np.zeros((tot_nrows, norders, xidl_params['nspec']))
 
     # copy the xidl table to the final table (we need to do this, instead of just merging 2 tables,
     # because the number of the orders increased with the pypeit templates)
@@ -465,12 +662,13 @@ def append_pypeit_archive(outfile, xidl_arxiv_file):
         final_table['det'][xirow, this_xindx] = xidl_tab['det'][xirow][xidl_tab['populated'][xirow]]
         final_table['binspec'][xirow, this_xindx] = xidl_tab['binspec'][xirow][xidl_tab['populated'][xirow]]
         final_table['lambda_cen'][xirow, this_xindx] = xidl_tab['lambda_cen'][xirow][xidl_tab['populated'][xirow]]
-        final_table['wave'][xirow, this_xindx, :] = xidl_tab['wave'][xirow][xidl_tab['populated'][xirow]]
-        final_table['arcspec'][xirow, this_xindx, :] = xidl_tab['arcspec'][xirow][xidl_tab['populated'][xirow]]
         final_table['coeff'][xirow, this_xindx_good, :] = xidl_tab['coeff'][xirow][xidl_tab['populated_and_good'][xirow]]
 
     # Now deal with the pypeit format
     # load the pypeit templates (they are WaveCalib files)
+    xnspecmin1 = float(xidl_params['nspec'] - 1)
+    xvec = np.arange(xidl_params['nspec']) / xnspecmin1
+    good_waves, good_rows, good_indx = [], [], []
     for irow in np.arange(p_nrows):
         ifinal_row = irow + len(xidl_tab)
         templ_file = os.path.join(os.getenv('PYPEIT_DEV'), 'dev_algorithms', 'hires_wvcalib',
@@ -518,28 +716,20 @@ def append_pypeit_archive(outfile, xidl_arxiv_file):
         final_table['det'][ifinal_row, indx] = ptbl[irow]['Chip']
         final_table['binspec'][ifinal_row, indx] = ptbl[irow]['Rbin']
         final_table['lambda_cen'][ifinal_row, indx] = np.median(this_wave, axis=1)
-        final_table['wave'][ifinal_row, indx, :] = this_wave
-        final_table['arcspec'][ifinal_row, indx, :] = this_arc
-        # Fit the wavelengths
-        xnspecmin1 = float(xidl_params['nspec'] - 1)
-        xvec = np.arange(xidl_params['nspec']) / xnspecmin1
-        this_coeff_array = np.zeros((nsolns_good, xidl_params['n_final'] + 1))
-        for ii, iwave in enumerate(this_wave[igood, :]):
-            pypeitFit = fitting.robust_fit(xvec, iwave, xidl_params['n_final'], function=xidl_params['func'], maxiter=10,
-                                           lower=1e10, upper=1e10, maxrej=0, sticky=True,
-                                           minx=xidl_params['xmin'], maxx=xidl_params['xmax'], weights=None)
-            this_coeff_array[ii, :] = pypeitFit.fitc
-        final_table['coeff'][ifinal_row, indx_good, :] = this_coeff_array
+        add_order_spectra(order_spectra, ifinal_row, this_order_vec_raw, this_wave, this_arc)
+        good_waves.append(this_wave[igood, :])
+        good_rows.append(np.full(nsolns_good, ifinal_row))
+        good_indx.append(indx_good)
+
+    # Fit the wavelengths
+    if p_nrows > 0:
+        final_table['coeff'][np.concatenate(good_rows), np.concatenate(good_indx), :] = fit_wave_orders(
+            xvec, np.concatenate(good_waves), xidl_params['n_final'], func=xidl_params['func'],
+            minx=xidl_params['xmin'], maxx=xidl_params['xmax'])
 
     # Write out to multi-extension fits
     print(f'Writing HIRES xidl+pypeit wv_calib archive to file: {outfile}')
-    hdu_param = fits.BinTableHDU(xidl_params.table.as_array())
-    hdu_table = fits.BinTableHDU(final_table.as_array())
-
-    hdulist = fits.HDUList()
-    hdulist.append(hdu_param)
-    hdulist.append(hdu_table)
-    hdulist.writeto(outfile, overwrite=True)
+    write_hires_archive(outfile, xidl_params.table, final_table, order_spectra)
 
 
 def fit_wvcalib_vs_angles(arxiv_file, outfile, func='legendre',
@@ -576,8 +766,9 @@ def fit_wvcalib_vs_angles(arxiv_file, outfile, func='legendre',
     """
 
 
-    arxiv_params = Table.read(arxiv_file, hdu=1)[0]
-    arxiv = Table.read(arxiv_file, hdu=2)
+    # Only the archive table is needed, not the spectra
+    with HIRESArchive(arxiv_file) as archive:
+        arxiv_params, arxiv = archive.params, archive.table
 
     ech_angle_fit_params, ech_angle_fit_coeffs = fit_coeffs_vs_ech_angle(
         arxiv_params, arxiv, func=func, nmax = ech_nmax, coeff_fit_order_min=ech_coeff_fit_order_min,
@@ -657,38 +848,42 @@ def fit_coeffs_vs_ech_angle(arxiv_params, arxiv, func='legendre', nmax = 3, coef
 
     ech_angle_fit_coeffs = np.zeros((norders, n_final + 1, coeff_fit_order_max + 1))
 
-    for iord, this_order in enumerate(order_vec):
-        populated = arxiv['populated_and_good'][:, iord] # & (arxiv['xdisp'][:, iord] == xdisp)
-        nsolns_this_order = np.sum(populated)
-        if nsolns_this_order > 0:
-            ech_angle_this_order = arxiv['ech_angle'][:, iord][populated]
-            coeff_this_order = arxiv['coeff'][:, iord, :][populated, :]
-            #xd_angle_this_order = arxiv['xd_angle'][:, iord][populated]
-            #lambda_cen_this_order = arxiv['lambda_cen'][:, iord][populated]
-            for ic in range(coeff_this_order.shape[1]):
-                pypeitFit = fitting.robust_fit(ech_angle_this_order, coeff_this_order[:, ic], coeff_fit_order_vec[ic], function=func,
-                                               minx=ech_min, maxx=ech_max, maxiter=25,
-                                               lower=sigrej, upper=sigrej, maxrej=maxrej, sticky=True, use_mad=True,
-                                               weights=None)
-                ech_angle_fit_coeffs[iord, ic, 0:coeff_fit_order_vec[ic]+1] = pypeitFit.fitc
-                if debug:
-                    this_fit = fitting.evaluate_fit(pypeitFit.fitc, func, ech_vec, minx=ech_min, maxx=ech_max)
-                    plt.plot(ech_vec, this_fit, color='blue', label='fit')
-                    fit_gpm = pypeitFit.bool_gpm
-                    plt.plot(ech_angle_this_order[fit_gpm], coeff_this_order[fit_gpm, ic], marker='o', markersize=7.0, mfc='black',
-                             mec='black', fillstyle='full', linestyle='None', zorder=5, label='used by fit')
-                    plt.plot(ech_angle_this_order[np.logical_not(fit_gpm)], coeff_this_order[np.logical_not(fit_gpm), ic],
-                             marker='s', markersize=9.0, mfc='red', mec='red', fillstyle='full', linestyle='None',
-                             zorder=7, label='rejected')
-                    plt.legend()
-                    plt.title(
-                        f'order={this_order}, cc_ii={ic}, nkept={np.sum(fit_gpm)}, nrej={np.sum(np.logical_not(fit_gpm))}')
-                    plt.xlabel('ech_angle')
-                    plt.ylabel('coeff')
-                    plt.ylim(this_fit.min() - 0.05 * np.abs(this_fit.min()),
-                             this_fit.max() + 0.05 * np.abs(this_fit.max()))
-                    plt.show()
-
+    # Fit every (order, coefficient) series against ech_angle at once. Each series runs over all the rows of the arxiv
+    # and the unpopulated rows are masked.
+    populated = np.asarray(arxiv['populated_and_good'])
+    fit_orders = np.where(np.any(populated, axis=0))[0]
+    ncoeff = n_final + 1
+    ech_angle_series = np.repeat(np.asarray(arxiv['ech_angle'])[:, fit_orders].T, ncoeff, axis=0)
+    coeff_series = np.asarray(arxiv['coeff'])[:, fit_orders, :].transpose(1, 2, 0).reshape(fit_orders.size*ncoeff, -1)
+    populated_series = np.repeat(populated[:, fit_orders].T, ncoeff, axis=0)
+    fitc, fit_gpm = robust_fit_batch(ech_angle_series, coeff_series, np.tile(coeff_fit_order_vec, fit_orders.size),
+                                     function=func, minx=ech_min, maxx=ech_max, maxiter=25, in_gpm=populated_series,
+                                     lower=sigrej, upper=sigrej, maxrej=maxrej, sticky=True, use_mad=True)
+    ech_angle_fit_coeffs[fit_orders, :, :fitc.shape[1]] = fitc.reshape(fit_orders.size, ncoeff, -1)
+
+    if debug:
+        for iseries in range(fitc.shape[0]):
+            iord, ic = divmod(iseries, ncoeff)
+            this_order = order_vec[fit_orders[iord]]
+            use = populated_series[iseries]
+            ech_angle_this_order, coeff_this_order = ech_angle_series[iseries, use], coeff_series[iseries, use]
+            this_fit = fitting.evaluate_fit(fitc[iseries, :coeff_fit_order_vec[ic] + 1], func, ech_vec,
+                                            minx=ech_min, maxx=ech_max)
+            plt.plot(ech_vec, this_fit, color='blue', label='fit')
+            this_gpm = fit_gpm[iseries, use]
+            plt.plot(ech_angle_this_order[this_gpm], coeff_this_order[this_gpm], marker='o', markersize=7.0,
+                     mfc='black', mec='black', fillstyle='full', linestyle='None', zorder=5, label='used by fit')
+            plt.plot(ech_angle_this_order[np.logical_not(this_gpm)], coeff_this_order[np.logical_not(this_gpm)],
+                     marker='s', markersize=9.0, mfc='red', mec='red', fillstyle='full', linestyle='None',
+                     zorder=7, label='rejected')
+            plt.legend()
+            plt.title(
+                f'order={this_order}, cc_ii={ic}, nkept={np.sum(this_gpm)}, nrej={np.sum(np.logical_not(this_gpm))}')
+            plt.xlabel('ech_angle')
+            plt.ylabel('coeff')
+            plt.ylim(this_fit.min() - 0.05 * np.abs(this_fit.min()),
+                     this_fit.max() + 0.05 * np.abs(this_fit.max()))
+            plt.show()
 
     return ech_angle_fit_params, ech_angle_fit_coeffs
 
@@ -706,29 +901,30 @@ def fit_reddest_vs_xd_angle(arxiv, func='legendre', polyorder = 2, sigrej=3.0, m
                 ,names=('xd_xmin','xd_xmax','xdisp_vec', 'xd_polyorder', 'xd_func'))
 
     # First dimension is UV or RED, second dimension is the set of polynomial coefficients
-    xd_angle_fit_coeffs = np.zeros((2, polyorder + 1))
-
-    for idisp, xdisp in enumerate(['UV', 'RED']):
-
-        indx = (arxiv['det_file'] == 3) & (arxiv['xdisp_file'] == xdisp)
-        xd_angles_this_disp = xd_angles[indx]
-        reddest_order_this_disp = arxiv['reddest_order'][indx].astype(float)
-        pypeitFit = fitting.robust_fit(xd_angles_this_disp, reddest_order_this_disp, polyorder,
-                                       function=func, minx=xd_min, maxx=xd_max, maxiter=25,
-                                       lower=sigrej, upper=sigrej, maxrej=maxrej, sticky=True, use_mad=True,
-                                       weights=None)
-        xd_angle_fit_coeffs[idisp, :] = pypeitFit.fitc
-        if debug:
-            this_fit = fitting.evaluate_fit(pypeitFit.fitc, func, xd_vec, minx=xd_min, maxx=xd_max)
+    xdisp_vec = ['UV', 'RED']
+    indx = [(arxiv['det_file'] == 3) & (arxiv['xdisp_file'] == xdisp) for xdisp in xdisp_vec]
+    xd_angle_series, reddest_order_series, in_gpm = pad_series(
+        [xd_angles[this_indx] for this_indx in indx],
+        [arxiv['reddest_order'][this_indx].astype(float) for this_indx in indx])
+    xd_angle_fit_coeffs, fit_gpm = robust_fit_batch(xd_angle_series, reddest_order_series, polyorder, function=func,
+                                                    minx=xd_min, maxx=xd_max, maxiter=25, in_gpm=in_gpm,
+                                                    lower=sigrej, upper=sigrej, maxrej=maxrej, sticky=True,
+                                                    use_mad=True)
+
+    if debug:
+        for idisp, xdisp in enumerate(xdisp_vec):
+            use = in_gpm[idisp]
+            xd_angles_this_disp, reddest_order_this_disp = xd_angle_series[idisp, use], reddest_order_series[idisp, use]
+            this_fit = fitting.evaluate_fit(xd_angle_fit_coeffs[idisp], func, xd_vec, minx=xd_min, maxx=xd_max)
             plt.plot(xd_vec, this_fit, color='green', label='fit')
-            fit_gpm = pypeitFit.bool_gpm
-            plt.plot(xd_angles_this_disp[fit_gpm], reddest_order_this_disp[fit_gpm], marker='o', markersize=7.0,
+            this_gpm = fit_gpm[idisp, use]
+            plt.plot(xd_angles_this_disp[this_gpm], reddest_order_this_disp[this_gpm], marker='o', markersize=7.0,
                      mfc='black', mec='black', fillstyle='full', linestyle='None', zorder=5, label='used by fit')
-            plt.plot(xd_angles_this_disp[np.logical_not(fit_gpm)],reddest_order_this_disp[np.logical_not(fit_gpm)],
+            plt.plot(xd_angles_this_disp[np.logical_not(this_gpm)],reddest_order_this_disp[np.logical_not(this_gpm)],
                      marker='s', markersize=9.0, mfc='red', mec='red', fillstyle='full', linestyle='None',
                      zorder=7, label='rejected')
             plt.legend()
-            plt.title(f'XDISP={xdisp}, nkept={np.sum(fit_gpm)}, nrej={np.sum(np.logical_not(fit_gpm))}')
+            plt.title(f'XDISP={xdisp}, nkept={np.sum(this_gpm)}, nrej={np.sum(np.logical_not(this_gpm))}')
             plt.xlabel('xd_angle')
             plt.ylabel('reddest_order')
             plt.ylim(this_fit.min()-3, this_fit.max() +3)
@@ -746,8 +942,9 @@ def echelle_composite_arcspec(arxiv_file, outfile, show_individual_solns=False,
                    'lightgreen', 'cornflowerblue')
     colors = itertools.cycle(color_tuple)
 
-    arxiv_params = Table.read(arxiv_file, hdu=1)[0]
-    arxiv = Table.read(arxiv_file, hdu=2)
+    archive = HIRESArchive(arxiv_file)
+    arxiv_params = archive.params
+    arxiv = archive.table
     norders = arxiv_params['norders']
     order_vec = np.arange(arxiv_params['order_min'], arxiv_params['order_max'] + 1, 1)
 
@@ -763,8 +960,7 @@ def echelle_composite_arcspec(arxiv_file, outfile, show_individual_solns=False,
         populated = arxiv['populated_and_good'][:, iord]
         nsolns_this_order = np.sum(populated)
         if nsolns_this_order > 0:
-            this_wave = arxiv['wave'][:, iord, :][populated, :]
-            this_arc = arxiv['arcspec'][:, iord, :][populated, :]
+            _, this_wave, this_arc = archive.order_spectra(this_order)
             this_gpm = (this_wave > 0.0) & (this_arc != 0.0)
             this_dwave = np.zeros_like(this_wave)
             for ii in range(nsolns_this_order):
@@ -807,8 +1003,7 @@ def echelle_composite_arcspec(arxiv_file, outfile, show_individual_solns=False,
         populated = arxiv['populated_and_good'][:, iord]
         nsolns_this_order = np.sum(populated)
         if nsolns_this_order > 0:
-            this_wave = arxiv['wave'][:, iord, :][populated, :]
-            this_arc = arxiv['arcspec'][:, iord, :][populated, :]
+            _, this_wave, this_arc = archive.order_spectra(this_order)
             this_gpm = (this_wave > 0.0) & (this_arc != 0.0)
             this_wave_composite = wave_total_composite[ind_min[iord]:ind_max[iord]]
             this_nspec = this_wave_composite.size
@@ -836,7 +1031,7 @@ def echelle_composite_arcspec(arxiv_file, outfile, show_individual_solns=False,
                 utils.array_to_explist(ivar_arc_iord), utils.array_to_explist(gpm_arc_iord), sn_smooth_npix,
                 wave_method='user_input', wave_grid_input=this_wave_composite,
                 ref_percentile=70.0, maxiter_scale=5, sigrej_scale=3.0, scale_method='median',
-                sn_min_polyscale=2.0, sn_min_medscale=0.5, const_weights=True, maxiter_reject=5, sn_clip=30.0,
+                sn_min_polyscale=2.0, sn_min_medscale=0.5, weight_method='constant', maxiter_reject=5, sn_clip=30.0,
                 lower=5.0, upper=5.0,
                 debug=debug, debug_scale=debug, show_scale=debug, show=show_orders, verbose=True)
             #ind_mid_min[iord] = np.argmin(np.abs(wave_grid_mid.min() - wave_total_composite_mid))
@@ -844,6 +1039,7 @@ def echelle_composite_arcspec(arxiv_file, outfile, show_individual_solns=False,
             wave_composite[0:wave_grid_mid.size, iord] = wave_grid_mid
             arc_composite[0:wave_grid_mid.size, iord] = arcspec_stack
             gpm_composite[0:wave_grid_mid.size, iord] = arcspec_gpm
+    archive.close()
 
     # Now generate a final composite arc combining all the orders. Experimental. Not sure we need this.
     if do_total:
@@ -853,7 +1049,7 @@ def echelle_composite_arcspec(arxiv_file, outfile, show_individual_solns=False,
         wave_grid_mid, wave_grid_stack, arcspec_stack, _, arcspec_gpm = coadd.combspec(
             wave_composite, arc_composite, ivar_composite, gpm_composite, sn_smooth_npix,
             wave_method='user_input', wave_grid_input=wave_total_composite, ref_percentile=70.0, maxiter_scale=5, sigrej_scale=3.0, scale_method='median',
-            sn_min_polyscale=2.0, sn_min_medscale=0.5, const_weights=True, maxiter_reject=5, sn_clip=30.0,
+            sn_min_polyscale=2.0, sn_min_medscale=0.5, weight_method='constant', maxiter_reject=5, sn_clip=30.0,
             lower=5.0, upper=5.0,
             debug=debug, debug_scale=debug, show_scale=debug, show=show_total, verbose=True)
 
@@ -872,350 +1068,617 @@ def echelle_composite_arcspec(arxiv_file, outfile, show_individual_solns=False,
 
 
 
-xidl_arxiv_file = os.path.join(os.getenv('PYPEIT_DEV'), 'dev_algorithms', 'hires_wvcalib', 'hires_wvcalib_xidl.fits')
-# Create the astropy table form of the xidl save file arxiv
-if not os.path.isfile(xidl_arxiv_file):
-    ingest_xidl_archive(xidl_arxiv_file)
-# append the pypeit templates to the xidl archive
-arxiv_file = os.path.join(os.getenv('PYPEIT_DEV'), 'dev_algorithms', 'hires_wvcalib', 'hires_wvcalib.fits')
-if not os.path.isfile(arxiv_file):
-    append_pypeit_archive(arxiv_file, xidl_arxiv_file)
-
-# sys.exit(-1)
-# Perform fits to the coefficients vs ech angle
-# TODO see if pca works better here
-debug=False
-wvcalib_angle_fit_file = os.path.join(os.getenv('PYPEIT_DEV'), 'dev_algorithms', 'hires_wvcalib', 'wvcalib_angle_fits.fits')
-if not os.path.isfile(wvcalib_angle_fit_file):
-    fit_wvcalib_vs_angles(arxiv_file, wvcalib_angle_fit_file, func='legendre',
-                      ech_nmax = 3, ech_coeff_fit_order_min=1, ech_coeff_fit_order_max=2,
-                      xd_reddest_fit_polyorder=2, sigrej=3.0, maxrej=1, debug=debug)
-
-# Compute a composite arc from the solution arxiv
-composite_arcfile = os.path.join(os.getenv('PYPEIT_DEV'), 'dev_algorithms', 'hires_wvcalib', 'HIRES_composite_arc.fits')
-if not os.path.isfile(composite_arcfile):
-    echelle_composite_arcspec(arxiv_file, composite_arcfile, show_orders=debug)
-
-sys.exit(-1)
-
-
-use_unknowns = True
-line_lists_all = waveio.load_line_lists(['ThAr'])
-line_lists = line_lists_all[np.where(line_lists_all['ion'] != 'UNKNWN')]
-unknwns = line_lists_all[np.where(line_lists_all['ion'] == 'UNKNWN')]
-tot_line_list = table.vstack([line_lists, unknwns]) if use_unknowns else line_lists
-spectrograph = load_spectrograph('keck_hires')
-par = spectrograph.default_pypeit_par()['calibrations']['wavelengths']
-n_final = 4
-# xmin, xmax for wavelength vs pixel fits
-fmin, fmax = 0.0, 1.0
-color_tuple = ('green', 'cyan', 'magenta', 'blue', 'darkorange', 'yellow', 'dodgerblue', 'purple',
-               'lightgreen', 'cornflowerblue')
-colors = itertools.cycle(color_tuple)
-#
-#
-# # Read template file
-# templ_table_file = os.path.join(
-#     resource_filename('pypeit', 'data'), 'arc_lines',
-#     'hires', 'hires_templ_xidl.dat')
-# tbl = Table.read(templ_table_file, format='ascii')
-# nrows = len(tbl)
-#
-# order_min = tbl['IOrder'].min()
-# order_max = 118
-#
-# order_vec = np.arange(order_min, order_max +1, 1)
-# norders = order_vec.size
-#
-# # Subset of orders in every file. Populated indicates whether a given order is populated
-# lambda_cen = np.zeros((norders, nrows))
-# ech_angle = np.zeros((norders, nrows))
-# populated = np.zeros((norders, nrows), dtype=bool)
-# XDISP_is_red = np.zeros((norders, nrows), dtype=bool)
-# binspec = np.zeros((norders, nrows), dtype=int)
-# det = np.zeros((norders, nrows), dtype=int)
-# xd_angle = np.zeros((norders, nrows))
-# coeff = np.zeros((norders, nrows, n_final+1))
-# bluest_order = np.zeros(nrows, dtype=int)
-# xd_angle_file = np.zeros(nrows)
-# ech_angle_file = np.zeros(nrows)
-# det_file = np.zeros(nrows)
-# XDISP_is_red_file = np.zeros(nrows, dtype=bool)
-#
-# for irow in np.arange(nrows):
-#     this_order_vec_raw, this_wave, this_arc = templates.xidl_hires(
-#         os.path.join(os.getenv('HIRES_CALIBS'), 'ARCS', tbl[irow]['Name']), specbin=tbl[irow]['Rbin'])
-#     if irow == 0:
-#         nspec = this_wave.shape[1]
-#         xnspecmin1 = float(nspec - 1)
-#         xvec = np.arange(nspec)/xnspecmin1
-#         wave = np.zeros((norders, nrows, nspec))
-#         arcspec = np.zeros((norders, nrows, nspec))
-#         table_xidl = Table([np.zeros((nrows, norders), dtype="<U30"),
-#                             np.zeros((nrows, norders)),
-#                             np.zeros((nrows, norders)),
-#                             np.zeros((nrows, norders), dtype=int),
-#                             np.zeros((nrows,), dtype=int),
-#                             np.zeros((nrows, norders), dtype="<U3"),
-#                             np.zeros((nrows, norders), dtype=int),
-#                             np.zeros((nrows, norders), dtype=int),
-#                             np.zeros((nrows, norders), dtype=bool),
-#                             np.zeros((nrows, norders, n_final+1)),
-#                             np.zeros((nrows, norders, nspec)),
-#                             np.zeros((nrows, norders, nspec)),],
-#                             names = ('filename', 'ech_angle', 'xd_angle', 'order', 'bluest_order',
-#                                      'xdisp', 'det', 'binspec', 'populated', 'coeff', 'wave', 'arcspec'))
-#     else:
-#         assert this_wave.shape[1] == nspec
-#     # Restrict to what is labeled as good in the Table
-#     igood = (this_order_vec_raw >= tbl[irow]['IOrder']) & (this_order_vec_raw <= tbl[irow]['EOrder'])
-#     nsolns = np.sum(igood)
-#     this_order_vec = this_order_vec_raw[igood]
-#     indx = this_order_vec - order_min
-#     populated[indx, irow] = True
-#     ech_angle[indx, irow] = tbl[irow]['ECH']
-#     xd_angle[indx, irow] = tbl[irow]['XDAng']
-#     XDISP_is_red[indx, irow] = tbl[irow]['XDISP'] == 'RED'
-#     binspec[indx, irow] =  tbl[irow]['Rbin']
-#     det[indx, irow] =  tbl[irow]['Chip']
-#
-#     wave[indx, irow, :] = this_wave[igood, :]
-#     arcspec[indx, irow, :] = this_arc[igood, :]
-#     lambda_cen[indx, irow] = np.median(this_wave[igood, :], axis=1)
-#     # Fit the wavelengths
-#     coeff_array = np.zeros((nsolns, n_final +1))
-#     for ii, iwave in enumerate(this_wave[igood, :]):
-#         pypeitFit = fitting.robust_fit(xvec, iwave, n_final, function=par['func'], maxiter=10,
-#                                        lower=1e10, upper=1e10, maxrej=0, sticky=True,
-#                                        minx=fmin, maxx=fmax, weights=None)
-#         coeff_array[ii, :] = pypeitFit.fitc
-#     coeff[indx, irow, :] = coeff_array
-#     # file specific
-#     bluest_order[irow] = this_order_vec[-1]
-#     ech_angle_file[irow] = tbl[irow]['ECH']
-#     xd_angle_file[irow] = tbl[irow]['XDAng']
-#     det_file[irow] = tbl[irow]['Chip']
-#     XDISP_is_red_file[irow] = tbl[irow]['XDISP'] == 'RED'
-
-#all_dlam = []
-#all_lam = []
-#all_orders = []
-
-
-pad_factor = 0.10
-# xvec_pad = np.arange(-int(np.round(pad_factor*nspec)), int(np.round((1.0 + pad_factor)*nspec)))/xnspecmin1
-#
-# # Plot the polynomial coefficients versus echelle angle order by order
-# debug_all=False
-# show_wv_grid=False
-# ncoeff_fit_order = 2
-# coeff_vs_order = np.zeros((norders, n_final + 1, ncoeff_fit_order+1))
-# ech_min, ech_max = ech_angle_file.min(), ech_angle_file.max()
-# ech_vec = ech_min + (ech_max-ech_min)*np.arange(100)/99
-# func = 'legendre'
-# debug_fits=False
-# for iord, this_order in enumerate(order_vec):
-#     if np.any(populated[iord, :]):
-#         nsolns = np.sum( populated[iord, :])
-#         this_ech = ech_angle[iord, populated[iord, :]]
-#         this_xd_angle = xd_angle[iord, populated[iord, :]]
-#         this_lambda_cen = lambda_cen[iord, populated[iord, :]]
-#         this_coeff = coeff[iord, populated[iord, :], :]
-#         for ic in range(n_final + 1):
-#             pypeitFit = fitting.robust_fit(this_ech, this_coeff[:, ic], ncoeff_fit_order, function=func,
-#                                            minx=ech_min, maxx=ech_max, maxiter=25,
-#                                            lower=3.0, upper=3.0, maxrej=2, sticky=True,use_mad=True, weights=None)
-#             coeff_vs_order[iord, ic, :] = pypeitFit.fitc
-#             if debug_fits:
-#                 this_fit = fitting.evaluate_fit(pypeitFit.fitc, func, ech_vec, minx=ech_min, maxx=ech_max)
-#                 plt.plot(ech_vec, this_fit, color='blue', label='fit')
-#                 fit_gpm = pypeitFit.bool_gpm
-#                 plt.plot(this_ech[fit_gpm], this_coeff[fit_gpm, ic], marker='o', markersize=7.0, mfc='black',
-#                          mec='black', fillstyle='full', linestyle='None', zorder=5, label='used by fit')
-#                 plt.plot(this_ech[np.logical_not(fit_gpm)], this_coeff[np.logical_not(fit_gpm), ic],
-#                          marker='s', markersize=9.0, mfc='red', mec='red',fillstyle='full', linestyle='None', zorder=7,label='rejected')
-#                 plt.legend()
-#                 plt.title(f'order={this_order}, cc_ii={ic}, nkept={np.sum(fit_gpm)}, nrej={np.sum(np.logical_not(fit_gpm))}')
-#                 plt.xlabel('ech_angle')
-#                 plt.ylabel('coeff')
-#                 plt.ylim(this_fit.min() - 0.05*np.abs(this_fit.min()), this_fit.max() + 0.05*np.abs(this_fit.max()))
-#                 plt.show()
-#         #for ii in range(n_final+1):
-#         #    plt.plot(this_xd_angle, this_coeff[:, ii], 'k.', label=f'order={iorder}, cc_ii={ii}')
-#         #    plt.legend()
-#         #    plt.xlabel('xd_angle')
-#         #    plt.ylabel('coeff')
-#         #    plt.show()
-
-
-# Plot lam vs dlam/lam for each order
-
-#for iord, this_order in enumerate(order_vec):
-for iord in np.arange(norders)[::-1]:
-    this_order = order_vec[iord]
-    if np.any(populated[iord, :]):
-        nsolns = np.sum(populated[iord, :])
-        this_ech = ech_angle[iord, populated[iord, :]]
-        this_xd_angle = xd_angle[iord, populated[iord, :]]
-        this_lambda_cen = lambda_cen[iord, populated[iord, :]]
-        this_wave = wave[iord, populated[iord, :], :]
-        this_arc = arcspec[iord, populated[iord, :], :]
-        #this_coeff = coeff[iord, populated[iord, :], :]
-
-        this_dwave = np.zeros_like(this_wave)
-        for ii, iwave in enumerate(this_wave):
-            this_dwave[ii, :] = wvutils.get_delta_wave(iwave, (iwave > 0.0))
-
-        # Now try a fit. TODO any wavelength grid will work here
-        med_dlam = np.median(this_dwave[this_wave > 1.0])
-        fit = robust_fit(this_wave.flatten(), this_dwave.flatten(), 3, maxiter=25, maxdev = 0.10*med_dlam, groupbadpix=True)
-        wave_grid_fit, wave_grid_fit_mid, dsamp = wvutils.get_wave_grid(this_wave.T,wave_method='log10')
-        dwave_fit = fit.eval(wave_grid_fit)
-        gpm = fit.bool_gpm.copy()
-        gpm.resize(this_wave.shape)
-
-        if show_wv_grid:
+def get_delta_wave_batch(waves, gpms, frac_spec_med_filter=0.03):
+    """
+    Compute the change in wavelength per pixel for a set of wavelength vectors at once.
+
+    This is the same as calling wvutils.get_delta_wave on every row, with the running median and the Gaussian
+    smoothing applied along the rows of the whole array.
+
+    Args:
+        waves (`numpy.ndarray`_):
+            Wavelengths, shape (nsolns, nspec).
+        gpms (`numpy.ndarray`_):
+            Good pixel masks of the wavelengths, shape (nsolns, nspec).
+        frac_spec_med_filter (:obj:`float`, optional):
+            Fraction of nspec used for the running median, see wvutils.get_delta_wave.
+
+    Returns:
+        `numpy.ndarray`_: Smooth change in wavelength per pixel, shape (nsolns, nspec).
+    """
+    nspec = waves.shape[1]
+    nspec_med_filter = 2*int(np.round(nspec*frac_spec_med_filter/2.0)) + 1
+    wave_diff = np.diff(waves, axis=1)
+    wave_diff = np.append(wave_diff, wave_diff[:, -1:], axis=1)
+    # Set the bad pixels of every row to the median of the good ones
+    wave_diff_med = np.nanmedian(np.where(gpms, wave_diff, np.nan), axis=1)
+    wave_diff = np.where(gpms, wave_diff, wave_diff_med[:, np.newaxis])
+    # Running median along the rows, padded and shifted as in utils.fast_running_median
+    window = int(np.fmax(np.fmin(nspec_med_filter, nspec - 1), 1))
+    wave_diff_pad = np.concatenate((wave_diff[:, window - 1::-1], wave_diff, wave_diff[:, -1:(-1 - window):-1]),
+                                   axis=1)
+    wave_diff_filt = np.roll(move_median(wave_diff_pad, window, axis=1), -window // 2 + 1, axis=1)[:, window:-window]
+    # Smooth with the normalized Gaussian kernel, extending the edges as convolution.convolve does
+    sig_res = np.fmax(nspec_med_filter/10.0, 3.0)
+    kernel = convolution.Gaussian1DKernel(sig_res).array
+    return ndimage.convolve1d(wave_diff_filt, kernel/kernel.sum(), axis=1, mode='nearest')
+
+
+def rebin_arcs(wave_grid, waves, arcs, gpms, ind_min, ind_max):
+    """
+    Flux conserving rebinning of a set of arcs onto windows of a common wavelength grid.
+
+    Every input pixel is treated as a constant level between its edges (halfway to its neighbours in log10
+    wavelength), and every output bin gets the average level of the good input pixels overlapping it. The cumulative
+    integrals of all the arcs are flattened into one vector, with the rows offset in log10 wavelength so that the vector
+    is sorted, which lets a single searchsorted locate every output bin edge of every arc.
+
+    Args:
+        wave_grid (`numpy.ndarray`_):
+            Bin edges of the common wavelength grid, shape (ngrid,).
+        waves (`numpy.ndarray`_):
+            Wavelengths of the arcs, shape (nsolns, nspec).
+        arcs (`numpy.ndarray`_):
+            Arcs, shape (nsolns, nspec).
+        gpms (`numpy.ndarray`_):
+            Good pixel masks of the arcs, shape (nsolns, nspec).
+        ind_min, ind_max (`numpy.ndarray`_):
+            The arc in row i is rebinned onto the bins with edges wave_grid[ind_min[i]:ind_max[i]], i.e.
+            ind_max[i] - ind_min[i] - 1 bins, shape (nsolns,).
+
+    Returns:
+        :obj:`tuple`: The rebinned arcs and their good pixel masks, both of shape (nsolns, nbin_max). Bin j of row i
+        covers wave_grid[ind_min[i] + j] to wave_grid[ind_min[i] + j + 1]. Bins that are not fully covered by the arc,
+        are less than half covered by good pixels, or are beyond the window of the row are masked.
+    """
+    nsolns, nspec = waves.shape
+    gpms = gpms & (waves > 0.0)
+    # Work in log10 wavelength, with wavelengths increasing along every row
+    flip = waves[:, -1] < waves[:, 0]
+    waves = np.where(flip[:, np.newaxis], waves[:, ::-1], waves)
+    arcs = np.where(flip[:, np.newaxis], arcs[:, ::-1], arcs)
+    gpms = np.where(flip[:, np.newaxis], gpms[:, ::-1], gpms)
+    loglam = np.log10(np.where(waves > 0.0, waves, 1.0))
+    pixvec = np.arange(nspec)
+    for irow in np.where(np.any(waves <= 0.0, axis=1))[0]:
+        good = waves[irow] > 0.0
+        loglam[irow] = np.interp(pixvec, pixvec[good], loglam[irow, good]) if np.any(good) else pixvec
+        gpms[irow] &= good
+
+    # Pixel edges, and the cumulative integrals of the arc and of the good pixels at the edges
+    loglam_edges = np.concatenate((1.5*loglam[:, :1] - 0.5*loglam[:, 1:2], 0.5*(loglam[:, 1:] + loglam[:, :-1]),
+                                   1.5*loglam[:, -1:] - 0.5*loglam[:, -2:-1]), axis=1)
+    dloglam = np.diff(loglam_edges, axis=1)
+    level_arc = np.zeros((nsolns, nspec + 1))
+    level_arc[:, :-1] = np.where(gpms, arcs, 0.0)
+    level_gpm = np.zeros((nsolns, nspec + 1))
+    level_gpm[:, :-1] = gpms
+    cumul_arc = np.zeros((nsolns, nspec + 1))
+    cumul_arc[:, 1:] = np.cumsum(level_arc[:, :-1]*dloglam, axis=1)
+    cumul_gpm = np.zeros((nsolns, nspec + 1))
+    cumul_gpm[:, 1:] = np.cumsum(level_gpm[:, :-1]*dloglam, axis=1)
+
+    # Output bin edges of every row, padded by repeating the last edge of the window
+    nbin = ind_max - ind_min - 1
+    nbin_max = nbin.max()
+    igrid = np.minimum(ind_min[:, np.newaxis] + np.arange(nbin_max + 1), ind_max[:, np.newaxis] - 1)
+    loglam_grid = np.log10(wave_grid)[igrid]
+
+    # Offset the rows so that the flattened edges are sorted
+    loglam_min = min(loglam_edges.min(), loglam_grid.min())
+    row_offset = (max(loglam_edges.max(), loglam_grid.max()) - loglam_min + 1.0)*np.arange(nsolns)[:, np.newaxis]
+    key_in = (loglam_edges - loglam_min + row_offset).ravel()
+    key_out = (loglam_grid - loglam_min + row_offset).ravel()
+    ipix = np.clip(np.searchsorted(key_in, key_out, side='right') - 1, 0, key_in.size - 1)
+    irow_pix, ispec_pix = np.divmod(ipix, nspec + 1)
+    irow_out = np.repeat(np.arange(nsolns), nbin_max + 1)
+    edge_in_arc = (irow_pix == irow_out) & ((ispec_pix < nspec) | (key_out == key_in[ipix]))
+    dkey = key_out - key_in[ipix]
+    edge_arc = (cumul_arc.ravel()[ipix] + dkey*level_arc.ravel()[ipix]).reshape(nsolns, nbin_max + 1)
+    edge_gpm = (cumul_gpm.ravel()[ipix] + dkey*level_gpm.ravel()[ipix]).reshape(nsolns, nbin_max + 1)
+    edge_in_arc = edge_in_arc.reshape(nsolns, nbin_max + 1)
+
+    bin_width = np.diff(loglam_grid, axis=1)
+    bin_arc = np.diff(edge_arc, axis=1)
+    bin_gpm = np.diff(edge_gpm, axis=1)
+    gpm_rebin = edge_in_arc[:, :-1] & edge_in_arc[:, 1:] & (bin_width > 0.0) & (bin_gpm >= 0.5*bin_width) \
+                & (np.arange(nbin_max) < nbin[:, np.newaxis])
+    arc_rebin = np.zeros((nsolns, nbin_max))
+    arc_rebin[gpm_rebin] = bin_arc[gpm_rebin]/bin_gpm[gpm_rebin]
+    return arc_rebin, gpm_rebin
+
+
+def stack_order_arcs(arc_rebin, gpm_rebin, iord, norders, sigrej=5.0, maxiters=5):
+    """
+    Stack the rebinned arcs of every order in one pass.
+
+    The arcs are arranged in a (norders, nsolns_max, nbin_max) masked cube. Every arc is scaled to the median arc of
+    its order by the ratio of the medians of the two over the good bins of the arc, like the 'median' scaling of
+    combspec, and the scaled arcs are sigma clipped and averaged along the solution axis.
+
+    Args:
+        arc_rebin (`numpy.ndarray`_):
+            Rebinned arcs, shape (nsolns, nbin_max), see rebin_arcs.
+        gpm_rebin (`numpy.ndarray`_):
+            Good pixel masks of the rebinned arcs, shape (nsolns, nbin_max).
+        iord (`numpy.ndarray`_):
+            Order index of every arc, shape (nsolns,).
+        norders (:obj:`int`):
+            Number of orders.
+        sigrej (:obj:`float`, optional):
+            Rejection threshold of the sigma clipping.
+        maxiters (:obj:`int`, optional):
+            Maximum number of sigma clipping iterations.
+
+    Returns:
+        :obj:`tuple`: The stacked arcs and their good pixel masks, both of shape (norders, nbin_max).
+    """
+    nsolns, nbin_max = arc_rebin.shape
+    nsolns_order = np.bincount(iord, minlength=norders)
+    # Position of every arc among the arcs of its order
+    isort = np.argsort(iord, kind='stable')
+    islot = np.empty(nsolns, dtype=int)
+    islot[isort] = np.arange(nsolns) - (np.cumsum(nsolns_order) - nsolns_order)[iord[isort]]
+
+    cube = np.zeros((norders, max(nsolns_order.max(), 1), nbin_max))
+    cube_gpm = np.zeros(cube.shape, dtype=bool)
+    cube[iord, islot] = arc_rebin
+    cube_gpm[iord, islot] = gpm_rebin
+    cube = np.ma.array(cube, mask=np.logical_not(cube_gpm))
+
+    ref = np.ma.median(cube, axis=1)
+    scale = np.ma.median(np.ma.array(np.broadcast_to(ref[:, np.newaxis, :], cube.shape), mask=cube.mask), axis=2) \
+            / np.ma.median(cube, axis=2)
+    scale = np.ma.filled(scale, 1.0)
+    scale[np.logical_not(np.isfinite(scale)) | (scale <= 0.0)] = 1.0
+    cube_clip = sigma_clip(cube*scale[:, :, np.newaxis], sigma=sigrej, maxiters=maxiters, axis=1, masked=True)
+    arc_stack = np.ma.mean(cube_clip, axis=1)
+    gpm_stack = np.logical_not(np.ma.getmaskarray(arc_stack))
+    return np.ma.filled(arc_stack, 0.0), gpm_stack
+
+
+def echelle_composite_arcspec_rebin(arxiv_file, outfile, sigrej=5.0, maxiters=5):
+    """
+    Build the composite arc of every order of the HIRES archive with a single rebinning pass.
+
+    This is a faster version of echelle_composite_arcspec, and writes a file with the same layout. The sampling of
+    every arc is computed with get_delta_wave_batch, all the arcs of all the orders are resampled at once onto their
+    windows of the common log10 wavelength grid with rebin_arcs, and the arcs of every order are stacked with
+    stack_order_arcs. The stacks of all the orders are also averaged onto the full grid, in hdus 5-7.
+
+    The flux conserving rebinning and the ratio of medians scaling and sigma clipping of stack_order_arcs differ from
+    the interpolation and the combspec scaling and rejection of echelle_composite_arcspec, so the composites are
+    close but not identical (see test_composite_arcspec.py). The archive is still built with
+    echelle_composite_arcspec.
+
+    Args:
+        arxiv_file (:obj:`str`):
+            File containing the archive.
+        outfile (:obj:`str`):
+            Output file.
+        sigrej (:obj:`float`, optional):
+            Rejection threshold used when stacking the arcs of every order.
+        maxiters (:obj:`int`, optional):
+            Maximum number of rejection iterations.
+    """
+    with HIRESArchive(arxiv_file) as archive:
+        arxiv_params = archive.params
+        norders = arxiv_params['norders']
+        order_vec = np.arange(arxiv_params['order_min'], arxiv_params['order_max'] + 1, 1)
+        waves, arcs, iord = [], [], []
+        for ii, this_order in enumerate(order_vec):
+            _, this_wave, this_arc = archive.order_spectra(this_order)
+            if this_wave.shape[0] == 0:
+                msgs.error(f'No arc solutions contribute to order={ii}. There must be a bug')
+            waves.append(this_wave)
+            arcs.append(this_arc)
+            iord.append(np.full(this_wave.shape[0], ii))
+    waves, arcs, iord = np.concatenate(waves), np.concatenate(arcs), np.concatenate(iord)
+    gpms = (waves > 0.0) & (arcs != 0.0)
+
+    # Wavelength coverage and sampling of each order
+    dwave = get_delta_wave_batch(waves, gpms)
+    dloglam_soln = (dwave/waves/np.log(10.0)).min(axis=1, where=(dwave != 0) & (waves > 0.0), initial=10)
+    dloglam_pix = np.array([np.median(dloglam_soln[iord == ii]) for ii in range(norders)])
+    wave_grid_min = np.full(norders, np.inf)
+    wave_grid_max = np.zeros(norders)
+    np.minimum.at(wave_grid_min, iord, waves.min(axis=1, where=waves > 0.0, initial=np.inf))
+    np.maximum.at(wave_grid_max, iord, waves.max(axis=1))
+
+    # Use the smallest value of dloglam across all orders for the spectral grid spacing
+    dloglam_pix_final = dloglam_pix.min()
+    dv_pix_final = np.log(10.0)*c_kms*dloglam_pix_final
+    wave_total_composite, _, _ = wvutils.wavegrid(wave_grid_min.min(), wave_grid_max.max(), dloglam_pix_final,
+                                                  log10=True)
+    ind_min = np.searchsorted(wave_total_composite, wave_grid_min, side='left')
+    ind_max = np.searchsorted(wave_total_composite, wave_grid_max, side='right') - 1
+
+    # Rebin all the arcs, and stack them order by order
+    arc_rebin, gpm_rebin = rebin_arcs(wave_total_composite, waves, arcs, gpms, ind_min[iord], ind_max[iord])
+    arc_stack, gpm_stack = stack_order_arcs(arc_rebin, gpm_rebin, iord, norders, sigrej=sigrej, maxiters=maxiters)
+
+    # Pad the stacks to the size of the largest order window, as in echelle_composite_arcspec
+    nspec_max = (ind_max - ind_min + 1).max()
+    arc_stack = np.pad(arc_stack, ((0, 0), (0, nspec_max - arc_stack.shape[1])))
+    gpm_stack = np.pad(gpm_stack, ((0, 0), (0, nspec_max - gpm_stack.shape[1])))
+
+    # Bin centers of every order
+    igrid = np.minimum(ind_min[:, np.newaxis] + np.arange(nspec_max), wave_total_composite.size - 2)
+    wave_stack = np.sqrt(wave_total_composite[igrid]*wave_total_composite[igrid + 1])
+    wave_stack[np.logical_not(gpm_stack)] = 0.0
+
+    # Average the stacks of all the orders on the full grid
+    ngrid = wave_total_composite.size - 1
+    wave_total_mid = np.sqrt(wave_total_composite[:-1]*wave_total_composite[1:])
+    arc_sum = np.bincount(igrid[gpm_stack], weights=arc_stack[gpm_stack], minlength=ngrid)
+    nused = np.bincount(igrid[gpm_stack], minlength=ngrid)
+    gpm_total = nused > 0
+    arc_total = np.zeros(ngrid)
+    arc_total[gpm_total] = arc_sum[gpm_total]/nused[gpm_total]
+
+    params = Table([[os.path.basename(arxiv_file)], [arxiv_params['order_min']], [arxiv_params['order_max']],
+                    [norders], [wave_stack[gpm_stack].min()], [wave_stack[gpm_stack].max()],
+                    [dloglam_pix_final], [dv_pix_final]],
+                   names=('arxiv_file', 'order_min', 'order_max', 'norders', 'wave_min', 'wave_max', 'dloglam', 'dv'))
+
+    hdulist = fits.HDUList()
+    hdulist.append(fits.BinTableHDU(params.as_array()))  # hdu = 1
+    hdulist.append(fits.ImageHDU(wave_stack.T))  # hdu = 2
+    hdulist.append(fits.ImageHDU(arc_stack.T))  # hdu = 3
+    hdulist.append(fits.ImageHDU(gpm_stack.T.astype(float)))  # hdu = 4
+    hdulist.append(fits.ImageHDU(wave_total_mid))  # hdu = 5
+    hdulist.append(fits.ImageHDU(arc_total))  # hdu = 6
+    hdulist.append(fits.ImageHDU(gpm_total.astype(float)))  # hdu = 7
+    hdulist.writeto(outfile, overwrite=True)
+
+
+
+if __name__ == '__main__':
+
+    xidl_arxiv_file = os.path.join(os.getenv('PYPEIT_DEV'), 'dev_algorithms', 'hires_wvcalib', 'hires_wvcalib_xidl.fits')
+    # Create the astropy table form of the xidl save file arxiv
+    if not os.path.isfile(xidl_arxiv_file):
+        ingest_xidl_archive(xidl_arxiv_file)
+    # append the pypeit templates to the xidl archive
+    arxiv_file = os.path.join(os.getenv('PYPEIT_DEV'), 'dev_algorithms', 'hires_wvcalib', 'hires_wvcalib.fits')
+    if not os.path.isfile(arxiv_file):
+        append_pypeit_archive(arxiv_file, xidl_arxiv_file)
+
+    # sys.exit(-1)
+    # Perform fits to the coefficients vs ech angle
+    # TODO see if pca works better here
+    debug=False
+    wvcalib_angle_fit_file = os.path.join(os.getenv('PYPEIT_DEV'), 'dev_algorithms', 'hires_wvcalib', 'wvcalib_angle_fits.fits')
+    if not os.path.isfile(wvcalib_angle_fit_file):
+        fit_wvcalib_vs_angles(arxiv_file, wvcalib_angle_fit_file, func='legendre',
+                          ech_nmax = 3, ech_coeff_fit_order_min=1, ech_coeff_fit_order_max=2,
+                          xd_reddest_fit_polyorder=2, sigrej=3.0, maxrej=1, debug=debug)
+
+    # Compute a composite arc from the solution arxiv
+    composite_arcfile = os.path.join(os.getenv('PYPEIT_DEV'), 'dev_algorithms', 'hires_wvcalib', 'HIRES_composite_arc.fits')
+    if not os.path.isfile(composite_arcfile):
+        echelle_composite_arcspec(arxiv_file, composite_arcfile, show_orders=debug)
+
+    sys.exit(-1)
+
+
+    use_unknowns = True
+    line_lists_all = waveio.load_line_lists(['ThAr'])
+    line_lists = line_lists_all[np.where(line_lists_all['ion'] != 'UNKNWN')]
+    unknwns = line_lists_all[np.where(line_lists_all['ion'] == 'UNKNWN')]
+    tot_line_list = table.vstack([line_lists, unknwns]) if use_unknowns else line_lists
+    spectrograph = load_spectrograph('keck_hires')
+    par = spectrograph.default_pypeit_par()['calibrations']['wavelengths']
+    n_final = 4
+    # xmin, xmax for wavelength vs pixel fits
+    fmin, fmax = 0.0, 1.0
+    color_tuple = ('green', 'cyan', 'magenta', 'blue', 'darkorange', 'yellow', 'dodgerblue', 'purple',
+                   'lightgreen', 'cornflowerblue')
+    colors = itertools.cycle(color_tuple)
+    #
+    #
+    # # Read template file
+    # templ_table_file = os.path.join(
+    #     resource_filename('pypeit', 'data'), 'arc_lines',
+    #     'hires', 'hires_templ_xidl.dat')
+    # tbl = Table.read(templ_table_file, format='ascii')
+    # nrows = len(tbl)
+    #
+    # order_min = tbl['IOrder'].min()
+    # order_max = 118
+    #
+    # order_vec = np.arange(order_min, order_max +1, 1)
+    # norders = order_vec.size
+    #
+    # # Subset of orders in every file. Populated indicates whether a given order is populated
+    # lambda_cen = np.zeros((norders, nrows))
+    # ech_angle = np.zeros((norders, nrows))
+    # populated = np.zeros((norders, nrows), dtype=bool)
+    # XDISP_is_red = np.zeros((norders, nrows), dtype=bool)
+    # binspec = np.zeros((norders, nrows), dtype=int)
+    # det = np.zeros((norders, nrows), dtype=int)
+    # xd_angle = np.zeros((norders, nrows))
+    # coeff = np.zeros((norders, nrows, n_final+1))
+    # bluest_order = np.zeros(nrows, dtype=int)
+    # xd_angle_file = np.zeros(nrows)
+    # ech_angle_file = np.zeros(nrows)
+    # det_file = np.zeros(nrows)
+    # XDISP_is_red_file = np.zeros(nrows, dtype=bool)
+    #
+    # for irow in np.arange(nrows):
+    #     this_order_vec_raw, this_wave, this_arc = templates.xidl_hires(
+    #         os.path.join(os.getenv('HIRES_CALIBS'), 'ARCS', tbl[irow]['Name']), specbin=tbl[irow]['Rbin'])
+    #     if irow == 0:
+    #         nspec = this_wave.shape[1]
+    #         xnspecmin1 = float(nspec - 1)
+    #         xvec = np.arange(nspec)/xnspecmin1
+    #         wave = np.zeros((norders, nrows, nspec))
+    #         arcspec = np.zeros((norders, nrows, nspec))
+    #         table_xidl = Table([np.zeros((nrows, norders), dtype="<U30"),
+    #                             np.zeros((nrows, norders)),
+    #                             np.zeros((nrows, norders)),
+    #                             np.zeros((nrows, norders), dtype=int),
+    #                             np.zeros((nrows,), dtype=int),
+    #                             np.zeros((nrows, norders), dtype="<U3"),
+    #                             np.zeros((nrows, norders), dtype=int),
+    #                             np.zeros((nrows, norders), dtype=int),
+    #                             np.zeros((nrows, norders), dtype=bool),
+    #                             np.zeros((nrows, norders, n_final+1)),
+    #                             np.zeros((nrows, norders, nspec)),
+    #                             np.zeros((nrows, norders, nspec)),],
+    #                             names = ('filename', 'ech_angle', 'xd_angle', 'order', 'bluest_order',
+    #                                      'xdisp', 'det', 'binspec', 'populated', 'coeff', 'wave', 'arcspec'))
+    #     else:
+    #         assert this_wave.shape[1] == nspec
+    #     # Restrict to what is labeled as good in the Table
+    #     igood = (this_order_vec_raw >= tbl[irow]['IOrder']) & (this_order_vec_raw <= tbl[irow]['EOrder'])
+    #     nsolns = np.sum(igood)
+    #     this_order_vec = this_order_vec_raw[igood]
+    #     indx = this_order_vec - order_min
+    #     populated[indx, irow] = True
+    #     ech_angle[indx, irow] = tbl[irow]['ECH']
+    #     xd_angle[indx, irow] = tbl[irow]['XDAng']
+    #     XDISP_is_red[indx, irow] = tbl[irow]['XDISP'] == 'RED'
+    #     binspec[indx, irow] =  tbl[irow]['Rbin']
+    #     det[indx, irow] =  tbl[irow]['Chip']
+    #
+    #     wave[indx, irow, :] = this_wave[igood, :]
+    #     arcspec[indx, irow, :] = this_arc[igood, :]
+    #     lambda_cen[indx, irow] = np.median(this_wave[igood, :], axis=1)
+    #     # Fit the wavelengths
+    #     coeff_array = np.zeros((nsolns, n_final +1))
+    #     for ii, iwave in enumerate(this_wave[igood, :]):
+    #         pypeitFit = fitting.robust_fit(xvec, iwave, n_final, function=par['func'], maxiter=10,
+    #                                        lower=1e10, upper=1e10, maxrej=0, sticky=True,
+    #                                        minx=fmin, maxx=fmax, weights=None)
+    #         coeff_array[ii, :] = pypeitFit.fitc
+    #     coeff[indx, irow, :] = coeff_array
+    #     # file specific
+    #     bluest_order[irow] = this_order_vec[-1]
+    #     ech_angle_file[irow] = tbl[irow]['ECH']
+    #     xd_angle_file[irow] = tbl[irow]['XDAng']
+    #     det_file[irow] = tbl[irow]['Chip']
+    #     XDISP_is_red_file[irow] = tbl[irow]['XDISP'] == 'RED'
+
+    #all_dlam = []
+    #all_lam = []
+    #all_orders = []
+
+
+    pad_factor = 0.10
+    # xvec_pad = np.arange(-int(np.round(pad_factor*nspec)), int(np.round((1.0 + pad_factor)*nspec)))/xnspecmin1
+    #
+    # # Plot the polynomial coefficients versus echelle angle order by order
+    # debug_all=False
+    # show_wv_grid=False
+    # ncoeff_fit_order = 2
+    # coeff_vs_order = np.zeros((norders, n_final + 1, ncoeff_fit_order+1))
+    # ech_min, ech_max = ech_angle_file.min(), ech_angle_file.max()
+    # ech_vec = ech_min + (ech_max-ech_min)*np.arange(100)/99
+    # func = 'legendre'
+    # debug_fits=False
+    # for iord, this_order in enumerate(order_vec):
+    #     if np.any(populated[iord, :]):
+    #         nsolns = np.sum( populated[iord, :])
+    #         this_ech = ech_angle[iord, populated[iord, :]]
+    #         this_xd_angle = xd_angle[iord, populated[iord, :]]
+    #         this_lambda_cen = lambda_cen[iord, populated[iord, :]]
+    #         this_coeff = coeff[iord, populated[iord, :], :]
+    #         for ic in range(n_final + 1):
+    #             pypeitFit = fitting.robust_fit(this_ech, this_coeff[:, ic], ncoeff_fit_order, function=func,
+    #                                            minx=ech_min, maxx=ech_max, maxiter=25,
+    #                                            lower=3.0, upper=3.0, maxrej=2, sticky=True,use_mad=True, weights=None)
+    #             coeff_vs_order[iord, ic, :] = pypeitFit.fitc
+    #             if debug_fits:
+    #                 this_fit = fitting.evaluate_fit(pypeitFit.fitc, func, ech_vec, minx=ech_min, maxx=ech_max)
+    #                 plt.plot(ech_vec, this_fit, color='blue', label='fit')
+    #                 fit_gpm = pypeitFit.bool_gpm
+    #                 plt.plot(this_ech[fit_gpm], this_coeff[fit_gpm, ic], marker='o', markersize=7.0, mfc='black',
+    #                          mec='black', fillstyle='full', linestyle='None', zorder=5, label='used by fit')
+    #                 plt.plot(this_ech[np.logical_not(fit_gpm)], this_coeff[np.logical_not(fit_gpm), ic],
+    #                          marker='s', markersize=9.0, mfc='red', mec='red',fillstyle='full', linestyle='None', zorder=7,label='rejected')
+    #                 plt.legend()
+    #                 plt.title(f'order={this_order}, cc_ii={ic}, nkept={np.sum(fit_gpm)}, nrej={np.sum(np.logical_not(fit_gpm))}')
+    #                 plt.xlabel('ech_angle')
+    #                 plt.ylabel('coeff')
+    #                 plt.ylim(this_fit.min() - 0.05*np.abs(this_fit.min()), this_fit.max() + 0.05*np.abs(this_fit.max()))
+    #                 plt.show()
+    #         #for ii in range(n_final+1):
+    #         #    plt.plot(this_xd_angle, this_coeff[:, ii], 'k.', label=f'order={iorder}, cc_ii={ii}')
+    #         #    plt.legend()
+    #         #    plt.xlabel('xd_angle')
+    #         #    plt.ylabel('coeff')
+    #         #    plt.show()
+
+
+    # Plot lam vs dlam/lam for each order
+
+    #for iord, this_order in enumerate(order_vec):
+    for iord in np.arange(norders)[::-1]:
+        this_order = order_vec[iord]
+        if np.any(populated[iord, :]):
+            nsolns = np.sum(populated[iord, :])
+            this_ech = ech_angle[iord, populated[iord, :]]
+            this_xd_angle = xd_angle[iord, populated[iord, :]]
+            this_lambda_cen = lambda_cen[iord, populated[iord, :]]
+            this_wave = wave[iord, populated[iord, :], :]
+            this_arc = arcspec[iord, populated[iord, :], :]
+            #this_coeff = coeff[iord, populated[iord, :], :]
+
+            this_dwave = np.zeros_like(this_wave)
             for ii, iwave in enumerate(this_wave):
-                this_color=next(colors)
-                this_gpm = gpm[ii, :]
-                plt.plot(iwave[this_gpm], this_dwave[ii, this_gpm], marker='o', markersize=1.0, mfc=this_color,
-                fillstyle='full',  linestyle='None', zorder=1)
-                plt.plot(iwave[np.logical_not(this_gpm)], this_dwave[ii, np.logical_not(this_gpm)], marker='o',
-                     markersize=2.0, mfc='red', fillstyle='full', zorder=3, linestyle='None')
-
-            plt.plot(wave_grid_fit, dwave_fit, color='black', label='fit', zorder=10)
-            plt.title(f'order={this_order}', fontsize=14)
-            plt.legend()
-            plt.show()
+                this_dwave[ii, :] = wvutils.get_delta_wave(iwave, (iwave > 0.0))
+
+            # Now try a fit. TODO any wavelength grid will work here
+            med_dlam = np.median(this_dwave[this_wave > 1.0])
+            fit = robust_fit(this_wave.flatten(), this_dwave.flatten(), 3, maxiter=25, maxdev = 0.10*med_dlam, groupbadpix=True)
+            wave_grid_fit, wave_grid_fit_mid, dsamp = wvutils.get_wave_grid(this_wave.T,wave_method='log10')
+            dwave_fit = fit.eval(wave_grid_fit)
+            gpm = fit.bool_gpm.copy()
+            gpm.resize(this_wave.shape)
 
-        lam_min, lam_max = this_wave[gpm].min(), this_wave[gpm].max()
-        wave_grid = get_variable_dlam_wavegrid(lam_min, lam_max, wave_grid_fit, dwave_fit)
-        nspec_tmpl = wave_grid.shape[0]
-        # TESTING
-        #dwave_chk = wvutils.get_delta_wave(wave_grid, (wave_grid > 0.0))
-        #plt.plot(wave_grid, dwave_chk, color='red', label='our new grid')
-        #plt.plot(wave_grid_fit, dwave_fit, color='black', label='fit')
-        #plt.title('dwave compared to our fit')
-        #plt.legend()
-        #plt.show()
-        tmpl_iord = np.zeros((nsolns, nspec_tmpl))
-        gpm_tmpl = np.zeros((nsolns, nspec_tmpl), dtype=bool)
-        # Interpolate our arcs onto the new grid
-        for ii, iwave in enumerate(this_wave):
-            in_gpm = this_arc[ii, :] != 0.0
-            tmpl_iord[ii, :] = interpolate.interp1d(iwave[in_gpm], this_arc[ii, in_gpm], kind='cubic', bounds_error=False, fill_value=-1e10)(wave_grid)
-            gpm_tmpl[ii, :] = tmpl_iord[ii, :] > -1e9
             if show_wv_grid:
-                #plt.plot(iwave[in_gpm], this_arc[ii, in_gpm], color=next(colors), alpha=0.7)
-                plt.plot(wave_grid[gpm_tmpl[ii, :]], tmpl_iord[ii, gpm_tmpl[ii, :]], color=next(colors), alpha=0.7)
+                for ii, iwave in enumerate(this_wave):
+                    this_color=next(colors)
+                    this_gpm = gpm[ii, :]
+                    plt.plot(iwave[this_gpm], this_dwave[ii, this_gpm], marker='o', markersize=1.0, mfc=this_color,
+                    fillstyle='full',  linestyle='None', zorder=1)
+                    plt.plot(iwave[np.logical_not(this_gpm)], this_dwave[ii, np.logical_not(this_gpm)], marker='o',
+                         markersize=2.0, mfc='red', fillstyle='full', zorder=3, linestyle='None')
+
+                plt.plot(wave_grid_fit, dwave_fit, color='black', label='fit', zorder=10)
+                plt.title(f'order={this_order}', fontsize=14)
+                plt.legend()
                 plt.show()
 
-        sn_smooth_npix = 1 # Should not matter since we use uniform weights
-        wave_grid_in = np.repeat(wave_grid[:, np.newaxis], nsolns, axis=1)
-        ivar_tmpl_iord = utils.inverse(np.abs(tmpl_iord) + 10.0)
-        wave_grid_mid, wave_grid_stack, arcspec_tmpl, _, arcspec_tmpl_gpm = coadd.combspec(
-            wave_grid_in, tmpl_iord.T, ivar_tmpl_iord.T, gpm_tmpl.T, sn_smooth_npix,
-            wave_method='iref',  ref_percentile=70.0, maxiter_scale=5, sigrej_scale=3.0, scale_method='median',
-            sn_min_polyscale=2.0, sn_min_medscale=0.5, const_weights=True, maxiter_reject=5, sn_clip=30.0, lower=5.0, upper=5.0,
-            debug=debug_all, debug_scale=debug_all, show_scale=debug_all, show=True, verbose=True)
-
-        all_patt_dict = {}
-        detections = {}
-        wv_calib = {}
-
-        all_patt_dict_pad = {}
-        detections_pad = {}
-        wv_calib_pad = {}
-
-        for slit in range(nsolns):
-            print('Working on soln={:d}'.format(slit))
-            # Trim the template to the relevant range. Hack this for now
-            #itmpl = (wave_grid_mid >= 0.999*iwave.min()) & (wave_grid_mid <= 1.001*iwave.max())
-            coeff_predict = np.zeros(n_final + 1)
-            for ic in range(n_final+1):
-                coeff_predict[ic] = fitting.evaluate_fit(coeff_vs_order[iord, ic, :], func, this_ech[slit], minx=ech_min, maxx=ech_max)
-
-            wave_predict = fitting.evaluate_fit(coeff_predict, par['func'], xvec, minx=fmin, maxx=fmax)
-            wave_predict_pad = fitting.evaluate_fit(coeff_predict, par['func'], xvec_pad, minx=fmin, maxx=fmax)
-            wave_true = this_wave[slit, :]
-            # Substitute wave_true here as a test
-            arcspec_templ_predict_pad =  interpolate.interp1d(wave_grid_stack[arcspec_tmpl_gpm], arcspec_tmpl[arcspec_tmpl_gpm],
-                                                          kind='cubic', bounds_error=False, fill_value=0.0)(wave_predict_pad)
-            arcspec_templ_predict =  interpolate.interp1d(wave_grid_stack[arcspec_tmpl_gpm], arcspec_tmpl[arcspec_tmpl_gpm],
-                                                          kind='cubic', bounds_error=False, fill_value=0.0)(wave_predict)
-            #arcspec_tmpl_trim = arcspec_tmpl[itmpl]
-            #wave_grid_mid_trim = wave_grid_mid[itmpl]
-            #arc_in_pad = np.zeros_like(arcspec_tmpl_trim)
-            #in_gpm = this_arc[slit, :] != 0.0
-            #npix = np.sum(in_gpm)
-            #arc_in_pad[:npix] = this_arc[slit, in_gpm]
-            #xcorr_poly(this_wave[slit, in_gpm], this_arc[slit, in_gpm], wave_grid_mid, arcspec_tmpl, smooth=1.0, percent_ceil=50.0, use_raw_arc=False,
-            #           sigdetect=10.0, fwhm=4.0, debug=True, seed=42)
-
-            # WITH PADDING
-            #arc_pad = np.zeros_like(xvec_pad)
-            #arc_pad[0:nspec] = this_arc[slit, :]
-            #detections_pad[str(slit)], spec_cont_sub_pad, all_patt_dict_pad[str(slit)] = autoid.reidentify(
-            #    arc_pad, arcspec_templ_predict_pad, wave_predict_pad,  tot_line_list, par['nreid_min'],
-            #    cc_thresh=par['cc_thresh'], match_toler=par['match_toler'], cc_local_thresh=par['cc_local_thresh'],
-            #    nlocal_cc=par['nlocal_cc'], nonlinear_counts=1e10,
-            #    sigdetect=par['sigdetect'], fwhm=par['fwhm'], debug_peaks=True, debug_xcorr=True, debug_reid=True)
-
-            # WITHOUT PADDING
-            detections[str(slit)], spec_cont_sub, all_patt_dict[str(slit)] = autoid.reidentify(
-                this_arc[slit, :], arcspec_templ_predict, wave_predict,  tot_line_list, par['nreid_min'],
-                cc_thresh=par['cc_thresh'], match_toler=par['match_toler'], cc_local_thresh=par['cc_local_thresh'],
-                nlocal_cc=par['nlocal_cc'], nonlinear_counts=1e10,
-                sigdetect=par['sigdetect'], fwhm=par['fwhm'], debug_peaks=True, debug_xcorr=True, debug_reid=True)
-
-            # Check if an acceptable reidentification solution was found
-            if not all_patt_dict[str(slit)]['acceptable']:
-                wv_calib[str(slit)] = None
-                continue
-
-            final_fit = wv_fitting.fit_slit(spec_cont_sub, all_patt_dict[str(slit)], detections[str(slit)],
-                                            tot_line_list, match_toler=par['match_toler'],func=par['func'], n_first=par['n_first'],
-                                            sigrej_first=par['sigrej_first'], n_final=n_final,sigrej_final=par['sigrej_final'])
-
-            #autoid.arc_fit_qa(final_fit, title='Silt: {}'.format(str(slit)))
-
-
-#        dlam = []
-#        lam = []
-#        for iwave in this_wave:
-#            dlam += list(wvutils.get_delta_wave(iwave, np.ones_like(iwave,dtype=bool)))
-#            lam += iwave.tolist()
-#            #xlam += ((np.array(iwave) - np.array(iwave).min())/(np.array(iwave).max() - np.array(iwave).min())).tolist()
-#        plt.plot(lam, 3.0e5*np.array(dlam)/np.array(lam), '.', label=f'order={iorder}')
-#        plt.legend()
-#        plt.show()
-
- #       all_dlam += dlam
- #       all_lam += lam
- #       all_orders += [iorder]*len(lam)
-
-
-#plt.plot(all_lam, 3.0e5*np.array(all_dlam)/np.array(all_lam), '.')
-#plt.legend()
-#plt.show()
-
-# Plot the central wavelength vs echelle angle order by order
-for iord, iorder in enumerate(order_vec):
-    if np.any(populated[iord, :]):
-        this_ech = ech_angle[iord, populated[iord, :]]
-        this_xd_angle = xd_angle[iord, populated[iord, :]]
-        this_lambda_cen = lambda_cen[iord, populated[iord, :]]
-        plt.plot(this_ech, this_lambda_cen, 'k.', label=f'order={iorder}')
-        plt.legend()
-        plt.show()
-
-
-for xdisp in ['UV', 'RED']:
-    for idet in [1,2,3]:
-        iord = (XDISP_is_red_file == (xdisp == 'RED')) & (det_file == idet)
-        plt.plot(xd_angle_file[iord], bluest_order[iord], 'k.', label=f'XDISP={xdisp}, det={idet}')
-        plt.legend()
-        plt.show()
+            lam_min, lam_max = this_wave[gpm].min(), this_wave[gpm].max()
+            wave_grid = get_variable_dlam_wavegrid(lam_min, lam_max, wave_grid_fit, dwave_fit)
+            nspec_tmpl = wave_grid.shape[0]
+            # TESTING
+            #dwave_chk = wvutils.get_delta_wave(wave_grid, (wave_grid > 0.0))
+            #plt.plot(wave_grid, dwave_chk, color='red', label='our new grid')
+            #plt.plot(wave_grid_fit, dwave_fit, color='black', label='fit')
+            #plt.title('dwave compared to our fit')
+            #plt.legend()
+            #plt.show()
+            tmpl_iord = np.zeros((nsolns, nspec_tmpl))
+            gpm_tmpl = np.zeros((nsolns, nspec_tmpl), dtype=bool)
+            # Interpolate our arcs onto the new grid
+            for ii, iwave in enumerate(this_wave):
+                in_gpm = this_arc[ii, :] != 0.0
+                tmpl_iord[ii, :] = interpolate.interp1d(iwave[in_gpm], this_arc[ii, in_gpm], kind='cubic', bounds_error=False, fill_value=-1e10)(wave_grid)
+                gpm_tmpl[ii, :] = tmpl_iord[ii, :] > -1e9
+                if show_wv_grid:
+                    #plt.plot(iwave[in_gpm], this_arc[ii, in_gpm], color=next(colors), alpha=0.7)
+                    plt.plot(wave_grid[gpm_tmpl[ii, :]], tmpl_iord[ii, gpm_tmpl[ii, :]], color=next(colors), alpha=0.7)
+                    plt.show()
+
+            sn_smooth_npix = 1 # Should not matter since we use uniform weights
+            wave_grid_in = np.repeat(wave_grid[:, np.newaxis], nsolns, axis=1)
+            ivar_tmpl_iord = utils.inverse(np.abs(tmpl_iord) + 10.0)
+            wave_grid_mid, wave_grid_stack, arcspec_tmpl, _, arcspec_tmpl_gpm = coadd.combspec(
+                wave_grid_in, tmpl_iord.T, ivar_tmpl_iord.T, gpm_tmpl.T, sn_smooth_npix,
+                wave_method='iref',  ref_percentile=70.0, maxiter_scale=5, sigrej_scale=3.0, scale_method='median',
+                sn_min_polyscale=2.0, sn_min_medscale=0.5, const_weights=True, maxiter_reject=5, sn_clip=30.0, lower=5.0, upper=5.0,
+                debug=debug_all, debug_scale=debug_all, show_scale=debug_all, show=True, verbose=True)
+
+            all_patt_dict = {}
+            detections = {}
+            wv_calib = {}
+
+            all_patt_dict_pad = {}
+            detections_pad = {}
+            wv_calib_pad = {}
+
+            for slit in range(nsolns):
+                print('Working on soln={:d}'.format(slit))
+                # Trim the template to the relevant range. Hack this for now
+                #itmpl = (wave_grid_mid >= 0.999*iwave.min()) & (wave_grid_mid <= 1.001*iwave.max())
+                coeff_predict = np.zeros(n_final + 1)
+                for ic in range(n_final+1):
+                    coeff_predict[ic] = fitting.evaluate_fit(coeff_vs_order[iord, ic, :], func, this_ech[slit], minx=ech_min, maxx=ech_max)
+
+                wave_predict = fitting.evaluate_fit(coeff_predict, par['func'], xvec, minx=fmin, maxx=fmax)
+                wave_predict_pad = fitting.evaluate_fit(coeff_predict, par['func'], xvec_pad, minx=fmin, maxx=fmax)
+                wave_true = this_wave[slit, :]
+                # Substitute wave_true here as a test
+                arcspec_templ_predict_pad =  interpolate.interp1d(wave_grid_stack[arcspec_tmpl_gpm], arcspec_tmpl[arcspec_tmpl_gpm],
+                                                              kind='cubic', bounds_error=False, fill_value=0.0)(wave_predict_pad)
+                arcspec_templ_predict =  interpolate.interp1d(wave_grid_stack[arcspec_tmpl_gpm], arcspec_tmpl[arcspec_tmpl_gpm],
+                                                              kind='cubic', bounds_error=False, fill_value=0.0)(wave_predict)
+                #arcspec_tmpl_trim = arcspec_tmpl[itmpl]
+                #wave_grid_mid_trim = wave_grid_mid[itmpl]
+                #arc_in_pad = np.zeros_like(arcspec_tmpl_trim)
+                #in_gpm = this_arc[slit, :] != 0.0
+                #npix = np.sum(in_gpm)
+                #arc_in_pad[:npix] = this_arc[slit, in_gpm]
+                #xcorr_poly(this_wave[slit, in_gpm], this_arc[slit, in_gpm], wave_grid_mid, arcspec_tmpl, smooth=1.0, percent_ceil=50.0, use_raw_arc=False,
+                #           sigdetect=10.0, fwhm=4.0, debug=True, seed=42)
+
+                # WITH PADDING
+                #arc_pad = np.zeros_like(xvec_pad)
+                #arc_pad[0:nspec] = this_arc[slit, :]
+                #detections_pad[str(slit)], spec_cont_sub_pad, all_patt_dict_pad[str(slit)] = autoid.reidentify(
+                #    arc_pad, arcspec_templ_predict_pad, wave_predict_pad,  tot_line_list, par['nreid_min'],
+                #    cc_thresh=par['cc_thresh'], match_toler=par['match_toler'], cc_local_thresh=par['cc_local_thresh'],
+                #    nlocal_cc=par['nlocal_cc'], nonlinear_counts=1e10,
+                #    sigdetect=par['sigdetect'], fwhm=par['fwhm'], debug_peaks=True, debug_xcorr=True, debug_reid=True)
+
+                # WITHOUT PADDING
+                detections[str(slit)], spec_cont_sub, all_patt_dict[str(slit)] = autoid.reidentify(
+                    this_arc[slit, :], arcspec_templ_predict, wave_predict,  tot_line_list, par['nreid_min'],
+                    cc_thresh=par['cc_thresh'], match_toler=par['match_toler'], cc_local_thresh=par['cc_local_thresh'],
+                    nlocal_cc=par['nlocal_cc'], nonlinear_counts=1e10,
+                    sigdetect=par['sigdetect'], fwhm=par['fwhm'], debug_peaks=True, debug_xcorr=True, debug_reid=True)
+
+                # Check if an acceptable reidentification solution was found
+                if not all_patt_dict[str(slit)]['acceptable']:
+                    wv_calib[str(slit)] = None
+                    continue
+
+                final_fit = wv_fitting.fit_slit(spec_cont_sub, all_patt_dict[str(slit)], detections[str(slit)],
+                                                tot_line_list, match_toler=par['match_toler'],func=par['func'], n_first=par['n_first'],
+                                                sigrej_first=par['sigrej_first'], n_final=n_final,sigrej_final=par['sigrej_final'])
+
+                #autoid.arc_fit_qa(final_fit, title='Silt: {}'.format(str(slit)))
+
+
+    #        dlam = []
+    #        lam = []
+    #        for iwave in this_wave:
+    #            dlam += list(wvutils.get_delta_wave(iwave, np.ones_like(iwave,dtype=bool)))
+    #            lam += iwave.tolist()
+    #            #xlam += ((np.array(iwave) - np.array(iwave).min())/(np.array(iwave).max() - np.array(iwave).min())).tolist()
+    #        plt.plot(lam, 3.0e5*np.array(dlam)/np.array(lam), '.', label=f'order={iorder}')
+    #        plt.legend()
+    #        plt.show()
+
+     #       all_dlam += dlam
+     #       all_lam += lam
+     #       all_orders += [iorder]*len(lam)
+
+
+    #plt.plot(all_lam, 3.0e5*np.array(all_dlam)/np.array(all_lam), '.')
+    #plt.legend()
+    #plt.show()
+
+    # Plot the central wavelength vs echelle angle order by order
+    for iord, iorder in enumerate(order_vec):
+        if np.any(populated[iord, :]):
+            this_ech = ech_angle[iord, populated[iord, :]]
+            this_xd_angle = xd_angle[iord, populated[iord, :]]
+            this_lambda_cen = lambda_cen[iord, populated[iord, :]]
+            plt.plot(this_ech, this_lambda_cen, 'k.', label=f'order={iorder}')
+            plt.legend()
+            plt.show()
+
+
+    for xdisp in ['UV', 'RED']:
+        for idet in [1,2,3]:
+            iord = (XDISP_is_red_file == (xdisp == 'RED')) & (det_file == idet)
+            plt.plot(xd_angle_file[iord], bluest_order[iord], 'k.', label=f'XDISP={xdisp}, det={idet}')
+            plt.legend()
+            plt.show()
 
 
 
@@ -0,0 +1,225 @@
+"""
+Check the vectorised composite arc builder of ingest_archive against the per-solution implementation.
+
+Run with::
+
+    pytest pypeitdev/hires_wvcalib/test_composite_arcspec.py
+"""
+import numpy as np
+from scipy import interpolate
+from astropy.io import fits
+from astropy.table import Table
+
+from pypeit.core.wavecal import wvutils
+
+from pypeitdev.hires_wvcalib import ingest_archive
+
+
+def fake_archive(outfile, orders=(40, 41, 42), nsolns=5, nspec=1024, seed=1):
+    """
+    Write a small HIRES archive with ThAr-like arcs whose lines sit at the same wavelengths in every solution.
+    """
+    rng = np.random.default_rng(seed)
+    norders = len(orders)
+    lines = np.sort(rng.uniform(4500., 7000., 600))
+    line_ampl = rng.uniform(100., 3000., lines.size)
+    params = Table([[orders[0]], [orders[-1]], [norders], [4], ['legendre'], [0.0], [1.0], [nspec]],
+                   names=('order_min', 'order_max', 'norders', 'n_final', 'func', 'xmin', 'xmax', 'nspec'))
+    arxiv = ingest_archive.empty_design_table(nsolns, norders, n_final=4)
+    order_spectra = {}
+    xvec = np.arange(nspec)/(nspec - 1)
+    for irow in range(nsolns):
+        for iord, order in enumerate(orders):
+            wave_min = 2.5e5/order + rng.normal(0.0, 2.0)
+            wave = wave_min + 90.0*xvec + rng.normal(0.0, 0.3)*xvec**2
+            near = np.abs(lines - wave_min - 45.0) < 60.0
+            arc = 5.0 + rng.normal(0.0, 1.0, nspec) + rng.uniform(0.5, 2.0)*np.sum(
+                line_ampl[near]*np.exp(-0.5*((wave[:, np.newaxis] - lines[near])/0.11)**2), axis=1)
+            arc[:3] = 0.0
+            arxiv['order'][irow, iord] = order
+            arxiv['populated'][irow, iord] = True
+            arxiv['populated_and_good'][irow, iord] = True
+            ingest_archive.add_order_spectra(order_spectra, irow, [order], wave[np.newaxis, :], arc[np.newaxis, :])
+    ingest_archive.write_hires_archive(outfile, params, arxiv, order_spectra)
+
+
+def rebin_one(wave_grid, wave, arc, gpm):
+    """
+    Reference flux conserving rebinning of one arc onto all the bins of wave_grid.
+    """
+    loglam = np.log10(wave)
+    edges = np.concatenate(([1.5*loglam[0] - 0.5*loglam[1]], 0.5*(loglam[1:] + loglam[:-1]),
+                            [1.5*loglam[-1] - 0.5*loglam[-2]]))
+    cumul_arc = np.append(0.0, np.cumsum(np.where(gpm, arc, 0.0)*np.diff(edges)))
+    cumul_gpm = np.append(0.0, np.cumsum(gpm*np.diff(edges)))
+    loglam_grid = np.log10(wave_grid)
+    bin_arc = np.diff(np.interp(loglam_grid, edges, cumul_arc))
+    bin_gpm = np.diff(np.interp(loglam_grid, edges, cumul_gpm))
+    inside = (loglam_grid[:-1] >= edges[0]) & (loglam_grid[1:] <= edges[-1])
+    gpm_bin = inside & (bin_gpm >= 0.5*np.diff(loglam_grid))
+    return np.where(gpm_bin, bin_arc/np.where(gpm_bin, bin_gpm, 1.0), 0.0), gpm_bin
+
+
+def order_arcs(arxiv_file, order):
+    with ingest_archive.HIRESArchive(arxiv_file) as archive:
+        _, waves, arcs = archive.order_spectra(order)
+    return waves, arcs, (waves > 0.0) & (arcs != 0.0)
+
+
+def test_delta_wave_batch(tmp_path):
+    arxiv_file = str(tmp_path / 'arxiv.fits')
+    fake_archive(arxiv_file)
+    waves, arcs, gpms = order_arcs(arxiv_file, 41)
+    dwave = ingest_archive.get_delta_wave_batch(waves, gpms)
+    for wave, gpm, this_dwave in zip(waves, gpms, dwave):
+        assert np.allclose(this_dwave, wvutils.get_delta_wave(wave, gpm), rtol=1e-12, atol=0.0)
+
+
+def test_rebin_arcs(tmp_path):
+    arxiv_file = str(tmp_path / 'arxiv.fits')
+    fake_archive(arxiv_file)
+    waves, arcs, gpms = order_arcs(arxiv_file, 41)
+    wave_grid, _, _ = wvutils.wavegrid(waves.min() - 1.0, waves.max() + 1.0, 5e-6, log10=True)
+    # Give every arc a different window of the grid, and flip one of them
+    ind_min = np.searchsorted(wave_grid, waves.min(axis=1)) + np.arange(waves.shape[0])
+    ind_max = np.searchsorted(wave_grid, waves.max(axis=1)) - np.arange(waves.shape[0])
+    waves[1], arcs[1], gpms[1] = waves[1, ::-1], arcs[1, ::-1], gpms[1, ::-1]
+
+    arc_rebin, gpm_rebin = ingest_archive.rebin_arcs(wave_grid, waves, arcs, gpms, ind_min, ind_max)
+    for irow in range(waves.shape[0]):
+        isort = np.argsort(waves[irow])
+        this_grid = wave_grid[ind_min[irow]:ind_max[irow]]
+        arc_ref, gpm_ref = rebin_one(this_grid, waves[irow, isort], arcs[irow, isort], gpms[irow, isort])
+        nbin = this_grid.size - 1
+        assert np.array_equal(gpm_rebin[irow, :nbin], gpm_ref)
+        assert not np.any(gpm_rebin[irow, nbin:])
+        assert np.allclose(arc_rebin[irow, :nbin], arc_ref, rtol=1e-8, atol=1e-8)
+
+
+def test_rebin_arcs_native_grid(tmp_path):
+    arxiv_file = str(tmp_path / 'arxiv.fits')
+    fake_archive(arxiv_file)
+    waves, arcs, gpms = order_arcs(arxiv_file, 40)
+    # Rebinning onto the pixel edges of the arc itself gives back the arc
+    loglam = np.log10(waves[0])
+    wave_grid = np.power(10.0, 0.5*(loglam[1:] + loglam[:-1]))
+    arc_rebin, gpm_rebin = ingest_archive.rebin_arcs(wave_grid, waves[:1], arcs[:1], gpms[:1],
+                                                    np.array([0]), np.array([wave_grid.size]))
+    assert np.array_equal(gpm_rebin[0], gpms[0, 1:-1])
+    assert np.allclose(arc_rebin[0][gpm_rebin[0]], arcs[0, 1:-1][gpm_rebin[0]], rtol=1e-8)
+
+
+def test_rebin_arcs_interpolation(tmp_path):
+    arxiv_file = str(tmp_path / 'arxiv.fits')
+    fake_archive(arxiv_file)
+    waves, arcs, gpms = order_arcs(arxiv_file, 42)
+    dloglam = np.median(np.diff(np.log10(waves), axis=1))
+    wave_grid, _, _ = wvutils.wavegrid(waves.min(), waves.max(), dloglam, log10=True)
+    nsolns = waves.shape[0]
+    arc_rebin, gpm_rebin = ingest_archive.rebin_arcs(wave_grid, waves, arcs, gpms, np.zeros(nsolns, dtype=int),
+                                                    np.full(nsolns, wave_grid.size))
+    # The rebinned arcs follow the cubic interpolation used by echelle_composite_arcspec at the bin centers
+    wave_mid = np.sqrt(wave_grid[1:]*wave_grid[:-1])
+    for wave, arc, gpm, this_arc, this_gpm in zip(waves, arcs, gpms, arc_rebin, gpm_rebin):
+        arc_interp = interpolate.interp1d(wave[gpm], arc[gpm], kind='cubic', bounds_error=False,
+                                          fill_value=-1e10)(wave_mid)
+        use = this_gpm & (arc_interp > -1e9)
+        assert np.corrcoef(this_arc[use], arc_interp[use])[0, 1] > 0.99
+
+
+def test_composite_matches_current(tmp_path):
+    """
+    Compare the composite with the one of echelle_composite_arcspec.
+
+    The two builders resample the arcs differently (flux conserving rebinning and cubic interpolation), so the
+    composites are only required to be strongly correlated and close. See test_composite_linear_arcs for a comparison
+    with the true arc.
+    """
+    arxiv_file = str(tmp_path / 'arxiv.fits')
+    fake_archive(arxiv_file)
+    ingest_archive.echelle_composite_arcspec(arxiv_file, str(tmp_path / 'composite_loop.fits'))
+    ingest_archive.echelle_composite_arcspec_rebin(arxiv_file, str(tmp_path / 'composite_rebin.fits'))
+
+    with fits.open(tmp_path / 'composite_loop.fits') as hdul_loop, \
+            fits.open(tmp_path / 'composite_rebin.fits') as hdul_rebin:
+        params_loop, params_rebin = hdul_loop[1].data, hdul_rebin[1].data
+        for key in ['order_min', 'order_max', 'norders', 'dloglam', 'dv']:
+            assert np.allclose(params_loop[key], params_rebin[key], rtol=1e-12)
+        assert hdul_loop[2].data.shape == hdul_rebin[2].data.shape
+        for iord in range(params_loop['norders'][0]):
+            gpm_loop = hdul_loop[4].data[:, iord] > 0.0
+            gpm_rebin = hdul_rebin[4].data[:, iord] > 0.0
+            assert np.sum(gpm_loop & gpm_rebin) > 0.95*np.sum(gpm_loop)
+            both = gpm_loop & gpm_rebin
+            assert np.allclose(hdul_loop[2].data[both, iord], hdul_rebin[2].data[both, iord], rtol=1e-10)
+            # echelle_composite_arcspec samples the arcs at the left edges of the bins and labels them with the bin
+            # centers, so compare the two composites at the left edges
+            wave_rebin = hdul_rebin[2].data[gpm_rebin, iord]
+            arc_rebin = hdul_rebin[3].data[gpm_rebin, iord]
+            wave_left = hdul_loop[2].data[gpm_loop, iord]/np.power(10.0, params_loop['dloglam'][0]/2.0)
+            arc_loop = hdul_loop[3].data[gpm_loop, iord]
+            use = (wave_left > wave_rebin[0]) & (wave_left < wave_rebin[-1])
+            arc_rebin_left = np.interp(wave_left[use], wave_rebin, arc_rebin)
+            assert np.corrcoef(arc_loop[use], arc_rebin_left)[0, 1] > 0.95
+            assert np.median(np.abs(arc_loop[use] - arc_rebin_left)) < 0.1*np.median(np.abs(arc_loop[use]))
+
+
+def test_composite_linear_arcs(tmp_path):
+    """
+    Compare the two builders with the true arc, for arcs that are linear in log10 wavelength.
+
+    The flux conserving rebinning of echelle_composite_arcspec_rebin intentionally differs from the cubic
+    interpolation of echelle_composite_arcspec, so the two composites are not expected to agree exactly, see
+    test_composite_matches_current. On these arcs the scaling and rejection of the stacks do nothing and the rebinned
+    composite follows the true arc at its bin centers, whereas echelle_composite_arcspec is offset from it by half a
+    bin to one bin, because its arcs are not sampled at the wavelengths they are labelled with. The check allows 1.1
+    bins.
+    """
+    orders, nsolns, nspec = (40, 41, 42), 4, 1024
+    params = Table([[orders[0]], [orders[-1]], [len(orders)], [4], ['legendre'], [0.0], [1.0], [nspec]],
+                   names=('order_min', 'order_max', 'norders', 'n_final', 'func', 'xmin', 'xmax', 'nspec'))
+    arxiv = ingest_archive.empty_design_table(nsolns, len(orders), n_final=4)
+    order_spectra = {}
+    xvec = np.arange(nspec)/(nspec - 1)
+    true_arc = lambda wave: 1000.0 + 2e4*(np.log10(wave) - 3.75)
+    for iord, order in enumerate(orders):
+        wave = 2.5e5/order + 90.0*xvec + 3.0*xvec**2
+        for irow in range(nsolns):
+            arxiv['order'][irow, iord] = order
+            arxiv['populated'][irow, iord] = True
+            arxiv['populated_and_good'][irow, iord] = True
+            ingest_archive.add_order_spectra(order_spectra, irow, [order], wave[np.newaxis, :],
+                                             true_arc(wave)[np.newaxis, :])
+    arxiv_file = str(tmp_path / 'arxiv.fits')
+    ingest_archive.write_hires_archive(arxiv_file, params, arxiv, order_spectra)
+    ingest_archive.echelle_composite_arcspec(arxiv_file, str(tmp_path / 'composite_loop.fits'))
+    ingest_archive.echelle_composite_arcspec_rebin(arxiv_file, str(tmp_path / 'composite_rebin.fits'))
+
+    with fits.open(tmp_path / 'composite_loop.fits') as hdul_loop, \
+            fits.open(tmp_path / 'composite_rebin.fits') as hdul_rebin:
+        dloglam = hdul_loop[1].data['dloglam'][0]
+        for iord in range(len(orders)):
+            gpm_rebin = hdul_rebin[4].data[:, iord] > 0.0
+            wave_rebin = hdul_rebin[2].data[gpm_rebin, iord]
+            assert np.allclose(hdul_rebin[3].data[gpm_rebin, iord], true_arc(wave_rebin), rtol=1e-5, atol=0.0)
+            gpm_loop = hdul_loop[4].data[:, iord] > 0.0
+            wave_loop = hdul_loop[2].data[gpm_loop, iord]
+            one_bin = true_arc(wave_loop*np.power(10.0, dloglam)) - true_arc(wave_loop)
+            assert np.all(np.abs(hdul_loop[3].data[gpm_loop, iord] - true_arc(wave_loop)) < 1.1*one_bin)
+
+
+def test_fit_wave_orders():
+    # The batched fit matches robust_fit without rejection, as used by ingest_xidl_archive and append_pypeit_archive
+    rng = np.random.default_rng(5)
+    nspec = 2048
+    xvec = np.arange(nspec)/(nspec - 1)
+    waves = 4000.0 + rng.uniform(0.0, 3000.0, (6, 1))*(1.0 + 0.1*xvec + rng.normal(0.0, 0.01, (6, 1))*xvec**2) \
+            + rng.normal(0.0, 0.01, (6, nspec))
+    waves[2, 10] = np.nan
+    for func in ['legendre', 'chebyshev', 'polynomial']:
+        coeff = ingest_archive.fit_wave_orders(xvec, waves, 4, func=func)
+        for iwave, wave in enumerate(waves):
+            pypeitFit = ingest_archive.fitting.robust_fit(xvec, wave, 4, function=func, maxiter=10, lower=1e10,
+                                                          upper=1e10, maxrej=0, sticky=True, minx=0.0, maxx=1.0,
+                                                          weights=None)
+            assert np.allclose(coeff[iwave], pypeitFit.fitc, rtol=1e-8, atol=1e-6, equal_nan=True)
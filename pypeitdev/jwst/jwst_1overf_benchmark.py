@@ -0,0 +1,111 @@
+"""
+Benchmark the masked array and the vectorised 1/f noise models of jwst_1overf_unfold.
+
+For every rate file the row (4 amplifiers) and column (1 amplifier) models used by fnoise_sub are built with both
+get_rowamp_model and get_rowamp_model_fast, and the time of each and the largest difference between the two models are
+reported. If no rate files are given, synthetic 2048x2048 frames with 1/f stripes and masked pixels are used.
+
+Example::
+
+    python jwst_1overf_benchmark.py --files '/path/to/rate/*_rate.fits'
+"""
+import glob
+import time
+import argparse
+
+import numpy as np
+from astropy.io import fits
+
+from pypeitdev.jwst.jwst_1overf_unfold import get_rowamp_model, get_rowamp_model_fast
+
+
+def fake_rate(nframe, seed=1234):
+    """
+    Synthetic rate images with 1/f stripes, even/odd column offsets, hot pixels and masked pixels.
+    """
+    rng = np.random.default_rng(seed)
+    frames = []
+    for iframe in range(nframe):
+        data = rng.normal(0.0, 1.0, (2048, 2048)) + rng.normal(0.0, 0.5, (2048, 4)).repeat(512, axis=1) \
+               + np.tile([0.3, -0.2], 1024)
+        data[rng.random(data.shape) < 0.005] = 50.0
+        data[rng.random(data.shape) < 0.1] = 0.0
+        data[100:110, :700] = 0.0
+        frames.append(('fake_{0}'.format(iframe), data))
+    return frames
+
+
+def read_rate(files):
+    """
+    Read the science images of the rate files, in the orientation used by jwst_run_1overf.
+    """
+    frames = []
+    for rate_file in files:
+        with fits.open(rate_file) as hdul:
+            frames.append((rate_file, np.array(hdul['SCI'].data.T, dtype=float)))
+    return frames
+
+
+def benchmark(data, namp=4, evenOdd=True):
+    """
+    Time the row and column 1/f models of both implementations on one image.
+
+    Returns
+    -------
+    time_ma : float
+        Wall-clock time of get_rowamp_model in seconds.
+    time_fast : float
+        Wall-clock time of get_rowamp_model_fast in seconds.
+    max_diff : float
+        Largest absolute difference between the two models.
+    """
+    gpm = np.isfinite(data) & (data != 0)
+    data_masked = np.ma.array(data, mask=np.logical_not(gpm))
+    data_masked.fill_value = np.nan
+    data_nan = data_masked.filled()
+
+    t0 = time.perf_counter()
+    model_ma = get_rowamp_model(data_masked, namp, evenOdd=evenOdd)
+    model_ma[np.isnan(model_ma)] = 0.
+    model_ma_col = get_rowamp_model(data_masked.T - model_ma.T, 1, evenOdd=evenOdd)
+    time_ma = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    model_fast = get_rowamp_model_fast(data_nan, namp, evenOdd=evenOdd)
+    model_fast[np.isnan(model_fast)] = 0.
+    model_fast_col = get_rowamp_model_fast(data_nan.T - model_fast.T, 1, evenOdd=evenOdd)
+    time_fast = time.perf_counter() - t0
+
+    max_diff = max(np.nanmax(np.abs(model_ma - model_fast)), np.nanmax(np.abs(model_ma_col - model_fast_col)))
+    return time_ma, time_fast, max_diff
+
+
+def parse_args(options=None):
+    parser = argparse.ArgumentParser(description='Benchmark the masked array and vectorised 1/f noise models')
+    parser.add_argument('--files', type=str, nargs='+', default=None,
+                        help='Rate files or glob patterns. Synthetic frames are used if not given.')
+    parser.add_argument('--nfake', type=int, default=3, help='Number of synthetic frames')
+    parser.add_argument('--namp', type=int, default=4, help='Number of amplifiers of the row model')
+    parser.add_argument('--no_evenOdd', default=False, action='store_true', help='Skip the even/odd correction')
+    return parser.parse_args(options)
+
+
+def main(args):
+    if args.files is None:
+        frames = fake_rate(args.nfake)
+    else:
+        frames = read_rate(sorted(f for pattern in args.files for f in glob.glob(pattern)))
+
+    print('{0:>40} {1:>12} {2:>12} {3:>8} {4:>10}'.format('file', 'np.ma [s]', 'fast [s]', 'speedup', 'max diff'))
+    total_ma, total_fast = 0., 0.
+    for name, data in frames:
+        time_ma, time_fast, max_diff = benchmark(data, namp=args.namp, evenOdd=not args.no_evenOdd)
+        total_ma += time_ma
+        total_fast += time_fast
+        print('{0:>40} {1:>12.2f} {2:>12.2f} {3:>8.1f} {4:>10.2e}'.format(name[-40:], time_ma, time_fast,
+                                                                         time_ma/time_fast, max_diff))
+    print('{0:>40} {1:>12.2f} {2:>12.2f} {3:>8.1f}'.format('total', total_ma, total_fast, total_ma/total_fast))
+
+
+if __name__ == '__main__':
+    main(parse_args())
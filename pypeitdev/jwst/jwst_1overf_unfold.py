@@ -1,8 +1,10 @@
 # modified from https://github.com/JWST-EREBUS/unfold_jwst/blob/master/unfold_jwst/background.py
 
 import os, time, sys
-import copy
+import json
+import hashlib
 import warnings
+from collections import OrderedDict
 import scipy
 import numpy as np
 from scipy import ndimage
@@ -12,6 +14,7 @@ from pypeit import msgs
 import pypeit.utils as utils
 from pypeit.display import display
 import multiprocessing
+from pypeitdev.fileio import atomic_write
 
 import astropy
 from astropy.time import Time
@@ -36,7 +39,8 @@ warnings.simplefilter('ignore', category=AstropyWarning)
 def fnoise_sub(data, bpm=None, error=None, namp=4, minimum_pixels=10, rej_nsigma=3, maxiters=5,
                brightstar_nsigma=2, npixels=4, fwhm=3, back_type='sextractor', back_rms_type='biweight',
                back_size=(51, 51), back_filter_size=(3, 3), back_rej_nsigma=3, back_maxiters=5,
-               sub_bkg=True, mask_brightstar=True, evenOdd=True, skip_col=False, skip_row=False, inst='NIRCam', show=False):
+               sub_bkg=True, mask_brightstar=True, evenOdd=True, skip_col=False, skip_row=False, inst='NIRCam', show=False,
+               fast=True, bkg_cache=False, bkg_cache_dir=None):
     """
     Subtract amplifier noise (i.e., the so called 1/f noise caused by readout) row-by-row
     This function was modified by Feige Wang and Jinyi Yang based on rowamp_sub.py in tshirt package (https://github.com/eas342/tshirt)
@@ -134,6 +138,19 @@ def fnoise_sub(data, bpm=None, error=None, namp=4, minimum_pixels=10, rej_nsigma
     inst: str
         Instrument name. If inst!='NIRCam', only namp=1 is supported.
 
+    fast: bool
+        Use the vectorised get_rowamp_model_fast to build the row and column models. It gives the same results as
+        get_rowamp_model. The masked array implementation is always used if show=True.
+
+    bkg_cache: bool
+        Keep the object mask and background in memory and reuse them in a later call with the same data, masks and
+        background parameters, see get_objmask_bkg_cached. Only the row and column models are then recomputed, e.g.
+        when tuning their parameters. Off by default, since every cached exposure holds ~70MB.
+
+    bkg_cache_dir: str or None
+        Directory where the object masks and backgrounds are also cached on disk, so that they are reused by other
+        processes and runs.
+
     Returns
     -------
     outimg: numpy array with the same shape of data
@@ -150,13 +167,15 @@ def fnoise_sub(data, bpm=None, error=None, namp=4, minimum_pixels=10, rej_nsigma
 
     ## Estimate a smooth background and make a bright star mask
     if sub_bkg or mask_brightstar:
-        objmask, background_array, _ = get_objmask_bkg(data, bpm=np.invert(gpm), error=error,
-                                                       brightstar_nsigma=brightstar_nsigma,
-                                                       npixels=npixels, fwhm=fwhm, back_type=back_type,
-                                                       back_rms_type=back_rms_type,
-                                                       back_size=back_size, back_filter_size=back_filter_size,
-                                                       back_rej_nsigma=back_rej_nsigma,
-                                                       back_maxiters=back_maxiters)
+        bkg_kwargs = dict(bpm=np.invert(gpm), error=error, brightstar_nsigma=brightstar_nsigma,
+                          npixels=npixels, fwhm=fwhm, back_type=back_type, back_rms_type=back_rms_type,
+                          back_size=back_size, back_filter_size=back_filter_size,
+                          back_rej_nsigma=back_rej_nsigma, back_maxiters=back_maxiters)
+        if bkg_cache or bkg_cache_dir is not None:
+            objmask, background_array, _ = get_objmask_bkg_cached(data, cache_dir=bkg_cache_dir,
+                                                                  memory_cache=bkg_cache, **bkg_kwargs)
+        else:
+            objmask, background_array, _ = get_objmask_bkg(data, **bkg_kwargs)
         if mask_brightstar:
             gpm &= np.invert(objmask)
         if sub_bkg:
@@ -167,6 +186,9 @@ def fnoise_sub(data, bpm=None, error=None, namp=4, minimum_pixels=10, rej_nsigma
         data_masked = np.ma.masked_where(np.invert(gpm), data)
 
     data_masked.fill_value = np.nan
+    if fast and not show:
+        # The vectorised models work on plain arrays with the masked pixels set to NaN
+        data_masked = data_masked.filled()
 
     if skip_row:
         modelimg = np.zeros_like(data)
@@ -175,8 +197,12 @@ def fnoise_sub(data, bpm=None, error=None, namp=4, minimum_pixels=10, rej_nsigma
     else:
 
         ## Get the model image
-        modelimg = get_rowamp_model(data_masked, namp, minimum_pixels=minimum_pixels,
-                                    rej_nsigma=rej_nsigma, maxiters=maxiters, evenOdd=evenOdd, inst=inst, show=show)
+        if fast and not show:
+            modelimg = get_rowamp_model_fast(data_masked, namp, minimum_pixels=minimum_pixels,
+                                             rej_nsigma=rej_nsigma, maxiters=maxiters, evenOdd=evenOdd, inst=inst)
+        else:
+            modelimg = get_rowamp_model(data_masked, namp, minimum_pixels=minimum_pixels,
+                                        rej_nsigma=rej_nsigma, maxiters=maxiters, evenOdd=evenOdd, inst=inst, show=show)
 
         modelimg[np.isnan(modelimg)] = 0.
         ## do the subtraction
@@ -185,8 +211,12 @@ def fnoise_sub(data, bpm=None, error=None, namp=4, minimum_pixels=10, rej_nsigma
     ## Also subtract stripe along column?
     # I set namp = 1 for the column stripe the readout is along row but not column.
     if not skip_col:
-        modelimg_col = get_rowamp_model(data_masked.T - modelimg.T, 1, minimum_pixels=minimum_pixels,
-                                        rej_nsigma=rej_nsigma, maxiters=maxiters, evenOdd=evenOdd, inst=inst, show=show, skipcol_show=show)
+        if fast and not show:
+            modelimg_col = get_rowamp_model_fast(data_masked.T - modelimg.T, 1, minimum_pixels=minimum_pixels,
+                                                 rej_nsigma=rej_nsigma, maxiters=maxiters, evenOdd=evenOdd, inst=inst)
+        else:
+            modelimg_col = get_rowamp_model(data_masked.T - modelimg.T, 1, minimum_pixels=minimum_pixels,
+                                            rej_nsigma=rej_nsigma, maxiters=maxiters, evenOdd=evenOdd, inst=inst, show=show, skipcol_show=show)
         outimg -= modelimg_col.T
         modelimg += modelimg_col.T
 
@@ -226,18 +256,16 @@ def get_objmask_bkg(data, bpm=None, error=None, brightstar_nsigma=2, npixels=4,
     kernel = Gaussian2DKernel(sigma, x_size=3, y_size=3)
     kernel.normalize()
 
-    this_data = copy.deepcopy(data)
-    if error is not None:
-        this_error = copy.deepcopy(error)
-    else:
-        this_error = None
+    # The inputs are never modified in place, so they do not need to be copied
+    this_data = data
+    this_error = error
 
     if bpm is None:
         this_bpm_bkg = np.zeros_like(data, dtype='bool')
     else:
-        this_bpm_bkg = copy.deepcopy(bpm)
+        this_bpm_bkg = bpm
 
-    gpm = np.invert(copy.deepcopy(this_bpm_bkg))
+    gpm = np.invert(this_bpm_bkg)
 
     ## Estimate background and objmask with two iterations
     objmask, background_array = np.zeros_like(data, dtype='bool'), np.zeros_like(data)
@@ -263,21 +291,21 @@ def get_objmask_bkg(data, bpm=None, error=None, brightstar_nsigma=2, npixels=4,
 
         # Do the detection using Image Segmentation
         # The return is a Segmentation image
-        msgs.info('Making bright star mask with iter={:}'.format(niter+1))
+        msgs.info('Making bright star mask with iter={:}'.format(iiter+1))
         segm = detect_sources(convolved_data, threshold, npixels=npixels)
 
         # grow mask for bright stars
         bright_blob = ndimage.binary_erosion(segm.data > 0., iterations=11)
         mask_bright_blob = ndimage.binary_dilation(bright_blob, iterations=50)
         objmask = np.logical_or(mask_bright_blob, (segm.data > 0.))
-        this_bpm_bkg &= objmask
+        this_bpm_bkg = this_bpm_bkg & objmask
         # replace bright star values with background values
-        this_data[objmask] = background_array[objmask]
+        this_data = np.where(objmask, background_array, this_data).astype(data.dtype, copy=False)
 
         if error is None:
             this_error = background_rms
         else:
-            this_error = copy.deepcopy(error)
+            this_error = error
         iiter += 1
 
     if qa is not None or show:
@@ -311,6 +339,99 @@ def get_objmask_bkg(data, bpm=None, error=None, brightstar_nsigma=2, npixels=4,
     return objmask, background_array, this_error
 
 
+## In-memory cache of get_objmask_bkg_cached, with the most recently used entries last. Each entry of a 2048x2048
+## image takes ~70MB. The least recently used entries are dropped when the cache exceeds OBJMASK_BKG_CACHE_BYTES.
+_objmask_bkg_cache = OrderedDict()
+OBJMASK_BKG_CACHE_BYTES = 256*1024**2
+
+
+def objmask_bkg_key(data, bpm=None, error=None, **kwargs):
+    """
+    Key identifying the inputs of get_objmask_bkg
+
+    Parameters
+    ----------
+    data, bpm, error: numpy array or None
+        The inputs of get_objmask_bkg. Their contents are hashed, so the key identifies the exposure.
+
+    kwargs:
+        The background and bright star parameters of get_objmask_bkg.
+
+    Returns
+    -------
+    key: str
+        SHA1 hash of the inputs and parameters
+    """
+    sha1 = hashlib.sha1(json.dumps(kwargs, sort_keys=True).encode())
+    for arr in (data, bpm, error):
+        if arr is None:
+            sha1.update(b'None')
+        else:
+            arr = np.ascontiguousarray(arr)
+            sha1.update('{:}{:}'.format(arr.dtype.str, arr.shape).encode())
+            sha1.update(arr)
+    return sha1.hexdigest()
+
+
+def get_objmask_bkg_cached(data, bpm=None, error=None, brightstar_nsigma=2, npixels=4, fwhm=3, back_type='sextractor',
+                           back_rms_type='biweight', back_size=(51, 51), back_filter_size=(3, 3), back_rej_nsigma=3,
+                           back_maxiters=5, cache_dir=None, memory_cache=True):
+    """
+    Cached version of get_objmask_bkg
+
+    The Background2D estimates and the source detection are by far the most expensive part of fnoise_sub, but they
+    only depend on the data, masks and background parameters. The results are kept in memory for the most recently
+    used inputs, up to OBJMASK_BKG_CACHE_BYTES, and, if cache_dir is given, also on disk so that they are reused
+    across processes and runs.
+
+    Parameters
+    ----------
+    See get_objmask_bkg for the other parameters.
+
+    cache_dir: str or None
+        Directory of the on-disk cache.
+
+    memory_cache: bool
+        Use the in-memory cache. If False, only the on-disk cache is used.
+
+    Returns
+    -------
+    objmask, background_array, error
+        Same as get_objmask_bkg. The arrays are shared with the cache, so they are read-only.
+    """
+    kwargs = dict(brightstar_nsigma=brightstar_nsigma, npixels=npixels, fwhm=fwhm, back_type=back_type,
+                  back_rms_type=back_rms_type, back_size=back_size, back_filter_size=back_filter_size,
+                  back_rej_nsigma=back_rej_nsigma, back_maxiters=back_maxiters)
+    key = objmask_bkg_key(data, bpm=bpm, error=error, **kwargs)
+    if memory_cache and key in _objmask_bkg_cache:
+        _objmask_bkg_cache.move_to_end(key)
+        return _objmask_bkg_cache[key]
+
+    cache_file = None if cache_dir is None else os.path.join(cache_dir, 'objmask_bkg_{:}.npz'.format(key[:20]))
+    if cache_file is not None and os.path.isfile(cache_file):
+        msgs.info('Reading object mask and background from {:}'.format(cache_file))
+        with np.load(cache_file) as npz:
+            result = npz['objmask'], npz['background'], npz['error']
+    else:
+        result = get_objmask_bkg(data, bpm=bpm, error=error, **kwargs)
+        if cache_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            with atomic_write(cache_file) as tmp_file:
+                np.savez(tmp_file, objmask=result[0], background=result[1], error=result[2])
+
+    # Read-only views, so that neither the cache nor the input error array can be modified through them
+    result = tuple(arr.view() for arr in result)
+    for arr in result:
+        arr.flags.writeable = False
+    if memory_cache:
+        _objmask_bkg_cache[key] = result
+        # Always keep the latest entry, even if it is larger than the limit
+        while len(_objmask_bkg_cache) > 1 \
+                and sum(arr.nbytes for entry in _objmask_bkg_cache.values() for arr in entry) > OBJMASK_BKG_CACHE_BYTES:
+            _objmask_bkg_cache.popitem(last=False)
+    return result
+
+
 def get_rowamp_model(data_masked, namp, minimum_pixels=10, rej_nsigma=3, maxiters=5, evenOdd=True, inst='NIRCam', show=False, skipcol_show=False):
     """
     Get a 1/f noise model
@@ -432,6 +553,246 @@ def get_rowamp_model(data_masked, namp, minimum_pixels=10, rej_nsigma=3, maxiter
 
     return modelimg
 
+
+def sorted_take(sorted_data, index):
+    """
+    Take one element of each 1D slice along the last axis, clipping the indices to the valid range.
+    """
+    return np.take_along_axis(sorted_data, np.clip(index, 0, sorted_data.shape[-1] - 1), axis=-1)
+
+
+def sorted_count(sorted_data, value, stop, inclusive=False):
+    """
+    Number of elements smaller than (or equal to, if inclusive) value in the first stop elements of each 1D slice of
+    an array sorted along its last axis. Found with a binary search of all the slices at once.
+    """
+    lo, hi = np.zeros_like(stop), stop.copy()
+    while np.any(lo < hi):
+        active = lo < hi
+        mid = (lo + hi) // 2
+        below = sorted_take(sorted_data, mid) <= value if inclusive else sorted_take(sorted_data, mid) < value
+        lo = np.where(active & below, mid + 1, lo)
+        hi = np.where(active & np.logical_not(below), mid, hi)
+    return lo
+
+
+def sorted_window_median(sorted_data, start, stop):
+    """
+    Median of a range of each 1D slice of an array sorted along its last axis.
+
+    Parameters
+    ----------
+    sorted_data: numpy array
+        The data, sorted along the last axis.
+
+    start, stop: numpy array
+        First and one past the last index of the range of each slice, with the shape of sorted_data but length one
+        along the last axis.
+
+    Returns
+    -------
+    median: numpy array
+        The median of each range, with length one along the last axis. Empty ranges give NaN.
+    """
+    ngood = stop - start
+    lower = sorted_take(sorted_data, start + (ngood - 1) // 2)
+    upper = sorted_take(sorted_data, start + ngood // 2)
+    return np.where(ngood > 0, (lower + upper) / 2, np.nan)
+
+
+def sorted_window_mad(sorted_data, start, stop, cen):
+    """
+    Median absolute deviation from cen of a range of each 1D slice of an array sorted along its last axis.
+
+    The deviations of the elements below and above cen are two sorted sequences, so the k-th smallest deviation is found
+    with a binary search of the number of elements it takes from the lower sequence, without sorting the deviations.
+
+    Parameters
+    ----------
+    sorted_data: numpy array
+        The data, sorted along the last axis.
+
+    start, stop: numpy array
+        First and one past the last index of the range of each slice, with the shape of sorted_data but length one
+        along the last axis.
+
+    cen: numpy array
+        The center of each range, with length one along the last axis.
+
+    Returns
+    -------
+    mad: numpy array
+        The median absolute deviation of each range, with length one along the last axis. Empty ranges give NaN.
+    """
+    ngood = stop - start
+    split = np.clip(sorted_count(sorted_data, cen, stop), start, stop)
+    nlow, nhigh = split - start, stop - split
+
+    def kth_absdev(k):
+        # Number of deviations taken from below cen, i, and from above cen, k + 1 - i
+        lo, hi = np.maximum(0, k + 1 - nhigh), np.minimum(k + 1, nlow)
+        while np.any(lo < hi):
+            active = lo < hi
+            i = (lo + hi) // 2
+            take_high = (cen - sorted_take(sorted_data, split - 1 - i)) >= (sorted_take(sorted_data, split + k - i) - cen)
+            lo = np.where(active & np.logical_not(take_high), i + 1, lo)
+            hi = np.where(active & take_high, i, hi)
+        absdev_low = np.where(lo > 0, cen - sorted_take(sorted_data, split - lo), -np.inf)
+        absdev_high = np.where(k + 1 - lo > 0, sorted_take(sorted_data, split + k - lo) - cen, -np.inf)
+        return np.maximum(absdev_low, absdev_high)
+
+    mad = (kth_absdev((ngood - 1) // 2) + kth_absdev(ngood // 2)) / 2
+    return np.where(ngood > 0, mad, np.nan)
+
+
+def nan_sigma_clipped_median(data, rej_nsigma=3, maxiters=5, stdfunc='std', reclip=False):
+    """
+    Sigma-clipped median along the last axis of an array in which the masked pixels are NaN.
+
+    This is a vectorised equivalent of the median returned by astropy sigma_clipped_stats with cenfunc='median',
+    computed independently for every 1D slice along the last axis. The data are sorted once, with the NaNs at the
+    end, so that the pixels that survive the clipping are always a contiguous range of each sorted slice. Every
+    iteration then only needs binary searches of the sorted slices and, for the standard deviation, cumulative sums.
+
+    Parameters
+    ----------
+    data: numpy array
+        The data. Masked pixels must be NaN.
+
+    rej_nsigma: int or float
+        The number of standard deviations to use for clipping limit.
+
+    maxiters: int
+        The maximum number of sigma-clipping iterations.
+
+    stdfunc: str
+        'std' or 'mad_std'
+
+    reclip: bool
+        How the clipped pixels are determined. If False, pixels clipped in any iteration stay clipped, as astropy does
+        when sigma_clipped_stats is called with axis=None. If True, the final set of clipped pixels is found by
+        clipping the input data with the bounds of the last iteration, as astropy does when an axis is specified.
+
+    Returns
+    -------
+    median: numpy array
+        The sigma-clipped median of each 1D slice, with the shape of data without its last axis.
+    """
+    sorted_data = np.sort(np.asarray(data, dtype=float), axis=-1)
+    nfinite = np.sum(np.isfinite(sorted_data), axis=-1, keepdims=True)
+    start, stop = np.zeros_like(nfinite), nfinite
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if stdfunc != 'mad_std':
+            # Cumulative sums of the data relative to their median, to get the sums over any range. NaNs are at the
+            # end of the slices, so they never enter the sums over the ranges of good pixels.
+            resid = sorted_data - sorted_window_median(sorted_data, start, stop)
+            zero = np.zeros_like(nfinite, dtype=float)
+            cumsum = np.concatenate([zero, np.cumsum(resid, axis=-1)], axis=-1)
+            cumsum2 = np.concatenate([zero, np.cumsum(resid**2, axis=-1)], axis=-1)
+        for iiter in range(maxiters):
+            cen = sorted_window_median(sorted_data, start, stop)
+            if stdfunc == 'mad_std':
+                std = 1.482602218505602 * sorted_window_mad(sorted_data, start, stop, cen)
+            else:
+                ngood = stop - start
+                mean = (np.take_along_axis(cumsum, stop, axis=-1) - np.take_along_axis(cumsum, start, axis=-1)) / ngood
+                meansq = (np.take_along_axis(cumsum2, stop, axis=-1) - np.take_along_axis(cumsum2, start, axis=-1)) / ngood
+                std = np.sqrt(np.maximum(meansq - mean**2, 0.))
+            lower, upper = cen - rej_nsigma * std, cen + rej_nsigma * std
+            # Comparisons with NaN are False, so empty slices stay empty
+            new_start = np.maximum(start, sorted_count(sorted_data, lower, nfinite))
+            new_stop = np.maximum(new_start, np.minimum(stop, sorted_count(sorted_data, upper, nfinite, inclusive=True)))
+            # Slices that have converged are not changed by further iterations
+            if np.array_equal(new_start, start) and np.array_equal(new_stop, stop):
+                break
+            start, stop = new_start, new_stop
+        if reclip:
+            start = sorted_count(sorted_data, lower, nfinite)
+            stop = np.maximum(start, sorted_count(sorted_data, upper, nfinite, inclusive=True))
+    return sorted_window_median(sorted_data, start, stop)[..., 0]
+
+
+def get_rowamp_model_fast(data, namp, minimum_pixels=10, rej_nsigma=3, maxiters=5, evenOdd=True, inst='NIRCam'):
+    """
+    Get a 1/f noise model
+
+    Vectorised version of get_rowamp_model that gives the same model. Instead of looping over the amplifiers with
+    masked arrays, the image is viewed as a (nrow, namp, ampWidth) array with the masked pixels set to NaN, the
+    sigma-clipped statistics of all the amplifiers are computed at once, and the model is built by broadcasting.
+
+    Parameters
+    ----------
+    data: numpy array
+        The input image, with NaN for the pixels that should not be used.
+
+    namp: int
+        Number of amplifiers, 4 or 1.
+
+    See get_rowamp_model for the other parameters.
+
+    Returns
+    -------
+    modelimg: numpy array with the same shape of data
+        model image
+    """
+    nrow, ncol = data.shape
+    if namp == 4:
+        if inst != 'NIRCam':
+            msgs.error('Only NIRCam is supported at this moment.')
+        ampWidth = 512
+        if ncol != namp * ampWidth:
+            msgs.error('The 4 amplifier model requires {:} columns.'.format(namp * ampWidth))
+        amps = data.reshape(nrow, namp, ampWidth)
+
+        if evenOdd:
+            # Offset of the even and odd columns of each amplifier, shape (namp, 2)
+            parity = amps.reshape(nrow, namp, ampWidth // 2, 2).transpose(1, 3, 0, 2).reshape(namp, 2, -1)
+            offsets = nan_sigma_clipped_median(parity, rej_nsigma=rej_nsigma, maxiters=maxiters, stdfunc='std')
+            slowread_model = np.tile(offsets, ampWidth // 2)
+        else:
+            ## even if not doing an even/odd correction, still do an overall median
+            offsets = nan_sigma_clipped_median(amps.transpose(1, 0, 2).reshape(namp, -1), rej_nsigma=rej_nsigma,
+                                               maxiters=maxiters, stdfunc='std')
+            slowread_model = np.repeat(offsets[:, None], ampWidth, axis=1)
+        thisAmp = amps - slowread_model[None, :, :]
+
+        ## sigma clipped median of each row of each amplifier, shape (nrow, namp)
+        bad_rows = np.sum(np.isfinite(thisAmp), axis=2) <= minimum_pixels
+        medVals = nan_sigma_clipped_median(thisAmp, rej_nsigma=rej_nsigma, maxiters=maxiters, stdfunc='mad_std',
+                                           reclip=True)
+        medVals[bad_rows] = 0.
+
+        ## Let's replace the bad rows with that row in other amplifiers
+        replace_rows = np.any(bad_rows, axis=1) & np.logical_not(np.all(bad_rows, axis=1))
+        if np.any(replace_rows):
+            fastread_model = np.repeat(medVals, ampWidth, axis=1)
+            rowModel = nan_sigma_clipped_median(fastread_model, rej_nsigma=rej_nsigma, maxiters=maxiters,
+                                                stdfunc='std', reclip=True)
+            this_amp_replace = replace_rows[:, None] & bad_rows
+            medVals = np.where(this_amp_replace, rowModel[:, None], medVals)
+
+        ## broadcast the row medians across the fast-read direction
+        modelimg = slowread_model[None, :, :] + medVals[:, :, None]
+        return modelimg.reshape(nrow, ncol)
+
+    elif namp == 1:
+        if evenOdd:
+            offsets = nan_sigma_clipped_median(np.stack([data[:, 0::2].ravel(), data[:, 1::2].ravel()]),
+                                               rej_nsigma=rej_nsigma, maxiters=maxiters, stdfunc='std')
+            slowread_model = np.zeros(ncol)
+            slowread_model[0::2], slowread_model[1::2] = offsets
+        else:
+            slowread_model = np.full(ncol, nan_sigma_clipped_median(data.ravel(), rej_nsigma=rej_nsigma,
+                                                                    maxiters=maxiters, stdfunc='std'))
+        thisAmp = data - slowread_model
+
+        medVals = nan_sigma_clipped_median(thisAmp, rej_nsigma=rej_nsigma, maxiters=maxiters, stdfunc='std',
+                                           reclip=True)
+        return slowread_model + medVals[:, None]
+    else:
+        msgs.error('{:} amplifiers is not implemented yet.'.format(namp))
+
+
 def BKG2D(data, back_size, bpm=None, filter_size=(3, 3), sigclip=5, back_type='sextractor', back_rms_type='biweight',
           back_maxiters=5, verbose=True):
     """
@@ -486,12 +847,12 @@ def BKG2D(data, back_size, bpm=None, filter_size=(3, 3), sigclip=5, back_type='s
     if verbose:
         msgs.info('Estimating {:} BACKGROUND with Photutils Background2D.'.format(back_type))
 
-    tmp = copy.deepcopy(data)
+    # Background2D does not modify the data, so there is no need to copy them
     Sigma_Clip = SigmaClip(sigma=sigclip, maxiters=back_maxiters)
-    bkg = Background2D(tmp, back_size, mask=bpm, filter_size=filter_size, sigma_clip=Sigma_Clip,
+    bkg = Background2D(data, back_size, mask=bpm, filter_size=filter_size, sigma_clip=Sigma_Clip,
                        bkg_estimator=bkg_estimator, bkgrms_estimator=bkgrms_estimator)
     bkg_map, rms_map = bkg.background, bkg.background_rms
-    bkg_map[tmp == 0.] = 0.
+    bkg_map[data == 0.] = 0.
 
     if back_type == 'GlobalMedian':
         bkg_map = np.ones_like(bkg_map) * np.nanmedian(bkg_map[np.invert(bpm)])
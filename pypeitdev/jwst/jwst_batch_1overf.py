@@ -0,0 +1,321 @@
+"""
+Batch 1/f noise correction of JWST NIRCam/NIRSpec rate files.
+
+Every rate file matching the input patterns is corrected with either the Brammer
+(jwst_1overf_brammer.exposure_oneoverf_correction) or the unfold_jwst (jwst_1overf_unfold.fnoise_sub) algorithm and
+written to a new ``*_rate_1overf.fits`` file. The files are independent, so they are distributed over a pool of worker
+processes. Each output is written with pypeitdev.fileio.atomic_write, and its primary header records the algorithm, its parameters and the checksum of the input
+file. Files whose output already exists with the same input checksum and parameters are skipped. The brammer
+algorithm fits the stripes along the detector axis of the instrument (INSTRUME header) and does not correct MIRI
+exposures, which are reported as not corrected.
+
+Example::
+
+    python jwst_batch_1overf.py 'level_12/01764/*_rate.fits' --algorithm unfold --outdir rate_1overf --nproc 8
+"""
+import os
+import glob
+import json
+import time
+import hashlib
+import argparse
+import datetime
+import traceback
+import multiprocessing
+
+import numpy as np
+from astropy.io import fits
+
+from pypeit import msgs
+from pypeit import __version__
+
+from pypeitdev.jwst import jwst_1overf_brammer
+from pypeitdev.jwst import jwst_1overf_unfold
+from pypeitdev.jwst.jwst_utils import jwst_file_checksum
+from pypeitdev.fileio import atomic_write
+
+
+def oneoverf_params(algorithm, params):
+    """
+    Hash of the algorithm and its parameters, used to decide if an existing output can be reused.
+
+    Parameters
+    ----------
+    algorithm : str
+        'brammer' or 'unfold'
+    params : dict
+        Keyword parameters of the algorithm.
+
+    Returns
+    -------
+    params_json : str
+        The algorithm and parameters as a JSON string.
+    params_hash : str
+        Short SHA1 hash of params_json.
+    """
+    params_json = json.dumps(dict(algorithm=algorithm, **params), sort_keys=True)
+    return params_json, hashlib.sha1(params_json.encode()).hexdigest()[:16]
+
+
+def oneoverf_outfile(ratefile, outdir=None, suffix='_1overf'):
+    """
+    Name of the corrected file, e.g. ``jw01764014001_03102_00001_nrs1_rate_1overf.fits``.
+    """
+    outdir = os.path.dirname(ratefile) if outdir is None else outdir
+    return os.path.join(outdir, os.path.basename(ratefile).replace('.fits', suffix + '.fits'))
+
+
+def is_up_to_date(outfile, checksum, params_hash):
+    """
+    Check if outfile was written from an input with this checksum and with the same algorithm parameters.
+    """
+    if not os.path.isfile(outfile):
+        return False
+    try:
+        header = fits.getheader(outfile, 0)
+    except OSError:
+        return False
+    return header.get('ONEFISUM') == checksum and header.get('ONEFPHSH') == params_hash
+
+
+def brammer_axis(instrument):
+    """
+    Axis of the SCI extension along which brammer fits the 1/f stripes of an instrument.
+
+    As in jwst_1overf_brammer.exposure_oneoverf_correction_ori, the stripes are fit along axis 0 for NIRSpec and
+    NIRISS and along axis 1 for the other instruments, e.g. NIRCam. The rows correction (fix_rows) uses the other
+    axis.
+    """
+    return 0 if instrument.strip().upper() in ('NIRISS', 'NIRSPEC') else 1
+
+
+def oneoverf_model(ratefile, algorithm, params, bkg_cache_dir=None):
+    """
+    Compute the 1/f noise model of a rate file.
+
+    Parameters
+    ----------
+    ratefile : str
+        The rate file.
+    algorithm : str
+        'brammer' or 'unfold'
+    params : dict
+        Keyword parameters of the algorithm. For brammer: deg_pix, fix_rows. For unfold: the keyword parameters of
+        fnoise_sub.
+    bkg_cache_dir : str, optional
+        unfold: directory where the object masks and backgrounds are cached, see fnoise_sub.
+
+    Returns
+    -------
+    model : numpy.ndarray or None
+        The 1/f noise model in the orientation of the SCI extension (not rotated to the PypeIt format), or None if the
+        exposure is not corrected (MIRI exposures with brammer).
+    """
+    if algorithm == 'brammer':
+        params = params.copy()
+        fix_rows = params.pop('fix_rows', False)
+        instrument = fits.getval(ratefile, 'INSTRUME', 0)
+        if instrument.strip().upper() == 'MIRI':
+            # brammer does not correct MIRI exposures
+            return None
+        axis = brammer_axis(instrument)
+        out = jwst_1overf_brammer.exposure_oneoverf_correction(ratefile, rot_pypeit_fmt=False, axis=axis,
+                                                               make_plot=False, in_place=False, verbose=False,
+                                                               **params)
+        if len(out) != 3:
+            # The exposure was skipped, (None, 0) is returned
+            return None
+        model = out[1]
+        model[np.logical_not(np.isfinite(model))] = 0.
+        if fix_rows:
+            # Fit independently of the first model, as in jwst_run_1overf.run_brammer
+            params['deg_pix'] = 2048
+            _, fix_row_model, _ = jwst_1overf_brammer.exposure_oneoverf_correction(
+                ratefile, rot_pypeit_fmt=False, axis=1 - axis, make_plot=False, in_place=False, verbose=False,
+                **params)
+            fix_row_model[np.logical_not(np.isfinite(fix_row_model))] = 0.
+            model = model + fix_row_model
+        return model
+    elif algorithm == 'unfold':
+        with fits.open(ratefile) as hdul:
+            # Rotated to the PypeIt format
+            data = np.array(hdul['SCI'].data.T, dtype=float)
+            bpm = (hdul['DQ'].data.T & 1) != 0
+        _, model = jwst_1overf_unfold.fnoise_sub(data, bpm=bpm, show=False, bkg_cache_dir=bkg_cache_dir, **params)
+        return model.T
+    else:
+        msgs.error('Unknown 1/f algorithm {0}. Must be brammer or unfold.'.format(algorithm))
+
+
+def correct_rate_file(ratefile, outfile, algorithm, params, overwrite=False, bkg_cache_dir=None):
+    """
+    Correct a rate file for 1/f noise and write the result, unless an up-to-date output already exists.
+
+    Parameters
+    ----------
+    ratefile : str
+        The input rate file.
+    outfile : str
+        The corrected rate file.
+    algorithm : str
+        'brammer' or 'unfold'
+    params : dict
+        Keyword parameters of the algorithm, see :func:`oneoverf_model`.
+    overwrite : bool, optional
+        Correct the file even if the output is up to date.
+    bkg_cache_dir : str, optional
+        unfold: directory where the object masks and backgrounds are cached, see fnoise_sub.
+
+    Returns
+    -------
+    status : str
+        'corrected', 'skipped' if the output is up to date or 'not corrected' if the algorithm does not apply to the
+        instrument (MIRI with brammer). Nothing is written in the last case.
+    """
+    checksum = jwst_file_checksum(ratefile)
+    params_json, params_hash = oneoverf_params(algorithm, params)
+    if not overwrite and is_up_to_date(outfile, checksum, params_hash):
+        return 'skipped'
+
+    model = oneoverf_model(ratefile, algorithm, params, bkg_cache_dir=bkg_cache_dir)
+    if model is None:
+        return 'not corrected'
+    with fits.open(ratefile) as hdul:
+        hdul['SCI'].data = hdul['SCI'].data - model.astype(hdul['SCI'].data.dtype)
+        header = hdul[0].header
+        header['ONEFEXP'] = (True, 'Exposure 1/f correction applied')
+        header['ONEFALGO'] = (algorithm, '1/f correction algorithm')
+        header['ONEFPHSH'] = (params_hash, 'Hash of the 1/f algorithm parameters')
+        header['ONEFINP'] = (os.path.basename(ratefile), 'Rate file before the 1/f correction')
+        header['ONEFISUM'] = (checksum, 'SHA1 of the rate file')
+        header['ONEFDATE'] = (datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+                              'UTC time of the 1/f correction')
+        header['ONEFPYPV'] = (__version__, 'PypeIt version of the 1/f correction')
+        header.add_history('1/f correction parameters: {0}'.format(params_json))
+        os.makedirs(os.path.dirname(os.path.abspath(outfile)), exist_ok=True)
+        with atomic_write(outfile) as tmp_file:
+            hdul.writeto(tmp_file, overwrite=True)
+    return 'corrected'
+
+
+def _correct_rate_file_worker(args):
+    """
+    Run :func:`correct_rate_file` in a worker process, catching any failure so that it only affects this file.
+    """
+    ratefile = args[0]
+    t0 = time.perf_counter()
+    try:
+        status = correct_rate_file(*args)
+    except Exception:
+        return ratefile, 'failed', time.perf_counter() - t0, traceback.format_exc()
+    return ratefile, status, time.perf_counter() - t0, None
+
+
+def batch_1overf(ratefiles, algorithm, params, outdir=None, suffix='_1overf', overwrite=False, nproc=1,
+                 bkg_cache_dir=None):
+    """
+    Correct a set of rate files for 1/f noise, optionally in parallel.
+
+    Parameters
+    ----------
+    ratefiles : list
+        The rate files.
+    algorithm : str
+        'brammer' or 'unfold'
+    params : dict
+        Keyword parameters of the algorithm, see :func:`oneoverf_model`.
+    outdir : str, optional
+        Directory for the corrected files. Default is the directory of each rate file.
+    suffix : str, optional
+        Suffix added to the name of the rate files.
+    overwrite : bool, optional
+        Correct the files even if the outputs are up to date.
+    nproc : int, optional
+        Number of worker processes. If 1, the files are processed serially in this process.
+    bkg_cache_dir : str, optional
+        unfold: directory where the object masks and backgrounds are cached, so that runs with different row/column
+        parameters reuse them.
+
+    Returns
+    -------
+    failed : dict
+        Traceback of the failure of each rate file that could not be corrected.
+    """
+    args = [(ratefile, oneoverf_outfile(ratefile, outdir=outdir, suffix=suffix), algorithm, params, overwrite,
+             bkg_cache_dir) for ratefile in ratefiles]
+    nproc = min(nproc, len(args))
+    msgs.info('Correcting {0} rate files for 1/f noise with the {1} algorithm using {2} processes'.format(
+        len(args), algorithm, max(nproc, 1)))
+    if nproc <= 1:
+        results = map(_correct_rate_file_worker, args)
+        pool = None
+    else:
+        pool = multiprocessing.get_context('spawn').Pool(processes=nproc)
+        results = pool.imap_unordered(_correct_rate_file_worker, args)
+
+    failed = {}
+    try:
+        for ratefile, status, elapsed, tb in results:
+            if tb is not None:
+                msgs.warn('1/f correction of {0} failed:\n{1}'.format(ratefile, tb))
+                failed[ratefile] = tb
+            else:
+                msgs.info('{0}: {1} in {2:.1f}s'.format(os.path.basename(ratefile), status, elapsed))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    msgs.info('Done: {0} of {1} rate files failed'.format(len(failed), len(args)))
+    return failed
+
+
+def parse_args(options=None):
+    parser = argparse.ArgumentParser(description='Batch 1/f noise correction of JWST rate files')
+    parser.add_argument('files', type=str, nargs='+', help='Rate files or glob patterns, e.g. "*_rate.fits"')
+    parser.add_argument('--algorithm', type=str, default='unfold', choices=['brammer', 'unfold'],
+                        help='1/f correction algorithm')
+    parser.add_argument('--outdir', type=str, default=None,
+                        help='Directory for the corrected files. Default is the directory of each rate file.')
+    parser.add_argument('--suffix', type=str, default='_1overf', help='Suffix added to the names of the rate files')
+    parser.add_argument('--nproc', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--overwrite', default=False, action='store_true',
+                        help='Correct the files even if the outputs are up to date')
+    # brammer
+    parser.add_argument('--deg_pix', type=int, default=256,
+                        help='brammer: pixels per degree of the smooth Chebyshev component')
+    parser.add_argument('--fix_rows', default=False, action='store_true',
+                        help='brammer: also correct along the detector rows')
+    # unfold
+    parser.add_argument('--namp', type=int, default=4, help='unfold: number of amplifiers, 4 or 1')
+    parser.add_argument('--no_evenOdd', default=False, action='store_true',
+                        help='unfold: skip the even/odd column correction')
+    parser.add_argument('--skip_col', default=False, action='store_true', help='unfold: skip the column correction')
+    parser.add_argument('--no_sub_bkg', default=False, action='store_true',
+                        help='unfold: do not subtract a smooth background before the row/column medians')
+    parser.add_argument('--no_mask_brightstar', default=False, action='store_true',
+                        help='unfold: do not mask the sources detected with photutils')
+    parser.add_argument('--bkg_cache_dir', type=str, default=None,
+                        help='unfold: directory where the object masks and backgrounds are cached')
+    return parser.parse_args(options)
+
+
+def main(args):
+    ratefiles = sorted(set(f for pattern in args.files for f in glob.glob(pattern)))
+    # Never correct the outputs of a previous run
+    ratefiles = [f for f in ratefiles if not f.endswith(args.suffix + '.fits')]
+    if len(ratefiles) == 0:
+        msgs.error('No rate files found matching {0}'.format(args.files))
+
+    if args.algorithm == 'brammer':
+        params = dict(deg_pix=args.deg_pix, fix_rows=args.fix_rows)
+    else:
+        params = dict(namp=args.namp, evenOdd=not args.no_evenOdd, skip_col=args.skip_col,
+                      sub_bkg=not args.no_sub_bkg, mask_brightstar=not args.no_mask_brightstar)
+
+    failed = batch_1overf(ratefiles, args.algorithm, params, outdir=args.outdir, suffix=args.suffix,
+                          overwrite=args.overwrite, nproc=args.nproc, bkg_cache_dir=args.bkg_cache_dir)
+    return 1 if len(failed) > 0 else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main(parse_args()))
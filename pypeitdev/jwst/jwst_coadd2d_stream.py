@@ -0,0 +1,525 @@
+"""
+Streaming 2D coadd of JWST spec2d files.
+
+:class:`~pypeit.coadd2d.CoAdd2D` reads every spec2d of a slit into memory before rectifying and combining them, which
+exhausts the memory for large dither sets. Here the exposures are read one at a time: a first pass only collects the
+wavelength and spatial coverage of each exposure to set up the rectified grid, and a second pass rectifies each
+exposure onto that grid with :func:`~pypeit.core.coadd.rebin2d` and immediately discards the detector images.
+
+The rectified exposures are either
+
+    - combined with :func:`~pypeit.core.combine.weighted_combine` and the same sigma clipping as
+      :func:`~pypeit.core.coadd.compute_coadd2d` (the default). Only the rectified stacks are kept, optionally in
+      memory-mapped files in a scratch directory for very large stacks, and they are combined in chunks of spectral
+      pixels, or
+    - accumulated into running weighted sums (``sigma_clip=False``), so the memory does not grow with the number of
+      exposures. This is equivalent to weighted_combine without sigma clipping.
+
+The detectors are independent, so they are coadded in parallel by a pool of worker processes.
+
+Example::
+
+    python jwst_coadd2d_stream.py 'Science/spec2d_*_S200A1.fits' --det NRS1 NRS2 --offsets 0 5 -5 \\
+        --outfile coadd2d_S200A1.fits --nproc 2
+"""
+import os
+import glob
+import shutil
+import argparse
+import tempfile
+import traceback
+import multiprocessing
+from functools import partial
+
+import numpy as np
+import scipy
+from astropy.io import fits
+
+from pypeit import msgs
+from pypeit import utils
+from pypeit import spec2dobj
+from pypeit.core import coadd
+from pypeit.core import combine
+from pypeit.core.moment import moment1d
+from pypeit.core.wavecal import wvutils
+
+
+def load_slit_exposure(spec2d_file, detname, slit_idx=0, spat_toler=5, chk_version=False):
+    """
+    Read the images of one slit of one exposure from a spec2d file.
+
+    This mirrors :meth:`~pypeit.coadd2d.CoAdd2D.load_coadd2d_stacks` for a single file and detector.
+
+    Parameters
+    ----------
+    spec2d_file : str
+        The spec2d file.
+    detname : str
+        Name of the detector (or mosaic) to read.
+    slit_idx : int, optional
+        Index of the slit in the SlitTraceSet.
+    spat_toler : int, optional
+        Tolerance in spatial pixels used to identify the slit in the slit mask, see the coadd2d parameters.
+    chk_version : bool, optional
+        Check the version of the spec2d data model.
+
+    Returns
+    -------
+    exp : dict
+        The science, inverse variance, sky model, good pixel mask, slit mask and wavelength images, the slit center
+        and edges, and the exposure time.
+    """
+    s2dobj = spec2dobj.Spec2DObj.from_file(spec2d_file, detname, chk_version=chk_version)
+    slits = s2dobj.slits
+    slitmask = slits.slit_img(flexure=s2dobj.sci_spat_flexure)
+    slits_left, slits_righ, _ = slits.select_edges()
+    return dict(sciimg=s2dobj.sciimg, sciivar=s2dobj.ivarmodel, skymodel=s2dobj.skymodel,
+                gpm=s2dobj.bpmmask.mask == 0,
+                thismask=np.abs(slitmask - slits.spat_id[slit_idx]) <= spat_toler,
+                waveimg=s2dobj.waveimg, slitcen=slits.center[:, slit_idx],
+                slit_left=slits_left[:, slit_idx], slit_righ=slits_righ[:, slit_idx],
+                exptime=s2dobj.head0['EXPTIME'])
+
+
+def slit_wave_traces(exp, box_radius=3.):
+    """
+    Boxcar wavelengths along apertures at 5%, 50% and 95% of the slit width of one exposure.
+
+    These are the wavelengths used by :meth:`~pypeit.coadd2d.CoAdd2D.get_wave_grid` when the wavelength grid is
+    built from the slits.
+
+    Returns
+    -------
+    waves, gpms : list
+        The wavelengths and good pixel masks of the apertures with any good pixel.
+    """
+    waveimg, mask = exp['waveimg'], exp['thismask']
+    row = np.arange(waveimg.shape[0])
+    trace_spat = exp['slit_left'][:, np.newaxis] \
+                 + np.outer(exp['slit_righ'] - exp['slit_left'], [0.05, 0.5, 0.95])
+    box_denom = moment1d(waveimg * mask > 0.0, trace_spat, 2 * box_radius, row=row)[0]
+    wave_box = moment1d(waveimg * mask, trace_spat, 2 * box_radius, row=row)[0] / (box_denom + (box_denom == 0.0))
+    gpm_box = box_denom > 0.
+    waves = [wave for (wave, gpm) in zip(wave_box.T, gpm_box.T) if np.any(gpm)]
+    gpms = [(wave > 0.) & gpm for (wave, gpm) in zip(wave_box.T, gpm_box.T) if np.any(gpm)]
+    return waves, gpms
+
+
+class StreamingCoadd2D:
+    """
+    Rectify exposures one at a time onto a fixed grid and combine them.
+
+    The rectification and the combination are the same as in :func:`~pypeit.core.coadd.compute_coadd2d`, so for the
+    same grid, weights and reference traces :meth:`finalize` returns the same coadd.
+
+    Parameters
+    ----------
+    wave_bins : `numpy.ndarray`_
+        Wavelength bins of the rectified grid, see :func:`~pypeit.core.coadd.get_wave_bins`.
+    dspat_bins : `numpy.ndarray`_
+        Spatial bins of the rectified grid, see :func:`~pypeit.core.coadd.get_spat_bins`.
+    nexp : int
+        Number of exposures that will be added.
+    spat_samp_fact : float, optional
+        Spatial sampling of the rectified grid in pixels.
+    sigma_clip : bool, optional
+        Keep the rectified exposures and sigma clip them when combining, as compute_coadd2d does. If False, only
+        running weighted sums are kept.
+    scratch_dir : str, optional
+        If given, the rectified exposures are kept in memory-mapped files in a temporary directory created in
+        scratch_dir, instead of in memory. Only used if sigma_clip is True.
+    """
+    # Rectified images combined with the weights, in the order of sci_list in compute_coadd2d
+    sci_names = ['sciimg', 'imgminsky', 'waveimg', 'dspat']
+
+    def __init__(self, wave_bins, dspat_bins, nexp, spat_samp_fact=1.0, sigma_clip=True, scratch_dir=None):
+        self.wave_bins = wave_bins
+        self.dspat_bins = dspat_bins
+        self.nexp = nexp
+        self.spat_samp_fact = spat_samp_fact
+        self.sigma_clip = sigma_clip
+        self.shape = (wave_bins.size - 1, dspat_bins.size - 1)
+        self.nadded = 0
+        self.scratch = None
+
+        if self.sigma_clip:
+            stack_shape = (nexp,) + self.shape
+            if scratch_dir is None:
+                new_stack = lambda name, dtype: np.zeros(stack_shape, dtype=dtype)
+            else:
+                os.makedirs(scratch_dir, exist_ok=True)
+                self.scratch = tempfile.mkdtemp(prefix='coadd2d_', dir=scratch_dir)
+                new_stack = lambda name, dtype: np.lib.format.open_memmap(
+                    os.path.join(self.scratch, name + '.npy'), mode='w+', dtype=dtype, shape=stack_shape)
+            self.weights = new_stack('weights', float)
+            self.sci = {name: new_stack(name, float) for name in self.sci_names}
+            self.var = new_stack('var', float)
+            self.norm = new_stack('norm', int)
+        else:
+            self.weights_sum = np.zeros(self.shape)
+            self.nused = np.zeros(self.shape, dtype=int)
+            self.sci = {name: np.zeros(self.shape) for name in self.sci_names}
+            self.var = np.zeros(self.shape)
+
+    def add(self, exp, ref_trace, weight=1.0, exp_scale=1.0):
+        """
+        Rectify one exposure and add it to the coadd.
+
+        Parameters
+        ----------
+        exp : dict
+            Images of the exposure, see :func:`load_slit_exposure`.
+        ref_trace : `numpy.ndarray`_
+            Reference trace about which the exposure is rectified, shape (nspec,).
+        weight : float or `numpy.ndarray`_, optional
+            Weight of the exposure, either a float or an array with shape (nspec,) or (nspec, nspat), see
+            :func:`~pypeit.core.combine.broadcast_weights`.
+        exp_scale : float, optional
+            Factor used to scale the exposure to the common exposure time.
+        """
+        if self.nadded >= self.nexp:
+            msgs.error('All the {0} exposures have already been added to the coadd'.format(self.nexp))
+        sciimg, skymodel, sciivar = exp['sciimg'], exp['skymodel'], exp['sciivar']
+        if exp_scale != 1.0:
+            sciimg, skymodel, sciivar = sciimg * exp_scale, skymodel * exp_scale, sciivar / exp_scale**2
+        nspat = sciimg.shape[1]
+        dspat = (np.arange(nspat)[np.newaxis, :] - ref_trace[:, np.newaxis]) / self.spat_samp_fact
+        weights = combine.broadcast_lists_of_weights([weight], [sciimg.shape])[0]
+
+        sci_list = [[weights], [sciimg], [sciimg - skymodel], [exp['waveimg']], [dspat]]
+        var_list = [[utils.inverse(sciivar)]]
+        sci_list_rebin, var_list_rebin, norm_rebin, _ = coadd.rebin2d(
+            self.wave_bins, self.dspat_bins, [exp['waveimg']], [dspat], [exp['thismask']], [exp['gpm']],
+            sci_list, var_list)
+
+        iexp = self.nadded
+        if self.sigma_clip:
+            self.weights[iexp] = sci_list_rebin[0][0]
+            for name, rebin in zip(self.sci_names, sci_list_rebin[1:]):
+                self.sci[name][iexp] = rebin[0]
+            self.var[iexp] = var_list_rebin[0][0]
+            self.norm[iexp] = norm_rebin[0]
+        else:
+            # Same operations as weighted_combine, accumulated one exposure at a time
+            mask = norm_rebin[0] != 0
+            weights_mask = sci_list_rebin[0][0] * mask.astype(float)
+            self.nused += mask
+            self.weights_sum += weights_mask
+            for name, rebin in zip(self.sci_names, sci_list_rebin[1:]):
+                self.sci[name] += rebin[0] * weights_mask
+            self.var += var_list_rebin[0][0] * weights_mask**2
+        self.nadded += 1
+
+    def combine(self, sigrej=3.0, maxiters=10, chunk_nspec=256):
+        """
+        Combine the rectified exposures.
+
+        Returns
+        -------
+        sci_list_out : list
+            The combined sciimg, imgminsky, waveimg and dspat images.
+        var : `numpy.ndarray`_
+            The propagated variance.
+        outmask : `numpy.ndarray`_
+            Good pixel mask of the coadd.
+        nused : `numpy.ndarray`_
+            Number of exposures used for each pixel.
+        """
+        if self.nadded != self.nexp:
+            msgs.error('Only {0} of {1} exposures were added to the coadd'.format(self.nadded, self.nexp))
+        if not self.sigma_clip:
+            inv_w_sum = 1./(self.weights_sum + (self.weights_sum == 0.0))
+            sci_list_out = [self.sci[name] * inv_w_sum for name in self.sci_names]
+            return sci_list_out, self.var * inv_w_sum**2, self.nused > 0, self.nused
+
+        # The sigma clipping is independent for every rectified pixel, so the stacks are combined in chunks of
+        # spectral pixels to bound the memory used
+        sci_list_out = [np.zeros(self.shape) for name in self.sci_names]
+        var = np.zeros(self.shape)
+        outmask = np.zeros(self.shape, dtype=bool)
+        nused = np.zeros(self.shape, dtype=int)
+        for i0 in range(0, self.shape[0], chunk_nspec):
+            chunk = np.s_[:, i0:i0 + chunk_nspec]
+            sci_chunk = [np.asarray(self.sci[name][chunk]) for name in self.sci_names]
+            _sci, _var, _outmask, _nused = combine.weighted_combine(
+                np.asarray(self.weights[chunk]), sci_chunk, [np.asarray(self.var[chunk])],
+                np.asarray(self.norm[chunk]) != 0, sigma_clip=True, sigma_clip_stack=sci_chunk[1],
+                sigrej=sigrej, maxiters=maxiters)
+            for out, img in zip(sci_list_out, _sci):
+                out[i0:i0 + chunk_nspec] = img
+            var[i0:i0 + chunk_nspec] = _var[0]
+            outmask[i0:i0 + chunk_nspec] = _outmask
+            nused[i0:i0 + chunk_nspec] = _nused
+        return sci_list_out, var, outmask, nused
+
+    def finalize(self, sigrej=3.0, maxiters=10, chunk_nspec=256, interp_dspat=True):
+        """
+        Combine the rectified exposures into the coadd and release the rectified stacks.
+
+        Returns
+        -------
+        coadd_dict : dict
+            Same as the dictionary returned by :func:`~pypeit.core.coadd.compute_coadd2d`, without mask design
+            information.
+        """
+        try:
+            (sciimg, imgminsky, waveimg, dspat), var, outmask, nused = self.combine(
+                sigrej=sigrej, maxiters=maxiters, chunk_nspec=chunk_nspec)
+        finally:
+            self.close()
+        sciivar = utils.inverse(var)
+
+        wave_bins, dspat_bins = self.wave_bins, self.dspat_bins
+        wave_mid = ((wave_bins + np.roll(wave_bins, 1))/2.0)[1:]
+        dspat_mid = ((dspat_bins + np.roll(dspat_bins, 1))/2.0)[1:]
+
+        # Interpolate the dspat images wherever the coadds are masked, as compute_coadd2d does, because
+        # local_skysub_extract does not allow holes in the dspat image
+        nspec_coadd, nspat_coadd = imgminsky.shape
+        spat_img_coadd, spec_img_coadd = np.meshgrid(np.arange(nspat_coadd), np.arange(nspec_coadd))
+        badmask = np.logical_not(outmask)
+        if np.any(badmask) and interp_dspat:
+            points_good = np.stack((spec_img_coadd[outmask], spat_img_coadd[outmask]), axis=1)
+            points_bad = np.stack((spec_img_coadd[badmask], spat_img_coadd[badmask]), axis=1)
+            dspat[badmask] = scipy.interpolate.griddata(points_good, dspat[outmask], points_bad, method='nearest')
+            nanpix = np.isnan(dspat)
+            if np.any(nanpix):
+                dspat_img_fake = spat_img_coadd + dspat_mid[0]
+                dspat[nanpix] = dspat_img_fake[nanpix]
+        else:
+            dspat_img_fake = spat_img_coadd + dspat_mid[0]
+            dspat[badmask] = dspat_img_fake[badmask]
+
+        return dict(wave_bins=wave_bins, dspat_bins=dspat_bins, wave_mid=wave_mid, wave_min=wave_bins[:-1],
+                    wave_max=wave_bins[1:], dspat_mid=dspat_mid, sciimg=sciimg, sciivar=sciivar,
+                    imgminsky=imgminsky, outmask=outmask, nused=nused, waveimg=waveimg, dspat=dspat,
+                    nspec=nspec_coadd, nspat=nspat_coadd, maskdef_id=None, maskdef_slitcen=None,
+                    maskdef_objpos=None, maskdef_designtab=None)
+
+    def close(self):
+        """
+        Remove the memory-mapped rectified stacks, if any.
+        """
+        if self.scratch is not None:
+            if self.sigma_clip:
+                # Drop the references to the memory maps before removing their files
+                self.weights, self.sci, self.var, self.norm = None, None, None, None
+            shutil.rmtree(self.scratch, ignore_errors=True)
+            self.scratch = None
+
+
+def stream_coadd2d_exposures(load_exposure, nexp, offsets=None, weights=None, wave_grid=None, wave_method='linear',
+                             spec_samp_fact=1.0, spat_samp_fact=1.0, sigma_clip=True, sigrej=3.0, maxiters=10,
+                             scratch_dir=None, chunk_nspec=256, interp_dspat=True):
+    """
+    Streaming 2D coadd of one slit of a set of exposures.
+
+    Parameters
+    ----------
+    load_exposure : callable
+        Function that returns the images of an exposure given its index, see :func:`load_slit_exposure`. It is called
+        twice for every exposure, once to build the rectified grid and once to rectify it.
+    nexp : int
+        Number of exposures.
+    offsets : list, optional
+        Spatial offset in pixels of each exposure. The exposures are rectified about the slit center minus the offset,
+        as in :meth:`~pypeit.coadd2d.CoAdd2D.offset_slit_cen`. Default is no offsets.
+    weights : list, optional
+        Weight of each exposure, see :meth:`StreamingCoadd2D.add`. Default is uniform weights.
+    wave_grid : `numpy.ndarray`_, optional
+        Wavelength grid of the coadd. If None, it is built from the wavelengths along the slit of every exposure, as
+        :meth:`~pypeit.coadd2d.CoAdd2D.get_wave_grid` does with use_slits4wvgrid.
+    wave_method : str, optional
+        Method used to build the wavelength grid, see :func:`~pypeit.core.wavecal.wvutils.get_wave_grid`.
+    spec_samp_fact, spat_samp_fact : float, optional
+        Spectral and spatial sampling of the rectified grid.
+    sigma_clip, scratch_dir : optional
+        See :class:`StreamingCoadd2D`.
+    sigrej, maxiters, chunk_nspec, interp_dspat : optional
+        See :meth:`StreamingCoadd2D.finalize`.
+
+    Returns
+    -------
+    coadd_dict : dict
+        The coadd, see :meth:`StreamingCoadd2D.finalize`.
+    """
+    offsets = np.zeros(nexp) if offsets is None else np.asarray(offsets, dtype=float)
+    weights = (np.ones(nexp)/float(nexp)).tolist() if weights is None else weights
+    if len(offsets) != nexp or len(weights) != nexp:
+        msgs.error('The offsets and weights must have one entry per exposure')
+
+    # First pass: coverage of every exposure
+    wave_lower, wave_upper = np.inf, -np.inf
+    spat_min, spat_max = np.inf, -np.inf
+    exptime = np.zeros(nexp)
+    waves, gpms = [], []
+    for iexp in range(nexp):
+        exp = load_exposure(iexp)
+        thismask, waveimg = exp['thismask'], exp['waveimg']
+        if not np.any(thismask):
+            msgs.error('The slit was not found in exposure {0}'.format(iexp))
+        wavemask = thismask & (waveimg > 1.0)
+        wave_lower = min(wave_lower, np.amin(waveimg[wavemask]))
+        wave_upper = max(wave_upper, np.amax(waveimg[wavemask]))
+        ref_trace = exp['slitcen'] - offsets[iexp]
+        dspat = (np.arange(thismask.shape[1])[np.newaxis, :] - ref_trace[:, np.newaxis]) / spat_samp_fact
+        spat_min = min(spat_min, np.amin(dspat[thismask]))
+        spat_max = max(spat_max, np.amax(dspat[thismask]))
+        exptime[iexp] = exp['exptime']
+        if wave_grid is None:
+            _waves, _gpms = slit_wave_traces(exp)
+            waves += _waves
+            gpms += _gpms
+        del exp
+
+    if wave_grid is None:
+        wave_grid, _, _ = wvutils.get_wave_grid(waves=waves, gpms=gpms, wave_method=wave_method,
+                                                spec_samp_fact=spec_samp_fact)
+    ind_lower, ind_upper = coadd.get_wave_ind(wave_grid, wave_lower, wave_upper)
+    wave_bins = wave_grid[ind_lower:ind_upper + 1]
+    dspat_bins = np.arange(np.floor(spat_min), np.ceil(spat_max) + 1.0, 1.0, dtype=float)
+
+    # Scale to the median exposure time, as load_coadd2d_stacks does
+    exptime_coadd = np.percentile(exptime, 50., method='higher')
+    exp_scale = np.where(np.isclose(exptime, exptime_coadd, atol=1.), 1.0, exptime_coadd / exptime)
+    if np.any(exp_scale != 1.0):
+        msgs.warn('Exposure time is not consistent (within 1 sec) for all frames being coadded! '
+                  'Scaling each image by the median exposure time ({0} s) before coadding.'.format(exptime_coadd))
+
+    # Second pass: rectify and combine
+    stream = StreamingCoadd2D(wave_bins, dspat_bins, nexp, spat_samp_fact=spat_samp_fact, sigma_clip=sigma_clip,
+                              scratch_dir=scratch_dir)
+    try:
+        for iexp in range(nexp):
+            exp = load_exposure(iexp)
+            stream.add(exp, exp['slitcen'] - offsets[iexp], weight=weights[iexp], exp_scale=exp_scale[iexp])
+            del exp
+    except Exception:
+        stream.close()
+        raise
+    return stream.finalize(sigrej=sigrej, maxiters=maxiters, chunk_nspec=chunk_nspec, interp_dspat=interp_dspat)
+
+
+def stream_coadd2d(spec2d_files, detname, slit_idx=0, spat_toler=5, chk_version=False, **kwargs):
+    """
+    Streaming 2D coadd of one slit of one detector of a set of spec2d files.
+
+    Parameters
+    ----------
+    spec2d_files : list
+        The spec2d files, one per exposure.
+    detname : str
+        Name of the detector.
+    slit_idx, spat_toler, chk_version : optional
+        See :func:`load_slit_exposure`.
+    kwargs :
+        Passed to :func:`stream_coadd2d_exposures`.
+
+    Returns
+    -------
+    coadd_dict : dict
+        The coadd, see :meth:`StreamingCoadd2D.finalize`.
+    """
+    msgs.info('Streaming 2D coadd of {0} exposures of {1}'.format(len(spec2d_files), detname))
+    load_exposure = lambda iexp: load_slit_exposure(spec2d_files[iexp], detname, slit_idx=slit_idx,
+                                                    spat_toler=spat_toler, chk_version=chk_version)
+    return stream_coadd2d_exposures(load_exposure, len(spec2d_files), **kwargs)
+
+
+def _stream_coadd2d_worker(detname, spec2d_files, kwargs):
+    """
+    Run :func:`stream_coadd2d` in a worker process, catching any failure so that it only affects this detector.
+    """
+    try:
+        return detname, stream_coadd2d(spec2d_files, detname, **kwargs), None
+    except Exception:
+        return detname, None, traceback.format_exc()
+
+
+def stream_coadd2d_detectors(spec2d_files, detnames, nproc=1, **kwargs):
+    """
+    Streaming 2D coadd of a set of spec2d files, with the detectors coadded in parallel.
+
+    Parameters
+    ----------
+    spec2d_files : list
+        The spec2d files, one per exposure.
+    detnames : list
+        Names of the detectors to coadd.
+    nproc : int, optional
+        Number of worker processes. If 1, the detectors are coadded serially in this process.
+    kwargs :
+        Passed to :func:`stream_coadd2d`.
+
+    Returns
+    -------
+    coadd_dicts : dict
+        The coadd of each detector that could be coadded.
+    """
+    worker = partial(_stream_coadd2d_worker, spec2d_files=spec2d_files, kwargs=kwargs)
+    nproc = min(nproc, len(detnames))
+    if nproc <= 1:
+        results = [worker(detname) for detname in detnames]
+    else:
+        with multiprocessing.get_context('spawn').Pool(processes=nproc) as pool:
+            results = pool.map(worker, detnames, chunksize=1)
+
+    coadd_dicts = {}
+    for detname, coadd_dict, tb in results:
+        if tb is not None:
+            msgs.warn('2D coadd of {0} failed:\n{1}'.format(detname, tb))
+        else:
+            coadd_dicts[detname] = coadd_dict
+    return coadd_dicts
+
+
+def write_coadd2d(outfile, coadd_dicts, overwrite=True):
+    """
+    Write the rectified coadds of a set of detectors to a FITS file, with one extension per detector and image.
+    """
+    hdus = [fits.PrimaryHDU()]
+    for detname, coadd_dict in coadd_dicts.items():
+        for key in ['sciimg', 'sciivar', 'imgminsky', 'waveimg', 'dspat', 'nused']:
+            hdus.append(fits.ImageHDU(coadd_dict[key], name='{0}-{1}'.format(detname, key.upper())))
+        hdus.append(fits.ImageHDU(coadd_dict['outmask'].astype(np.uint8), name='{0}-OUTMASK'.format(detname)))
+        hdus.append(fits.ImageHDU(coadd_dict['wave_bins'], name='{0}-WAVE_BINS'.format(detname)))
+        hdus.append(fits.ImageHDU(coadd_dict['dspat_bins'], name='{0}-DSPAT_BINS'.format(detname)))
+    fits.HDUList(hdus).writeto(outfile, overwrite=overwrite)
+    msgs.info('Wrote {0}'.format(outfile))
+
+
+def parse_args(options=None):
+    parser = argparse.ArgumentParser(description='Streaming 2D coadd of JWST spec2d files')
+    parser.add_argument('files', type=str, nargs='+', help='spec2d files or glob patterns, one per exposure')
+    parser.add_argument('--outfile', type=str, required=True, help='Output FITS file with the rectified coadds')
+    parser.add_argument('--det', type=str, nargs='+', default=['NRS1', 'NRS2'], help='Detectors to coadd')
+    parser.add_argument('--slit_idx', type=int, default=0, help='Index of the slit in the spec2d files')
+    parser.add_argument('--offsets', type=float, nargs='+', default=None,
+                        help='Spatial offset in pixels of each exposure, in the order of the sorted files')
+    parser.add_argument('--weights', type=float, nargs='+', default=None, help='Weight of each exposure')
+    parser.add_argument('--wave_method', type=str, default='linear', help='Method of the wavelength grid')
+    parser.add_argument('--spec_samp_fact', type=float, default=1.0, help='Spectral sampling of the coadd')
+    parser.add_argument('--spat_samp_fact', type=float, default=1.0, help='Spatial sampling of the coadd')
+    parser.add_argument('--no_sigma_clip', default=False, action='store_true',
+                        help='Combine with running weighted sums, without sigma clipping')
+    parser.add_argument('--scratch_dir', type=str, default=None,
+                        help='Keep the rectified exposures in memory-mapped files in this directory')
+    parser.add_argument('--nproc', type=int, default=1, help='Number of worker processes (one per detector)')
+    return parser.parse_args(options)
+
+
+def main(args):
+    spec2d_files = sorted(set(f for pattern in args.files for f in glob.glob(pattern)))
+    if len(spec2d_files) == 0:
+        msgs.error('No spec2d files found matching {0}'.format(args.files))
+    coadd_dicts = stream_coadd2d_detectors(spec2d_files, args.det, nproc=args.nproc, slit_idx=args.slit_idx,
+                                           offsets=args.offsets, weights=args.weights, wave_method=args.wave_method,
+                                           spec_samp_fact=args.spec_samp_fact, spat_samp_fact=args.spat_samp_fact,
+                                           sigma_clip=not args.no_sigma_clip, scratch_dir=args.scratch_dir)
+    if len(coadd_dicts) == 0:
+        msgs.error('All the detectors failed')
+    write_coadd2d(args.outfile, coadd_dicts)
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,102 @@
+"""
+Benchmark the time and memory used by jwst_mosaic to build the mosaic of a single slit.
+
+Synthetic slit calibrations and rate image cutouts are used, so no calwebb outputs are needed. Typical NIRSpec MSA
+slits are ~2000 spectral x ~30-50 spatial pixels per detector, and a program has hundreds of slits times the number of
+exposures, so the time and peak memory per slit are what matter.
+
+Example::
+
+    python jwst_mosaic_benchmark.py --nslits 50 --ndet 1 2 --dtype float64 float32
+"""
+import time
+import argparse
+import tracemalloc
+
+import numpy as np
+
+from pypeit.spectrographs.util import load_spectrograph
+
+from pypeitdev.jwst.jwst_utils import NIRSpecSlitCalibrations, NIRSpecRateCutout, jwst_mosaic
+
+
+def fake_slit(detector, det_name, spat_start, nspec, nspat, rng):
+    """
+    Build synthetic calibrations and a rate image cutout for a slit on one detector.
+    """
+    slit_slice = np.s_[100:100 + nspec, spat_start:spat_start + nspat]
+    waveimg = np.full((nspec, nspat), np.nan)
+    waveimg[:, 3:nspat - 3] = np.linspace(1e4, 1.5e4, nspec)[:, None] + rng.uniform(0, 5, (nspec, 1))
+    finitemask = np.isfinite(waveimg)
+    tilts = np.zeros_like(waveimg)
+    tilts[finitemask] = (waveimg[finitemask] - np.nanmin(waveimg)) / (np.nanmax(waveimg) - np.nanmin(waveimg))
+    calib = NIRSpecSlitCalibrations.from_dict(d=dict(
+        slit_name='1', det_name=det_name, on_detector=True, t_eff=1000.0, detector=detector, slit_indx=0,
+        slit_slice=slit_slice, slit_left=np.full(nspec, 3.0), slit_righ=np.full(nspec, nspat - 4.0),
+        finitemask=finitemask, waveimg=waveimg, tilts=tilts, flatfield=rng.uniform(0.5, 1.5, (nspec, nspat)),
+        pathloss=np.ones((nspec, nspat)), barshadow=np.ones((nspec, nspat)), photom_conversion=2.0))
+    cutout = NIRSpecRateCutout(rng.normal(1.0, 0.1, (nspec, nspat)), rng.uniform(0.1, 1.0, (nspec, nspat)),
+                               rng.uniform(0.1, 1.0, (nspec, nspat)), np.zeros((nspec, nspat), dtype=int),
+                               1000.0, slit_slice)
+    return calib, cutout
+
+
+def benchmark(ndet, dtype, nslits, nspec, nspat, seed=1234):
+    """
+    Time jwst_mosaic over nslits synthetic slits.
+
+    Returns
+    -------
+    time_per_slit : float
+        Mean wall-clock time per slit in seconds.
+    peak_mem : float
+        Peak memory allocated while building one mosaic, in MB.
+    shape : tuple
+        Shape of the mosaic.
+    """
+    rng = np.random.default_rng(seed)
+    spectrograph = load_spectrograph('jwst_nirspec')
+    detectors = [spectrograph.get_detector_par(min(idet + 1, 2)) for idet in range(ndet)]
+    slits = [[fake_slit(detectors[idet], 'NRS{0}'.format(idet + 1), 20 + 3*idet, nspec, nspat, rng)
+              for idet in range(ndet)] for islit in range(nslits)]
+
+    # Peak memory of a single mosaic
+    calibs, cutouts = zip(*slits[0])
+    tracemalloc.start()
+    sciImg, _, _, _, _ = jwst_mosaic(cutouts, calibs, dtype=dtype)
+    _, peak_mem = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    shape = sciImg.image.shape
+
+    t0 = time.perf_counter()
+    for slit in slits:
+        calibs, cutouts = zip(*slit)
+        jwst_mosaic(cutouts, calibs, dtype=dtype)
+    time_per_slit = (time.perf_counter() - t0) / nslits
+    return time_per_slit, peak_mem / 1024**2, shape
+
+
+def parse_args(options=None):
+    parser = argparse.ArgumentParser(description='Benchmark the time and memory used by jwst_mosaic per slit')
+    parser.add_argument('--nslits', type=int, default=20, help='Number of synthetic slits to mosaic')
+    parser.add_argument('--nspec', type=int, default=2048, help='Spectral pixels of the slit on each detector')
+    parser.add_argument('--nspat', type=int, default=40, help='Spatial pixels of the slit on each detector')
+    parser.add_argument('--ndet', type=int, nargs='+', default=[1, 2], help='Number of detectors in the mosaic')
+    parser.add_argument('--dtype', type=str, nargs='+', default=['float64', 'float32'],
+                        help='Data types of the mosaic images')
+    return parser.parse_args(options)
+
+
+def main(args):
+    print('{0:>5} {1:>8} {2:>14} {3:>15} {4:>14}'.format('ndet', 'dtype', 'shape', 'time/slit [ms]',
+                                                          'peak mem [MB]'))
+    for ndet in args.ndet:
+        for dtype in args.dtype:
+            time_per_slit, peak_mem, shape = benchmark(ndet, np.dtype(dtype).type, args.nslits, args.nspec,
+                                                       args.nspat)
+            print('{0:>5d} {1:>8} {2:>14} {3:>15.2f} {4:>14.1f}'.format(ndet, dtype, str(shape),
+                                                                      1e3*time_per_slit, peak_mem))
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,454 @@
+"""
+Batch extraction of NIRCam WFSS subimages for a catalog of sources.
+
+:func:`~pypeitdev.jwst.jwst_utils.jwst_nircam_subimgs` reopens the rate file, rebuilds the WCS transform and the grism
+configuration and reads the full detector images for every target, which is slow for the thousands of grism sources of
+a field. Here every rate file is opened once:
+
+    - all the source positions are transformed from RA/DEC to detector pixels in a single call of the WCS transform,
+    - the bounding boxes of the traces are indexed on a grid of cells (:class:`TraceBoxIndex`), which gives for every
+      source the other traces overlapping it and the fraction of its subimage that they cover,
+    - the subimages of all the sources are cut from the images in memory and written to one HDF5 file, with a group
+      per rate file and a subgroup per source, named after the catalog row of the source (``source_<row>``) since
+      the source ids need not be unique or valid HDF5 names. The id is an attribute of the subgroup.
+
+The rate files are processed in parallel by a pool of worker processes, each writing a temporary HDF5 file that is
+merged into the output file at the end.
+
+Example::
+
+    python jwst_nircam_wfss_batch.py '/path/to/rate/*_nrcalong_rate.fits' --catalog sources.ecsv \\
+        --configfile NIRCAM_F356W_modA_R.conf --h5name F356W_subimgs.h5 --nproc 4
+"""
+import os
+import glob
+import shutil
+import argparse
+import tempfile
+import traceback
+import multiprocessing
+from functools import partial
+
+import numpy as np
+import h5py
+from astropy.io import fits
+from astropy.table import Table
+
+import grismconf
+from jwst import datamodels
+
+from pypeit import msgs
+from pypeit import __version__
+
+from pypeitdev.fileio import atomic_write
+
+
+class TraceBoxIndex:
+    """
+    Spatial index of the bounding boxes of grism traces.
+
+    Every box is registered in the cells of a regular grid that it touches, so only the boxes sharing a cell are
+    tested for overlap.
+
+    Parameters
+    ----------
+    bboxes : `numpy.ndarray`_
+        Bounding boxes, shape (nbox, 4), with the inclusive pixel limits xmin, xmax, ymin, ymax.
+    cell : int, optional
+        Size of the cells in pixels. It should be comparable to the shorter side of the boxes.
+    """
+    def __init__(self, bboxes, cell=128):
+        self.bboxes = np.asarray(bboxes, dtype=int).reshape(-1, 4)
+        self.cell = cell
+        self.cells = {}
+        cell_lims = self.bboxes // cell
+        for ibox, (cx0, cx1, cy0, cy1) in enumerate(cell_lims):
+            for cx in range(cx0, cx1 + 1):
+                for cy in range(cy0, cy1 + 1):
+                    self.cells.setdefault((cx, cy), []).append(ibox)
+
+    def __len__(self):
+        return self.bboxes.shape[0]
+
+    def query(self, bbox, exclude=None):
+        """
+        Indices of the boxes overlapping a bounding box, sorted.
+
+        Parameters
+        ----------
+        bbox : array-like
+            The inclusive pixel limits xmin, xmax, ymin, ymax.
+        exclude : int, optional
+            Index of a box to leave out, e.g. the box itself.
+        """
+        cx0, cx1, cy0, cy1 = np.asarray(bbox, dtype=int) // self.cell
+        candidates = set()
+        for cx in range(cx0, cx1 + 1):
+            for cy in range(cy0, cy1 + 1):
+                candidates.update(self.cells.get((cx, cy), []))
+        candidates.discard(exclude)
+        if len(candidates) == 0:
+            return np.zeros(0, dtype=int)
+        candidates = np.array(sorted(candidates))
+        boxes = self.bboxes[candidates]
+        overlap = (boxes[:, 0] <= bbox[1]) & (boxes[:, 1] >= bbox[0]) \
+                  & (boxes[:, 2] <= bbox[3]) & (boxes[:, 3] >= bbox[2])
+        return candidates[overlap]
+
+    def contamination(self, ibox):
+        """
+        Boxes overlapping a box and the fraction of the box that they cover.
+
+        Returns
+        -------
+        contaminants : `numpy.ndarray`_
+            Indices of the overlapping boxes.
+        contam_frac : float
+            Fraction of the pixels of the box covered by at least one other box.
+        """
+        bbox = self.bboxes[ibox]
+        contaminants = self.query(bbox, exclude=ibox)
+        if contaminants.size == 0:
+            return contaminants, 0.0
+        covered = np.zeros((bbox[3] - bbox[2] + 1, bbox[1] - bbox[0] + 1), dtype=bool)
+        for xmin, xmax, ymin, ymax in self.bboxes[contaminants]:
+            covered[max(ymin, bbox[2]) - bbox[2]:min(ymax, bbox[3]) - bbox[2] + 1,
+                    max(xmin, bbox[0]) - bbox[0]:min(xmax, bbox[1]) - bbox[0] + 1] = True
+        return contaminants, np.mean(covered)
+
+
+def wfss_source_pixels(rate_model, ra, dec, yoffset=0.):
+    """
+    Detector pixel positions of a set of sources, from a single call of the WCS transform.
+
+    Parameters
+    ----------
+    rate_model : `jwst.datamodels.ImageModel`
+        Rate file with the WCS assigned.
+    ra, dec : `numpy.ndarray`_
+        Coordinates of the sources in degrees.
+    yoffset : float, optional
+        Offset in pixels added to the y positions, see :func:`~pypeitdev.jwst.jwst_utils.jwst_nircam_subimgs`.
+
+    Returns
+    -------
+    x0, y0 : `numpy.ndarray`_
+        Positions of the sources in detector pixels.
+    """
+    ra, dec = np.atleast_1d(ra).astype(float), np.atleast_1d(dec).astype(float)
+    world_to_pix = rate_model.meta.wcs.get_transform('world', 'detector')
+    x0, y0, _, _ = world_to_pix(ra, dec, np.zeros_like(ra), np.zeros_like(ra))
+    return np.asarray(x0, dtype=float), np.asarray(y0, dtype=float) + yoffset
+
+
+def wfss_trace_bboxes(C, x0, y0, shape, wave_range=(2.99, 4.21), yhsize=20., order='+1'):
+    """
+    Bounding boxes of the grism traces of a set of sources.
+
+    The boxes are the same as the subimages cut by :func:`~pypeitdev.jwst.jwst_utils.jwst_nircam_subimgs`.
+
+    Parameters
+    ----------
+    C : `grismconf.Config`
+        Grism configuration.
+    x0, y0 : `numpy.ndarray`_
+        Positions of the sources in detector pixels.
+    shape : tuple
+        Shape of the detector images.
+    wave_range : tuple, optional
+        Wavelength range of the traces in microns.
+    yhsize : float, optional
+        Half size in pixels of the boxes in the cross-dispersion direction.
+    order : str, optional
+        Spectral order of the traces.
+
+    Returns
+    -------
+    bboxes : `numpy.ndarray`_
+        Inclusive pixel limits xmin, xmax, ymin, ymax of the boxes, shape (nsrc, 4).
+    valid : `numpy.ndarray`_
+        Sources with a position and a trace on the detector.
+    """
+    ny, nx = shape
+    nsrc = x0.size
+    bboxes = np.zeros((nsrc, 4), dtype=int)
+    valid = np.isfinite(x0) & np.isfinite(y0)
+    waves = np.asarray(wave_range, dtype=float)
+    # The trace model polynomials depend on the source position, so the end points are computed for one source at a
+    # time. This is cheap compared to the WCS transform and the subimages.
+    for isrc in np.where(valid)[0]:
+        t = C.INVDISPL(order, x0[isrc], y0[isrc], waves)
+        x_line = x0[isrc] + C.DISPX(order, x0[isrc], y0[isrc], t)
+        y_line = y0[isrc] + C.DISPY(order, x0[isrc], y0[isrc], t)
+        if not np.all(np.isfinite(x_line) & np.isfinite(y_line)):
+            valid[isrc] = False
+            continue
+        bboxes[isrc] = [max(0, np.int32(np.min(x_line))), min(nx - 1, np.int32(np.max(x_line))),
+                        max(0, np.int32(np.min(y_line - yhsize))), min(ny - 1, np.int32(np.max(y_line + yhsize)))]
+    valid &= (bboxes[:, 1] >= bboxes[:, 0]) & (bboxes[:, 3] >= bboxes[:, 2])
+    return bboxes, valid
+
+
+def wfss_subimage(C, grism, x0, y0, bbox, images, order='+1', senscorrect=False):
+    """
+    Cut the subimage of a source and compute its wavelength and cross-dispersion distance images.
+
+    This follows :func:`~pypeitdev.jwst.jwst_utils.jwst_nircam_subimgs`: the subimages are transposed for the column
+    grism so that the spectrum always runs along the rows, and they can be divided by the sensitivity function of the
+    grism configuration at the mean wavelength of each column. Unlike jwst_nircam_subimgs, which divides the variances
+    by the sensitivity too, the variances are divided by its square.
+
+    Parameters
+    ----------
+    C : `grismconf.Config`
+        Grism configuration.
+    grism : str
+        Grism, 'R' or 'C'.
+    x0, y0 : float
+        Position of the source in detector pixels.
+    bbox : array-like
+        Inclusive pixel limits xmin, xmax, ymin, ymax of the subimage.
+    images : dict
+        Full detector images to cut.
+    order : str, optional
+        Spectral order of the trace.
+    senscorrect : bool, optional
+        Divide the 'sci' and variance ('var_*') subimages by the sensitivity function.
+
+    Returns
+    -------
+    subimgs : dict
+        The subimages of every entry of images, the wavelength image ('wave') and the cross-dispersion distance from
+        the trace ('dspat').
+    """
+    xmin, xmax, ymin, ymax = bbox
+    ys, xs = np.indices((ymax - ymin + 1, xmax - xmin + 1))
+    xs = xs + xmin - x0
+    ys = ys + ymin - y0
+    if grism == 'R':
+        ts = C.INVDISPX(order, x0, y0, xs)
+        dys = ys - C.DISPY(order, x0, y0, ts)
+    elif grism == 'C':
+        ts = C.INVDISPY(order, x0, y0, ys)
+        dys = C.DISPX(order, x0, y0, ts) + xs
+    else:
+        msgs.error('Unknown grism {0}'.format(grism))
+    ws = C.DISPL(order, x0, y0, ts)
+
+    subimgs = {key: img[ymin:ymax + 1, xmin:xmax + 1] for key, img in images.items()}
+    subimgs['wave'] = ws.astype(float)
+    subimgs['dspat'] = dys.astype(float)
+    if grism == 'C':
+        subimgs = {key: img.T for key, img in subimgs.items()}
+    if senscorrect:
+        sens = 1e-18*C.SENS[order](np.nanmean(subimgs['wave'], axis=0))
+        for key in subimgs.keys():
+            if key == 'sci':
+                subimgs[key] = subimgs[key]/sens
+            elif key.startswith('var_'):
+                subimgs[key] = subimgs[key]/sens**2
+    return subimgs
+
+
+def extract_rate_file(rate_file, configfile, source_ids, ra, dec, h5file, wave_range=(2.99, 4.21), yhsize=20.,
+                      yoffset=0., order='+1', cell=128, compression=None, senscorrect=False):
+    """
+    Extract the subimages of all the sources of a catalog from one rate file into an HDF5 file.
+
+    The file has one group named after the rate file, with the catalog positions, bounding boxes and contamination of
+    all the sources as datasets, and one subgroup per source on the detector with its subimages. The subgroups are
+    named ``source_<row>`` after the row of the source in the catalog and have the source id as an attribute.
+
+    Parameters
+    ----------
+    rate_file : str
+        Rate file with the WCS assigned.
+    configfile : str
+        Grism configuration file.
+    source_ids : `numpy.ndarray`_
+        Identifiers of the sources.
+    ra, dec : `numpy.ndarray`_
+        Coordinates of the sources in degrees.
+    h5file : str
+        Output HDF5 file, written with :func:`~pypeitdev.fileio.atomic_write`.
+    wave_range, yhsize, order : optional
+        See :func:`wfss_trace_bboxes`.
+    yoffset : float, optional
+        See :func:`wfss_source_pixels`.
+    cell : int, optional
+        Cell size of the :class:`TraceBoxIndex`.
+    compression : str, optional
+        HDF5 compression filter of the subimages, e.g. 'gzip' or 'lzf'. Compression makes the file much smaller for
+        sparse or smooth images, but slows down the extraction several times for noisy rate images.
+    senscorrect : bool, optional
+        See :func:`wfss_subimage`.
+
+    Returns
+    -------
+    nextract : int
+        Number of subimages written.
+    """
+    source_ids = np.asarray(source_ids).astype(str)
+    header = fits.getheader(rate_file, 0)
+    grism = header['PUPIL'][-1]
+    C = grismconf.Config(configfile)
+
+    with datamodels.open(rate_file) as rate_model:
+        x0, y0 = wfss_source_pixels(rate_model, ra, dec, yoffset=yoffset)
+        # Keep the native (float32) precision of the rate images, which halves the size of the output
+        images = dict(sci=np.asarray(rate_model.data), var_tot=np.square(rate_model.err),
+                      var_poisson=np.asarray(rate_model.var_poisson), var_rnoise=np.asarray(rate_model.var_rnoise),
+                      dq=np.asarray(rate_model.dq))
+
+    bboxes, valid = wfss_trace_bboxes(C, x0, y0, images['sci'].shape, wave_range=wave_range, yhsize=yhsize,
+                                      order=order)
+    isrc_valid = np.where(valid)[0]
+    index = TraceBoxIndex(bboxes[isrc_valid], cell=cell)
+    msgs.info('{0}: {1} of {2} sources on the detector'.format(os.path.basename(rate_file), isrc_valid.size,
+                                                              source_ids.size))
+
+    ncontam = np.zeros(source_ids.size, dtype=int)
+    contam_frac = np.zeros(source_ids.size)
+    with atomic_write(h5file) as tmpfile, h5py.File(tmpfile, 'w') as h5:
+        grp = h5.create_group(os.path.basename(rate_file).replace('.fits', ''))
+        grp.attrs.update(dict(rate_file=os.path.abspath(rate_file), configfile=os.path.abspath(configfile),
+                              grism=grism, filter=header['FILTER'], module=header['MODULE'], order=order,
+                              wave_range=np.asarray(wave_range), yhsize=yhsize, yoffset=yoffset,
+                              senscorrect=senscorrect, pypeit_version=__version__))
+        for ibox, isrc in enumerate(isrc_valid):
+            contaminants, contam_frac[isrc] = index.contamination(ibox)
+            ncontam[isrc] = contaminants.size
+            subimgs = wfss_subimage(C, grism, x0[isrc], y0[isrc], bboxes[isrc], images, order=order,
+                                    senscorrect=senscorrect)
+            src = grp.create_group('source_{0}'.format(isrc))
+            for key, img in subimgs.items():
+                src.create_dataset(key, data=img, compression=compression)
+            src.attrs.update(dict(source_id=source_ids[isrc], row=isrc, ra=ra[isrc], dec=dec[isrc], x0=x0[isrc],
+                                  y0=y0[isrc], bbox=bboxes[isrc], contam_frac=contam_frac[isrc],
+                                  contaminants=source_ids[isrc_valid[contaminants]].astype('S'),
+                                  contaminant_rows=isrc_valid[contaminants]))
+        for key, value in dict(source_id=source_ids.astype('S'), ra=ra, dec=dec, x0=x0, y0=y0, bbox=bboxes,
+                               on_detector=valid, ncontam=ncontam, contam_frac=contam_frac).items():
+            grp.create_dataset(key, data=value)
+    return isrc_valid.size
+
+
+def _extract_rate_file_worker(rate_file, h5file, args, kwargs):
+    """
+    Run :func:`extract_rate_file` in a worker process, catching any failure so that it only affects this rate file.
+    """
+    try:
+        extract_rate_file(rate_file, *args, h5file, **kwargs)
+        return rate_file, h5file, None
+    except Exception:
+        return rate_file, h5file, traceback.format_exc()
+
+
+def batch_wfss_subimgs(rate_files, configfile, source_ids, ra, dec, h5name, nproc=1, overwrite=False, **kwargs):
+    """
+    Extract the subimages of a catalog of sources from a set of rate files into a single HDF5 file.
+
+    Parameters
+    ----------
+    rate_files : list
+        Rate files with the WCS assigned, from the same filter, module and grism.
+    configfile : str
+        Grism configuration file.
+    source_ids, ra, dec : `numpy.ndarray`_
+        The catalog of sources.
+    h5name : str
+        Output HDF5 file, with one group per rate file, see :func:`extract_rate_file`.
+    nproc : int, optional
+        Number of worker processes, each processing one rate file at a time.
+    overwrite : bool, optional
+        Overwrite the groups of rate files already in h5name. By default those rate files are skipped.
+    kwargs :
+        Passed to :func:`extract_rate_file`.
+
+    Returns
+    -------
+    failures : dict
+        Traceback of every rate file that could not be processed.
+    """
+    done = set()
+    if os.path.isfile(h5name):
+        with h5py.File(h5name, 'r') as h5:
+            done = set(h5.keys())
+    groups = [os.path.basename(rate_file).replace('.fits', '') for rate_file in rate_files]
+    todo = [rate_file for rate_file, group in zip(rate_files, groups) if overwrite or group not in done]
+    if len(todo) < len(rate_files):
+        msgs.info('Skipping {0} rate files already in {1}'.format(len(rate_files) - len(todo), h5name))
+    if len(todo) == 0:
+        return {}
+
+    outdir = os.path.dirname(os.path.abspath(h5name))
+    scratch = tempfile.mkdtemp(prefix='wfss_subimgs_', dir=outdir)
+    failures = {}
+    try:
+        jobs = [(rate_file, os.path.join(scratch, '{0:04d}.h5'.format(ijob))) for ijob, rate_file in enumerate(todo)]
+        worker = partial(_extract_rate_file_worker, args=(configfile, source_ids, ra, dec), kwargs=kwargs)
+        if nproc <= 1:
+            results = (worker(*job) for job in jobs)
+        else:
+            with multiprocessing.get_context('spawn').Pool(processes=min(nproc, len(jobs))) as pool:
+                results = pool.starmap(worker, jobs, chunksize=1)
+        # Merge the per-rate file outputs in the order of the rate files
+        with h5py.File(h5name, 'a') as h5:
+            for rate_file, h5file, tb in results:
+                if tb is not None:
+                    msgs.warn('Subimage extraction of {0} failed:\n{1}'.format(rate_file, tb))
+                    failures[rate_file] = tb
+                    continue
+                with h5py.File(h5file, 'r') as h5in:
+                    for group in h5in.keys():
+                        if group in h5:
+                            del h5[group]
+                        h5in.copy(h5in[group], h5, name=group)
+                os.remove(h5file)
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    msgs.info('Wrote subimages of {0} rate files to {1}'.format(len(todo) - len(failures), h5name))
+    return failures
+
+
+def parse_args(options=None):
+    parser = argparse.ArgumentParser(description='Batch extraction of NIRCam WFSS subimages for a catalog of sources')
+    parser.add_argument('files', type=str, nargs='+', help='Rate files or glob patterns')
+    parser.add_argument('--catalog', type=str, required=True, help='Source catalog readable by astropy Table')
+    parser.add_argument('--id_col', type=str, default='id', help='Column of the catalog with the source ids')
+    parser.add_argument('--ra_col', type=str, default='ra', help='Column of the catalog with the RA in degrees')
+    parser.add_argument('--dec_col', type=str, default='dec', help='Column of the catalog with the DEC in degrees')
+    parser.add_argument('--configfile', type=str, required=True, help='Grism configuration file')
+    parser.add_argument('--h5name', type=str, required=True, help='Output HDF5 file')
+    parser.add_argument('--wave_range', type=float, nargs=2, default=[2.99, 4.21],
+                        help='Wavelength range of the traces in microns')
+    parser.add_argument('--yhsize', type=float, default=20., help='Cross-dispersion half size of the subimages')
+    parser.add_argument('--yoffset', type=float, default=0., help='Offset added to the y positions of the sources')
+    parser.add_argument('--order', type=str, default='+1', help='Spectral order of the traces')
+    parser.add_argument('--cell', type=int, default=128, help='Cell size in pixels of the trace spatial index')
+    parser.add_argument('--compression', type=str, default=None, choices=['gzip', 'lzf'],
+                        help='HDF5 compression of the subimages')
+    parser.add_argument('--senscorrect', default=False, action='store_true',
+                        help='Divide the subimages by the sensitivity function of the grism configuration')
+    parser.add_argument('--nproc', type=int, default=1, help='Number of worker processes')
+    parser.add_argument('--overwrite', default=False, action='store_true',
+                        help='Re-extract rate files already in the HDF5 file')
+    return parser.parse_args(options)
+
+
+def main(args):
+    rate_files = sorted(set(f for pattern in args.files for f in glob.glob(pattern)))
+    if len(rate_files) == 0:
+        msgs.error('No rate files found matching {0}'.format(args.files))
+    catalog = Table.read(args.catalog)
+    failures = batch_wfss_subimgs(rate_files, args.configfile, np.asarray(catalog[args.id_col]),
+                                  np.asarray(catalog[args.ra_col], dtype=float),
+                                  np.asarray(catalog[args.dec_col], dtype=float), args.h5name, nproc=args.nproc,
+                                  overwrite=args.overwrite, wave_range=tuple(args.wave_range), yhsize=args.yhsize,
+                                  yoffset=args.yoffset, order=args.order, cell=args.cell,
+                                  compression=args.compression, senscorrect=args.senscorrect)
+    return 1 if len(failures) > 0 else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main(parse_args()))
@@ -1,4 +1,11 @@
 import os
+import time
+import fcntl
+import argparse
+import traceback
+import threading
+import multiprocessing
+from contextlib import contextmanager
 from pathlib import Path
 import numpy as np
 from astropy.io import fits
@@ -23,7 +30,8 @@ from jwst import datamodels
 DO_NOT_USE = datamodels.dqflags.pixel['DO_NOT_USE']
 
 # PypeIt imports
-from pypeitdev.jwst.jwst_utils import NIRSpecSlitCalibrations, jwst_mosaic, jwst_reduce
+from pypeitdev.jwst.jwst_utils import NIRSpecSlitCalibrations, NIRSpecRateImage, jwst_slit_index, jwst_file_checksum, \
+    jwst_mosaic, jwst_reduce
 from pypeitdev.jwst import jwst_targets
 from pypeit.metadata import PypeItMetaData
 from pypeit.display import display
@@ -110,13 +118,353 @@ def validate_redux_input(reduce_input, name):
     
 
 
+# Environment variables that cap the number of threads used by the numerical libraries in each calwebb worker
+THREAD_ENV_VARS = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS',
+                   'NUMEXPR_NUM_THREADS']
+
+
+@contextmanager
+def calwebb_lock(outfile, poll=10.0):
+    """
+    Context manager that holds an exclusive lock on a calwebb output file while it is being produced.
+
+    The lock is an advisory ``flock`` on ``outfile + '.lock'``, so that several redux runs on the same program
+    (e.g. for different slits or sources) that share an output directory do not run calwebb on the same exposure at
+    the same time and clobber each others outputs. The lock file is removed when the lock is released, so none are
+    left in the output directory.
+
+    Parameters
+    ----------
+    outfile : str
+        The calwebb output file that is guarded by the lock.
+    poll : float, optional
+        Time in seconds between messages while waiting for another process to release the lock.
+
+    Yields
+    ------
+    waited : bool
+        True if the lock was held by another process when we tried to acquire it.
+    """
+    lockfile = outfile + '.lock'
+    waited = False
+    while True:
+        fh = open(lockfile, 'a')
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            fh.close()
+            if not waited:
+                msgs.info('Waiting for another process to finish producing {0}'.format(outfile))
+            waited = True
+            time.sleep(poll)
+            continue
+        # The process that held the lock may have removed the lock file after we opened it, in which case we hold
+        # a lock on a file that other processes can no longer see. Start again with the current lock file.
+        try:
+            if os.path.samestat(os.fstat(fh.fileno()), os.stat(lockfile)):
+                break
+        except FileNotFoundError:
+            pass
+        fh.close()
+        waited = True
+    try:
+        yield waited
+    finally:
+        # Remove the lock file while we still hold the lock, see above
+        try:
+            os.remove(lockfile)
+        except FileNotFoundError:
+            pass
+        fcntl.flock(fh, fcntl.LOCK_UN)
+        fh.close()
+
+
+def run_calwebb_stage(stage, infile, outfile, output_dir, steps=None, overwrite=False):
+    """
+    Run calwebb stage 1 (Detector1Pipeline) or stage 2 (Spec2Pipeline) on a single exposure.
+
+    The stage is skipped if outfile already exists and overwrite is False, or if another process produced it while
+    we were waiting on the lock.
+
+    Parameters
+    ----------
+    stage : int
+        The calwebb stage to run. Must be 1 or 2.
+    infile : str
+        The uncal (stage 1) or rate (stage 2) file to process.
+    outfile : str
+        The output file whose existence indicates that the stage has already been run on this exposure.
+    output_dir : str
+        Directory for the calwebb outputs.
+    steps : dict, optional
+        Step parameters passed to the pipeline.
+    overwrite : bool, optional
+        Rerun the pipeline even if outfile exists.
+
+    Returns
+    -------
+    ran : bool
+        True if the pipeline was run, False if the existing outfile was used.
+    """
+    pipeline = {1: Detector1Pipeline, 2: Spec2Pipeline}[stage]
+    with calwebb_lock(outfile) as waited:
+        if os.path.isfile(outfile) and (not overwrite or waited):
+            msgs.info('Using existing stage{0} file: {1}'.format(stage, outfile))
+            return False
+        msgs.info('Running calwebb stage{0} on {1}'.format(stage, infile))
+        pipeline.call(infile, save_results=True, output_dir=output_dir, steps={} if steps is None else steps)
+    return True
+
+
+def _run_calwebb_stage_star(args):
+    return run_calwebb_stage(*args)
+
+
+def run_calwebb_stages(stage, infiles, outfiles, output_dir, steps=None, overwrite=False, nproc=1, nthreads=1):
+    """
+    Run a calwebb stage on a set of exposures, optionally in parallel.
+
+    Every exposure and detector is independent, so they are distributed over a pool of nproc worker processes.
+    Each worker has the number of threads used by the numerical libraries capped at nthreads, so that the pool does
+    not oversubscribe the machine.
+
+    The workers are started with the ``spawn`` method, so they import the ``__main__`` module of the calling script.
+    A driver script that calls this with nproc > 1 must therefore run its reduction under an
+    ``if __name__ == '__main__':`` guard, otherwise every worker runs the script again.
+
+    Parameters
+    ----------
+    stage : int
+        The calwebb stage to run. Must be 1 or 2.
+    infiles : list
+        The input files, one per exposure and detector.
+    outfiles : list
+        The output file for each input file used for the skip-if-exists test, see :func:`run_calwebb_stage`.
+    output_dir : str
+        Directory for the calwebb outputs.
+    steps : dict, optional
+        Step parameters passed to the pipeline.
+    overwrite : bool, optional
+        Rerun the pipeline even if the outputs exist.
+    nproc : int, optional
+        Number of worker processes. If 1, the exposures are processed serially in this process.
+    nthreads : int, optional
+        Maximum number of threads used by the numerical libraries in each worker process.
+
+    Returns
+    -------
+    ran : list
+        For each input file, True if the pipeline was run, False if the existing output was used.
+    """
+    args = [(stage, infile, outfile, output_dir, steps, overwrite) for infile, outfile in zip(infiles, outfiles)]
+    nproc = min(nproc, len(args))
+    if nproc <= 1:
+        return [run_calwebb_stage(*arg) for arg in args]
+
+    msgs.info('Running calwebb stage{0} on {1} files using {2} processes with {3} threads each'.format(
+        stage, len(args), nproc, nthreads))
+    # The thread caps have to be in the environment before the workers import numpy, so set them while the pool is
+    # spawned and restore the environment afterwards.
+    saved_env = {var: os.environ.get(var) for var in THREAD_ENV_VARS}
+    os.environ.update({var: str(nthreads) for var in THREAD_ENV_VARS})
+    try:
+        with multiprocessing.get_context('spawn').Pool(processes=nproc) as pool:
+            ran = pool.map(_run_calwebb_stage_star, args, chunksize=1)
+    finally:
+        for var, value in saved_env.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+    return ran
+
+
+def jwst_reduce_slit(calibs, rate_data, spectrograph, par, basenames, bkg_indices=None, kludge_err=1.5,
+                     show=False):
+    """
+    Reduce every exposure of a single slit.
+
+    Parameters
+    ----------
+    calibs : list
+        The NIRSpecSlitCalibrations for the slit, one per detector.
+    rate_data : np.ndarray
+        Object array with shape (ndet, nexp) holding the nsclean image datamodels, or the
+        :class:`~pypeitdev.jwst.jwst_utils.NIRSpecRateCutout` of those images for this slit.
+    spectrograph : :class:`~pypeit.spectrographs.spectrograph.Spectrograph`
+        The JWST NIRSpec spectrograph.
+    par : :class:`~pypeit.par.pypeitpar.PypeItPar`
+        Reduction parameters.
+    basenames : list
+        Basename of each exposure.
+    bkg_indices : list, optional
+        For each exposure, the indices of the exposures to combine and subtract as the background. If None, no
+        background image is subtracted.
+    kludge_err : float, optional
+        Factor to scale the sigma error maps up by.
+    show : bool, optional
+        Show the images and QA for the reduction in the ginga window.
+
+    Returns
+    -------
+    slit_results : list
+        For each exposure a tuple with the detector (or mosaic) name, the
+        :class:`~pypeit.spec2dobj.Spec2DObj` and a list of the extracted
+        :class:`~pypeit.specobj.SpecObj` objects.
+    """
+    bkg_redux = bkg_indices is not None
+    noise_floor = par['scienceframe']['process']['noise_floor']
+    slit_results = []
+    for iexp in range(rate_data.shape[1]):
+        # Create the image mosaic
+        sciImg, slits, waveimg, tilts, ndet = jwst_mosaic(rate_data[:, iexp], calibs, kludge_err=kludge_err,
+                                                          noise_floor=noise_floor, show=show)
+
+        # If this is a bkg_redux, perform background subtraction
+        if bkg_redux:
+            ibkg = bkg_indices[iexp]
+            bkgImg_list = []
+            for rate_data_i in rate_data[:, ibkg]:
+                bkgImg_i, _, _, _, _ = jwst_mosaic(rate_data_i, calibs, kludge_err=kludge_err,
+                                                   noise_floor=noise_floor)
+                bkgImg_list.append(bkgImg_i)
+
+            # TODO the parset label here may change in Pypeit to bkgframe
+            combineImage = combineimage.CombineImage(bkgImg_list, spectrograph, par['scienceframe']['process'])
+            bkgImg = combineImage.run(ignore_saturation=True)
+            sciImg = sciImg.sub(bkgImg)
+
+        # Run the reduction
+        spec2DObj, tmp_sobjs = jwst_reduce(sciImg, slits, waveimg, tilts, spectrograph, par,
+                                           show=show, find_negative=bkg_redux, bkg_redux=bkg_redux,
+                                           clear_ginga=False, show_peaks=show, show_skysub_fit=show,
+                                           basename=basenames[iexp])
+        if show and tmp_sobjs.nobj > 0:
+            # Plot boxcar
+            wv_gpm_box = tmp_sobjs[0].BOX_WAVE > 1.0
+            gpm_temp = tmp_sobjs[0].BOX_MASK[wv_gpm_box]
+            flux_temp = tmp_sobjs[0].BOX_COUNTS[wv_gpm_box] * gpm_temp
+
+            data = np.ma.MaskedArray(flux_temp, mask=np.logical_not(gpm_temp))
+            sigclip = stats.SigmaClip(sigma=5.0, maxiters=15, cenfunc='median', stdfunc=nan_mad_std)
+            data_clipped, lower, upper = sigclip(data, masked=True, return_bounds=True)
+            gpm_clip = np.logical_not(data_clipped.mask)  # mask_stack = True are good values
+            flux_sm = fast_running_median(flux_temp*gpm_clip, 10)
+            sigma_sm = fast_running_median(tmp_sobjs[0].BOX_COUNTS_SIG[wv_gpm_box], 100)
+            ymax = 1.2*np.max(flux_sm)
+            ymin = -np.max(sigma_sm)
+            plt.plot(tmp_sobjs[0].BOX_WAVE[wv_gpm_box],tmp_sobjs[0].BOX_COUNTS[wv_gpm_box] * tmp_sobjs[0].BOX_MASK[wv_gpm_box],
+            color='green', drawstyle='steps-mid', label='Boxcar Counts')
+            plt.plot(tmp_sobjs[0].BOX_WAVE[wv_gpm_box], tmp_sobjs[0].BOX_COUNTS_SIG[wv_gpm_box] * tmp_sobjs[0].BOX_MASK[wv_gpm_box],
+                color='cyan', drawstyle='steps-mid', label='Boxcar Counts Error')
+
+            # plot optimal
+            if tmp_sobjs[0].OPT_WAVE is not None:
+                wv_gpm_opt = tmp_sobjs[0].OPT_WAVE > 1.0
+                plt.plot(tmp_sobjs[0].OPT_WAVE[wv_gpm_opt], tmp_sobjs[0].OPT_COUNTS[wv_gpm_opt] * tmp_sobjs[0].OPT_MASK[wv_gpm_opt],
+                        color='black', drawstyle='steps-mid', label='Optimal Counts')
+                plt.plot(tmp_sobjs[0].OPT_WAVE[wv_gpm_opt], tmp_sobjs[0].OPT_COUNTS_SIG[wv_gpm_opt] * tmp_sobjs[0].OPT_MASK[wv_gpm_opt],
+                        color='red', drawstyle='steps-mid', label='Optimal Counts Error')
+
+            plt.ylim([ymin, ymax])
+            plt.legend()
+            plt.show()
+
+        slit_results.append((sciImg.detector.name, spec2DObj, [sobj for sobj in tmp_sobjs]))
+
+    return slit_results
+
+
+def _jwst_reduce_slit_worker(args):
+    """
+    Run :func:`jwst_reduce_slit` in a worker process, catching any failure so that it only affects this slit.
+    """
+    islit, isource, calibs, rate_cutouts, spectrograph, par, basenames, bkg_indices, kludge_err = args
+    try:
+        slit_results = jwst_reduce_slit(calibs, rate_cutouts, spectrograph, par, basenames,
+                                        bkg_indices=bkg_indices, kludge_err=kludge_err)
+    except Exception:
+        return islit, isource, None, traceback.format_exc()
+    return islit, isource, slit_results, None
+
+
+def write_slit_outputs(scipath, spectrograph, islit, isource, basenames, head2d_list, subheader_list, slit_results,
+                       bkg_redux=False):
+    """
+    Gather the reductions of a slit into SpecObjs and AllSpec2DObj and write the spec1d and spec2d files.
+
+    Parameters
+    ----------
+    scipath : str
+        Directory for the outputs.
+    spectrograph : :class:`~pypeit.spectrographs.spectrograph.Spectrograph`
+        The JWST NIRSpec spectrograph.
+    islit : str
+        Name of the slit.
+    isource : str
+        Name of the source in the slit.
+    basenames : list
+        Basename of each exposure.
+    head2d_list : list
+        Primary header of the rate file of each exposure.
+    subheader_list : list
+        Header cards for the spec1d file of each exposure.
+    slit_results : list
+        The output of :func:`jwst_reduce_slit`.
+    bkg_redux : bool, optional
+        Whether the background was subtracted using image differencing.
+    """
+    for iexp, (detname, spec2DObj, sobj_list) in enumerate(slit_results):
+        # Container for all the Spec2DObj, different spec2dobj and specobjs for each slit
+        all_spec2d = spec2dobj.AllSpec2DObj()
+        all_spec2d['meta']['bkg_redux'] = bkg_redux
+        all_spec2d['meta']['find_negative'] = bkg_redux
+        all_spec2d[detname] = spec2DObj
+        # Container for the specobjs
+        all_specobjs = specobjs.SpecObjs()
+        if len(sobj_list) > 0:
+            all_specobjs.add_sobj(sobj_list)
+
+        # THE FOLLOWING MIMICS THE CODE IN pypeit.save_exposure()
+        base_suffix = 'source_{:s}'.format(isource) if isource is not None else 'slit_{:s}'.format(islit)
+        basename = '{:s}_{:s}'.format(basenames[iexp], base_suffix)
+
+        # TODO Populate the header with metadata relevant to this source?
+
+        # Write out specobjs
+        # Build header for spec2d
+        head2d = head2d_list[iexp]
+        subheader = dict(subheader_list[iexp])
+        # Overload the target name with the source name
+        subheader['target'] = isource
+        if all_specobjs.nobj > 0:
+            outfile1d = os.path.join(scipath, 'spec1d_{:s}.fits'.format(basename))
+            all_specobjs.write_to_fits(subheader, outfile1d)
+
+        # Info
+        outfiletxt = os.path.join(scipath, 'spec1d_{:s}.txt'.format(basename))
+        all_specobjs.write_info(outfiletxt, spectrograph.pypeline)
+
+        # Build header for spec2d
+        outfile2d = os.path.join(scipath, 'spec2d_{:s}.fits'.format(basename))
+        # TODO For the moment hack so that we can write this out
+        pri_hdr = all_spec2d.build_primary_hdr(head2d, spectrograph, subheader=subheader,
+                                               redux_path=None, calib_dir=None)
+        # Write spec2d
+        all_spec2d.write_to_fits(outfile2d, pri_hdr=pri_hdr, overwrite=True)
+
 
 def jwst_run_redux(redux_dir, disperser, uncal_list=None, rate_list=None, 
                    reduce_slits=None, reduce_sources=None,
                    source_type='POINT', show=False, overwrite_stage1=False, overwrite_stage2=False, 
-                   kludge_err=1.5, bkg_redux=False):
+                   kludge_err=1.5, bkg_redux=False, nproc=1, nthreads=1, nproc_slits=1,
+                   calib_cache=False):
     """
     Main routine to reduce JWST NIRSpec data
+
+    With nproc > 1 or nproc_slits > 1 the work is done by ``spawn`` worker processes, which import the ``__main__``
+    module of the calling script, so the script must call this routine under an ``if __name__ == '__main__':``
+    guard.
     
     Parameters
     ----------
@@ -146,6 +494,25 @@ def jwst_run_redux(redux_dir, disperser, uncal_list=None, rate_list=None,
     bkg_redux : bool, optional
         If True, perform a background redux using image differencing. If False, model the background with a bspline. bkg_redux should typically be set to True for MSA reductions, 
         and False for FS reductions.
+    nproc : int, optional
+        Number of processes used to run the calwebb stage1 and stage2 pipelines. Each exposure and detector is
+        processed independently. Default is 1, i.e. run them serially.
+    nthreads : int, optional
+        Maximum number of threads used by the numerical libraries in each calwebb process when nproc > 1.
+    nproc_slits : int, optional
+        Number of processes used to reduce the slits. If larger than 1, each worker is sent the calibrations and
+        image cutouts for one slit at a time. Default is 1, i.e. reduce the slits serially in this process.
+    calib_cache : bool, optional
+        Cache the NIRSpecSlitCalibrations of each slit in the pypeit/Calibrations directory and reuse them on later
+        runs. The cache files are keyed by the checksums of the calwebb files and the calibration parameters. They
+        are never removed, so this is off by default; the command line turns it on unless ``--no_calib_cache`` is
+        given.
+
+    Returns
+    -------
+    failed_slits : list
+        The (slit, source) names of the slits whose reduction failed. A failure in the calibrations,
+        reduction or outputs of a slit only affects that slit.
     """
 
     _reduce_slits = validate_redux_input(reduce_slits, 'reduce_slits')
@@ -188,12 +555,10 @@ def jwst_run_redux(redux_dir, disperser, uncal_list=None, rate_list=None,
 
 
         #parameter_dict_det1 = {"jump": {"maximum_cores": 'quarter'},}
-        for uncal in uncalfiles_all:
-            ratefile = os.path.join(output_dir,  os.path.basename(uncal).replace('_uncal', '_rate'))
-            if os.path.isfile(ratefile) and not overwrite_stage1:
-                msgs.info('Using existing rate file: {0}'.format(ratefile))
-                continue
-            Detector1Pipeline.call(uncal, save_results=True, output_dir=output_dir) #, steps=parameter_dict_det1)
+        ratefiles_all = [os.path.join(output_dir,  os.path.basename(uncal).replace('_uncal', '_rate'))
+                         for uncal in uncalfiles_all]
+        run_calwebb_stages(1, uncalfiles_all, ratefiles_all, output_dir, overwrite=overwrite_stage1,
+                           nproc=nproc, nthreads=nthreads) #, steps=parameter_dict_det1)
 
     elif uncal_list is None and rate_list is not None:
         rate_files_1 = rate_list[0]
@@ -243,12 +608,10 @@ def jwst_run_redux(redux_dir, disperser, uncal_list=None, rate_list=None,
     #param_dict_spec2['nsclean'] = {'save_results': True, 'skip': False}
     # Run the spec2 pipeline
 
-    for sci in rate_files_all:
-        nscleanfile = os.path.join(output_dir, sci.replace('_rate', '_nsclean'))
-        if os.path.isfile(nscleanfile) and not overwrite_stage2:
-            msgs.info('Using existing nsclean file: {0}'.format(nscleanfile))
-            continue
-        Spec2Pipeline.call(sci, save_results=True, output_dir=output_dir, steps=param_dict_spec2)
+    nsclean_files_all = [os.path.join(output_dir, os.path.basename(sci).replace('_rate', '_nsclean'))
+                         for sci in rate_files_all]
+    run_calwebb_stages(2, rate_files_all, nsclean_files_all, output_dir, steps=param_dict_spec2,
+                       overwrite=overwrite_stage2, nproc=nproc, nthreads=nthreads)
 
 
     # Some pypeit things
@@ -334,17 +697,20 @@ def jwst_run_redux(redux_dir, disperser, uncal_list=None, rate_list=None,
 
     print('Reading in calwebb outputs. This may take a while...')
 
-    # TODO Figure out why this is so damn slow! I suspect it is calwebb1
-    for iexp in range(nexp):
-        # Open some JWST data models
-        #e2d_multi_list_1.append(datamodels.open(e2d_output_files_1[iexp]))
-        msa_data[0, iexp] = datamodels.open(msa_output_files_1[iexp])
-        flat_data[0, iexp] = datamodels.open(intflat_output_files_1[iexp])
-        cal_data[0, iexp] = datamodels.open(cal_output_files_1[iexp])
-
-        msa_data[1, iexp] = datamodels.open(msa_output_files_2[iexp])
-        flat_data[1, iexp] = datamodels.open(intflat_output_files_2[iexp])
-        cal_data[1, iexp] = datamodels.open(cal_output_files_2[iexp])
+    # The nsclean images are memory-mapped, and only the pixels of the slits being reduced are read from disk. The
+    # calibrations are only built from the reference exposure, so the cal and intflat files of the other exposures
+    # are never opened.
+    iexp_ref = 0
+    msa_output_files = [msa_output_files_1, msa_output_files_2]
+    intflat_output_files = [intflat_output_files_1, intflat_output_files_2]
+    cal_output_files = [cal_output_files_1, cal_output_files_2]
+    slit_indices = []
+    for idet in range(ndetectors):
+        for iexp in range(nexp):
+            msa_data[idet, iexp] = NIRSpecRateImage(msa_output_files[idet][iexp])
+        flat_data[idet, iexp_ref] = datamodels.open(intflat_output_files[idet][iexp_ref], memmap=True)
+        cal_data[idet, iexp_ref] = datamodels.open(cal_output_files[idet][iexp_ref], memmap=True)
+        slit_indices.append((jwst_slit_index(cal_data[idet, iexp_ref]), jwst_slit_index(flat_data[idet, iexp_ref])))
 
 
     # Create a set of aligned slit and source names for both detectors
@@ -352,11 +718,11 @@ def jwst_run_redux(redux_dir, disperser, uncal_list=None, rate_list=None,
 
     # Use the first exposure to se the slit names
     # (ndet, nslit)
-    slit_names_1 = [slit.name for slit in cal_data[0,0].slits]
-    slit_names_2 = [slit.name for slit in cal_data[1,0].slits]
+    slit_names_1 = [slit.name for slit in cal_data[0,iexp_ref].slits]
+    slit_names_2 = [slit.name for slit in cal_data[1,iexp_ref].slits]
     slit_names_tot = np.hstack([slit_names_1, slit_names_2])
-    source_names_1 = [slit.source_name for slit in cal_data[0,0].slits]
-    source_names_2 = [slit.source_name for slit in cal_data[1,0].slits]
+    source_names_1 = [slit.source_name for slit in cal_data[0,iexp_ref].slits]
+    source_names_2 = [slit.source_name for slit in cal_data[1,iexp_ref].slits]
     source_names_tot = np.hstack([source_names_1, source_names_2])
 
     # Find the unique slit names and the unique sources aligned with those slits
@@ -389,7 +755,6 @@ def jwst_run_redux(redux_dir, disperser, uncal_list=None, rate_list=None,
 
     # TODO Fix this, currently does not work if target names have - or _
     #out_filenames = basenames
-    iexp_ref = 0
     if not os.path.isdir(scipath):
         msgs.info('Creating directory for Science output: {0}'.format(scipath))
 
@@ -408,119 +773,102 @@ def jwst_run_redux(redux_dir, disperser, uncal_list=None, rate_list=None,
     else:
         gd_slits_sources = slit_sources_uni
 
-    # Loop over all slits. For each exposure create a mosaic and save them to individual PypeIt spec2d files.
-    for ii, (islit, isource) in enumerate(gd_slits_sources):
-
-        # Clear the ginga canvas for each new source/slit
+    # Header information for the outputs only depends on the exposure
+    head2d_list = [fits.getheader(rate_file) for rate_file in rate_files_1]
+    subheader_list = [spectrograph.subheader_for_spec(fitstbl_1[iexp], head2d_list[iexp], allow_missing=False)
+                      for iexp in range(nexp)]
+    _bkg_indices = bkg_indices if bkg_redux else None
+    f070_f100_rescale = 'bogus_FS_F100LP' in disperser
+
+    # TODO This step is only performed with a reference exposure because calwebb has an annoying property that
+    # it does not always extract the same subimage spectral pixels for the different dithers in the dither pattern.
+    # This seems to be a bug in calwebb, since it is unclear why the subimage calibrations should change.
+    # This is problem for 2d coadding, since then the offsets in the detector frame will be not allow one to register
+    # the frames. It is possible to fix this by using the RA/DEC images provided by calwebb to determine the
+    # actual locations on the sky, which would be preferable. However, this does not appear to be working correctly
+    # in calwebb. So for now, we just use the first exposure as the reference exposure for the calibrations.
+    if calib_cache:
+        calib_cache_dir = os.path.join(pypeit_output_dir, 'Calibrations')
+        calib_checksums = [(jwst_file_checksum(cal_output_files[idet][iexp_ref]),
+                            jwst_file_checksum(intflat_output_files[idet][iexp_ref])) for idet in range(ndetectors)]
+
+    def slit_calibrations(islit):
+        calibs = []
+        for idet in range(ndetectors):
+            args = (det_container_list[idet], cal_data[idet, iexp_ref], flat_data[idet, iexp_ref], islit)
+            kwargs = dict(f070_f100_rescale=f070_f100_rescale, slit_index=slit_indices[idet][0],
+                          flat_slit_index=slit_indices[idet][1])
+            if calib_cache:
+                cache_file = NIRSpecSlitCalibrations.cache_file(
+                    calib_cache_dir, islit, cal_data[idet, iexp_ref].meta.instrument.detector,
+                    calib_checksums[idet], f070_f100_rescale=f070_f100_rescale)
+                calibs.append(NIRSpecSlitCalibrations.from_cache(cache_file, *args, **kwargs))
+            else:
+                calibs.append(NIRSpecSlitCalibrations(*args, **kwargs))
+        return calibs
+
+    failed_slits = []
+    def slit_failed(islit, isource, error):
+        msgs.warn('Reduction of slit {0} (source {1}) failed:\n{2}'.format(islit, isource, error))
+        failed_slits.append((islit, isource))
+
+    if nproc_slits <= 1:
+        # Loop over all slits. For each exposure create a mosaic and save them to individual PypeIt spec2d files.
+        for ii, (islit, isource) in enumerate(gd_slits_sources):
+            # Clear the ginga canvas for each new source/slit
+            if show:
+                display.clear_all(allow_new=True)
+            try:
+                slit_results = jwst_reduce_slit(slit_calibrations(islit), msa_data, spectrograph, par, basenames,
+                                                bkg_indices=_bkg_indices, kludge_err=kludge_err, show=show)
+                write_slit_outputs(scipath, spectrograph, islit, isource, basenames, head2d_list, subheader_list,
+                                   slit_results, bkg_redux=bkg_redux)
+            except Exception:
+                slit_failed(islit, isource, traceback.format_exc())
+    else:
         if show:
-            display.clear_all(allow_new=True)
-
-        # TODO This step is only performed with a reference exposure because calwebb has an annoying property that
-        # it does not always extract the same subimage spectral pixels for the different dithers in the dither pattern.
-        # This seems to be a bug in calwebb, since it is unclear why the subimage calibrations should change.
-        # This is problem for 2d coadding, since then the offsets in the detector frame will be not allow one to register
-        # the frames. It is possible to fix this by using the RA/DEC images provided by calwebb to determine the
-        # actual locations on the sky, which would be preferable. However, this does not appear to be working correctly
-        # in calwebb. So for now, we just use the first exposure as the reference exposure for the calibrations.
-        CalibrationsNRS1 = NIRSpecSlitCalibrations(det_container_list[0], cal_data[0, iexp_ref], flat_data[0, iexp_ref],
-                                                islit, f070_f100_rescale='bogus_FS_F100LP' in disperser)
-        CalibrationsNRS2 = NIRSpecSlitCalibrations(det_container_list[1], cal_data[1, iexp_ref], flat_data[1, iexp_ref],
-                                                islit, f070_f100_rescale='bogus_FS_F100LP' in disperser)
-        for iexp in range(nexp):
-            # Container for all the Spec2DObj, different spec2dobj and specobjs for each slit
-            all_spec2d = spec2dobj.AllSpec2DObj()
-            all_spec2d['meta']['bkg_redux'] = bkg_redux
-            all_spec2d['meta']['find_negative'] = bkg_redux
-            # Container for the specobjs
-            all_specobjs = specobjs.SpecObjs()
-
-            # Create the image mosaic
-            sciImg, slits, waveimg, tilts, ndet = jwst_mosaic(msa_data[:, iexp], [CalibrationsNRS1, CalibrationsNRS2], kludge_err=kludge_err,
-                noise_floor=par['scienceframe']['process']['noise_floor'], show=show)
-            
-            #    show=show & (iexp == iexp_ref))
-
-            # If this is a bkg_redux, perform background subtraction
-            if bkg_redux:
-                ibkg = bkg_indices[iexp]
-                bkgImg_list = []
-                for msa_data_i in msa_data[:,ibkg]: 
-                    bkgImg_i, _, _, _, _= jwst_mosaic(msa_data_i, [CalibrationsNRS1, CalibrationsNRS2], kludge_err=kludge_err,
-                                            noise_floor=par['scienceframe']['process']['noise_floor'])
-                    bkgImg_list.append(bkgImg_i)
-
-                # TODO the parset label here may change in Pypeit to bkgframe
-                combineImage = combineimage.CombineImage(bkgImg_list, spectrograph, par['scienceframe']['process'])
-                bkgImg = combineImage.run(ignore_saturation=True)
-                sciImg = sciImg.sub(bkgImg)
-
-            # Run the reduction
-            all_spec2d[sciImg.detector.name], tmp_sobjs = jwst_reduce(sciImg, slits, waveimg, tilts, spectrograph, par,
-                                                                    show=show, find_negative=bkg_redux, bkg_redux=bkg_redux,
-                                                                    clear_ginga=False, show_peaks=show, show_skysub_fit=show,
-                                                                    basename=basenames[iexp])
-            # Hold em
-            if tmp_sobjs.nobj > 0:
-                all_specobjs.add_sobj(tmp_sobjs)
-
-                if show:
-                    # Plot boxcar
-                    wv_gpm_box = tmp_sobjs[0].BOX_WAVE > 1.0
-                    gpm_temp = tmp_sobjs[0].BOX_MASK[wv_gpm_box]
-                    flux_temp = tmp_sobjs[0].BOX_COUNTS[wv_gpm_box] * gpm_temp
-
-                    data = np.ma.MaskedArray(flux_temp, mask=np.logical_not(gpm_temp))
-                    sigclip = stats.SigmaClip(sigma=5.0, maxiters=15, cenfunc='median', stdfunc=nan_mad_std)
-                    data_clipped, lower, upper = sigclip(data, masked=True, return_bounds=True)
-                    gpm_clip = np.logical_not(data_clipped.mask)  # mask_stack = True are good values
-                    flux_sm = fast_running_median(flux_temp*gpm_clip, 10)
-                    sigma_sm = fast_running_median(tmp_sobjs[0].BOX_COUNTS_SIG[wv_gpm_box], 100)
-                    ymax = 1.2*np.max(flux_sm)
-                    ymin = -np.max(sigma_sm)
-                    plt.plot(tmp_sobjs[0].BOX_WAVE[wv_gpm_box],tmp_sobjs[0].BOX_COUNTS[wv_gpm_box] * tmp_sobjs[0].BOX_MASK[wv_gpm_box],
-                    color='green', drawstyle='steps-mid', label='Boxcar Counts')
-                    plt.plot(tmp_sobjs[0].BOX_WAVE[wv_gpm_box], tmp_sobjs[0].BOX_COUNTS_SIG[wv_gpm_box] * tmp_sobjs[0].BOX_MASK[wv_gpm_box],
-                        color='cyan', drawstyle='steps-mid', label='Boxcar Counts Error')
-
-                    # plot optimal
-                    if tmp_sobjs[0].OPT_WAVE is not None:
-                        wv_gpm_opt = tmp_sobjs[0].OPT_WAVE > 1.0
-                        plt.plot(tmp_sobjs[0].OPT_WAVE[wv_gpm_opt], tmp_sobjs[0].OPT_COUNTS[wv_gpm_opt] * tmp_sobjs[0].OPT_MASK[wv_gpm_opt],
-                                color='black', drawstyle='steps-mid', label='Optimal Counts')
-                        plt.plot(tmp_sobjs[0].OPT_WAVE[wv_gpm_opt], tmp_sobjs[0].OPT_COUNTS_SIG[wv_gpm_opt] * tmp_sobjs[0].OPT_MASK[wv_gpm_opt],
-                                color='red', drawstyle='steps-mid', label='Optimal Counts Error')
-
-                    plt.ylim([ymin, ymax])
-                    plt.legend()
-                    plt.show()
-
-            # THE FOLLOWING MIMICS THE CODE IN pypeit.save_exposure()
-            base_suffix = 'source_{:s}'.format(isource) if isource is not None else 'slit_{:s}'.format(islit)
-            basename = '{:s}_{:s}'.format(basenames[iexp], base_suffix)
-
-            # TODO Populate the header with metadata relevant to this source?
-
-            # Write out specobjs
-            # Build header for spec2d
-            head2d = fits.getheader(rate_files_1[iexp])
-            subheader = spectrograph.subheader_for_spec(fitstbl_1[iexp], head2d, allow_missing=False)
-            # Overload the target name with the source name
-            subheader['target'] = isource
-            if all_specobjs.nobj > 0:
-                outfile1d = os.path.join(scipath, 'spec1d_{:s}.fits'.format(basename))
-                all_specobjs.write_to_fits(subheader, outfile1d)
-
-            # Info
-            outfiletxt = os.path.join(scipath, 'spec1d_{:s}.txt'.format(basename))
-            all_specobjs.write_info(outfiletxt, spectrograph.pypeline)
-
-            # Build header for spec2d
-            outfile2d = os.path.join(scipath, 'spec2d_{:s}.fits'.format(basename))
-            # TODO For the moment hack so that we can write this out
-            pri_hdr = all_spec2d.build_primary_hdr(head2d, spectrograph, subheader=subheader,
-                                                redux_path=None, calib_dir=None)
-            # Write spec2d
-            all_spec2d.write_to_fits(outfile2d, pri_hdr=pri_hdr, overwrite=True)
+            msgs.warn('show=True is not supported when reducing slits in parallel and will be ignored.')
+
+        # The workers are only sent the calibrations and the rate image cutouts for their slit, not the full
+        # datamodels. The pool pulls the tasks from this generator in a separate thread, so the calibrations for the
+        # next slits are computed while the workers reduce the previous ones. The semaphore limits the number of
+        # slits waiting to be reduced so that the cutouts do not pile up in memory. A slit whose calibrations or
+        # cutouts fail is recorded as failed and never sent to the pool.
+        pending = threading.BoundedSemaphore(2*nproc_slits)
+        def slit_tasks():
+            for islit, isource in gd_slits_sources:
+                pending.acquire()
+                try:
+                    calibs = slit_calibrations(islit)
+                    rate_cutouts = np.empty((ndetectors, nexp), dtype=object)
+                    for idet, calib in enumerate(calibs):
+                        if not calib.on_detector:
+                            continue
+                        for iexp in range(nexp):
+                            rate_cutouts[idet, iexp] = msa_data[idet, iexp].cutout(calib.slit_slice)
+                except Exception:
+                    pending.release()
+                    slit_failed(islit, isource, traceback.format_exc())
+                    continue
+                yield islit, isource, calibs, rate_cutouts, spectrograph, par, basenames, _bkg_indices, kludge_err
+
+        msgs.info('Reducing {0} slits using {1} processes'.format(len(gd_slits_sources), nproc_slits))
+        with multiprocessing.get_context('spawn').Pool(processes=nproc_slits) as pool:
+            for islit, isource, slit_results, error in pool.imap_unordered(_jwst_reduce_slit_worker, slit_tasks()):
+                pending.release()
+                if error is not None:
+                    slit_failed(islit, isource, error)
+                    continue
+                try:
+                    write_slit_outputs(scipath, spectrograph, islit, isource, basenames, head2d_list,
+                                       subheader_list, slit_results, bkg_redux=bkg_redux)
+                except Exception:
+                    slit_failed(islit, isource, traceback.format_exc())
+
+    if len(failed_slits) > 0:
+        msgs.warn('The reduction failed for {0} slits: {1}'.format(
+            len(failed_slits), ', '.join([slt for slt, src in failed_slits])))
+    return failed_slits
 
 
 
@@ -565,4 +913,47 @@ def jwst_run_redux(redux_dir, disperser, uncal_list=None, rate_list=None,
 #     for disp in dispersers:
 #         for slt in slits:
 #             print('Running NIRSpec redux for program {0}, target {1}, slit {2}, disperser {3}'.format(progid, target, slt, disp))            
-#             #jwst_mosaic(progid, disp, target, slits=slt, show=False, overwrite_stage1=False, overwrite_stage2=False, reduce_slits=None, reduce_sources=None, kludge_err=1.5, bkg_redux=False)
\ No newline at end of file
+#             #jwst_mosaic(progid, disp, target, slits=slt, show=False, overwrite_stage1=False, overwrite_stage2=False, reduce_slits=None, reduce_sources=None, kludge_err=1.5, bkg_redux=False)
+
+
+def parse_args(options=None):
+    parser = argparse.ArgumentParser(description='Reduce the JWST NIRSpec exposures of a target listed in '
+                                                 'jwst_targets')
+    parser.add_argument('progid', type=str, help='Program ID, e.g. 1764')
+    parser.add_argument('disperser', type=str, help='Name of the disperser, e.g. 235H')
+    parser.add_argument('target', type=str, help='Name of the target, e.g. J0313-1806')
+    parser.add_argument('--slit', type=str, default=None, help='Slit to reduce. Default is all the slits.')
+    parser.add_argument('--reduce_sources', type=str, nargs='+', default=None,
+                        help='Sources to reduce. Default is all the sources.')
+    parser.add_argument('--source_type', type=str, default='POINT', choices=['POINT', 'EXTENDED'],
+                        help='source_type for the spec2d pipeline')
+    parser.add_argument('--bkg_redux', default=False, action='store_true',
+                        help='Subtract the background by image differencing instead of modeling it')
+    parser.add_argument('--overwrite_stage1', default=False, action='store_true',
+                        help='Rerun the calwebb stage1 pipeline')
+    parser.add_argument('--overwrite_stage2', default=False, action='store_true',
+                        help='Rerun the calwebb stage2 pipeline')
+    parser.add_argument('--kludge_err', type=float, default=1.5, help='Scale factor of the sigma error maps')
+    parser.add_argument('--nproc', type=int, default=1, help='Number of calwebb worker processes')
+    parser.add_argument('--nthreads', type=int, default=1,
+                        help='Number of threads of the numerical libraries in each calwebb worker process')
+    parser.add_argument('--nproc_slits', type=int, default=1, help='Number of slit reduction worker processes')
+    parser.add_argument('--no_calib_cache', default=False, action='store_true',
+                        help='Do not cache the slit calibrations in the pypeit/Calibrations directory')
+    parser.add_argument('--show', default=False, action='store_true', help='Show the images and QA in ginga')
+    return parser.parse_args(options)
+
+
+def main(args):
+    uncal_list, redux_dir = jwst_targets.jwst_targets(args.progid, args.disperser, args.target, slit=args.slit)
+    failed_slits = jwst_run_redux(redux_dir, args.disperser, uncal_list=uncal_list, reduce_slits=args.slit,
+                                  reduce_sources=args.reduce_sources, source_type=args.source_type, show=args.show,
+                                  overwrite_stage1=args.overwrite_stage1, overwrite_stage2=args.overwrite_stage2,
+                                  kludge_err=args.kludge_err, bkg_redux=args.bkg_redux, nproc=args.nproc,
+                                  nthreads=args.nthreads, nproc_slits=args.nproc_slits,
+                                  calib_cache=not args.no_calib_cache)
+    return 1 if len(failed_slits) > 0 else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main(parse_args()))
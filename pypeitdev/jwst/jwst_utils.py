@@ -1,5 +1,7 @@
 import os 
 import copy
+import json
+import hashlib
 import numpy as np
 from scipy import interpolate
 from astropy.io import fits
@@ -19,9 +21,11 @@ from pypeit.utils import inverse, zero_not_finite, fast_running_median
 DO_NOT_USE = datamodels.dqflags.pixel['DO_NOT_USE']
 from pypeit import msgs
 from pypeit import datamodel
+from pypeit import __version__
 from pypeit.core import flat
 from pypeit.core import procimg
 from pypeit.core import combine
+from pypeitdev.fileio import atomic_write
 from pypeit.images.detector_container import DetectorContainer
 from pypeit.images.pypeitimage import PypeItImage
 from pypeit.images.mosaic import Mosaic
@@ -258,10 +262,208 @@ def jwst_get_slits(finitemask, polyorder=5, function='legendre', debug=False):
     return slit_left, slit_righ
 
 
+class NIRSpecRateCutout:
+    """
+    The rate image planes of a calwebb image datamodel cut down to the sub-image of a single slit.
+
+    The planes are stored in the PypeIt orientation, i.e. transposed and sliced by slit_slice, so that a slit can be
+    processed by :func:`jwst_proc` without access to the full detector datamodel. These are small and cheap to pickle
+    so they can be sent to worker processes that reduce one slit at a time.
+
+    Parameters
+    ----------
+    data : np.ndarray
+        Rate image.
+    var_rnoise : np.ndarray
+        Read noise variance of the rate image.
+    var_poisson : np.ndarray
+        Poisson variance of the rate image.
+    dq : np.ndarray
+        Data quality flags.
+    t_eff : float
+        Effective exposure time.
+    slit_slice : tuple
+        The slice of the transposed detector image that the cutout was taken from.
+    """
+    def __init__(self, data, var_rnoise, var_poisson, dq, t_eff, slit_slice):
+        self.data = data
+        self.var_rnoise = var_rnoise
+        self.var_poisson = var_poisson
+        self.dq = dq
+        self.t_eff = t_eff
+        self.slit_slice = slit_slice
+
+    @classmethod
+    def from_datamodel(cls, msa_data, slit_slice):
+        """
+        Cut the slit sub-image out of a calwebb image datamodel.
+
+        Parameters
+        ----------
+        msa_data : jwst.datamodels.ImageModel
+            The full detector image, e.g. the nsclean output of calwebb stage 2.
+        slit_slice : tuple
+            Slice of the transposed detector image for the slit.
+
+        Returns
+        -------
+        cutout : NIRSpecRateCutout
+        """
+        return cls(np.array(msa_data.data.T[slit_slice], dtype=float),
+                   np.array(msa_data.var_rnoise.T[slit_slice], dtype=float),
+                   np.array(msa_data.var_poisson.T[slit_slice], dtype=float),
+                   np.array(msa_data.dq.T[slit_slice], dtype=int),
+                   msa_data.meta.exposure.effective_exposure_time, slit_slice)
+
+
+class NIRSpecRateImage:
+    """
+    Lazy, memory-mapped access to the rate image planes of a calwebb image file, e.g. the nsclean output of
+    calwebb stage 2.
+
+    Unlike ``datamodels.open``, which reads every plane of the full detector image into memory, the file is
+    memory-mapped and the extensions that hold each plane are indexed once when the object is created. Only the
+    pixels of the slits that are actually cut out with :meth:`cutout` are read from disk.
+
+    Parameters
+    ----------
+    filename : str
+        The calwebb image file.
+    """
+    planes = {'data': 'SCI', 'var_rnoise': 'VAR_RNOISE', 'var_poisson': 'VAR_POISSON', 'dq': 'DQ'}
+    """Maps the rate image planes to their FITS extension names."""
+
+    def __init__(self, filename):
+        self.filename = filename
+        # Scaled images, e.g. the unsigned DQ plane, cannot be memory-mapped by astropy, so the scaling is applied
+        # by read() instead.
+        self.hdul = fits.open(filename, memmap=True, do_not_scale_image_data=True)
+        self.det_name = self.hdul[0].header['DETECTOR']
+        self.t_eff = self.hdul[0].header['EFFEXPTM']
+        # HDU number and scaling of each plane
+        self.index = {}
+        for plane, extname in self.planes.items():
+            hdr = self.hdul[extname].header
+            self.index[plane] = (self.hdul.index_of(extname), hdr.get('BSCALE', 1), hdr.get('BZERO', 0))
+
+    def read(self, plane, file_slice=None):
+        """
+        Read one of the planes in :attr:`planes`, in the orientation of the file.
+
+        Parameters
+        ----------
+        plane : str
+            The plane to read.
+        file_slice : tuple, optional
+            Only read this section of the image. If None, read the full image.
+
+        Returns
+        -------
+        image : np.ndarray
+        """
+        hdu_indx, bscale, bzero = self.index[plane]
+        image = self.hdul[hdu_indx].data
+        image = image if file_slice is None else image[file_slice]
+        if bscale == 1 and bzero == 0:
+            return np.asarray(image)
+        if bscale == 1 and float(bzero).is_integer():
+            return image.astype(np.int64) + int(bzero)
+        return bscale*image.astype(float) + bzero
+
+    @property
+    def data(self):
+        return self.read('data')
+
+    @property
+    def var_rnoise(self):
+        return self.read('var_rnoise')
+
+    @property
+    def var_poisson(self):
+        return self.read('var_poisson')
+
+    @property
+    def dq(self):
+        return self.read('dq')
+
+    def cutout(self, slit_slice):
+        """
+        Read the sub-image of a slit.
+
+        Parameters
+        ----------
+        slit_slice : tuple
+            Slice of the transposed detector image for the slit.
+
+        Returns
+        -------
+        cutout : NIRSpecRateCutout
+        """
+        # Slice the file orientation directly, so that only the detector rows covered by the slit are read.
+        file_slice = slit_slice[::-1]
+        return NIRSpecRateCutout(np.array(self.read('data', file_slice).T, dtype=float),
+                                 np.array(self.read('var_rnoise', file_slice).T, dtype=float),
+                                 np.array(self.read('var_poisson', file_slice).T, dtype=float),
+                                 np.array(self.read('dq', file_slice).T, dtype=int),
+                                 self.t_eff, slit_slice)
+
+    def close(self):
+        self.hdul.close()
+
+
+def jwst_file_checksum(filename, blocksize=2**24):
+    """
+    SHA1 checksum of the contents of a file.
+
+    Parameters
+    ----------
+    filename : str
+        The file.
+    blocksize : int, optional
+        Number of bytes read at a time.
+
+    Returns
+    -------
+    checksum : str
+    """
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def jwst_slit_index(ms_model):
+    """
+    Map the slit names of a calwebb MultiSlitModel to the index of the slit in ms_model.slits.
+
+    Iterating over ms_model.slits is slow, so this is meant to be built once per file and passed to
+    :class:`NIRSpecSlitCalibrations` for every slit.
+
+    Parameters
+    ----------
+    ms_model : jwst.datamodels.MultiSlitModel
+        The calwebb datamodel.
+
+    Returns
+    -------
+    slit_index : dict
+        Dictionary with the slit names as keys and the slit indices as values. If a slit name appears more than once,
+        the first index is used.
+    """
+    slit_index = {}
+    for indx, slit in enumerate(ms_model.slits):
+        slit_index.setdefault(slit.name, indx)
+    return slit_index
+
+
 def jwst_proc(msa_data, slit_slice, finitemask, flatfield, pathloss, barshadow, photom_conversion, ronoise,
               kludge_err=1.0, saturation=65000, noise_floor=0.01, use_flat=True):
     """
     Routine to extract the iamge contents from a jwst.datamodels.MultiSlitModel object into a format that can be used by PypeIt.
+
+    msa_data can also be a :class:`NIRSpecRateImage`, or a :class:`NIRSpecRateCutout` that has already been cut out
+    with slit_slice.
     """
 
 
@@ -274,13 +476,19 @@ def jwst_proc(msa_data, slit_slice, finitemask, flatfield, pathloss, barshadow,
     #    return (None,)*21
 
     # Read in the output after msa_flagging. Extract the sub-images, rotate to PypeIt format.
-    rate = np.array(msa_data.data.T[slit_slice], dtype=float)
-    rate_var_rnoise = np.array(msa_data.var_rnoise.T[slit_slice], dtype=float)
-    rate_var_poisson = np.array(msa_data.var_poisson.T[slit_slice], dtype=float)
+    if isinstance(msa_data, NIRSpecRateCutout):
+        cutout = msa_data
+    elif isinstance(msa_data, NIRSpecRateImage):
+        cutout = msa_data.cutout(slit_slice)
+    else:
+        cutout = NIRSpecRateCutout.from_datamodel(msa_data, slit_slice)
+    rate = cutout.data
+    rate_var_rnoise = cutout.var_rnoise
+    rate_var_poisson = cutout.var_poisson
     # This is currently buggy as it includes flat field error
     # rate_var_tot = np.square(np.array(e2d_slit.err.T, dtype=float))
-    dq = np.array(msa_data.dq.T[slit_slice], dtype=int)
-    t_eff = msa_data.meta.exposure.effective_exposure_time
+    dq = cutout.dq
+    t_eff = cutout.t_eff
 
     # Now perform the image processing
     raw_counts = rate*t_eff
@@ -651,7 +859,8 @@ class NIRSpecSlitCalibrations(datamodel.DataContainer):
     """DataContainer datamodel."""
 
     internals = ['_indx', 'slit_names', 'intflat_slit_names',]
-    def __init__(self, detector, ms_model, ms_model_flat, slit_name, f070_f100_rescale=False):
+    def __init__(self, detector, ms_model, ms_model_flat, slit_name, f070_f100_rescale=False, slit_index=None,
+                 flat_slit_index=None):
 
         # Instantiate as an empty DataContainer
         super().__init__()
@@ -659,12 +868,12 @@ class NIRSpecSlitCalibrations(datamodel.DataContainer):
         self.det_name = ms_model.meta.instrument.detector
         self.t_eff = ms_model.meta.exposure.effective_exposure_time
         self.detector = detector
-        # Is this slit on nrs1?
-        slit_names = np.array([slit.name for slit in ms_model.slits])
-        intflat_slit_names = np.array([slit.name for slit in ms_model_flat.slits])
-        _indx = np.where((slit_names == slit_name) & (intflat_slit_names == slit_name))[0]
-        self.on_detector = _indx.size != 0
-        self.slit_indx = int(_indx[0]) if self.on_detector else -1
+        # Is this slit on nrs1? The slit indices can be precomputed with jwst_slit_index
+        _slit_index = jwst_slit_index(ms_model) if slit_index is None else slit_index
+        _flat_slit_index = jwst_slit_index(ms_model_flat) if flat_slit_index is None else flat_slit_index
+        _indx = _slit_index.get(slit_name)
+        self.on_detector = _indx is not None and _flat_slit_index.get(slit_name) == _indx
+        self.slit_indx = int(_indx) if self.on_detector else -1
         self.source_name = ms_model.slits[self.slit_indx].source_name
         self.f070_f100_rescale = f070_f100_rescale
 
@@ -676,6 +885,102 @@ class NIRSpecSlitCalibrations(datamodel.DataContainer):
                 self.barshadow, self.photom_conversion, self.calwebb_proc = jwst_extract_subimgs(
                 ms_model.slits[self.slit_indx], ms_model_flat.slits[self.slit_indx], f070_f100_rescale=f070_f100_rescale)
 
+    def _bundle(self):
+        """
+        Package the datamodel for writing.
+
+        The scalars are written to the header of the first extension, and the arrays and the detector to their own
+        extensions. The slit_slice is written as an array of (start, stop) pairs and boolean images as uint8.
+
+        Returns:
+            :obj:`list`: A list of dictionaries, each list element is written to
+            its own fits extension. See
+            :class:`~pypeit.datamodel.DataContainer`.
+        """
+        d = [{}]
+        for key in self.keys():
+            if self[key] is None:
+                continue
+            if key == 'slit_slice':
+                d.append({key: np.array([[s.start, s.stop] for s in self[key]])})
+            elif self.datamodel[key]['otype'] == np.ndarray and self.datamodel[key].get('atype') == np.bool_:
+                d.append({key: self[key].astype(np.uint8)})
+            elif self.datamodel[key]['otype'] == np.ndarray or isinstance(self[key], datamodel.DataContainer):
+                d.append({key: self[key]})
+            else:
+                d[0][key] = self[key]
+        return d
+
+    @classmethod
+    def _parse(cls, hdu, **kwargs):
+        """
+        Parse the data written by :func:`_bundle`.
+        """
+        d, dm_version_passed, dm_type_passed, parsed_hdus = super()._parse(hdu, **kwargs)
+        if d.get('slit_slice') is not None:
+            d['slit_slice'] = tuple(slice(int(lo), int(hi)) for lo, hi in d['slit_slice'])
+        for key in d.keys():
+            if d[key] is not None and cls.datamodel[key]['otype'] == np.ndarray \
+                    and cls.datamodel[key].get('atype') == np.bool_:
+                d[key] = d[key].astype(bool)
+        return d, dm_version_passed, dm_type_passed, parsed_hdus
+
+    @staticmethod
+    def cache_file(cache_dir, slit_name, det_name, checksums, f070_f100_rescale=False):
+        """
+        Name of the file used to cache the calibrations of a slit.
+
+        Parameters
+        ----------
+        cache_dir : str
+            Directory for the cache files.
+        slit_name : str
+            Name of the slit.
+        det_name : str
+            Name of the NIRSpec detector, i.e. either NRS1 or NRS2.
+        checksums : list
+            Checksums of the calwebb files the calibrations are built from, see :func:`jwst_file_checksum`.
+        f070_f100_rescale : bool, optional
+            Passed to :class:`NIRSpecSlitCalibrations`.
+
+        Returns
+        -------
+        cache_file : str
+            The file name. It changes if any of the inputs, the datamodel version or the PypeIt version change, so
+            stale caches are never used.
+        """
+        key = json.dumps([NIRSpecSlitCalibrations.version, __version__, slit_name, det_name, list(checksums),
+                          f070_f100_rescale])
+        return os.path.join(cache_dir, 'NIRSpecSlitCalibrations_{0}_{1}_{2}.fits'.format(
+            det_name, slit_name.strip(), hashlib.sha1(key.encode()).hexdigest()[:16]))
+
+    @classmethod
+    def from_cache(cls, cache_file, detector, ms_model, ms_model_flat, slit_name, **kwargs):
+        """
+        Read the calibrations of a slit from cache_file, or build them and write them to cache_file.
+
+        Parameters
+        ----------
+        cache_file : str
+            The cache file, see :func:`cache_file`.
+        detector, ms_model, ms_model_flat, slit_name, kwargs
+            Passed to :class:`NIRSpecSlitCalibrations` if the calibrations are not in the cache.
+
+        Returns
+        -------
+        calib : NIRSpecSlitCalibrations
+        """
+        if os.path.isfile(cache_file):
+            try:
+                return cls.from_file(cache_file)
+            except Exception as e:
+                msgs.warn('Could not read cached calibrations from {0}: {1}. Rebuilding them.'.format(cache_file, e))
+        calib = cls(detector, ms_model, ms_model_flat, slit_name, **kwargs)
+        os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+        with atomic_write(cache_file) as tmp_file:
+            calib.to_file(tmp_file, overwrite=True)
+        return calib
+
     def show(self):
         # Connect to an open ginga window, or open a new one
         display.connect_to_ginga(raise_err=True, allow_new=True)
@@ -702,9 +1007,13 @@ class NIRSpecSlitCalibrations(datamodel.DataContainer):
 
 
 def jwst_mosaic(image_model_tuple, Calibrations_tuple, kludge_err=1.0,
-                noise_floor=0.01, show=False):
+                noise_floor=0.01, show=False, dtype=float):
     """
     Create a JWST NIRSpec mosaic image from the provided image models and calibrations.
+
+    The detectors are stacked along the spectral direction, separated by the detector gap, and shifted spatially
+    according to where the slit starts on each detector. Any number of detectors is supported; detectors that the
+    slit does not fall on are skipped.
     
     Parameters
     ----------
@@ -718,32 +1027,21 @@ def jwst_mosaic(image_model_tuple, Calibrations_tuple, kludge_err=1.0,
         Noise floor for the variance arrays. Default is 0.01.
     show : bool, optional
         Show the raw rate images with their associated slits in Ginga. Default is False.
+    dtype : type, optional
+        Data type of the mosaic images. Use np.float32 to halve the memory used by each slit. Default is float.
 
     """
 
-    dets = [1,2]
-    sciimg_list, sciivar_list, gpm_list, base_var_list, count_scale_list, rn2_img_list = [], [], [], [], [], []
-    waveimg_list, tilts_list, slit_slice_list, slit_left_list, slit_righ_list, det_list, calib_list = [], [], [], [], [], [], []
-    for det, image_model, Calib in zip(dets, image_model_tuple, Calibrations_tuple):
+    proc_list, calib_list = [], []
+    for image_model, Calib in zip(image_model_tuple, Calibrations_tuple):
 
         if Calib.on_detector:
-            sciimg, sciivar, gpm, base_var, count_scale, rn2_img = jwst_proc(
+            # sciimg, sciivar, gpm, base_var, count_scale, rn2_img
+            proc_list.append(jwst_proc(
                 image_model, Calib.slit_slice, Calib.finitemask, Calib.flatfield, Calib.pathloss, Calib.barshadow,
-                Calib.photom_conversion, Calib.detector.ronoise, noise_floor=noise_floor, kludge_err=kludge_err)
-            sciimg_list.append(sciimg)
-            sciivar_list.append(sciivar)
-            gpm_list.append(gpm)
-            base_var_list.append(base_var)
-            count_scale_list.append(count_scale)
-            rn2_img_list.append(rn2_img)
-            waveimg_list.append(Calib.waveimg)
-            tilts_list.append(Calib.tilts)
-            slit_slice_list.append(Calib.slit_slice)
-            slit_left_list.append(Calib.slit_left)
-            slit_righ_list.append(Calib.slit_righ)
-            det_list.append(Calib.detector)
+                Calib.photom_conversion, Calib.detector.ronoise, noise_floor=noise_floor, kludge_err=kludge_err))
             calib_list.append(Calib)
-            if show:
+            if show and not isinstance(image_model, NIRSpecRateCutout):
                 display.connect_to_ginga(raise_err=True, allow_new=True)
                 # Show the raw rate image
                 rate_image = np.array(image_model.data.T)
@@ -773,101 +1071,57 @@ def jwst_mosaic(image_model_tuple, Calibrations_tuple, kludge_err=1.0,
             #    shell.call_global_plugin_method('WCSMatch', 'set_reference_channel', [ch_list[-1]], {})
 
     ndet = len(calib_list)
+    if ndet == 0:
+        msgs.error('Invalid number of detectors. There is a problem with this slit')
 
     # TODO I would like to create an image indicating which detector contributed to which pixels
-    if ndet == 1:
-        # Assign the data frames
-        sciimg_tot, sciivar_tot, gpm_tot, base_var_tot, count_scale_tot = \
-            sciimg_list[0], sciivar_list[0], gpm_list[0], base_var_list[0], count_scale_list[0]
-        # Assign the calibraitons
-        waveimg_tot, tilts_tot, rn2_img_tot = waveimg_list[0], tilts_list[0], rn2_img_list[0]
-        slit_left_tot, slit_righ_tot = slit_left_list[0], slit_righ_list[0]
-        det_or_mosaic = det_list[0]
-        shape = sciimg_tot.shape
-    elif ndet == 2:
-        # A positive spat_offset means nrs2 starts at a larger pixel than nrs1
-        detector_gap = int(calib_list[0].detector.xgap)
-        spat_offset = (slit_slice_list[1][1].start - slit_slice_list[0][1].start)
-        spec_lo1, spec_hi1 = 0, sciimg_list[0].shape[0]
-        spec_lo2, spec_hi2 = sciimg_list[0].shape[0] + detector_gap, \
-                             sciimg_list[0].shape[0] + detector_gap + sciimg_list[1].shape[0]
-        shape = (sciimg_list[0].shape[0] + sciimg_list[1].shape[0] + detector_gap,
-                 np.max([sciimg_list[0].shape[1], sciimg_list[1].shape[1]]) + np.abs(spat_offset))
-
-        if spat_offset >= 0:
-            # Detector nrs2 starts at a larger spat value than detector nrs1
-            spat_lo1, spat_hi1 = 0, sciimg_list[0].shape[1]  # nrs1 not shifted spatially
-            spat_lo2, spat_hi2 = spat_offset, spat_offset + sciimg_list[1].shape[1] # nrs2 shifted spatiallly
-        else:
-            # Detector nrs1 starts at larger spat value than detector nrs1
-            spat_lo1, spat_hi1 = np.abs(spat_offset), sciimg_list[0].shape[1] + np.abs(spat_offset)
-            spat_lo2, spat_hi2 = 0, sciimg_list[1].shape[1]
-
-        # Old code
-        # Spatial offset is relative to NRS1
-        #detector_gap = int(calib_list[0].detector.xgap)
-        #spat_offset = (slit_slice_list[0][1].start - slit_slice_list[1][1].start)
-        #spec_lo1, spec_hi1 = 0, sciimg_list[0].shape[0]
-        #spec_lo2, spec_hi2 = sciimg_list[0].shape[0] + detector_gap, \
-        #                     sciimg_list[0].shape[0] + detector_gap + sciimg_list[1].shape[0]
-        #shape = (sciimg_list[0].shape[0] + sciimg_list[1].shape[0] + detector_gap,
-        #         np.max([sciimg_list[0].shape[1], sciimg_list[1].shape[1]]) + np.abs(spat_offset))
-        #if spat_offset < 0:
-        #    spat_lo1, spat_hi1 = -spat_offset, sciimg_list[0].shape[1] - spat_offset
-        #    spat_lo2, spat_hi2 = 0, sciimg_list[1].shape[1]
-        #else:
-        #    spat_lo1, spat_hi1 = 0, sciimg_list[0].shape[1]
-        #    spat_lo2, spat_hi2 = spat_offset, spat_offset + sciimg_list[1].shape[1]
-
-        nrs1_slice = np.s_[spec_lo1: spec_hi1, spat_lo1: spat_hi1]
-        nrs2_slice = np.s_[spec_lo2: spec_hi2, spat_lo2: spat_hi2]
-
-        sciimg_tot = np.zeros(shape)
-        sciivar_tot = np.zeros(shape)
-        gpm_tot = np.zeros(shape, dtype=bool)
-        base_var_tot = np.zeros(shape)
-        count_scale_tot = np.zeros(shape)
-        rn2_img_tot = np.zeros(shape)
-        sciimg_tot[nrs1_slice] = sciimg_list[0]
-        sciimg_tot[nrs2_slice] = sciimg_list[1]
-        sciivar_tot[nrs1_slice] = sciivar_list[0]
-        sciivar_tot[nrs2_slice] = sciivar_list[1]
-        gpm_tot[nrs1_slice] = gpm_list[0]
-        gpm_tot[nrs2_slice] = gpm_list[1]
-        base_var_tot[nrs1_slice] = base_var_list[0]
-        base_var_tot[nrs2_slice] = base_var_list[1]
-        count_scale_tot[nrs1_slice] = count_scale_list[0]
-        count_scale_tot[nrs2_slice] = count_scale_list[1]
-        rn2_img_tot[nrs1_slice] = rn2_img_list[0]
-        rn2_img_tot[nrs2_slice] = rn2_img_list[1]
+    # The detectors are stacked spectrally, separated by the detector gap. Spatially, they are offset relative to
+    # the detector on which the slit starts at the smallest spatial pixel.
+    detector_gap = int(calib_list[0].detector.xgap) if ndet > 1 else 0
+    nspec = np.array([proc[0].shape[0] for proc in proc_list])
+    nspat = np.array([proc[0].shape[1] for proc in proc_list])
+    spat_start = np.array([Calib.slit_slice[1].start for Calib in calib_list])
+    spec_lo = np.concatenate(([0], np.cumsum(nspec + detector_gap)[:-1]))
+    spat_lo = spat_start - np.min(spat_start)
+    shape = (int(np.sum(nspec) + (ndet - 1)*detector_gap), int(np.max(nspat) + np.max(spat_lo)))
+
+    # Fill all of the floating point images with one assignment per detector. The images are planes of a single
+    # stacked array: sciimg, sciivar, base_var, count_scale, rn2_img, waveimg
+    isci, iivar, ibase, iscale, irn2, iwave = range(6)
+    mosaic = np.zeros((6,) + shape, dtype=dtype)
+    mosaic[iwave] = np.nan
+    gpm_tot = np.zeros(shape, dtype=bool)
+    for (sciimg, sciivar, gpm, base_var, count_scale, rn2_img), Calib, lo_spec, lo_spat \
+            in zip(proc_list, calib_list, spec_lo, spat_lo):
+        det_slice = np.s_[lo_spec:lo_spec + sciimg.shape[0], lo_spat:lo_spat + sciimg.shape[1]]
+        mosaic[(slice(None),) + det_slice] = (sciimg, sciivar, base_var, count_scale, rn2_img, Calib.waveimg)
+        gpm_tot[det_slice] = gpm
+    finitemask_tot = np.isfinite(mosaic[iwave])
+    # Make sure that we zero out any nan pixels since this causes problems in PypeIt
+    mosaic[np.logical_not(np.isfinite(mosaic))] = 0.0
 
-        waveimg_tot = np.full(shape, np.nan)
-        waveimg_tot[nrs1_slice] = waveimg_list[0]
-        waveimg_tot[nrs2_slice] = waveimg_list[1]
-        finitemask_tot = np.isfinite(waveimg_tot)
+    if ndet == 1:
+        # Use the calibrations of the detector directly
+        tilts_tot = zero_not_finite(calib_list[0].tilts.astype(dtype))
+        slit_left_tot, slit_righ_tot = calib_list[0].slit_left, calib_list[0].slit_righ
+        det_or_mosaic = calib_list[0].detector
+    else:
+        # The tilts and slit edges have to be recomputed, since the wavelengths span all the detectors
+        waveimg_tot = mosaic[iwave]
         wave_min, wave_max = np.min(waveimg_tot[finitemask_tot]), np.max(waveimg_tot[finitemask_tot])
-        tilts_tot = np.zeros(shape)
+        tilts_tot = np.zeros(shape, dtype=dtype)
         tilts_tot[finitemask_tot] = (waveimg_tot[finitemask_tot] - wave_min) / (wave_max - wave_min)
         slit_left_tot, slit_righ_tot = jwst_get_slits(finitemask_tot)
-        waveimg_tot[np.logical_not(finitemask_tot)] = 0.0
-
-        det_or_mosaic = Mosaic(1, np.array(det_list), shape, None, None, None, None)
-    else:
-        msgs.error('Invalid number of detectors. There is a problem with this slit')
-
+        det_or_mosaic = Mosaic(1, np.array([Calib.detector for Calib in calib_list]), shape, None, None, None, None)
 
     # Instantiate
-    sciImg = PypeItImage(image=zero_not_finite(sciimg_tot), ivar=zero_not_finite(sciivar_tot),
-                         base_var=zero_not_finite(base_var_tot),
-                         img_scale=zero_not_finite(count_scale_tot),
-                         rn2img=zero_not_finite(rn2_img_tot),
+    sciImg = PypeItImage(image=mosaic[isci], ivar=mosaic[iivar], base_var=mosaic[ibase],
+                         img_scale=mosaic[iscale], rn2img=mosaic[irn2],
                          detector=det_or_mosaic, bpm=np.logical_not(gpm_tot))
     slits = slittrace.SlitTraceSet(slit_left_tot, slit_righ_tot, 'MultiSlit', detname=det_or_mosaic.name,
                                    nspat=int(shape[1]),PYP_SPEC='jwst_nirspec')
 
-
-
-    return sciImg, slits, zero_not_finite(waveimg_tot), zero_not_finite(tilts_tot), ndet
+    return sciImg, slits, mosaic[iwave], tilts_tot, ndet
 
 
 def jwst_reduce(sciImg, slits, waveimg, tilts, spectrograph, par, show=False, find_negative=False, bkg_redux=False,
@@ -1581,7 +1835,7 @@ def jwst_mosaic_fbd(image_model_tuple, Calibrations_tuple, kludge_err=1.0,
             slit_righ_list.append(Calib.slit_righ)
             det_list.append(Calib.detector)
             calib_list.append(Calib)
-            if show:
+            if show and not isinstance(image_model, NIRSpecRateCutout):
                 display.connect_to_ginga(raise_err=True, allow_new=True)
                 # Show the raw rate image
                 rate_image = np.array(image_model.data.T)
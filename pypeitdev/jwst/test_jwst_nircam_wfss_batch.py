@@ -0,0 +1,73 @@
+"""
+Check the trace spatial index of jwst_nircam_wfss_batch against a brute-force overlap test.
+
+Run with::
+
+    pytest pypeitdev/jwst/test_jwst_nircam_wfss_batch.py
+"""
+import numpy as np
+import pytest
+
+pytest.importorskip('grismconf')
+pytest.importorskip('jwst')
+
+from pypeitdev.jwst.jwst_nircam_wfss_batch import TraceBoxIndex
+
+
+def fake_bboxes(nbox=300, shape=(512, 512), seed=7):
+    """
+    Random trace-like boxes, long along x and short along y, with a few touching boxes and duplicates.
+    """
+    rng = np.random.default_rng(seed)
+    ny, nx = shape
+    xmin = rng.integers(0, nx - 1, nbox)
+    ymin = rng.integers(0, ny - 1, nbox)
+    xmax = np.minimum(xmin + rng.integers(0, 200, nbox), nx - 1)
+    ymax = np.minimum(ymin + rng.integers(0, 40, nbox), ny - 1)
+    bboxes = np.stack([xmin, xmax, ymin, ymax], axis=1)
+    # Boxes that only share their edge pixels with another box, and an exact duplicate
+    bboxes[1] = [bboxes[0, 1], min(bboxes[0, 1] + 10, nx - 1), bboxes[0, 2], bboxes[0, 2]]
+    bboxes[2] = [bboxes[0, 0], bboxes[0, 0], bboxes[0, 3], min(bboxes[0, 3] + 5, ny - 1)]
+    bboxes[3] = bboxes[4]
+    return bboxes
+
+
+def brute_force_overlaps(bboxes, bbox):
+    return (bboxes[:, 0] <= bbox[1]) & (bboxes[:, 1] >= bbox[0]) & (bboxes[:, 2] <= bbox[3]) \
+           & (bboxes[:, 3] >= bbox[2])
+
+
+@pytest.mark.parametrize('cell', [16, 128, 1024])
+def test_trace_box_index(cell):
+    shape = (512, 512)
+    bboxes = fake_bboxes(shape=shape)
+    index = TraceBoxIndex(bboxes, cell=cell)
+    assert len(index) == bboxes.shape[0]
+
+    for ibox, bbox in enumerate(bboxes):
+        overlaps = brute_force_overlaps(bboxes, bbox)
+        overlaps[ibox] = False
+        contaminants, contam_frac = index.contamination(ibox)
+        assert np.array_equal(contaminants, np.where(overlaps)[0])
+
+        # Fraction of the box covered by the other boxes, painted on the full detector
+        covered = np.zeros(shape, dtype=bool)
+        for xmin, xmax, ymin, ymax in bboxes[overlaps]:
+            covered[ymin:ymax + 1, xmin:xmax + 1] = True
+        assert np.isclose(contam_frac, np.mean(covered[bbox[2]:bbox[3] + 1, bbox[0]:bbox[1] + 1]))
+
+    # Edge-sharing boxes and duplicates overlap
+    assert 1 in index.contamination(0)[0] and 2 in index.contamination(0)[0]
+    assert 4 in index.contamination(3)[0] and index.contamination(3)[1] == 1.0
+
+
+def test_trace_box_index_query():
+    bboxes = fake_bboxes()
+    index = TraceBoxIndex(bboxes, cell=64)
+    rng = np.random.default_rng(11)
+    for _ in range(100):
+        x0, y0 = rng.integers(0, 512, 2)
+        bbox = np.array([x0, x0 + rng.integers(0, 100), y0, y0 + rng.integers(0, 100)])
+        assert np.array_equal(index.query(bbox), np.where(brute_force_overlaps(bboxes, bbox))[0])
+    # A box off the indexed area overlaps nothing
+    assert index.query([2000, 2100, 2000, 2100]).size == 0
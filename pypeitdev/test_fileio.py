@@ -0,0 +1,54 @@
+"""
+Check the atomic writes of pypeitdev.fileio.
+
+Run with::
+
+    pytest pypeitdev/test_fileio.py
+"""
+import os
+import stat
+
+import pytest
+
+from pypeitdev.fileio import atomic_write
+
+
+def test_atomic_write(tmp_path):
+    path = tmp_path / 'spec1d.fits'
+    path.write_text('old')
+    with atomic_write(path) as tmp_file:
+        assert tmp_file.endswith('.fits') and os.path.dirname(tmp_file) == str(tmp_path)
+        with open(tmp_file, 'w') as f:
+            f.write('new')
+        # The file is unchanged until the block exits
+        assert path.read_text() == 'old'
+    assert path.read_text() == 'new'
+    assert os.listdir(tmp_path) == ['spec1d.fits']
+
+    # The file gets the permissions of a file created with open()
+    umask = os.umask(0)
+    os.umask(umask)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o666 & ~umask
+
+
+def test_atomic_write_failure(tmp_path):
+    path = tmp_path / 'cache.npz'
+    path.write_text('old')
+    with pytest.raises(RuntimeError):
+        with atomic_write(path, suffix='.npz') as tmp_file:
+            with open(tmp_file, 'w') as f:
+                f.write('partial')
+            raise RuntimeError
+    assert path.read_text() == 'old'
+    assert os.listdir(tmp_path) == ['cache.npz']
+
+
+def test_atomic_write_concurrent(tmp_path):
+    path = tmp_path / 'ledger.json'
+    with atomic_write(path) as tmp1, atomic_write(path) as tmp2:
+        assert tmp1 != tmp2
+        for tmp_file, text in zip((tmp1, tmp2), ('first', 'second')):
+            with open(tmp_file, 'w') as f:
+                f.write(text)
+    # The last writer to finish wins
+    assert path.read_text() == 'first'
@@ -0,0 +1,271 @@
+"""
+Vectorised robust polynomial fits of many independent 1D series at once.
+
+:func:`robust_fit_batch` reproduces :func:`pypeit.core.fitting.robust_fit` (1D fits, no invvar, no grow or
+groupsize) for a stack of series padded to a common length. The iterative sigma rejection of
+:func:`pypeit.core.pydl.djs_reject` is applied to all the series in the same numpy operations and the weighted
+least-squares solves are done with one stacked SVD, instead of one Python level fit per series. This is what the
+wavelength archives need when they fit every (order, coefficient) series of the archive against the echelle or
+cross-disperser angles.
+"""
+import numpy as np
+
+from pypeit import msgs
+
+
+def pad_series(xlist, ylist, fill=0.0):
+    """
+    Pack ragged lists of series into padded arrays for :func:`robust_fit_batch`.
+
+    Args:
+        xlist (list):
+            List of nseries 1D arrays with the independent variable of each series.
+        ylist (list):
+            List of nseries 1D arrays with the dependent variable of each series.
+        fill (:obj:`float`, optional):
+            Value given to the padded entries.
+
+    Returns:
+        tuple: The padded x and y arrays, shape (nseries, nmax), and the boolean mask of the entries that hold data.
+    """
+    nseries = len(xlist)
+    npts = np.array([np.size(x) for x in xlist], dtype=int)
+    nmax = max(int(npts.max()) if nseries > 0 else 0, 1)
+    xarr = np.full((nseries, nmax), fill, dtype=float)
+    yarr = np.full((nseries, nmax), fill, dtype=float)
+    in_gpm = np.arange(nmax)[np.newaxis, :] < npts[:, np.newaxis]
+    xarr[in_gpm] = np.concatenate([np.ravel(x) for x in xlist]) if nseries > 0 else []
+    yarr[in_gpm] = np.concatenate([np.ravel(y) for y in ylist]) if nseries > 0 else []
+    return xarr, yarr, in_gpm
+
+
+def vander_batch(xarr, order, function='polynomial', minx=None, maxx=None):
+    """
+    Basis functions of the fits of a stack of series.
+
+    Args:
+        xarr (`numpy.ndarray`_):
+            Independent variable, shape (nseries, npts).
+        order (:obj:`int`, `numpy.ndarray`_):
+            Order of the fit of every series, either an integer or an array of shape (nseries,). The basis has
+            max(order) + 1 columns, the columns beyond the order of a series are zero.
+        function (:obj:`str`, optional):
+            'polynomial', 'legendre' or 'chebyshev'.
+        minx, maxx (:obj:`float`, `numpy.ndarray`_, optional):
+            Limits used to map xarr to [-1, 1] for the Legendre and Chebyshev fits, either scalars or arrays of
+            shape (nseries,).
+
+    Returns:
+        `numpy.ndarray`_: Basis functions, shape (nseries, npts, max(order) + 1).
+    """
+    order = np.broadcast_to(np.asarray(order, dtype=int), (xarr.shape[0],))
+    norder = int(order.max()) + 1 if order.size > 0 else 1
+    if function == 'polynomial':
+        vander = np.polynomial.polynomial.polyvander(xarr, norder - 1)
+    elif function in ['legendre', 'chebyshev']:
+        minx = np.asarray(minx, dtype=float).reshape(-1, 1) if minx is not None else np.min(xarr, axis=1, keepdims=True)
+        maxx = np.asarray(maxx, dtype=float).reshape(-1, 1) if maxx is not None else np.max(xarr, axis=1, keepdims=True)
+        xv = 2.0*(xarr - minx)/(maxx - minx) - 1.0
+        vanderfunc = np.polynomial.legendre.legvander if function == 'legendre' \
+            else np.polynomial.chebyshev.chebvander
+        vander = vanderfunc(xv, norder - 1)
+    else:
+        msgs.error("Fitting function '{:s}' is not supported by the batched fits".format(function))
+    return vander*(np.arange(norder)[np.newaxis, :] <= order[:, np.newaxis])[:, np.newaxis, :]
+
+
+def evaluate_fit_batch(fitc, function, xarr, minx=None, maxx=None):
+    """
+    Evaluate the fits returned by :func:`robust_fit_batch`.
+
+    Args:
+        fitc (`numpy.ndarray`_):
+            Fit coefficients, shape (nseries, norder).
+        function (:obj:`str`):
+            'polynomial', 'legendre' or 'chebyshev'.
+        xarr (`numpy.ndarray`_):
+            Locations to evaluate the fits at, shape (nseries, npts) or (npts,) to use the same locations for every
+            series.
+        minx, maxx (:obj:`float`, `numpy.ndarray`_, optional):
+            Limits of the fits, as passed to :func:`robust_fit_batch`.
+
+    Returns:
+        `numpy.ndarray`_: The fits, shape (nseries, npts).
+    """
+    xarr = np.broadcast_to(np.asarray(xarr, dtype=float), (fitc.shape[0], np.shape(xarr)[-1]))
+    vander = vander_batch(xarr, fitc.shape[1] - 1, function=function, minx=minx, maxx=maxx)
+    return np.einsum('spc,sc->sp', vander, fitc)
+
+
+def _lstsq_batch(vander, yarr, gpm, sqrt_weights):
+    """
+    Weighted least-squares solves of a stack of series, following numpy's legfit.
+
+    The basis columns are normalised, the masked rows are zeroed, which drops them from the solution, and the stack
+    is solved with one SVD using the legfit singular value cutoff of ngood*eps. Columns that are zero (beyond the
+    order of a series) give zero coefficients, as do series with no good points.
+    """
+    rowwgt = np.where(gpm, sqrt_weights, 0.0)
+    lhs = vander*rowwgt[:, :, np.newaxis]
+    rhs = yarr*rowwgt
+    scl = np.sqrt(np.sum(lhs**2, axis=1))
+    scl[scl == 0.0] = 1.0
+    lhs = lhs/scl[:, np.newaxis, :]
+    uu, ss, vh = np.linalg.svd(lhs, full_matrices=False)
+    rcond = np.sum(gpm, axis=1)*np.finfo(float).eps
+    keep = ss > (rcond*ss[:, 0])[:, np.newaxis]
+    sinv = np.where(keep, 1.0/np.where(keep, ss, 1.0), 0.0)
+    coeff = np.einsum('sck,sk,spk,sp->sc', np.swapaxes(vh, 1, 2), sinv, uu, rhs)
+    return coeff/scl
+
+
+def _reject_batch(yarr, ymodel, outmask, in_gpm, lower=None, upper=None, maxdev=None, maxrej=None, sticky=True,
+                  use_mad=True):
+    """
+    Vectorised :func:`pypeit.core.pydl.djs_reject` for a stack of series without invvar, grow or groups.
+
+    Returns:
+        tuple: The new good pixel masks, shape (nseries, npts), and whether each series has converged, shape
+        (nseries,).
+    """
+    igood = in_gpm & outmask
+    diff = yarr - ymodel
+    absdiff = np.abs(diff)
+    # Like djs_reject, sigma is only measured for series with more than one good point
+    sigma = np.zeros(yarr.shape[0])
+    rows = np.sum(igood, axis=1) > 1
+    if use_mad:
+        sigma[rows] = 1.4826*np.nanmedian(np.where(igood[rows], absdiff[rows], np.nan), axis=1)
+    else:
+        sigma[rows] = np.sqrt(np.nanvar(np.where(igood[rows], diff[rows], np.nan), axis=1))
+    # This is pypeit.utils.inverse, which gives invvar = 0 for sigma = 0
+    invvar = (sigma > 0.0)/(sigma**2 + (sigma == 0.0))
+    chi = diff*np.sqrt(invvar)[:, np.newaxis]
+
+    badness = np.zeros_like(diff)
+    if lower is not None:
+        badness += np.fmax(-chi, 0.0)*(chi < -lower)
+    if upper is not None:
+        badness += np.fmax(chi, 0.0)*(chi > upper)
+    if maxdev is not None:
+        badness += absdiff/maxdev*(absdiff > maxdev)
+    badness *= in_gpm
+    if sticky:
+        badness *= outmask
+    if maxrej is not None:
+        # Only keep the maxrej worst points of every series. djs_reject zeroes the lowest badness values of a stable
+        # sort, which always includes all the zero badness points, so zeroing the same ranks here is identical.
+        npts = yarr.shape[1]
+        isort = np.argsort(badness, axis=1, kind='stable')
+        rank = np.empty_like(isort)
+        np.put_along_axis(rank, isort, np.arange(npts)[np.newaxis, :], axis=1)
+        badness[rank < npts - maxrej] = 0.0
+
+    newmask = (badness == 0.0) & in_gpm
+    if sticky:
+        newmask &= outmask
+    return newmask, np.all(newmask == outmask, axis=1)
+
+
+def robust_fit_batch(xarr, yarr, order, function='polynomial', minx=None, maxx=None, maxiter=10, in_gpm=None,
+                     weights=None, lower=None, upper=None, maxdev=None, maxrej=None, sticky=True, use_mad=True,
+                     verbose=True):
+    """
+    Robust fits of a stack of independent 1D series, equivalent to calling
+    :func:`pypeit.core.fitting.robust_fit` on each of them.
+
+    The series are padded to a common length, and the padded entries are excluded with in_gpm (see
+    :func:`pad_series`). Every iteration fits all the series that have not converged yet and applies the
+    :func:`pypeit.core.pydl.djs_reject` rejection to them at once. The coefficients agree with the per-series
+    robust_fit to round-off, so the rejected points are the same except for points sitting exactly on the
+    rejection threshold, or series with no more points than parameters, whose residuals are pure round-off.
+
+    Args:
+        xarr (`numpy.ndarray`_):
+            Independent variable, shape (nseries, npts).
+        yarr (`numpy.ndarray`_):
+            Dependent variable, shape (nseries, npts).
+        order (:obj:`int`, `numpy.ndarray`_):
+            Order of the fits, either an integer or an array of shape (nseries,) with the order of every series.
+        function (:obj:`str`, optional):
+            'polynomial', 'legendre' or 'chebyshev'.
+        minx, maxx (:obj:`float`, `numpy.ndarray`_, optional):
+            Limits used to normalize the Legendre and Chebyshev fits, scalars or arrays of shape (nseries,). If not
+            given, the range of the good points of each series is used in each iteration, like robust_fit does.
+        maxiter (:obj:`int`, optional):
+            Maximum number of rejection iterations. Set to zero to disable the rejection.
+        in_gpm (`numpy.ndarray`_, optional):
+            Input good pixel mask, shape (nseries, npts). These points stay masked in the output.
+        weights (`numpy.ndarray`_, optional):
+            Weights of the fits, shape (nseries, npts).
+        lower, upper (:obj:`float`, optional):
+            Rejection thresholds in units of the sigma of the residuals of each series.
+        maxdev (:obj:`float`, optional):
+            Reject points with an absolute deviation larger than maxdev.
+        maxrej (:obj:`int`, optional):
+            Maximum number of points rejected per series and iteration.
+        sticky (:obj:`bool`, optional):
+            If True, rejected points stay rejected in the following iterations.
+        use_mad (:obj:`bool`, optional):
+            If True, sigma is estimated from the median absolute deviation instead of the standard deviation.
+        verbose (:obj:`bool`, optional):
+            If True, warn about series that reached maxiter.
+
+    Returns:
+        tuple: The fit coefficients, shape (nseries, max(order) + 1), with zeros beyond the order of each series,
+        and the final good pixel masks, shape (nseries, npts).
+    """
+    xarr = np.atleast_2d(np.asarray(xarr, dtype=float))
+    yarr = np.atleast_2d(np.asarray(yarr, dtype=float))
+    nseries, npts = yarr.shape
+    order = np.broadcast_to(np.asarray(order, dtype=int), (nseries,))
+    in_gpm = np.ones((nseries, npts), dtype=bool) if in_gpm is None else np.asarray(in_gpm, dtype=bool)
+    # Padded and masked entries may hold anything, e.g. NaNs in unpopulated archive slots
+    xarr, yarr = np.where(in_gpm, xarr, 0.0), np.where(in_gpm, yarr, 0.0)
+    sqrt_weights = np.ones((nseries, npts)) if weights is None else np.sqrt(np.asarray(weights, dtype=float))
+    if function not in ['polynomial', 'legendre', 'chebyshev']:
+        msgs.error("Fitting function '{:s}' is not supported by the batched fits".format(function))
+    if function == 'polynomial':
+        # Like robust_fit, the polynomial fits are not rescaled
+        minx, maxx = None, None
+    else:
+        minx = None if minx is None else np.broadcast_to(np.asarray(minx, dtype=float), (nseries,))
+        maxx = None if maxx is None else np.broadcast_to(np.asarray(maxx, dtype=float), (nseries,))
+
+    def fit(rows, gpm):
+        if function == 'polynomial':
+            this_minx, this_maxx = None, None
+        elif minx is None or maxx is None:
+            # robust_fit rescales x with the range of the good points of every fit
+            any_good = np.any(gpm, axis=1)
+            this_minx = np.where(any_good, np.min(xarr[rows], axis=1, where=gpm, initial=np.inf), 0.0) \
+                if minx is None else minx[rows]
+            this_maxx = np.where(any_good, np.max(xarr[rows], axis=1, where=gpm, initial=-np.inf), 1.0) \
+                if maxx is None else maxx[rows]
+        else:
+            this_minx, this_maxx = minx[rows], maxx[rows]
+        vander = vander_batch(xarr[rows], order[rows], function=function, minx=this_minx, maxx=this_maxx)
+        coeff = _lstsq_batch(vander, yarr[rows], gpm, sqrt_weights[rows])
+        return coeff, np.einsum('spc,sc->sp', vander, coeff)
+
+    this_gpm = in_gpm.copy()
+    done = np.zeros(nseries, dtype=bool)
+    niter = 0
+    while niter < maxiter and not np.all(done):
+        rows = np.where(np.logical_not(done))[0]
+        few = np.sum(this_gpm[rows], axis=1) <= order[rows] + 1
+        if np.any(few):
+            msgs.warn('More parameters than data points for {:d} series - fits might be undesirable'.format(
+                np.sum(few)))
+        _, ymodel = fit(rows, this_gpm[rows])
+        this_gpm[rows], done[rows] = _reject_batch(yarr[rows], ymodel, this_gpm[rows], in_gpm[rows], lower=lower,
+                                                   upper=upper, maxdev=maxdev, maxrej=maxrej, sticky=sticky,
+                                                   use_mad=use_mad)
+        niter += 1
+    if verbose and maxiter > 0 and niter == maxiter and not np.all(done):
+        msgs.warn('Maximum number of iterations maxiter={:d} reached for {:d} series'.format(
+            maxiter, np.sum(np.logical_not(done))))
+
+    # Final fit with the final masks
+    fitc, _ = fit(np.arange(nseries), this_gpm)
+    return fitc, this_gpm
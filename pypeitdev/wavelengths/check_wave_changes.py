@@ -1,4 +1,9 @@
+import os
+import json
+import multiprocessing
+import traceback
 from pypeit import wavecalib, msgs
+from pypeitdev.fileio import atomic_write
 from pathlib import Path
 import matplotlib.pyplot as plt
 from matplotlib import gridspec
@@ -8,12 +13,81 @@ import argparse
 from IPython import embed
 
 
-def load_all_wave_info(redux, input_spec=None):
+def _wave_diagnostics_worker(wfile):
+	"""
+	Load a WaveCalib file and compute its wavelength diagnostics. This is run in the process pool of load_all_wave_info.
+
+	Args:
+		wfile (str): path to the WaveCalib file
+
+	Returns:
+		tuple: path of the file, diagnostics table (None if the file could not be loaded) and traceback of the error
+
+	"""
+	try:
+		waveCalib = wavecalib.WaveCalib.from_file(wfile, chk_version=False)
+		return wfile, waveCalib.wave_diagnostics(), None
+	except Exception:
+		return wfile, None, traceback.format_exc()
+
+
+def read_wave_cache(cache_file):
+	"""
+	Read the cached wavelength diagnostics written by write_wave_cache
+	Args:
+		cache_file (str): path to the cache file
+
+	Returns:
+		dict: the diagnostics table of each WaveCalib file, keyed by the path of the file. The values are
+		(mtime, table) tuples, where mtime is the modification time (in ns) of the file when the table was computed.
+		Empty if the cache file does not exist or cannot be read.
+
+	"""
+	if cache_file is None or not Path(cache_file).is_file():
+		return {}
+	try:
+		cache = Table.read(cache_file, format='fits')
+	except Exception as e:
+		msgs.warn(f'Could not read the cache file {cache_file}: {e}')
+		return {}
+	if len(cache) == 0:
+		return {}
+	# restore the display formats of the columns, which FITS cannot store
+	for name, fmt in json.loads(cache.meta.get('COLFMTS', '{}')).items():
+		cache[name].format = fmt
+	cache = cache.group_by('path')
+	return {str(key['path']): (int(group['mtime'][0]), group) for key, group in zip(cache.groups.keys, cache.groups)}
+
+
+def write_wave_cache(cache_file, cached):
+	"""
+	Write the cached wavelength diagnostics with atomic_write.
+	Args:
+		cache_file (str): path to the cache file
+		cached (dict): diagnostics tables keyed by path, see read_wave_cache
+
+	"""
+	tables = [tab for _, tab in cached.values()]
+	cache = vstack(tables) if len(tables) > 0 else Table()
+	cache.meta['COLFMTS'] = json.dumps({col.name: col.format for col in cache.itercols() if col.format is not None})
+	for col in cache.itercols():
+		col.format = None
+	with atomic_write(cache_file) as tmp_file:
+		cache.write(tmp_file, format='fits', overwrite=True)
+
+
+def load_all_wave_info(redux, input_spec=None, nproc=1, cache_file=None):
 	"""
 	Load all wavecalib files and return a table with all the diagnostic info
 	Args:
 		redux (str): path to the redux folder
 		input_spec (str): name of the spectrograph to be analyzed
+		nproc (int): number of processes used to load the WaveCalib files
+		cache_file (str): path to a file where the diagnostics of each WaveCalib file are cached, keyed by the path
+			and the modification time of the file. Only new or modified files are loaded, and the entries of files
+			that were removed from the scanned spectrograph folders are dropped. If None, no cache is used.
+			If the cache file cannot be written, e.g. in a read-only redux folder, a warning is issued and the run
+			goes on without it.
 
 	Returns:
 		`astropy.table.Table`_: table with all the diagnostic info for all
@@ -22,29 +96,58 @@ def load_all_wave_info(redux, input_spec=None):
 	"""
 	redux_path = Path(redux).resolve()
 	spectrographs = sorted(redux_path.glob('*')) if input_spec is None else sorted(redux_path.glob(f'{input_spec}'))
-	wtable = Table()
-	# loop over spectrographs
+	# list the wavefiles of all the datasets of all the spectrographs
+	wavefiles = []
 	for s in spectrographs:
-		if s.name in ['QL_CALIB']:
+		if s.name in ['QL_CALIB'] or not s.is_dir():
 			continue
-		datasets = sorted(s.glob('*'))
-		# loop over datasets
-		for d in datasets:
-			wavefiles = sorted(d.glob('Calibrations/WaveCalib*'))
-
-			# loop over wavefiles
-			for w in wavefiles:
-				wfile = str(w.resolve())
-				try:
-					waveCalib = wavecalib.WaveCalib.from_file(wfile, chk_version=False)
-				except:
-					msgs.warn(f'file {wfile} could not be loaded')
-
-				tab = waveCalib.wave_diagnostics()
-				tab['file'] = f'{s.name}/{d.name}/Calibrations/{w.name}'
-				wtable = vstack([wtable, tab])
+		for d in sorted(s.glob('*')):
+			for w in sorted(d.glob('Calibrations/WaveCalib*')):
+				wavefiles.append((str(w.resolve()), f'{s.name}/{d.name}/Calibrations/{w.name}'))
+	mtimes = {wfile: os.stat(wfile).st_mtime_ns for wfile, _ in wavefiles}
+
+	# only load the files that are not in the cache or have changed since they were cached
+	cached = read_wave_cache(cache_file)
+	to_load = [wfile for wfile, _ in wavefiles if wfile not in cached or cached[wfile][0] != mtimes[wfile]]
+	msgs.info(f'{len(wavefiles) - len(to_load)} of {len(wavefiles)} WaveCalib files found in the cache')
+	if nproc > 1 and len(to_load) > 1:
+		ctx = multiprocessing.get_context('spawn')
+		with ctx.Pool(processes=min(nproc, len(to_load))) as pool:
+			results = pool.map(_wave_diagnostics_worker, to_load, chunksize=1)
+	else:
+		results = [_wave_diagnostics_worker(wfile) for wfile in to_load]
+
+	for wfile, tab, tb in results:
+		if tab is None:
+			msgs.warn(f'file {wfile} could not be loaded:\n{tb}')
+			cached.pop(wfile, None)
+			continue
+		tab['path'] = wfile
+		tab['mtime'] = mtimes[wfile]
+		cached[wfile] = (mtimes[wfile], tab)
+	# drop the files that are gone, keeping those of the spectrographs that were not scanned (see input_spec)
+	scanned = tuple(os.path.join(str(s.resolve()), '') for s in spectrographs)
+	stale = [wfile for wfile in cached if wfile not in mtimes and (wfile.startswith(scanned) or not os.path.exists(wfile))]
+	for wfile in stale:
+		del cached[wfile]
+	if cache_file is not None and (len(to_load) > 0 or len(stale) > 0):
+		# the cache is only a speed-up, e.g. a read-only redux directory must not stop the run
+		try:
+			write_wave_cache(cache_file, cached)
+		except OSError as e:
+			msgs.warn(f'Could not write the cache file {cache_file}: {e}')
+
+	# build the table once from the list of diagnostics tables
+	tables = []
+	for wfile, name in wavefiles:
+		if wfile not in cached:
+			continue
+		tab = cached[wfile][1].copy()
+		tab.remove_columns(['path', 'mtime'])
+		tab['file'] = name
+		tables.append(tab)
 
-	return wtable
+	return vstack(tables) if len(tables) > 0 else Table()
 
 
 def get_values_for_histo(wtable):
@@ -130,6 +233,9 @@ def get_parser():
 	parser.add_argument('new_redux', type=str, help='Path to the new redux folder')
 	parser.add_argument('--spec', default=None, type=str, help='Name of the spectrograph to be compared')
 	parser.add_argument('--print_tab', default=False, help='Print combined table in the terminal', action='store_true')
+	parser.add_argument('--nproc', default=1, type=int, help='Number of processes used to load the WaveCalib files')
+	parser.add_argument('--no_cache', default=False, action='store_true',
+						help='Do not read or write the wave_diagnostics_cache.fits file of each redux folder')
 	parser.add_argument('--embed', default=False, action='store_true')
 	return parser.parse_args()
 
@@ -151,8 +257,10 @@ def main(args):
 	if not Path(args.new_redux).exists():
 		msgs.error(f'Folder "{args.new_redux}" does not exist')
 
-	wtable_old = load_all_wave_info(args.old_redux, input_spec=args.spec)
-	wtable_new = load_all_wave_info(args.new_redux, input_spec=args.spec)
+	cache_old = None if args.no_cache else str(Path(args.old_redux) / 'wave_diagnostics_cache.fits')
+	cache_new = None if args.no_cache else str(Path(args.new_redux) / 'wave_diagnostics_cache.fits')
+	wtable_old = load_all_wave_info(args.old_redux, input_spec=args.spec, nproc=args.nproc, cache_file=cache_old)
+	wtable_new = load_all_wave_info(args.new_redux, input_spec=args.spec, nproc=args.nproc, cache_file=cache_new)
 
 	combined_wtable = join(wtable_old, wtable_new, join_type='left', keys=['file', 'SpatOrderID'])
 	if args.print_tab:
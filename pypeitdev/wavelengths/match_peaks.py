@@ -90,8 +90,8 @@ def xcorr_shift(inspec1,inspec2,smooth = None,debug = False):
     corr = scipy.signal.correlate(y1, y2, mode='full')
     corr_denom = np.sqrt(np.sum(y1*y1)*np.sum(y2*y2))
     corr_norm = corr/corr_denom
-    output = arc.detect_lines(corr_norm, nfitpix=7, sigdetect=5.0, fwhm=20.0, mask_width = 10.0, cont_samp=30, nfind = 1)
-    pix_max = output[1]
+    output = arc.detect_lines(corr_norm, sigdetect=5.0, fwhm=20.0, fit_frac_fwhm=0.35, cont_samp=30, nfind = 1)
+    pix_max = output[2]
     corr_max = np.interp(pix_max, np.arange(lags.shape[0]),corr_norm)
     lag_max  = np.interp(pix_max, np.arange(lags.shape[0]),lags)
     if debug:
@@ -205,35 +205,222 @@ def fit_shift_stretch_iter(inspec1, inspec2, smooth = 5.0, shift_mnmx = (-1.0,1.
     return True, shift_tot, stretch_tot, corr_tot, shift_cc, cc_val
 
 
+def spline_coeffs_batch(specs):
+    """
+    Cubic spline coefficients of a set of spectra, for stretch_spec_batch.
+
+    The spline is 2D, so the coefficients are computed along both axes: this way the interpolation at the integer
+    rows returns exactly every spectrum, without mixing in the neighbouring spectra.
+    """
+    return scipy.ndimage.spline_filter(np.asarray(specs, dtype=float), order=3, mode='constant')
+
+
+def stretch_spec_batch(specs, stretches, shifts=None, prefilter=True):
+    """
+    Stretch (and optionally shift) a set of spectra with cubic spline interpolation, for many stretches at once.
+
+    The transformed spectra are spec((x - shift)/stretch), i.e. the same transformation as shift_and_stretch up to the
+    rounding of the stretched length to an integer number of pixels, and zero outside the input spectra.
+
+    Args:
+        specs (ndarray): Spectra, shape (npairs, nspec). If prefilter is False, these are the spline
+            coefficients returned by spline_coeffs_batch.
+        stretches (ndarray): Stretches, shape (npairs, nstretch).
+        shifts (ndarray): Shifts in pixels, shape (npairs, nstretch). Default is no shift.
+        prefilter (bool): Compute the spline coefficients of specs.
+
+    Returns:
+        ndarray: Transformed spectra, shape (npairs, nstretch, nspec).
+    """
+    npairs, nspec = specs.shape
+    coeffs = spline_coeffs_batch(specs) if prefilter else specs
+    x = np.arange(nspec, dtype=float)
+    shifts = np.zeros_like(stretches) if shifts is None else shifts
+    x_in = (x[None, None, :] - shifts[..., None]) / stretches[..., None]
+    row = np.broadcast_to(np.arange(npairs, dtype=float)[:, None, None], x_in.shape)
+    return scipy.ndimage.map_coordinates(coeffs, [row, x_in], order=3, mode='constant', cval=0.0,
+                                         prefilter=False)
+
+
+def xcorr_lags_batch(y1, y2_stack, lag_lo, lag_hi):
+    """
+    Cross-correlate every spectrum of a stack with a reference spectrum using FFTs.
+
+    Args:
+        y1 (ndarray): Reference spectra, shape (npairs, nspec).
+        y2_stack (ndarray): Spectra to correlate with the reference of their pair, shape (npairs, nstack, nspec).
+        lag_lo, lag_hi (ndarray): Lowest and highest lags in pixels to consider, shape (npairs,). A positive lag means
+            the features of y2 must be shifted to larger pixels to match y1.
+
+    Returns:
+        tuple: Best lag and correlation at the best lag, both refined with parabolic interpolation, each with shape
+        (npairs, nstack).
+    """
+    npairs, nstack, nspec = y2_stack.shape
+    nfft = scipy.fft.next_fast_len(2*nspec)
+    corr = scipy.fft.irfft(scipy.fft.rfft(y1, nfft)[:, None, :]*np.conj(scipy.fft.rfft(y2_stack, nfft)), nfft)
+    # Same lag window for every pair, pixels outside the lag range of a pair are masked
+    lags = np.arange(np.min(lag_lo), np.max(lag_hi) + 1)
+    corr = corr[..., lags % nfft]
+    outside = (lags[None, :] < lag_lo[:, None]) | (lags[None, :] > lag_hi[:, None])
+    corr[np.broadcast_to(outside[:, None, :], corr.shape)] = -np.inf
+    imax = np.argmax(corr, axis=-1)
+    cmax = np.take_along_axis(corr, imax[..., None], axis=-1)[..., 0]
+    cm = np.take_along_axis(corr, np.clip(imax - 1, 0, lags.size - 1)[..., None], axis=-1)[..., 0]
+    cp = np.take_along_axis(corr, np.clip(imax + 1, 0, lags.size - 1)[..., None], axis=-1)[..., 0]
+    denom = cm - 2.0*cmax + cp
+    good = np.isfinite(denom) & (denom < 0.0)
+    delta = np.zeros_like(cmax)
+    delta[good] = np.clip(0.5*(cm[good] - cp[good])/denom[good], -0.5, 0.5)
+    cpeak = cmax.copy()
+    cpeak[good] -= 0.25*(cm[good] - cp[good])*delta[good]
+    return lags[imax] + delta, cpeak
+
+
+def _parabola_peak(x, y, imax):
+    """
+    Abscissa of the peak of the parabola through three points around imax of each row of y, on a uniform grid x.
+    """
+    nx = x.shape[1]
+    i0 = np.clip(imax, 1, nx - 2)
+    ym, y0, yp = [np.take_along_axis(y, (i0 + k)[:, None], axis=1)[:, 0] for k in (-1, 0, 1)]
+    denom = ym - 2.0*y0 + yp
+    delta = np.where(denom < 0.0, 0.5*(ym - yp)/np.where(denom < 0.0, denom, 1.0), 0.0)
+    x0 = np.take_along_axis(x, i0[:, None], axis=1)[:, 0]
+    dx = x[:, 1] - x[:, 0]
+    return x0 + np.clip(delta, -1.0, 1.0)*dx
+
+
+def xcorr_shift_stretch_batch(inspec1, inspec2, smooth=5.0, shift_mnmx=(-0.05,0.05), stretch_mnmx=(0.9,1.1),
+                              nstretch=101, nrefine=21, debug=False):
+    """
+    Shift and stretch matching many spectra to their templates with batched FFT cross-correlations.
+
+    This finds the same shift and stretch as xcorr_shift_stretch, which maximizes the zero-lag correlation with
+    differential evolution, but evaluates a grid of stretches at once: every inspec2 is stretched to all the grid
+    values with vectorised spline interpolation, and the best shift for every stretch comes from one FFT
+    cross-correlation. The best grid stretch is then refined locally on a finer grid around it, and the shift and
+    stretch are refined to sub-pixel and sub-grid precision with parabolic interpolation.
+
+    Args:
+        inspec1 (ndarray): Template spectra, shape (nspec,) or (npairs, nspec).
+        inspec2 (ndarray): Spectra to match to the templates, shape (nspec,) or (npairs, nspec).
+        smooth (float): Sigma of the gaussian smoothing applied to the spectra.
+        shift_mnmx (tuple): Range of the shift around the shift of the cross-correlation without stretch, in
+            units of nspec, as in xcorr_shift_stretch.
+        stretch_mnmx (tuple): Range of the stretch.
+        nstretch (int): Number of stretches of the coarse grid.
+        nrefine (int): Number of stretches of the fine grid, which spans one coarse grid step on each side of the
+            best coarse stretch.
+        debug (bool): Plot the correlation as a function of stretch and the matched spectra.
+
+    Returns:
+        tuple: success, shift, stretch, corr, shift_cc, cc_val, as returned by xcorr_shift_stretch, as arrays with
+        shape (npairs,).
+    """
+    y1 = np.atleast_2d(np.asarray(inspec1, dtype=float))
+    y2 = np.atleast_2d(np.asarray(inspec2, dtype=float))
+    y1, y2 = np.broadcast_arrays(y1, y2)
+    npairs, nspec = y1.shape
+    if smooth is not None:
+        y1 = scipy.ndimage.gaussian_filter1d(y1, smooth, axis=1)
+        y2 = scipy.ndimage.gaussian_filter1d(y2, smooth, axis=1)
+    corr_denom = np.sqrt(np.sum(y1*y1, axis=1)*np.sum(y2*y2, axis=1))
+    coeffs2 = spline_coeffs_batch(y2)
+
+    # Shift without stretch, which sets the range of the shifts
+    all_lags = np.full(npairs, nspec - 1)
+    shift_cc, cc_val = xcorr_lags_batch(y1, y2[:, None, :], -all_lags, all_lags)
+    shift_cc, cc_val = shift_cc[:, 0], cc_val[:, 0]/corr_denom
+    lag_lo = np.floor(shift_cc + nspec*shift_mnmx[0]).astype(int)
+    lag_hi = np.ceil(shift_cc + nspec*shift_mnmx[1]).astype(int)
+
+    # Coarse grid of stretches
+    stretch_grid = np.broadcast_to(np.linspace(stretch_mnmx[0], stretch_mnmx[1], nstretch), (npairs, nstretch))
+    _, corr_grid = xcorr_lags_batch(y1, stretch_spec_batch(coeffs2, stretch_grid, prefilter=False), lag_lo, lag_hi)
+    ibest = np.argmax(corr_grid, axis=1)
+
+    # Fine grid around the best coarse stretch
+    dstretch = stretch_grid[0, 1] - stretch_grid[0, 0]
+    stretch_best = np.take_along_axis(stretch_grid, ibest[:, None], axis=1)[:, 0]
+    fine_grid = np.clip(stretch_best[:, None] + dstretch*np.linspace(-1.0, 1.0, nrefine)[None, :],
+                        stretch_mnmx[0], stretch_mnmx[1])
+    _, corr_fine = xcorr_lags_batch(y1, stretch_spec_batch(coeffs2, fine_grid, prefilter=False), lag_lo, lag_hi)
+    stretch = np.clip(_parabola_peak(fine_grid, corr_fine, np.argmax(corr_fine, axis=1)),
+                      stretch_mnmx[0], stretch_mnmx[1])
+
+    # Sub-pixel shift at the final stretch, and the zero-lag correlation of the matched spectra
+    shift, _ = xcorr_lags_batch(y1, stretch_spec_batch(coeffs2, stretch[:, None], prefilter=False), lag_lo, lag_hi)
+    shift = shift[:, 0]
+    y2_trans = stretch_spec_batch(coeffs2, stretch[:, None], shifts=shift[:, None], prefilter=False)[:, 0, :]
+    corr = np.sum(y1*y2_trans, axis=1)/corr_denom
+
+    # The fit is not trusted if the best stretch is at the edge of the allowed range
+    success = np.isfinite(corr) & (ibest > 0) & (ibest < nstretch - 1)
+    if not np.all(success):
+        msgs.warn('Best stretch is at the edge of the allowed range for {:d} of {:d} spectra'.format(
+            np.sum(np.logical_not(success)), npairs))
+
+    if debug:
+        x1 = np.arange(nspec)
+        for ipair in range(npairs):
+            fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(14, 10))
+            ax1.plot(stretch_grid[ipair], corr_grid[ipair]/corr_denom[ipair], 'k-', drawstyle='steps-mid',
+                     label='coarse grid')
+            ax1.plot(fine_grid[ipair], corr_fine[ipair]/corr_denom[ipair], 'b.', label='fine grid')
+            ax1.set_xlabel('stretch')
+            ax1.legend()
+            ax2.plot(x1, y1[ipair], 'k-', drawstyle='steps', label='inspec1')
+            ax2.plot(x1, y2_trans[ipair], 'r-', drawstyle='steps', label='inspec2')
+            ax2.set_title('shift= {:5.3f}'.format(shift[ipair]) + ',  stretch = {:7.5f}'.format(stretch[ipair]) +
+                          ', corr = {:5.3f}'.format(corr[ipair]))
+            ax2.legend()
+            plt.show()
+
+    return success, shift, stretch, corr, shift_cc, cc_val
+
+
+def time_shift_stretch(spec_array, smooth=5.0, shift_mnmx=(-0.05,0.05), stretch_mnmx=(0.9,1.1)):
+    """
+    Time xcorr_shift_stretch_batch against the differential evolution of xcorr_shift_stretch.
+
+    Every spectrum (column) of spec_array is matched to the first one with both methods.
 
+    Returns:
+        tuple: Wall-clock times of the differential evolution and of the batched engine in seconds, and the shift,
+        stretch and correlation of both methods, each with shape (nslits, 2).
+    """
+    import time
 
+    nslits = spec_array.shape[1]
+    inspec1 = spec_array[:, 0]
+    shift, stretch, corr = np.zeros((nslits, 2)), np.zeros((nslits, 2)), np.zeros((nslits, 2))
 
-hdu = fits.open('./spec_array.fits')
-spec = hdu[0].data.astype('float64')
-inspec1=spec[:,0]
-nslits = spec.shape[1]
-nspec = spec.shape[0]
-#inspec2 = spec[:,4]
+    t0 = time.perf_counter()
+    for islit in range(nslits):
+        _, shift[islit, 0], stretch[islit, 0], corr[islit, 0], _, _ = xcorr_shift_stretch(
+            inspec1, spec_array[:, islit], smooth=smooth, shift_mnmx=shift_mnmx, stretch_mnmx=stretch_mnmx,
+            debug=False)
+    time_de = time.perf_counter() - t0
 
-# TESTING
-#shift = 200.0
-#stretch = 0.9
-#smooth = 5.0
+    t0 = time.perf_counter()
+    _, shift[:, 1], stretch[:, 1], corr[:, 1], _, _ = xcorr_shift_stretch_batch(
+        inspec1, spec_array.T, smooth=smooth, shift_mnmx=shift_mnmx, stretch_mnmx=stretch_mnmx)
+    time_batch = time.perf_counter() - t0
 
-# Apply the shift and stretch to a copy of inspec1
-#inspec2 = shift_and_stretch(inspec1, shift, stretch)
-# evaluate the correlation coefficient at this value
-success = np.zeros(nslits,dtype=bool)
-shift = np.zeros(nslits)
-shift_cc = np.zeros(nslits)
-stretch = np.zeros(nslits)
-xcorr = np.zeros(nslits)
-xcorr_cc = np.zeros(nslits)
-smooth = 5.0
+    print('{:>6s} {:>10s} {:>10s} {:>10s} {:>10s} {:>8s} {:>8s}'.format('slit', 'shift_de', 'shift_fft', 'stretch_de',
+                                                                       'stretch_fft', 'corr_de', 'corr_fft'))
+    for islit in range(nslits):
+        print('{:6d} {:10.3f} {:10.3f} {:10.5f} {:10.5f} {:8.4f} {:8.4f}'.format(
+            islit, shift[islit, 0], shift[islit, 1], stretch[islit, 0], stretch[islit, 1], corr[islit, 0],
+            corr[islit, 1]))
+    print('differential evolution: {:7.2f} s, batched FFT: {:7.2f} s, speedup: {:6.1f}'.format(
+        time_de, time_batch, time_de/time_batch))
+    return time_de, time_batch, shift, stretch, corr
 
-y1 = scipy.ndimage.filters.gaussian_filter(inspec1, smooth)
 
-for islit in range(nslits):
-    output = fit_shift_stretch(inspec1,spec[:,islit], debug = True)
-    success[islit], shift[islit], stretch[islit], xcorr[islit], shift_cc[islit], xcorr_cc[islit] = output
+if __name__ == '__main__':
 
+    hdu = fits.open('./spec_array.fits')
+    spec = hdu[0].data.astype('float64')
+    time_shift_stretch(spec)
@@ -0,0 +1,364 @@
+""" Reidentify arc lines against a precomputed index of an archive of wavelength solutions
+
+autoid.reidentify detects the lines of every archived arc, builds its synthetic cross-correlation arc and fits its
+shift and stretch with differential evolution for every slit, and then matches the lines by brute force. With masks of
+100+ slits (DEIMOS, MOSFIRE) and archives with many templates this dominates the wavelength calibration.
+ArchiveIndex does all the work that only depends on the archive once:
+
+    - the lines, the continuum subtracted arc and the synthetic cross-correlation arc of every template, and the FFT
+      of the latter on a common padded grid,
+    - the wavelength of every archived line and its nearest line in the line list,
+
+so that reidentify_indexed only needs, per slit, one batched FFT cross-correlation with all the templates to rank them,
+one batched shift/stretch fit of the best few (match_peaks.xcorr_shift_stretch_batch), and a searchsorted of the
+detected lines into the sorted, shifted and stretched lines of each of them.
+"""
+import numpy as np
+import scipy
+from astropy.io import fits
+
+from pypeit import msgs
+from pypeit.core import arc
+from pypeit.core.wavecal import wvutils, patterns
+
+from pypeitdev.wavelengths.match_peaks import xcorr_shift_stretch_batch
+
+
+def _nearest_sorted(sorted_values, values):
+    """
+    Index of the nearest element of a sorted array for every value, with one searchsorted.
+    """
+    if sorted_values.size == 1:
+        return np.zeros(values.size, dtype=int)
+    ihi = np.clip(np.searchsorted(sorted_values, values), 1, sorted_values.size - 1)
+    ilo = ihi - 1
+    return np.where(np.abs(values - sorted_values[ilo]) <= np.abs(sorted_values[ihi] - values), ilo, ihi)
+
+
+class ArchiveIndex:
+    """
+    Precomputed index of an archive of wavelength solutions, for reidentify_indexed.
+
+    Args:
+        spec_arxiv (ndarray): Archived arc spectra, shape (nspec_arxiv, narxiv) or (nspec_arxiv,), as in
+            autoid.reidentify.
+        wave_soln_arxiv (ndarray): Wavelength solutions of the archived spectra, same shape as spec_arxiv.
+        line_list (astropy.table.Table): The arc line list, with a 'wave' column.
+        nspec (int): Number of spectral pixels of the arcs to be reidentified. The archive is resized to it, as in
+            autoid.reidentify. Default is the size of the archived spectra.
+        sigdetect (float): Detection threshold of the arc lines, for the archive and the slits.
+        fwhm (float): FWHM of the arc lines in pixels.
+        nonlinear_counts (float): Lines above this level are not used.
+        percent_ceil (float): Ceiling of the line amplitudes of the synthetic cross-correlation arcs, see
+            wvutils.get_xcorr_arc.
+        cont_sub (bool): Cross-correlate the continuum subtracted arcs.
+    """
+    def __init__(self, spec_arxiv, wave_soln_arxiv, line_list, nspec=None, sigdetect=5.0, fwhm=4.0,
+                 nonlinear_counts=1e10, percent_ceil=50.0, cont_sub=True):
+        if spec_arxiv.shape != wave_soln_arxiv.shape:
+            msgs.error('spec_arxiv and wave_soln_arxiv must have the same shape')
+        spec_arxiv = spec_arxiv.reshape(spec_arxiv.shape[0], -1)
+        wave_soln_arxiv = wave_soln_arxiv.reshape(wave_soln_arxiv.shape[0], -1)
+        nspec = spec_arxiv.shape[0] if nspec is None else nspec
+        self.spec_arxiv = arc.resize_spec(spec_arxiv, nspec)
+        self.wave_soln_arxiv = arc.resize_spec(wave_soln_arxiv, nspec)
+        self.nspec, self.narxiv = self.spec_arxiv.shape
+        self.sigdetect, self.fwhm, self.nonlinear_counts = sigdetect, fwhm, nonlinear_counts
+        self.percent_ceil, self.cont_sub = percent_ceil, cont_sub
+
+        # Lines, continuum subtracted arcs and synthetic cross-correlation arcs of the templates
+        self.spec_cont_sub = np.zeros_like(self.spec_arxiv)
+        self.xcorr_arc = np.zeros((self.narxiv, self.nspec))
+        det_arxiv = []
+        for iarxiv in range(self.narxiv):
+            tcent, _, _, icut, self.spec_cont_sub[:, iarxiv] = wvutils.arc_lines_from_spec(
+                self.spec_arxiv[:, iarxiv], sigdetect=sigdetect, nonlinear_counts=nonlinear_counts, fwhm=fwhm)
+            det_arxiv.append(np.sort(tcent[icut]))
+            self.xcorr_arc[iarxiv] = self._xcorr_arc(self.use_spec_arxiv[:, iarxiv])
+        self.det_offsets = np.concatenate(([0], np.cumsum([det.size for det in det_arxiv]))).astype(int)
+        self.det_arxiv = np.concatenate(det_arxiv) if self.narxiv > 0 else np.zeros(0)
+        self._set_derived(line_list)
+
+    def _set_derived(self, line_list):
+        """
+        Quantities derived from the templates and their lines: central wavelengths, dispersions, the line list match
+        of every archived line and the FFTs of the synthetic arcs.
+        """
+        self.wvc_arxiv = self.wave_soln_arxiv[self.nspec//2, :]
+        self.disp_arxiv = np.array([np.median(np.diff(wave[wave > 1.0])) for wave in self.wave_soln_arxiv.T])
+        this_soln = self.wave_soln_arxiv[:, 0]
+        self.sign = 1 if this_soln[self.nspec//2] > this_soln[self.nspec//2 - 1] else -1
+
+        # Wavelength of every archived line, and its nearest line in the line list
+        self.wvdata = np.sort(np.array(line_list['wave'].data))
+        xrng = np.arange(self.nspec)
+        self.wave_det_arxiv = np.concatenate(
+            [scipy.interpolate.interp1d(xrng, self.wave_soln_arxiv[:, iarxiv], kind='cubic')(self.det(iarxiv))
+             for iarxiv in range(self.narxiv)]) if self.det_arxiv.size > 0 else np.zeros(0)
+        self.line_indx = _nearest_sorted(self.wvdata, self.wave_det_arxiv)
+        self.line_dwave = np.abs(self.wvdata[self.line_indx] - self.wave_det_arxiv)
+
+        # FFTs of the synthetic arcs, padded to avoid wrapping the cross-correlations
+        self.nfft = scipy.fft.next_fast_len(2*self.nspec)
+        self.xcorr_fft = np.conj(scipy.fft.rfft(self.xcorr_arc, self.nfft, axis=1))
+        self.xcorr_norm = np.sqrt(np.sum(self.xcorr_arc**2, axis=1))
+
+    @property
+    def use_spec_arxiv(self):
+        return self.spec_cont_sub if self.cont_sub else self.spec_arxiv
+
+    def _xcorr_arc(self, spec):
+        return wvutils.get_xcorr_arc(spec, percent_ceil=self.percent_ceil, sigdetect=self.sigdetect, fwhm=self.fwhm)
+
+    def det(self, iarxiv):
+        """
+        Sorted pixel positions of the lines of a template.
+        """
+        return self.det_arxiv[self.det_offsets[iarxiv]:self.det_offsets[iarxiv + 1]]
+
+    def rank(self, y1, max_lag_frac=1.0):
+        """
+        Cross-correlate a synthetic arc with all the templates at once.
+
+        Args:
+            y1 (ndarray): Synthetic cross-correlation arc of the slit, shape (nspec,).
+            max_lag_frac (float): Fraction of nspec of the largest lag.
+
+        Returns:
+            tuple: Shift (same convention as wvutils.xcorr_shift) and normalized correlation at the shift of every
+            template, each with shape (narxiv,).
+        """
+        corr = scipy.fft.irfft(scipy.fft.rfft(y1, self.nfft)[None, :]*self.xcorr_fft, self.nfft, axis=1)
+        maxlag = int((self.nspec - 1)*max_lag_frac)
+        lags = np.arange(-maxlag, maxlag + 1)
+        corr = corr[:, lags % self.nfft]
+        imax = np.argmax(corr, axis=1)
+        i0 = np.clip(imax, 1, lags.size - 2)
+        cm, c0, cp = [np.take_along_axis(corr, (i0 + k)[:, None], axis=1)[:, 0] for k in (-1, 0, 1)]
+        denom = cm - 2.0*c0 + cp
+        good = denom < 0.0
+        delta = np.zeros(self.narxiv)
+        delta[good] = np.clip(0.5*(cm[good] - cp[good])/denom[good], -0.5, 0.5)
+        corr_denom = np.sqrt(np.sum(y1**2))*self.xcorr_norm
+        cc = np.zeros(self.narxiv)
+        ok = corr_denom > 0.0
+        cc[ok] = (c0[ok] - 0.25*(cm[ok] - cp[ok])*delta[ok])/corr_denom[ok]
+        return lags[i0] + delta, cc
+
+    def to_file(self, outfile, overwrite=True):
+        """
+        Write the index to a FITS file. The line list is not saved: it is passed again to from_file.
+        """
+        hdr = fits.Header()
+        for key, value in zip(['SIGDET', 'FWHM', 'NONLIN', 'PCTCEIL', 'CONTSUB'],
+                              [self.sigdetect, self.fwhm, self.nonlinear_counts, self.percent_ceil, self.cont_sub]):
+            hdr[key] = value
+        hdul = fits.HDUList([fits.PrimaryHDU(header=hdr),
+                             fits.ImageHDU(self.spec_arxiv, name='SPEC_ARXIV'),
+                             fits.ImageHDU(self.wave_soln_arxiv, name='WAVE_SOLN'),
+                             fits.ImageHDU(self.spec_cont_sub, name='SPEC_CONT_SUB'),
+                             fits.ImageHDU(self.xcorr_arc, name='XCORR_ARC'),
+                             fits.ImageHDU(self.det_arxiv, name='DET_ARXIV'),
+                             fits.ImageHDU(self.det_offsets, name='DET_OFFSETS')])
+        hdul.writeto(outfile, overwrite=overwrite)
+        msgs.info('Wrote archive index to {:s}'.format(outfile))
+
+    @classmethod
+    def from_file(cls, infile, line_list):
+        """
+        Read an index written by to_file, without detecting the lines of the templates again.
+        """
+        self = cls.__new__(cls)
+        with fits.open(infile) as hdul:
+            hdr = hdul[0].header
+            self.sigdetect, self.fwhm, self.nonlinear_counts = hdr['SIGDET'], hdr['FWHM'], hdr['NONLIN']
+            self.percent_ceil, self.cont_sub = hdr['PCTCEIL'], hdr['CONTSUB']
+            self.spec_arxiv = hdul['SPEC_ARXIV'].data.astype(float)
+            self.wave_soln_arxiv = hdul['WAVE_SOLN'].data.astype(float)
+            self.spec_cont_sub = hdul['SPEC_CONT_SUB'].data.astype(float)
+            self.xcorr_arc = hdul['XCORR_ARC'].data.astype(float)
+            self.det_arxiv = hdul['DET_ARXIV'].data.astype(float)
+            self.det_offsets = hdul['DET_OFFSETS'].data.astype(int)
+        self.nspec, self.narxiv = self.spec_arxiv.shape
+        self._set_derived(line_list)
+        return self
+
+
+def reidentify_indexed(spec, index, nreid_min, detections=None, nselect=5, cc_thresh=0.8, cc_local_thresh=0.8,
+                       match_toler=2.0, nlocal_cc=11, shift_mnmx=(-0.2, 0.2), stretch_mnmx=(0.95, 1.05),
+                       max_lag_frac=1.0):
+    """
+    Determine the line identifications of an arc spectrum from an indexed archive of wavelength solutions.
+
+    This follows autoid.reidentify and returns the same outputs, but only the nselect templates that best
+    cross-correlate with the slit, without stretch, are fit for shift and stretch and used to reidentify the lines.
+
+    Args:
+        spec (ndarray): Arc spectrum, shape (nspec,).
+        index (ArchiveIndex): The indexed archive.
+        nreid_min (int): Minimum number of templates that must reidentify a line, see autoid.reidentify.
+        detections (ndarray): Pixel positions of the lines of the arc. Detected if None.
+        nselect (int): Number of templates fit for shift and stretch. Use index.narxiv to fit all of them.
+        cc_thresh (float): Templates whose correlation after shift and stretch is below this are not used.
+        cc_local_thresh (float): Threshold of the local correlation of the reidentified lines.
+        match_toler (float): Matching tolerance of the lines in pixels.
+        nlocal_cc (int): Size of the window of the local correlation in pixels.
+        shift_mnmx (tuple): Range of the shift around the cross-correlation shift, in units of nspec.
+        stretch_mnmx (tuple): Range of the stretch.
+        max_lag_frac (float): Fraction of nspec of the largest shift.
+
+    Returns:
+        tuple: detections, continuum subtracted arc and patt_dict, as returned by autoid.reidentify.
+    """
+    if spec.ndim != 1:
+        msgs.error('spec must be a one dimensional numpy array')
+    if spec.size != index.nspec:
+        msgs.error('The archive index was built for nspec={:d}, not {:d}'.format(index.nspec, spec.size))
+    nspec = spec.size
+    xrng = np.arange(nspec)
+
+    tcent, _, _, icut, spec_cont_sub = wvutils.arc_lines_from_spec(
+        spec, sigdetect=index.sigdetect, nonlinear_counts=index.nonlinear_counts, fwhm=index.fwhm)
+    if detections is None:
+        detections = tcent[icut]
+    use_spec = spec_cont_sub if index.cont_sub else spec
+
+    # Rank the templates with a single batched cross-correlation and fit the best ones for shift and stretch
+    y1 = index._xcorr_arc(use_spec)
+    if np.all(y1 == 0) or detections.size == 0:
+        msgs.warn('No lines detected in the arc spectrum. Cannot reidentify.')
+        patt_dict_slit = patterns.empty_patt_dict(detections.size)
+        patt_dict_slit['sigdetect'] = index.sigdetect
+        return detections, spec_cont_sub, patt_dict_slit
+    _, cc_rank = index.rank(y1, max_lag_frac=max_lag_frac)
+    iselect = np.argsort(-cc_rank, kind='stable')[:nselect]
+    success, shift, stretch, ccorr, _, _ = xcorr_shift_stretch_batch(
+        np.broadcast_to(y1, (iselect.size, nspec)), index.xcorr_arc[iselect], smooth=None, shift_mnmx=shift_mnmx,
+        stretch_mnmx=stretch_mnmx)
+    use = success & (ccorr >= cc_thresh)
+    for iarxiv, this_cc, this_shift, this_stretch in zip(iselect, ccorr, shift, stretch):
+        msgs.info('arxiv # {:d}: shift = {:5.3f}, stretch = {:5.3f}, cc = {:5.3f}'.format(
+            iarxiv, this_shift, this_stretch, this_cc))
+
+    nlocal_cc_odd = nlocal_cc + 1 if nlocal_cc % 2 == 0 else nlocal_cc
+    window = np.ones(nlocal_cc_odd)/nlocal_cc_odd
+    spec2_smooth = scipy.ndimage.convolve1d(use_spec**2, window)
+
+    line_indx, det_indx, line_cc = [], [], []
+    wcen, disp = [], []
+    for iarxiv, this_shift, this_stretch in zip(iselect[use], shift[use], stretch[use]):
+        disp.append(index.disp_arxiv[iarxiv]/this_stretch)
+        wcen.append(index.wvc_arxiv[iarxiv] - this_shift*disp[-1])
+        det_arxiv = index.det(iarxiv)
+        if det_arxiv.size == 0:
+            continue
+        # Nearest shifted and stretched archived line of every detection, and its line list match
+        det_arxiv_ss = det_arxiv*this_stretch + this_shift
+        inear = _nearest_sorted(det_arxiv_ss, detections)
+        iflat = index.det_offsets[iarxiv] + inear
+        good = (np.abs(detections - det_arxiv_ss[inear]) < match_toler) \
+            & (index.line_dwave[iflat] < match_toler*index.disp_arxiv[iarxiv])
+        if not np.any(good):
+            continue
+        # Local zero lag correlation of the slit and the shifted and stretched template
+        spec_arxiv_ss = wvutils.shift_and_stretch(index.use_spec_arxiv[:, iarxiv], this_shift, this_stretch, 0.0,
+                                                  stretch_func='linear')
+        prod_smooth = scipy.ndimage.convolve1d(use_spec*spec_arxiv_ss, window)
+        denom = np.sqrt(spec2_smooth*scipy.ndimage.convolve1d(spec_arxiv_ss**2, window))
+        corr_local = np.full(nspec, -1.0)
+        corr_local[denom > 0] = prod_smooth[denom > 0]/denom[denom > 0]
+        line_indx.append(index.line_indx[iflat[good]])
+        det_indx.append(np.where(good)[0])
+        line_cc.append(np.interp(detections[good], xrng, corr_local))
+
+    line_indx = np.concatenate(line_indx) if len(line_indx) > 0 else np.zeros(0, dtype=int)
+    if len(wcen) == 0 or np.unique(line_indx).size < 3:
+        patt_dict_slit = patterns.empty_patt_dict(detections.size)
+        patt_dict_slit['sigdetect'] = index.sigdetect
+        return detections, spec_cont_sub, patt_dict_slit
+
+    patt_dict_slit = patterns.solve_xcorr(detections, index.wvdata, np.concatenate(det_indx), line_indx,
+                                          np.concatenate(line_cc), nreid_min=nreid_min,
+                                          cc_local_thresh=cc_local_thresh)
+    patt_dict_slit['sign'] = index.sign
+    patt_dict_slit['bwv'] = np.median(wcen)
+    patt_dict_slit['bdisp'] = np.median(disp)
+    patt_dict_slit['sigdetect'] = index.sigdetect
+
+    # Use only the perfect IDs
+    iperfect = np.array(patt_dict_slit['scores']) != 'Perfect'
+    patt_dict_slit['mask'][iperfect] = False
+    patt_dict_slit['nmatch'] = np.sum(patt_dict_slit['mask'])
+    if patt_dict_slit['nmatch'] < 3:
+        msgs.warn('Insufficient number of good reidentifications: {:d} (at least 3 required).'.format(
+            patt_dict_slit['nmatch']))
+        patt_dict_slit['acceptable'] = False
+    return detections, spec_cont_sub, patt_dict_slit
+
+
+def reidentify_slits(spec, index, nreid_min, **kwargs):
+    """
+    Run reidentify_indexed on every slit of a mask.
+
+    Args:
+        spec (ndarray): Arc spectra, shape (nspec, nslits).
+        index (ArchiveIndex): The indexed archive.
+        nreid_min (int): See reidentify_indexed.
+        **kwargs: Passed to reidentify_indexed.
+
+    Returns:
+        tuple: Dictionaries of the detections, continuum subtracted arcs and patt_dict of every slit, keyed by the slit
+        index as a string, as in autoid.ArchiveReid.
+    """
+    detections, spec_cont_sub, all_patt_dict = {}, {}, {}
+    for islit in range(spec.shape[1]):
+        msgs.info('Reidentifying slit # {:d}/{:d}'.format(islit + 1, spec.shape[1]))
+        detections[str(islit)], spec_cont_sub[str(islit)], all_patt_dict[str(islit)] = \
+            reidentify_indexed(spec[:, islit], index, nreid_min, **kwargs)
+    return detections, spec_cont_sub, all_patt_dict
+
+
+def time_reidentify(spec, spec_arxiv, wave_soln_arxiv, line_list, nreid_min=1, nselect=5, **kwargs):
+    """
+    Time reidentify_indexed against autoid.reidentify on a set of slits.
+
+    Args:
+        spec (ndarray): Arc spectra, shape (nspec, nslits).
+        spec_arxiv, wave_soln_arxiv, line_list: The archive, as passed to autoid.reidentify.
+        nreid_min (int): See autoid.reidentify.
+        nselect (int): See reidentify_indexed.
+        **kwargs: Passed to both reidentify functions.
+
+    Returns:
+        tuple: Wall-clock times of autoid.reidentify, of building the index and of reidentify_indexed in seconds, and
+        the fraction of the lines of every slit that get the same identification from both.
+    """
+    import time
+    from pypeit.core.wavecal import autoid
+
+    nslits = spec.shape[1]
+    same = np.zeros(nslits)
+    t0 = time.perf_counter()
+    ids_reid = [autoid.reidentify(spec[:, islit], spec_arxiv, wave_soln_arxiv, line_list, nreid_min, **kwargs)[2]
+                for islit in range(nslits)]
+    t_reid = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    index = ArchiveIndex(spec_arxiv, wave_soln_arxiv, line_list, nspec=spec.shape[0])
+    t_index = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    _, _, ids_index = reidentify_slits(spec, index, nreid_min, nselect=nselect, **kwargs)
+    t_indexed = time.perf_counter() - t0
+
+    for islit in range(nslits):
+        ids1, ids2 = ids_reid[islit], ids_index[str(islit)]
+        if 'IDs' not in ids1 or 'IDs' not in ids2:
+            same[islit] = float(ids1['acceptable'] == ids2['acceptable'])
+            continue
+        mask1, mask2 = np.asarray(ids1['mask']), np.asarray(ids2['mask'])
+        both = mask1 | mask2
+        same[islit] = np.mean((mask1 == mask2)[both] & (np.asarray(ids1['IDs']) == np.asarray(ids2['IDs']))[both]) \
+            if np.any(both) else 1.0
+    msgs.info('autoid.reidentify: {:.2f} s, index: {:.2f} s, reidentify_indexed: {:.2f} s'.format(
+        t_reid, t_index, t_indexed))
+    return t_reid, t_index, t_indexed, same
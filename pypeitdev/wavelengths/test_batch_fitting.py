@@ -0,0 +1,75 @@
+"""
+Check the batched robust fits of batch_fitting against pypeit's robust_fit.
+
+Run with::
+
+    pytest pypeitdev/wavelengths/test_batch_fitting.py
+"""
+import numpy as np
+import pytest
+
+from pypeit.core import fitting
+
+from pypeitdev.wavelengths import batch_fitting
+
+
+def fake_series(nseries=60, nmin=8, nmax=40, seed=2):
+    """
+    Cubic series of random lengths with a tenth of the points turned into outliers.
+    """
+    rng = np.random.default_rng(seed)
+    xlist, ylist = [], []
+    for _ in range(nseries):
+        npts = rng.integers(nmin, nmax)
+        x = np.sort(rng.uniform(-1.0, 2.0, npts))
+        y = np.polynomial.polynomial.polyval(x, rng.normal(0.0, 1.0, 4)) + rng.normal(0.0, 0.1, npts)
+        bad = rng.random(npts) < 0.1
+        y[bad] += rng.normal(0.0, 3.0, np.sum(bad))
+        xlist.append(x)
+        ylist.append(y)
+    return xlist, ylist, rng.integers(1, 4, nseries)
+
+
+def check_against_robust_fit(xlist, ylist, orders, **kwargs):
+    xarr, yarr, in_gpm = batch_fitting.pad_series(xlist, ylist)
+    weights = kwargs.pop('weights', None)
+    fitc, gpm = batch_fitting.robust_fit_batch(xarr, yarr, orders, in_gpm=in_gpm, verbose=False,
+                                               weights=None if weights is None else
+                                               batch_fitting.pad_series(xlist, weights)[1], **kwargs)
+    for iseries, (x, y, order) in enumerate(zip(xlist, ylist, orders)):
+        pypeitFit = fitting.robust_fit(x, y, order, verbose=False,
+                                       weights=None if weights is None else weights[iseries], **kwargs)
+        assert np.array_equal(gpm[iseries, :x.size], pypeitFit.bool_gpm)
+        assert not np.any(gpm[iseries, x.size:])
+        assert np.allclose(fitc[iseries, :order + 1], pypeitFit.fitc, rtol=1e-10, atol=1e-10)
+        assert np.all(fitc[iseries, order + 1:] == 0.0)
+
+
+@pytest.mark.parametrize('function', ['polynomial', 'legendre', 'chebyshev'])
+def test_robust_fit_batch(function):
+    xlist, ylist, orders = fake_series()
+    check_against_robust_fit(xlist, ylist, orders, function=function, minx=-1.0, maxx=2.0, maxiter=25,
+                             lower=3.0, upper=3.0, maxrej=1, sticky=True, use_mad=True)
+
+
+def test_robust_fit_batch_options():
+    xlist, ylist, orders = fake_series(seed=7)
+    rng = np.random.default_rng(7)
+    weights = [rng.uniform(0.5, 2.0, x.size) for x in xlist]
+    # Fit range from the good points, standard deviation rejection, non-sticky and several rejections per iteration
+    check_against_robust_fit(xlist, ylist, orders, function='legendre', maxiter=10, lower=2.5, upper=2.5,
+                             maxrej=3, sticky=False, use_mad=False)
+    check_against_robust_fit(xlist, ylist, orders, function='polynomial', maxiter=10, maxdev=0.5, weights=weights)
+
+
+def test_robust_fit_batch_masked_nans():
+    xlist, ylist, orders = fake_series(nseries=5)
+    xarr, yarr, in_gpm = batch_fitting.pad_series(xlist, ylist, fill=np.nan)
+    fitc, gpm = batch_fitting.robust_fit_batch(xarr, yarr, 2, function='legendre', minx=-1.0, maxx=2.0,
+                                               in_gpm=in_gpm, lower=3.0, upper=3.0, maxrej=1, verbose=False)
+    assert np.all(np.isfinite(fitc))
+    model = batch_fitting.evaluate_fit_batch(fitc, 'legendre', np.nan_to_num(xarr), minx=-1.0, maxx=2.0)
+    for iseries, x in enumerate(xlist):
+        pypeitFit = fitting.robust_fit(x, ylist[iseries], 2, function='legendre', minx=-1.0, maxx=2.0, lower=3.0,
+                                       upper=3.0, maxrej=1, verbose=False)
+        assert np.allclose(model[iseries, :x.size], pypeitFit.eval(x), rtol=1e-10, atol=1e-10)
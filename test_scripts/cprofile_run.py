@@ -0,0 +1,46 @@
+#
+# See top-level LICENSE.rst file for Copyright information
+#
+# -*- coding: utf-8 -*-
+"""
+Run a script under cProfile, keeping the script's exit status.
+
+Used by ``pypeit_test --profile cprofile``. ``python -m cProfile`` can't be used
+for this because it swallows the ``SystemExit`` raised by the script, so a test
+that fails with ``sys.exit(1)`` or an argparse error would exit with status 0
+and be reported as passed.
+
+Usage::
+
+    python cprofile_run.py <profile_file> <script> [script arguments]
+"""
+import os
+import sys
+import runpy
+import cProfile
+
+
+def main():
+    if len(sys.argv) < 3:
+        print("Usage: cprofile_run.py <profile_file> <script> [script arguments]", file=sys.stderr)
+        return 2
+
+    profile_file = sys.argv[1]
+    script = sys.argv[2]
+    # Make the script see the command line and import path it would see if run directly
+    sys.argv = sys.argv[2:]
+    sys.path.insert(0, os.path.dirname(script))
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        # Any SystemExit or exception from the script propagates after the profile is written
+        runpy.run_path(script, run_name='__main__')
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_file)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
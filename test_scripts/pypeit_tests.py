@@ -8,6 +8,7 @@ Classes and utility functions for running individual pypeit tests.
 
 
 import os.path
+import sys
 import shutil
 import subprocess
 import datetime
@@ -26,6 +27,13 @@ from IPython import embed
 
 _COVERAGE_ARGS = ["--source", "pypeit", "--omit", "*PypeIt/pypeit/tests/*,*PypeIt/pypeit/deprecated/*", "--parallel-mode"] 
 
+_PROFILE_EXTENSIONS = {'cprofile': '.pstats', 'sample': '.speedscope.json'}
+"""dict: The profiling methods supported by pypeit_test --profile, and the extension of the profile file each
+writes next to the test's log file."""
+
+_CPROFILE_RUNNER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cprofile_run.py')
+"""str: Script that runs a test under cProfile while keeping its exit status."""
+
 class PypeItTest(ABC):
     """Abstract base class for classes that run pypeit tests and hold the results from those tests."""
 
@@ -44,6 +52,7 @@ class PypeItTest(ABC):
         self.description = description
         self.log_suffix = log_suffix
         self.coverage = pargs.coverage is not None
+        self.profile = pargs.profile
         self.env = os.environ
         """ :obj:`Mapping`: OS Environment to run the test under."""
 
@@ -71,6 +80,22 @@ class PypeItTest(ABC):
         self.max_mem = None
         """ :obj:`int`: The maximum memory used by the test."""
 
+        self.profile_file = None
+        """ str: The profile written by the test, if it was run with profiling."""
+
+        self.prepared = False
+        """ bool: Whether the preparation work for the test has been done."""
+
+        self.key = str(self)
+        """ str: Identifies the test in the journal of completed tests. Set by build_test_setup."""
+
+        self.cached = False
+        """ bool: True if the test was not run because its results from a previous run were reused."""
+
+        self.arguments = dict()
+        """ dict: The arguments the test was built with that change its command line. Part of the journal
+        fingerprint, so that a result is only reused for the same arguments."""
+
 
     def __str__(self):
         """Return a summary of the test and the status.
@@ -91,25 +116,56 @@ class PypeItTest(ABC):
     def build_command_line(self):
         pass
 
+    def prep(self):
+        """Do any work, such as writing input files, needed before the test can run.
+
+        Constructing a test must not have side effects, so subclasses put any
+        work on the file system here instead of in ``__init__``. This is called
+        at most once, through :meth:`prepare`.
+        """
+        pass
+
+    def prepare(self):
+        """Create the output directory for the test and run :meth:`prep`, if
+        this hasn't already been done."""
+        if not self.prepared:
+            os.makedirs(self.setup.rdxdir, exist_ok=True)
+            self.prep()
+            self.prepared = True
+
     def run(self):
         """Run a test in a child process."""
 
         try:
+            # Do the preparation work that was deferred when the test was built
+            self.prepare()
+
             # Open a log for the test
             child = None
             self.logfile = self.get_logfile()            
             self.command_line = self.build_command_line()
 
             with open(self.logfile, "a") as f:
-                if self.coverage:
-                    # Coverage will need the full path to the script
+                if self.coverage or self.profile is not None:
+                    # Coverage and the profilers will need the full path to the script
                     full_path_to_command = shutil.which(self.command_line[0])
                     if full_path_to_command is not None:
                         self.command_line[0] = full_path_to_command
                     else:
                         raise RuntimeError(f"Could not find full path for {self.command_line[0]}")
 
+                if self.coverage:
                     self.command_line = ["coverage", "run"] + _COVERAGE_ARGS + self.command_line
+                elif self.profile is not None:
+                    # Write the profile next to the log file
+                    self.profile_file = os.path.splitext(self.logfile)[0] + _PROFILE_EXTENSIONS[self.profile]
+                    if self.profile == 'cprofile':
+                        # Not "python -m cProfile", which exits with 0 even when the script fails
+                        self.command_line = [sys.executable, _CPROFILE_RUNNER, self.profile_file] \
+                                            + self.command_line
+                    else:
+                        self.command_line = ["py-spy", "record", "--subprocesses", "--format", "speedscope",
+                                             "-o", self.profile_file, "--", sys.executable] + self.command_line
                 if self.start_time is None:
                     # If a subclass sets the start time or calls run multiple times,
                     # (see deimos QL) use the first value as the start rather than overwriting it.
@@ -168,6 +224,23 @@ class PypeItTest(ABC):
         files generated during testing should be included"""
         return []
 
+    def input_files(self):
+        """Return a list of the dev-suite files used as input to the test. A change to
+        any of these files means the results of a previous run can't be reused."""
+        return []
+
+    def use_cached_result(self):
+        """Mark the test as passed using the results of a previous run, instead of running it.
+
+        Subclasses that update the test setup after running should do the same here.
+
+        Returns:
+            bool: True if the previous results could be used, False if the test must be run.
+        """
+        self.passed = True
+        self.cached = True
+        return True
+
 
 class PypeItSetupTest(PypeItTest):
     """Test subclass that runs pypeit_setup"""
@@ -179,22 +252,36 @@ class PypeItSetupTest(PypeItTest):
 
         if super().run():
             # Check for the pypeit file after running the test
-            rdxdir = os.path.join(self.setup.rdxdir, self.setup.instr + '_A')
-            pyp_file = os.path.join(
-                rdxdir, f'{self.setup.instr}_A.pypeit')
-            if not os.path.isfile(pyp_file):
-                self.error_msgs.append(f"Could not find expected pypeit file {pyp_file}")
+            if not self._use_pypeit_file():
+                self.error_msgs.append(f"Could not find expected pypeit file {self._expected_pypeit_file()}")
                 self.passed = False
-            else:
-                # If the pypeit file was created, put it's location and the new output
-                # directory into the setup object for subsequent tests to use
-                pyp_file = os.path.split(pyp_file)[1]
-
-                self.setup.pyp_file = pyp_file
-                self.setup.rdxdir = rdxdir
 
         return self.passed
 
+    def use_cached_result(self):
+        # The pypeit file from the previous run is needed by subsequent tests
+        return self._use_pypeit_file() and super().use_cached_result()
+
+    def _expected_pypeit_file(self):
+        """Return the pypeit file that pypeit_setup is expected to create."""
+        return os.path.join(self.setup.rdxdir, self.setup.instr + '_A', f'{self.setup.instr}_A.pypeit')
+
+    def _use_pypeit_file(self):
+        """Put the location of the generated pypeit file and the new output directory into the setup object
+        for subsequent tests to use.
+
+        Returns:
+            bool: False if the pypeit file does not exist.
+        """
+        pyp_file = self._expected_pypeit_file()
+        if not os.path.isfile(pyp_file):
+            return False
+
+        (rdxdir, pyp_file) = os.path.split(pyp_file)
+        self.setup.pyp_file = pyp_file
+        self.setup.rdxdir = rdxdir
+        return True
+
     def build_command_line(self):
         return ['pypeit_setup', '-r', self.setup.rawdir, '-s',
                 self.setup.instr, '-c all', '-o', '--output_path', self.setup.rdxdir]
@@ -211,20 +298,30 @@ class PypeItReduceTest(PypeItTest):
         super().__init__(setup, pargs, description, "test")
 
         self.std = std
-        # If the pypeit file isn't being created by pypeit_setup, copy it and update it's path
+        self.arguments = {'ignore_calibs': self.ignore_calibs, 'std': std,
+                          'generate_pyp_file': self.setup.generate_pyp_file}
+        # If the pypeit file isn't being created by pypeit_setup, it is copied
+        # from a template and it's path updated by prep()
         if not self.setup.generate_pyp_file:
-            self.pyp_file = template_pypeit_file(self.setup.dev_path,
-                                                 self.setup.instr,
-                                                 self.setup.name,
-                                                 self.std)
-
-            self.pyp_file = fix_pypeit_file_directory(self.pyp_file,
-                                                      self.setup.dev_path,
-                                                      self.setup.rawdir,
+            self.template_file = template_pypeit_file(self.setup.dev_path,
                                                       self.setup.instr,
                                                       self.setup.name,
-                                                      self.setup.rdxdir,
                                                       self.std)
+            self.pyp_file = os.path.join(self.setup.rdxdir,
+                                         pypeit_file_name(self.setup.instr, self.setup.name, std=self.std))
+        else:
+            self.template_file = None
+
+    def prep(self):
+        if self.template_file is not None:
+            fix_pypeit_file_directory(self.template_file,
+                                      self.setup.dev_path,
+                                      self.setup.rawdir,
+                                      self.setup.instr,
+                                      self.setup.name,
+                                      self.setup.rdxdir,
+                                      self.std,
+                                      outfile=self.pyp_file)
 
     def build_command_line(self):
         if self.setup.generate_pyp_file:
@@ -237,11 +334,14 @@ class PypeItReduceTest(PypeItTest):
         return command_line
 
     def check_for_missing_files(self):
-        if not self.setup.generate_pyp_file and not os.path.isfile(self.pyp_file):
-            return [self.pyp_file]
+        if self.template_file is not None and not os.path.isfile(self.template_file):
+            return [self.template_file]
         else:
             return []
 
+    def input_files(self):
+        return [] if self.template_file is None else [self.template_file]
+
 class PypeItSensFuncTest(PypeItTest):
     """Test subclass that runs pypeit_sensfunc"""
     def __init__(self, setup, pargs, std_file, sens_file=None):
@@ -251,6 +351,8 @@ class PypeItSensFuncTest(PypeItTest):
 
         if self.sens_file is not None:
             self.sens_file = os.path.join(setup.dev_path, 'sensfunc_files', self.sens_file)
+        # std_file is replaced by the matching file when the test runs, so keep the pattern
+        self.arguments = {'std_file': std_file, 'sens_file': self.sens_file}
 
     def run(self):
 
@@ -281,6 +383,9 @@ class PypeItSensFuncTest(PypeItTest):
         else:
             return []
 
+    def input_files(self):
+        return [] if self.sens_file is None else [self.sens_file]
+
 
 class PypeItFluxSetupTest(PypeItTest):
     """Test subclass that runs pypeit_flux_setup"""
@@ -308,6 +413,9 @@ class PypeItFluxTest(PypeItTest):
         else:
             return []
 
+    def input_files(self):
+        return [self.flux_file]
+
 class PypeItFlexureTest(PypeItTest):
     """Test subclass that runs pypeit_deimos_flexure"""
     def __init__(self, setup, pargs):
@@ -324,6 +432,9 @@ class PypeItFlexureTest(PypeItTest):
             return [self.flexure_file]
         else:
             return []
+
+    def input_files(self):
+        return [self.flexure_file]
 class PypeItCoadd1DTest(PypeItTest):
     """Test subclass that runs pypeit_coadd_1dspec"""
 
@@ -421,6 +532,9 @@ class PypeItCoadd1DTest(PypeItTest):
         else:
             return []
 
+    def input_files(self):
+        return [self.coadd_file]
+
 class PypeItCoadd2DTest(PypeItTest):
     """Test subclass that runs pypeit_coadd_2dspec"""
     def __init__(self, setup, pargs, coadd_file=None): #, obj=None):
@@ -434,6 +548,7 @@ class PypeItCoadd2DTest(PypeItTest):
 
         if self.coadd_file is None: # and self.obj is None:
             raise ValueError('Must provide coadd2d file') # or object name.')
+        self.arguments = {'coadd_file': self.coadd_file}
 
     def build_command_line(self):
         command_line = ['pypeit_coadd_2dspec', self.coadd_file]
@@ -446,6 +561,9 @@ class PypeItCoadd2DTest(PypeItTest):
         else:
             return []
 
+    def input_files(self):
+        return [self.coadd_file] if self.coadd_file else []
+
 
 class PypeItTelluricTest(PypeItTest):
     """Test subclass that runs pypeit_tellfit"""
@@ -457,22 +575,28 @@ class PypeItTelluricTest(PypeItTest):
         self.tell_file = os.path.join(self.setup.dev_path, 'tellfit_files',
                                 f'{self.setup.instr}_{self.setup.name.lower()}.tell') \
                             if tell_file else None
+        self.arguments = {'coadd_file': coadd_file, 'tell_file': self.tell_file}
 
     def build_command_line(self):
         command_line = ['pypeit_tellfit', os.path.join(self.setup.rdxdir, self.coadd_file)]
         command_line += ['-t', f'{self.tell_file}']
         return command_line
 
+    def input_files(self):
+        return [] if self.tell_file is None else [self.tell_file]
+
 class PypeItCollate1DTest(PypeItTest):
     """Test subclass that runs pypeit_collate_1d"""
     def __init__(self, setup, pargs, files, **options):
         super().__init__(setup, pargs, "pypeit_collate", "test_collate")
         self.files = files
         self.options = options
+        self.arguments = {'files': files, 'options': options}
 
+    def prep(self):
         # Cleanup some files so tests are repeatable (collate normally appends to these files)
-        report_file = os.path.join(setup.rdxdir, "collate_report.dat")
-        warnings_file = os.path.join(setup.rdxdir, "collate_warnings.txt")
+        report_file = os.path.join(self.setup.rdxdir, "collate_report.dat")
+        warnings_file = os.path.join(self.setup.rdxdir, "collate_warnings.txt")
         if os.path.exists(report_file):
             os.remove(report_file)
         if os.path.exists(warnings_file):
@@ -508,6 +632,7 @@ class PypeItQuickLookTest(PypeItTest):
         self.redux_dir = os.path.abspath(pargs.outputdir)
         self.pargs = pargs
         self.test_name = test_name
+        self.arguments = {'files': files, 'test_name': test_name, 'options': options}
         # Place the calibrations into REDUX_DIR/QL_CALIB directory.
         self.output_dir = os.path.join(self.redux_dir, 'QL_CALIB')
 
@@ -576,6 +701,8 @@ class PypeItQuickLookTest(PypeItTest):
         # calibs that don't (or rarely) change?
 
         if self.instr_uses_build_calib():
+            # The build log goes in the output directory, so it must exist first
+            self.prepare()
             logfile = get_unique_file(os.path.join(self.setup.rdxdir, "build_ql_calib_output.log"))
             try:
                 # Build the calibrations with the output going to a log file
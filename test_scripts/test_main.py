@@ -18,6 +18,9 @@ import traceback
 import datetime
 from pathlib import Path
 import textwrap
+import json
+import hashlib
+import pstats
 
 import numpy as np
 import pypeit 
@@ -25,8 +28,10 @@ import pypeit
 pypeit.msgs.reset(verbosity=0) 
 
 
+from pypeitdev.fileio import atomic_write
+
 from .test_setups import TestPhase, all_tests, all_setups, _raw_data_dirs
-from .pypeit_tests import get_unique_file, _COVERAGE_ARGS
+from .pypeit_tests import get_unique_file, _COVERAGE_ARGS, _PROFILE_EXTENSIONS
 
 test_run_queue = PriorityQueue()
 """:obj:`queue.Queue`: FIFO queue for test setups to be run."""
@@ -108,6 +113,104 @@ class TestPriorityList(object):
             self.updated = False
 
 
+class TestJournal(object):
+    """A journal of the tests completed by the dev suite, used to resume an interrupted run.
+
+    The journal is stored as a JSON file in the output directory and is rewritten after every test completes,
+    so that it is up to date if the dev suite is interrupted. Each entry records whether the test passed, a
+    fingerprint of its inputs, and the files the test wrote.  A test can be skipped when resuming if it passed,
+    its input fingerprint hasn't changed, and the files it wrote still exist.
+
+    The input fingerprint is built from the PypeIt version, the test key, the arguments the test was built with,
+    the pypeit_test options that change what the tests run or write, the files in the raw data directory, and the
+    dev-suite input files the test uses (e.g. the .pypeit template).
+
+    Attributes:
+        _entries (dict): Maps test keys to the journal entry for the test.
+        _file (str):     The file the journal is written to.
+        _options (dict): The pypeit_test options included in the fingerprint.
+        _lock (:obj:`threading.Lock`): Lock used to synchronize updates from multiple threads.
+    """
+
+    def __init__(self, file, pargs):
+        """Reads the journal from a file, if it exists."""
+        self._file = file
+        self._options = {'outputdir': os.path.abspath(pargs.outputdir),
+                         'do_not_reuse_calibs': pargs.do_not_reuse_calibs,
+                         'coverage': pargs.coverage is not None,
+                         'profile': pargs.profile}
+        self._lock = Lock()
+        self._entries = dict()
+        if os.path.exists(file):
+            try:
+                with open(file, "r") as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                # A corrupt journal just means nothing can be reused
+                self._entries = dict()
+
+    def __len__(self):
+        """Return how many tests are in the journal"""
+        return len(self._entries)
+
+    @staticmethod
+    def _file_signatures(files):
+        """Return the name, size, and modification time of each of the given files that exists."""
+        signatures = []
+        for file in files:
+            try:
+                stat_info = os.stat(file)
+            except OSError:
+                signatures.append([str(file), None, None])
+                continue
+            signatures.append([str(file), stat_info.st_size, stat_info.st_mtime_ns])
+        return signatures
+
+    def fingerprint(self, test):
+        """Return a fingerprint of the inputs to a test."""
+        rawdir = Path(test.setup.rawdir)
+        raw_files = sorted(rawdir.iterdir()) if rawdir.is_dir() else []
+        inputs = {'pypeit_version': pypeit.__version__,
+                  'test': test.key,
+                  'arguments': test.arguments,
+                  'options': self._options,
+                  'raw_files': self._file_signatures(raw_files),
+                  'input_files': self._file_signatures(test.input_files())}
+        return hashlib.sha1(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
+
+    def can_reuse(self, test):
+        """Return whether a test passed in a previous run and its results can be reused."""
+        entry = self._entries.get(test.key)
+        if entry is None or not entry['passed'] or entry['fingerprint'] != self.fingerprint(test):
+            return False
+
+        # Make sure the output from the previous run is still there
+        return all([os.path.exists(os.path.join(entry['rdxdir'], file)) for file in entry['outputs']])
+
+    def record(self, test):
+        """Record the results of a test that has just been run, and write the journal."""
+        outputs = []
+        if test.passed and test.start_time is not None and os.path.isdir(test.setup.rdxdir):
+            # Record the files written by the test, relative to the output directory
+            start = test.start_time.timestamp()
+            for file in Path(test.setup.rdxdir).rglob("*"):
+                if file.is_file() and file.stat().st_mtime >= start:
+                    outputs.append(str(file.relative_to(test.setup.rdxdir)))
+
+        entry = {'passed': bool(test.passed),
+                 'fingerprint': self.fingerprint(test),
+                 'rdxdir': test.setup.rdxdir,
+                 'outputs': sorted(outputs),
+                 'logfile': test.logfile,
+                 'end_time': None if test.end_time is None else test.end_time.isoformat()}
+
+        with self._lock:
+            self._entries[test.key] = entry
+            with atomic_write(self._file) as tmp_file:
+                with open(tmp_file, "w") as f:
+                    json.dump(self._entries, f, indent=1)
+
+
 class TestSetup(object):
     """Representation of a test setup within the pypeit development suite.
 
@@ -187,6 +290,8 @@ class TestReport(object):
     num_passed (int):  The number of tests that have passed.
     num_failed (int):  The number of tests that have failed.
     num_skipped (int): The number of tests that were skipped because they depended on the results of a failed tests.
+    num_cached (int):  The number of tests that passed in a previous run and were not run again. These are also
+                       counted as passed.
     num_active (int):  The number of tests that are currently in progress.
 
     failed_tests (:obj:`list` of str):  List of names of tests that have failed
@@ -205,6 +310,7 @@ class TestReport(object):
         self.num_passed = 0
         self.num_failed = 0
         self.num_skipped = 0
+        self.num_cached = 0
         self.num_active = 0
         self.failed_tests = []
         self.skipped_tests = []
@@ -224,7 +330,8 @@ class TestReport(object):
     def _get_test_counts(self):
         """Helper method to create a string with the current test counts"""
         verbose_info = f'{self.num_active:2} active/' if self.pargs.verbose else ''
-        return f'{verbose_info}{self.num_passed:2} passed/{self.num_failed:2} failed/{self.num_skipped:2} skipped'
+        cached_info = f'/{self.num_cached:2} cached' if self.pargs.resume else ''
+        return f'{verbose_info}{self.num_passed:2} passed/{self.num_failed:2} failed/{self.num_skipped:2} skipped{cached_info}'
 
     def setup_testing_started(self,setups):
         """Called once test setup testing has started.
@@ -273,6 +380,16 @@ class TestReport(object):
             if not self.pargs.quiet:
                 print(f'{self._get_test_counts()} {red_text("SKIPPED")} {test}', flush=True)
 
+    def test_cached(self, test):
+        """Called when a test was not run because its results from a previous run were reused"""
+        with self.lock:
+            self.num_tests += 1
+            self.num_passed += 1
+            self.num_cached += 1
+
+            if not self.pargs.quiet:
+                print(f'{self._get_test_counts()} {green_text("CACHED")}  {test}', flush=True)
+
     def test_completed(self, test):
         """Called when a test has finished executing."""
         with self.lock:
@@ -382,6 +499,8 @@ class TestReport(object):
         """Display a summary of the PypeIt setup tests"""
 
         calib_text = '(Existing calibrations ignored)' if self.pargs.do_not_reuse_calibs else ''
+        if self.num_cached > 0:
+            calib_text += f' ({self.num_cached} reused from a previous run)'
         if self.num_tests == self.num_passed:
             print("\x1B[" + "1;32m" +
                   "--- PYPEIT DEVELOPMENT SUITE PASSED {0}/{1} TESTS {2} ---".format(
@@ -453,6 +572,9 @@ class TestReport(object):
             print(f"Coverage results:", file=output)
             self.print_tail(self.pargs.coverage, 1, output)
 
+        if self.pargs.profile is not None:
+            print(f"Profile of PypeIt functions written to {profile_report_file(self.pargs)}", file=output)
+
         print(f"Testing Started at {self.start_time.isoformat()}", file=output)
         print(f"Testing Completed at {self.end_time.isoformat()}", file=output)
         print(f"Total Time: {self.end_time - self.start_time}", file=output)
@@ -461,7 +583,9 @@ class TestReport(object):
     def report_on_test(self, test, output=sys.stdout, flush=False):
         """Print a detailed report on the status of a test to the given output stream."""
 
-        if test.passed:
+        if test.cached:
+            result = green_text('--- PASSED (CACHED)')
+        elif test.passed:
             result = green_text('--- PASSED')
         elif test.passed is None:
             result = red_text('--- SKIPPED')
@@ -481,6 +605,8 @@ class TestReport(object):
         print(f'End time:   {test.end_time.ctime() if test.end_time is not None else "n/a"}', file=output, flush=flush)
         print(f'Duration:   {duration}', file=output, flush=flush)
         print(f'Mem Usage:  {test.max_mem}', file=output, flush=flush)
+        if test.profile_file is not None:
+            print(f'Profile:    {test.profile_file}', file=output, flush=flush)
         print(f"Command:    {' '.join(test.command_line) if test.command_line is not None else ''}", file=output, flush=flush)
         print('', file=output, flush=flush)
         print('Error Messages:', file=output, flush=flush)
@@ -597,6 +723,78 @@ def generate_coverage_report(pargs):
     with open(pargs.coverage, "w") as f:
         process = subprocess.run(["coverage", "report", "-m"], stdout=f, stderr=subprocess.STDOUT, cwd=pargs.outputdir)
 
+def profile_report_file(pargs):
+    """Return the file the aggregate profiling report is written to."""
+    return os.path.join(pargs.outputdir, 'pypeit_test_profile.txt')
+
+def _load_speedscope_profile(file):
+    """Read the cumulative time of each function in a speedscope profile written by py-spy.
+
+    Args:
+        file (str): The speedscope JSON file.
+
+    Returns:
+        dict: Maps (filename, line number, function name) tuples to the cumulative time spent in that function, in
+        the units of the profile.
+    """
+    with open(file, "r") as f:
+        speedscope = json.load(f)
+    frames = speedscope['shared']['frames']
+    cumulative = dict()
+    for profile in speedscope['profiles']:
+        if profile['type'] != 'sampled':
+            continue
+        for sample, weight in zip(profile['samples'], profile['weights']):
+            # A function that appears more than once in a stack (e.g. recursion) is only counted once
+            for frame_index in set(sample):
+                frame = frames[frame_index]
+                key = (frame.get('file', ''), frame.get('line', 0), frame['name'])
+                cumulative[key] = cumulative.get(key, 0.0) + weight
+    return cumulative
+
+def generate_profile_report(pargs, setups, num_functions=50):
+    """Write a report of the PypeIt functions with the most cumulative time across all of the profiled tests.
+
+    Args:
+        pargs (:obj:`argparse.Namespace`): The arguments to pypeit_test, as returned by argparse.
+        setups (list of :obj:`TestSetup`): The test setups that were run.
+        num_functions (int, optional): The number of functions to include in the report.
+    """
+    profile_files = [test.profile_file for setup in setups for test in setup.tests
+                     if test.profile_file is not None and os.path.exists(test.profile_file)]
+
+    with open(profile_report_file(pargs), "w") as f:
+        if len(profile_files) == 0:
+            print("Couldn't find any profiles to combine.", file=f)
+            return
+
+        cumulative = dict()
+        if pargs.profile == 'cprofile':
+            stats = pstats.Stats(*profile_files)
+            for key, (cc, nc, tt, ct, callers) in stats.stats.items():
+                cumulative[key] = ct
+            units = 's'
+        else:
+            for file in profile_files:
+                for key, value in _load_speedscope_profile(file).items():
+                    cumulative[key] = cumulative.get(key, 0.0) + value
+            units = 'samples'
+
+        # Only report on PypeIt functions
+        pypeit_dir = os.path.dirname(pypeit.__file__)
+        pypeit_functions = [(value, key) for key, value in cumulative.items() if key[0].startswith(pypeit_dir)]
+        pypeit_functions.sort(reverse=True)
+
+        print(f"Top {num_functions} PypeIt functions by cumulative time across {len(profile_files)} profiled tests",
+              file=f)
+        print(f"{'Cumulative (' + units + ')':>20}  Function", file=f)
+        for value, (filename, lineno, funcname) in pypeit_functions[:num_functions]:
+            print(f"{value:20.2f}  {os.path.relpath(filename, pypeit_dir)}:{lineno}({funcname})", file=f)
+
+        print("\nProfiles:", file=f)
+        for file in profile_files:
+            print(f"    {file}", file=f)
+
 def raw_data_dir():
     return os.path.join(os.environ['PYPEIT_DEV'], 'RAW_DATA')
 
@@ -646,6 +844,10 @@ def parser(options=None):
                         help='Only prepare to execute run_pypeit, but do not actually run it.')
     parser.add_argument('-m', '--do_not_reuse_calibs', default=False, action='store_true',
                         help='run pypeit without using any existing processed calibration frames')
+    parser.add_argument('--resume', default=False, action='store_true',
+                        help='Resume an interrupted run. Tests that passed in a previous run into the same output '
+                             'directory are not run again if their inputs and the PypeIt version have not changed, '
+                             'and the files they wrote still exist. Failed and incomplete tests are run.')
     parser.add_argument('-t', '--threads', default=1, type=int,
                         help='Run THREADS number of parallel tests.')
     parser.add_argument('-q', '--quiet', default=False, action='store_true',
@@ -656,6 +858,12 @@ def parser(options=None):
                              'detailed report at the end of testing. This has no effect if -q is given')
     parser.add_argument('--coverage', default=None, type=str, 
                         help='Collect code coverage information. and write it to the given file.')
+    parser.add_argument('--profile', default=None, choices=list(_PROFILE_EXTENSIONS.keys()),
+                        help='Profile each test, writing the profile next to the test\'s log file, and write a '
+                             'report of the PypeIt functions with the most cumulative time across all of the '
+                             'tests to <outputdir>/pypeit_test_profile.txt. "cprofile" uses the Python '
+                             'profiler, "sample" uses the py-spy sampling profiler, which must be installed. '
+                             'Cannot be used with --coverage.')
     parser.add_argument('-r', '--report', default=None, type=str,
                         help='Write a detailed test report to REPORT.')
     parser.add_argument('-c', '--csv', default=None, type=str,
@@ -677,8 +885,14 @@ def show_setup_list():
                                   subsequent_indent="    ", break_long_words=False):
             print(line)
 
-def thread_target(test_report):
-    """Thread target method for running tests."""
+def thread_target(test_report, journal, resume):
+    """Thread target method for running tests.
+
+    Args:
+        test_report (:obj:`TestReport`): The test report to send test results to.
+        journal (:obj:`TestJournal`): The journal to record test results in.
+        resume (bool): Whether tests that passed in a previous run should be reused instead of run.
+    """
     while not test_report.testing_complete:
         try:
             test_setup = test_run_queue.get(timeout=2)
@@ -687,14 +901,20 @@ def thread_target(test_report):
             continue
 
         passed = True
+        reuse = resume
         for test in test_setup.tests:
 
             if not passed:
                 test_report.test_skipped(test)
+            elif reuse and journal.can_reuse(test) and test.use_cached_result():
+                test_report.test_cached(test)
             else:
                 test_report.test_started(test)
                 passed = test.run()
                 test_report.test_completed(test)
+                journal.record(test)
+                # Any later tests in this setup may depend on the new results, so they must be run too
+                reuse = False
 
         test_report.test_setup_completed(test_setup)
 
@@ -714,6 +934,9 @@ def main():
         show_setup_list()
         return 0
 
+    if pargs.coverage is not None and pargs.profile is not None:
+        raise ValueError("--coverage and --profile cannot be used together")
+
     if pargs.threads <=0:
         raise ValueError("Number of threads must be >= 1")
     elif pargs.threads > 1:
@@ -756,8 +979,9 @@ def main():
             flg_ql = True
             flg_vet = True
 
-            # Write the test priority file if all tests are being run
-            if pargs.instruments is None and pargs.setups is None and pargs.debug == False:
+            # Write the test priority file if all tests are being run. The durations from resumed runs
+            # don't include the reused tests, so they aren't used.
+            if pargs.instruments is None and pargs.setups is None and pargs.debug == False and not pargs.resume:
                 write_priorities = True
 
         elif test == "pypeit_tests":
@@ -926,9 +1150,14 @@ def main():
         if not pargs.quiet and pargs.threads > 1:
             print(f'Running tests in {pargs.threads} parallel processes')
 
+        # The journal of completed tests is always written, so that a later run can be resumed
+        journal = TestJournal(os.path.join(pargs.outputdir, 'pypeit_test_journal.json'), pargs)
+        if not pargs.quiet and pargs.resume:
+            print(f'Loaded {len(journal)} results from a previous run')
+
         thread_pool = []
         for i in range(pargs.threads):
-            new_thread = Thread(target=thread_target, args=[test_report])
+            new_thread = Thread(target=thread_target, args=[test_report, journal, pargs.resume])
             thread_pool.append(new_thread)
             new_thread.start()
 
@@ -962,6 +1191,9 @@ def main():
     if pargs.coverage is not None:
         generate_coverage_report(pargs)
 
+    if pargs.profile is not None and (flg_reduce or flg_after or flg_ql):
+        generate_profile_report(pargs, setups)
+
     # ---------------------------------------------------------------------------
     # Finish up the report on the test results
     test_report.testing_completed()
@@ -1019,11 +1251,9 @@ def build_test_setup(pargs, instr, setup_name, flg_reduce, flg_after, flg_ql):
 
     rawdir = os.path.join(raw_data, instr_base_dir, setup_name)
 
-    # Directory for reduced data
+    # Directory for reduced data. This is created when the first test
+    # in the setup is prepared.
     rdxdir = os.path.join(pargs.outputdir, instr, setup_name)
-    if not os.path.exists(rdxdir):
-        # Make the directory
-        os.makedirs(rdxdir)
 
     # Create the test setup and set it's priority
     setup = TestSetup(instr, setup_name, rawdir, rdxdir, dev_path)
@@ -1032,24 +1262,22 @@ def build_test_setup(pargs, instr, setup_name, flg_reduce, flg_after, flg_ql):
     # selected by the command line arguments
     for test_descr in all_tests:
 
-        # Check instruments
-        if setup.instr not in test_descr['setups']:
+        # Skip the test type if it wasn't selected by the command line, before
+        # building any tests
+        if not flg_reduce and test_descr.phase == TestPhase.REDUCE:
             continue
-        # Check setup
-        if setup_name not in test_descr['setups'][setup.instr]:
+
+        if not flg_after and test_descr.phase == TestPhase.AFTERBURN:
             continue
 
-        for kwargs in test_descr['setups'][setup.instr][setup_name]:
-            # Create the test, this will also run any prep_only steps in the
-            # __init__ method
-            try:
-                test = test_descr['factory'](setup, pargs, **kwargs)
-            except FileNotFoundError as e:
-                # If the test prep work found a missing file, just record it in the
-                # list of missing files. This allows all missing files for the
-                # test suite to be reported at once
-                setup.missing_files.append(str(e))
-                continue
+        if not flg_ql and test_descr.phase == TestPhase.QL:
+            continue
+
+        for kwargs in test_descr.kwargs_for(instr, setup_name):
+            # Create the test. This has no side effects, any preparation work
+            # is deferred until the test is run.
+            test = test_descr.factory(setup, pargs, **kwargs)
+            test.key = f'{test} {test_descr.factory.__name__} {json.dumps(kwargs, sort_keys=True)}'
 
             # Check for any missing files
             missing_files = test.check_for_missing_files()
@@ -1057,17 +1285,9 @@ def build_test_setup(pargs, instr, setup_name, flg_reduce, flg_after, flg_ql):
                 setup.missing_files += missing_files
                 continue
 
-            # Skip the test if it wasn't selected by the command line
-            if pargs.prep_only and test_descr['type'] != TestPhase.PREP:
-                continue
-
-            if not flg_reduce and test_descr['type'] == TestPhase.REDUCE:
-                continue
-
-            if not flg_after and test_descr['type'] == TestPhase.AFTERBURN:
-                continue
-
-            if not flg_ql and test_descr['type'] == TestPhase.QL:
+            if pargs.prep_only and test_descr.phase != TestPhase.PREP:
+                # Only do the preparation work for tests outside of the PREP phase
+                test.prepare()
                 continue
 
             setup.tests.append(test)
@@ -33,6 +33,7 @@ import random
 from test_scripts import test_main
 from test_scripts.pypeit_tests import PypeItReduceTest
 import time
+import datetime
 
 
 class MockPopen(object):
@@ -467,3 +468,144 @@ def test_quick_look_calib_env(monkeypatch, tmp_path):
         monkeypatch.setattr(sys, "argv", ['pypeit_test', '-o', str(tmp_path), '-i', 'keck_nires', 'reduce', 'ql'])
 
         assert test_main.main() == 0
+
+def test_build_test_setup_is_lazy(tmp_path):
+    """
+    Test that building the tests for a setup does not touch the file system until the tests are prepared.
+    """
+    pargs = test_main.parser(['-o', str(tmp_path), 'all'])
+    setup = test_main.build_test_setup(pargs, 'shane_kast_blue', '452_3306_d57', True, True, True)
+    assert len(setup.tests) > 0
+    assert len(setup.missing_files) == 0
+
+    # Building the tests should not create any files or directories
+    assert len(list(tmp_path.iterdir())) == 0
+
+    # Preparing the reduce test creates the output directory and the .pypeit file
+    reduce_test = [test for test in setup.tests if isinstance(test, PypeItReduceTest)][0]
+    reduce_test.prepare()
+    assert reduce_test.prepared
+    assert (tmp_path / "shane_kast_blue" / "452_3306_d57" / "shane_kast_blue_452_3306_d57.pypeit").exists()
+
+    # Filtering out the reduce tests means they aren't built
+    setup = test_main.build_test_setup(pargs, 'shane_kast_blue', '452_3306_d57', False, True, True)
+    assert not any([isinstance(test, PypeItReduceTest) for test in setup.tests])
+
+def test_journal(monkeypatch, tmp_path):
+    """
+    Test the journal used to resume interrupted dev suite runs.
+    """
+    pargs = test_main.parser(['-o', str(tmp_path), '--resume', 'reduce'])
+    setup = test_main.build_test_setup(pargs, 'shane_kast_blue', '452_3306_d57', True, False, False)
+    test = setup.tests[0]
+    journal_file = str(tmp_path / 'pypeit_test_journal.json')
+    journal = test_main.TestJournal(journal_file, pargs)
+    assert len(journal) == 0
+    assert not journal.can_reuse(test)
+
+    # Simulate a passing test that writes the .pypeit file as its output
+    test.start_time = datetime.datetime.now() - datetime.timedelta(seconds=1)
+    test.prepare()
+    test.passed = True
+    test.end_time = datetime.datetime.now()
+    journal.record(test)
+
+    # Re-read the journal as a resumed run would
+    journal = test_main.TestJournal(journal_file, pargs)
+    assert len(journal) == 1
+    assert journal.can_reuse(test)
+    assert test.use_cached_result()
+    assert test.cached
+
+    # Running with different options or test arguments invalidates the results
+    for options in (['-m'], ['--profile', 'cprofile'], ['--coverage', 'coverage.txt']):
+        other_pargs = test_main.parser(['-o', str(tmp_path), '--resume'] + options + ['reduce'])
+        assert not test_main.TestJournal(journal_file, other_pargs).can_reuse(test)
+    other_pargs = test_main.parser(['-o', str(tmp_path / 'other'), '--resume', 'reduce'])
+    assert not test_main.TestJournal(journal_file, other_pargs).can_reuse(test)
+    monkeypatch.setitem(test.arguments, 'ignore_calibs', True)
+    assert not journal.can_reuse(test)
+    monkeypatch.undo()
+    assert journal.can_reuse(test)
+
+    # A new version of PypeIt invalidates the results
+    monkeypatch.setattr(test_main.pypeit, "__version__", "0.0.0.bogus")
+    assert not journal.can_reuse(test)
+    monkeypatch.undo()
+    assert journal.can_reuse(test)
+
+    # So does removing the output
+    os.unlink(test.pyp_file)
+    assert not journal.can_reuse(test)
+
+    # Failed tests are never reused
+    test.passed = False
+    journal.record(test)
+    assert not journal.can_reuse(test)
+
+def test_profile_report(tmp_path):
+    """
+    Test combining the per-test profiles into a report on PypeIt functions.
+    """
+    from types import SimpleNamespace
+    import cProfile
+    import json
+    from pypeit.spectrographs.util import load_spectrograph
+
+    # Profile a PypeIt function in two "tests"
+    profile_files = []
+    for i in range(2):
+        profiler = cProfile.Profile()
+        profiler.runcall(load_spectrograph, 'shane_kast_blue')
+        profile_files.append(str(tmp_path / f'test{i}.pstats'))
+        profiler.dump_stats(profile_files[-1])
+
+    setups = [SimpleNamespace(tests=[SimpleNamespace(profile_file=file) for file in profile_files])]
+    pargs = test_main.parser(['-o', str(tmp_path), '--profile', 'cprofile', 'reduce'])
+    test_main.generate_profile_report(pargs, setups)
+    report = (tmp_path / 'pypeit_test_profile.txt').read_text()
+    assert 'across 2 profiled tests' in report
+    assert 'load_spectrograph' in report
+
+    # A speedscope profile from the sampling profiler
+    pypeit_file = os.path.join(os.path.dirname(test_main.pypeit.__file__), 'core', 'wavecal', 'autoid.py')
+    speedscope = {'shared': {'frames': [{'name': 'main', 'file': '/usr/bin/run_pypeit', 'line': 1},
+                                        {'name': 'full_template', 'file': pypeit_file, 'line': 10}]},
+                  'profiles': [{'type': 'sampled', 'samples': [[0, 1], [0], [0, 1, 1]], 'weights': [1, 1, 1]}]}
+    speedscope_file = tmp_path / 'test.speedscope.json'
+    speedscope_file.write_text(json.dumps(speedscope))
+    setups = [SimpleNamespace(tests=[SimpleNamespace(profile_file=str(speedscope_file))])]
+    pargs = test_main.parser(['-o', str(tmp_path), '--profile', 'sample', 'reduce'])
+    test_main.generate_profile_report(pargs, setups)
+    report = (tmp_path / 'pypeit_test_profile.txt').read_text()
+    assert 'full_template' in report
+    assert 'run_pypeit' not in report.split("Profiles:")[0]
+    assert '2.00' in report
+
+def test_profile_keeps_exit_status(tmp_path):
+    """
+    Test that a failing test is still reported as failed when it is run under cProfile.
+    """
+    from types import SimpleNamespace
+    from test_scripts.pypeit_tests import PypeItTest
+
+    class ScriptTest(PypeItTest):
+        def __init__(self, setup, pargs, script):
+            super().__init__(setup, pargs, "script", "script")
+            self.script = script
+
+        def build_command_line(self):
+            return [str(self.script)]
+
+    pargs = test_main.parser(['-o', str(tmp_path), '--profile', 'cprofile', 'reduce'])
+    setup = SimpleNamespace(instr='shane_kast_blue', name='452_3306_d57', rdxdir=str(tmp_path / 'rdx'))
+    for name, body, expected in [('passing', 'print("ok")', True),
+                                 ('exiting', 'import sys\nsys.exit(1)', False),
+                                 ('raising', 'raise RuntimeError("Unit testing Exception")', False)]:
+        script = tmp_path / f'{name}_script'
+        script.write_text(f'#!{sys.executable}\n{body}\n')
+        script.chmod(0o755)
+        test = ScriptTest(setup, pargs, script)
+        assert test.run() is expected, name
+        assert os.path.exists(test.profile_file)
+        os.unlink(test.profile_file)
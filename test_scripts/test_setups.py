@@ -28,8 +28,11 @@ To add a new type of test:
 
 1) Edit pypeit_tests.py to add a new subclass to run the new test type as a child process.
 2) Add a new test list with at least one instrument/setup that runs the new test.
-3) Add the test to the all_tests list. This list defines the order the test types are run for a test setup, the
-   PypeItTest subclass that runs the test, and the test phase (prep, reduce, afterburn, quicklook).
+3) Add a TestDescription for the test to the all_tests list. This list defines the order the test types are run for
+   a test setup, the PypeItTest subclass that runs the test, and the test phase (prep, reduce, afterburn, quicklook).
+   The subclass's __init__ method must not have side effects, any work on the file system needed before the test
+   runs belongs in its prep() method. Tests are built for every selected setup when pypeit_test starts, but prep()
+   is only run when the test is about to run.
 
 Attributes:
     _reduce_setups:          The test setups that support reduction. A dict of instruments to the supported test
@@ -41,27 +44,22 @@ Attributes:
                              on.  The test types are listed in the order they run in so that tests can depend on the
                              result of previous tests.
 
-                             Each test type is represented by a dict with the following keys:
+                             Each test type is represented by a TestDescription with the following attributes:
 
-                             'factory': A callable that builds a PypeItTest subclasss to run the test.
+                             factory: A callable that builds a PypeItTest subclasss to run the test.
                              This callable will be passed a TestSetup object, the command line arguments to
                              pypeit_test (as returned by argparse.ArgumentParser), and any keyword arguments included
-                             in the 'setups' key.
+                             in the setups attribute.
 
-                             'type': A TestPhase enum that is either PREP, REDUCE, AFTERBURN, or QL.
+                             phase: A TestPhase enum that is either PREP, REDUCE, AFTERBURN, or QL.
 
-                             'setups': Which setups should run the test along with any arguments needed to run the test.
+                             setups: Which setups should run the test along with any arguments needed to run the test.
+                             This is a dict of instruments to a dict of setup names. Each setup name maps to a list
+                             of keyword arguments that will be passed to the PypeItTest __init__ method, one test is
+                             built for each entry in the list.  The key word arguments are represented as a dict and
+                             passed to the __init__ method with the ** operator.
 
-                             The setup can also be specified as an instrument name to indicate every setup for the
-                             instrument should run the test type, or as 'instrument/setup' to indicate only a specific
-                             setup should run the test type.
-
-                             The value for 'setups' can be a list of setups, or a dict. If a dict is used, it maps
-                             a setup specifier to the keyword arguments that will be passed to the PypeItTest __init__
-                             method.  The key word arguments are represented as a dict and passed to the __init__
-                             method with the ** operator.
-
-                            The 'setups' values are taken from the following private attributes of this module:
+                            The setups values are taken from the following private attributes of this module:
 
                             _pypeit_setup:      Test setups that run pypeit_setup to generate a .pypeit file.
                             _additional_reduce: Test setups that run additional reduce tests beyond the default test.
@@ -80,6 +78,8 @@ Attributes:
 from . import pypeit_tests
 from .setups import all_setups 
 from enum import Enum, IntEnum, auto
+from dataclasses import dataclass
+from typing import Callable
 import copy
 
 class TestPhase(Enum):
@@ -98,6 +98,34 @@ class TestPhase(Enum):
     AFTERBURN = auto()
     QL        = auto()
 
+@dataclass(frozen=True)
+class TestDescription:
+    """Description of a type of test and the test setups it runs on.
+
+    Attributes:
+        factory (callable): Builds the PypeItTest subclass that runs the test.
+        phase (:obj:`TestPhase`): The test phase the test runs in.
+        setups (dict): Maps instrument names to a dict of setup names to the list of
+                       keyword arguments for each test run on that setup.
+    """
+    factory: Callable
+    phase: TestPhase
+    setups: dict
+
+    def kwargs_for(self, instr, setup_name):
+        """Return the keyword arguments of each test of this type run on a setup.
+
+        Args:
+            instr (str): The instrument of the test setup.
+            setup_name (str): The name of the test setup.
+
+        Returns:
+            list of dict: The keyword arguments for each test, empty if the setup does not run
+            this type of test.
+        """
+        return self.setups.get(instr, {}).get(setup_name, [])
+
+
 # raw data directories for for setups that don't have the normal naming conventions
 _raw_data_dirs = {
     'p200_ngps_r': 'p200_ngps',
@@ -418,40 +446,16 @@ _quick_look = {
 # PypeItReduceTest and PypeItSensFuncTest must come before
 # PypeItFluxTest.
 #
-all_tests = [{'factory': pypeit_tests.PypeItSetupTest,
-              'type':    TestPhase.PREP,
-              'setups':  _pypeit_setup},
-             {'factory': pypeit_tests.PypeItReduceTest,
-              'type':    TestPhase.REDUCE,
-              'setups':  _reduce_setups},
-             {'factory': pypeit_tests.PypeItReduceTest,
-              'type':    TestPhase.REDUCE,
-              'setups':  _additional_reduce},
-             {'factory': pypeit_tests.PypeItSensFuncTest,
-              'type':    TestPhase.AFTERBURN,
-              'setups':  _sensfunc},
-             {'factory': pypeit_tests.PypeItFluxSetupTest,
-              'type':    TestPhase.AFTERBURN,
-              'setups':  _flux_setup},
-             {'factory': pypeit_tests.PypeItFluxTest,
-              'type':    TestPhase.AFTERBURN,
-              'setups':  _flux},
-             {'factory': pypeit_tests.PypeItFlexureTest,
-              'type':    TestPhase.AFTERBURN,
-              'setups':  _flexure},
-             {'factory': pypeit_tests.PypeItCollate1DTest,
-              'type':    TestPhase.AFTERBURN,
-              'setups':  _collate1d},
-             {'factory': pypeit_tests.PypeItCoadd1DTest,
-              'type':    TestPhase.AFTERBURN,
-              'setups':  _coadd1d},
-             {'factory': pypeit_tests.PypeItCoadd2DTest,
-              'type':    TestPhase.AFTERBURN,
-              'setups':  _coadd2d},
-             {'factory': pypeit_tests.PypeItTelluricTest,
-              'type':    TestPhase.AFTERBURN,
-              'setups':  _telluric},
-             {'factory': pypeit_tests.PypeItQuickLookTest,
-              'type':    TestPhase.QL,
-              'setups':  _quick_look},
+all_tests = [TestDescription(pypeit_tests.PypeItSetupTest, TestPhase.PREP, _pypeit_setup),
+             TestDescription(pypeit_tests.PypeItReduceTest, TestPhase.REDUCE, _reduce_setups),
+             TestDescription(pypeit_tests.PypeItReduceTest, TestPhase.REDUCE, _additional_reduce),
+             TestDescription(pypeit_tests.PypeItSensFuncTest, TestPhase.AFTERBURN, _sensfunc),
+             TestDescription(pypeit_tests.PypeItFluxSetupTest, TestPhase.AFTERBURN, _flux_setup),
+             TestDescription(pypeit_tests.PypeItFluxTest, TestPhase.AFTERBURN, _flux),
+             TestDescription(pypeit_tests.PypeItFlexureTest, TestPhase.AFTERBURN, _flexure),
+             TestDescription(pypeit_tests.PypeItCollate1DTest, TestPhase.AFTERBURN, _collate1d),
+             TestDescription(pypeit_tests.PypeItCoadd1DTest, TestPhase.AFTERBURN, _coadd1d),
+             TestDescription(pypeit_tests.PypeItCoadd2DTest, TestPhase.AFTERBURN, _coadd2d),
+             TestDescription(pypeit_tests.PypeItTelluricTest, TestPhase.AFTERBURN, _telluric),
+             TestDescription(pypeit_tests.PypeItQuickLookTest, TestPhase.QL, _quick_look),
              ]
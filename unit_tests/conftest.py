@@ -0,0 +1,61 @@
+# Local pytest plugin with fixtures shared by the dev-suite unit tests.
+#
+# Reading the raw data headers is by far the slowest part of building a
+# PypeItMetaData or PypeItSetup object, so the fixtures below build each object
+# once per test session and hand out deep copies that tests are free to modify.
+
+import copy
+import os
+from pathlib import Path
+
+import pytest
+
+from pypeit.spectrographs.util import load_spectrograph
+from pypeit.metadata import PypeItMetaData
+from pypeit.pypeitsetup import PypeItSetup
+
+
+def pytest_configure(config):
+    config.addinivalue_line("markers",
+                            "gui: test creates Qt widgets and requires a (possibly offscreen) "
+                            "display. Deselect with '-m \"not gui\"'.")
+
+
+@pytest.fixture(scope="session")
+def raw_data_path():
+    return Path(os.environ['PYPEIT_DEV'], 'RAW_DATA')
+
+
+@pytest.fixture(scope="session")
+def kast_blue_raw_path(raw_data_path):
+    return (raw_data_path / "shane_kast_blue" / "600_4310_d55").absolute()
+
+
+@pytest.fixture(scope="session")
+def _kast_blue_metadata(kast_blue_raw_path):
+    files = list(kast_blue_raw_path.glob("*.fits.gz"))
+    spec = load_spectrograph("shane_kast_blue")
+    par = spec.default_pypeit_par()
+    return PypeItMetaData(spec, par, files)
+
+
+@pytest.fixture
+def kast_blue_metadata(_kast_blue_metadata):
+    """A fresh copy of the shane_kast_blue 600_4310_d55 metadata, without frame types."""
+    return copy.deepcopy(_kast_blue_metadata)
+
+
+@pytest.fixture(scope="session")
+def _kast_blue_setup(kast_blue_raw_path):
+    files = [str(f) for f in kast_blue_raw_path.glob("*.fits.gz")]
+    ps = PypeItSetup.from_rawfiles(files, "shane_kast_blue")
+    # Same arguments used by PypeItSetupGUIModel.run_setup
+    ps.run(setup_only=True, groupings=True, clean_config=False)
+    return ps
+
+
+@pytest.fixture
+def kast_blue_setup(_kast_blue_setup):
+    """A fresh copy of a PypeItSetup that has already been run on the shane_kast_blue
+    600_4310_d55 raw data."""
+    return copy.deepcopy(_kast_blue_setup)
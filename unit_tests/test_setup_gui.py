@@ -13,7 +13,6 @@ import numpy as np
 from pypeit.setup_gui import dialog_helpers
 from pypeit.setup_gui import view, model, controller
 from pypeit.spectrographs.util import load_spectrograph
-from pypeit.metadata import PypeItMetaData
 from pypeit.inputfiles import PypeItFile
 from pypeit import msgs
 
@@ -22,17 +21,6 @@ from pypeit import msgs
 def qapp_args():
     return ["pytest", "-platform", "offscreen"]
 
-@pytest.fixture
-def raw_data_path():
-    return Path(os.environ['PYPEIT_DEV'], 'RAW_DATA')
-
-def get_test_metadata(raw_data_path):
-    # Create a PypeItMetadata to test with
-    files = list((raw_data_path / "shane_kast_blue" / "600_4310_d55").absolute().glob("*.fits.gz"))
-    spec = load_spectrograph("shane_kast_blue")
-    par = spec.default_pypeit_par()
-    return PypeItMetaData(spec, par, files)
-
 def get_mock_setup(metadata=None):
     MockSetup = namedtuple('MockSetup', ['par', 'user_cfg', 'fitstbl', 'spectrograph'])
 
@@ -79,9 +67,9 @@ class MockFileDialog():
     def create_open_file_dialog(*args, **kwargs):
         return MockFileDialog()
 
-def test_metadata_model(raw_data_path, qtbot, qtmodeltester):
+def test_metadata_model(kast_blue_metadata, qtbot, qtmodeltester):
 
-    metadata = get_test_metadata(raw_data_path)
+    metadata = kast_blue_metadata
     metadata_model = model.PypeItMetadataModel(metadata=None)
     spec_name = metadata.spectrograph.name
     spec = metadata.spectrograph
@@ -121,9 +109,9 @@ def test_metadata_model(raw_data_path, qtbot, qtmodeltester):
     # Test copyForRows
     # Test CopyFromConfig?
 
-def test_commenting_out_files(raw_data_path, tmp_path, qtbot):
+def test_commenting_out_files(kast_blue_metadata, tmp_path, qtbot):
 
-    metadata = get_test_metadata(raw_data_path)
+    metadata = kast_blue_metadata
     metadata.get_frame_types() # Needed so the metadata can be saved later
     metadata_model = model.PypeItMetadataModel(metadata=metadata)
 
@@ -219,10 +207,10 @@ def test_pypeit_params_proxy(qtmodeltester):
 def verify_state_change(name, state):
     return name == 'B' and state == model.ModelState.UNCHANGED
 
-def test_pypeit_file_model(qtbot, raw_data_path, tmp_path):
+def test_pypeit_file_model(qtbot, kast_blue_metadata, kast_blue_raw_path, tmp_path):
 
     # Get a mock pypeit setup
-    metadata = get_test_metadata(raw_data_path)
+    metadata = kast_blue_metadata
     # This will set "setup" to B for every file except b1.fits.gz
     metadata.get_frame_types()
     metadata.table['setup'] = 'A'
@@ -248,7 +236,7 @@ def test_pypeit_file_model(qtbot, raw_data_path, tmp_path):
 
     # Make sure one setup A and one setup B is there. This would probably be invalid
     # but the GUI trusts the user to know what they're doing
-    shane_kast_blue_path = (raw_data_path / "shane_kast_blue" / "600_4310_d55").absolute()
+    shane_kast_blue_path = kast_blue_raw_path
     assert str((shane_kast_blue_path / "b11.fits.gz").absolute()) in filenames
     assert str((shane_kast_blue_path / "b1.fits.gz").absolute()) in filenames
 
@@ -257,12 +245,12 @@ def test_pypeit_file_model(qtbot, raw_data_path, tmp_path):
     # test comments in configuration section being saved
 
  
-def test_pypeit_obslog_model(qtbot, raw_data_path, tmp_path):
+def test_pypeit_obslog_model(qtbot, kast_blue_metadata, kast_blue_raw_path, tmp_path):
     obslog_model = model.PypeItObsLogModel()
     assert obslog_model.state == model.ModelState.NEW
 
     # Copy only those fits files we want to run on
-    shane_kast_blue_path = (raw_data_path / "shane_kast_blue" / "600_4310_d55").absolute()
+    shane_kast_blue_path = kast_blue_raw_path
     shutil.copy2(shane_kast_blue_path / "b1.fits.gz", tmp_path)
     shutil.copy2(shane_kast_blue_path / "b27.fits.gz", tmp_path)
 
@@ -311,7 +299,7 @@ def test_pypeit_obslog_model(qtbot, raw_data_path, tmp_path):
     assert str(tmp_path/"b1.fits.gz") in raw_data_files
 
     # Test setting the metadata
-    metadata = get_test_metadata(raw_data_path)
+    metadata = kast_blue_metadata
 
     with qtbot.waitSignals([(obslog_model.paths_model.modelReset, "paths_reset"),
                             (obslog_model.spectrograph_changed, "spec_changed")],
@@ -486,6 +474,7 @@ def run_setup(spectrograph_name, setup_raw_data_path, main_controller, qtbot):
     # Make sure the thread finishes before continuing
     assert main_controller.operation_thread.wait(QDeadlineTimer(1000)) is True
 
+@pytest.mark.gui
 def test_run_setup(qapp, qtbot, raw_data_path, tmp_path, monkeypatch):
     """Test the basic process of setting a spectrograph, a raw data directory, and
     running setup."""
@@ -590,6 +579,7 @@ def test_run_setup(qapp, qtbot, raw_data_path, tmp_path, monkeypatch):
     history = settings.value('History')
     assert history == [str(j_multi)]
 
+@pytest.mark.gui
 def test_run_setup_failure(qapp, qtbot, raw_data_path, tmp_path, monkeypatch):
     c, main_window = setup_offscreen_gui(tmp_path, monkeypatch, qapp, qtbot)    
     setup_gui_model = c.model
@@ -616,6 +606,7 @@ def test_run_setup_failure(qapp, qtbot, raw_data_path, tmp_path, monkeypatch):
     # Verify all of the files are commented out
     assert np.all([filename.startswith("#") for filename in setup_gui_model.obslog_model.metadata_model.metadata['filename']])
 
+@pytest.mark.gui
 def test_run_setup_cancel(qapp, qtbot, raw_data_path, tmp_path, monkeypatch):
     c, main_window = setup_offscreen_gui(tmp_path, monkeypatch, qapp, qtbot)    
     setup_gui_model = c.model
@@ -657,6 +648,7 @@ def test_run_setup_cancel(qapp, qtbot, raw_data_path, tmp_path, monkeypatch):
  
     setup_gui_model.log_buffer.unwatch("test_cancel")
 
+@pytest.mark.gui
 def test_multi_paths(qapp, qtbot, raw_data_path, tmp_path, monkeypatch):
     """Test re-running setup on setting multiple paths"""
     c, main_window = setup_offscreen_gui(tmp_path, monkeypatch, qapp, qtbot)    
@@ -738,6 +730,7 @@ def test_multi_paths(qapp, qtbot, raw_data_path, tmp_path, monkeypatch):
     assert str(y_long) in history
 
 
+@pytest.mark.gui
 def test_save_and_open(qapp, qtbot, raw_data_path, tmp_path, monkeypatch):
     c, main_window = setup_offscreen_gui(tmp_path, monkeypatch, qapp, qtbot)    
 
@@ -828,6 +821,7 @@ def test_save_and_open(qapp, qtbot, raw_data_path, tmp_path, monkeypatch):
 
 # TODO test dialog_helpers directly and verify it's history abilities
 
+@pytest.mark.gui
 def test_save_all(qapp, qtbot, raw_data_path, tmp_path, monkeypatch):
     c, main_window = setup_offscreen_gui(tmp_path, monkeypatch, qapp, qtbot)    
 
@@ -964,6 +958,7 @@ def test_save_all(qapp, qtbot, raw_data_path, tmp_path, monkeypatch):
     assert tab_a_file.is_file()
     assert not tab_b_file.is_file()
 
+@pytest.mark.gui
 def test_clear(qapp, qtbot, raw_data_path, tmp_path, monkeypatch):
     """
     Test the "clear" button
@@ -1011,6 +1006,7 @@ def test_clear(qapp, qtbot, raw_data_path, tmp_path, monkeypatch):
     assert main_window.tab_widget.widget(0).name == "ObsLog"
     assert main_window.tab_widget.count() == 2
 
+@pytest.mark.gui
 def test_log_window(qapp, qtbot, tmp_path, monkeypatch):
     c, main_window = setup_offscreen_gui(tmp_path, monkeypatch, qapp, qtbot, verbosity=1)
 
@@ -0,0 +1,170 @@
+"""
+Model-only tests of the setup GUI.
+
+These tests drive the setup GUI models the same way the controllers do, but
+without creating a QApplication or any widgets. Signals between QObjects in the
+same thread are delivered synchronously, so they can be recorded directly
+instead of waiting on them with qtbot. This keeps the tests fast, lets them run
+without a display, and lets them run in parallel with the other unit tests.
+The tests that exercise the widgets themselves are in test_setup_gui.py and are
+marked with "gui".
+"""
+import shutil
+
+import pytest
+
+from pypeit.setup_gui import model
+from pypeit.inputfiles import PypeItFile
+
+
+class SignalRecorder:
+    """Records the emissions of Qt signals, in the order they were emitted.
+
+    Args:
+        signals (dict): Maps the name to record each signal under to the signal
+            to connect to.
+    """
+    def __init__(self, **signals):
+        self.emitted = []
+        for name, signal in signals.items():
+            signal.connect(self._recorder(name))
+
+    def _recorder(self, name):
+        def record(*args):
+            self.emitted.append((name, args))
+        return record
+
+    @property
+    def names(self):
+        """list of str: The names of the signals emitted so far, in order."""
+        return [name for name, args in self.emitted]
+
+    def clear(self):
+        self.emitted = []
+
+
+def seed_gui_model(gui_model, pypeit_setup):
+    """Populate a PypeItSetupGUIModel from an already run PypeItSetup.
+
+    This follows the same steps as :meth:`PypeItSetupGUIModel.run_setup` after
+    the raw data headers have been read.
+    """
+    gui_model._pypeit_setup = pypeit_setup
+    gui_model.obslog_model.setMetadata(pypeit_setup.fitstbl)
+    gui_model.createFilesForConfigs()
+    gui_model.stateChanged.emit()
+
+
+def test_model_run_setup(kast_blue_raw_path, tmp_path):
+    # Copy only those fits files we want to run on
+    shutil.copy2(kast_blue_raw_path / "b1.fits.gz", tmp_path)
+    shutil.copy2(kast_blue_raw_path / "b27.fits.gz", tmp_path)
+
+    gui_model = model.PypeItSetupGUIModel()
+    obslog_model = gui_model.obslog_model
+    recorder = SignalRecorder(spec_changed=obslog_model.spectrograph_changed,
+                              path_added=obslog_model.paths_model.rowsInserted,
+                              files_added=gui_model.filesAdded,
+                              state_changed=gui_model.stateChanged)
+    assert gui_model.state == model.ModelState.NEW
+
+    # The same steps the controller takes when the user runs setup
+    obslog_model.set_spectrograph("shane_kast_blue")
+    obslog_model.add_raw_data_directory(str(tmp_path))
+    gui_model.run_setup()
+
+    assert recorder.names == ['spec_changed', 'path_added', 'spec_changed', 'files_added',
+                              'state_changed']
+    assert gui_model.state == model.ModelState.CHANGED
+    assert list(gui_model.pypeit_files.keys()) == ['A']
+    assert set(gui_model.pypeit_files['A'].metadata_model.metadata['filename']) \
+                == {'b1.fits.gz', 'b27.fits.gz'}
+
+
+def test_model_run_setup_no_files(tmp_path):
+    gui_model = model.PypeItSetupGUIModel()
+    gui_model.obslog_model.set_spectrograph("shane_kast_blue")
+    gui_model.obslog_model.add_raw_data_directory(str(tmp_path))
+
+    with pytest.raises(ValueError, match="Could not find any files"):
+        gui_model.run_setup()
+    assert gui_model.state == model.ModelState.NEW
+
+
+def test_model_save_and_open(kast_blue_setup, tmp_path):
+    gui_model = model.PypeItSetupGUIModel()
+    seed_gui_model(gui_model, kast_blue_setup)
+    assert gui_model.state == model.ModelState.CHANGED
+    assert gui_model.obslog_model.spec_name == "shane_kast_blue"
+
+    # Save the one configuration in the raw data
+    file_model = gui_model.pypeit_files['A']
+    file_model.save_location = str(tmp_path)
+    recorder = SignalRecorder(file_state=file_model.stateChanged,
+                              state_changed=gui_model.stateChanged)
+    file_model.save()
+    assert ('file_state', ('A', model.ModelState.UNCHANGED)) in recorder.emitted
+    assert 'state_changed' in recorder.names
+    assert gui_model.state == model.ModelState.UNCHANGED
+
+    saved_file = tmp_path / "shane_kast_blue_A.pypeit"
+    assert saved_file.exists()
+    saved_filenames = set(PypeItFile.from_file(str(saved_file)).filenames)
+
+    # Reset the model
+    recorder = SignalRecorder(files_deleted=gui_model.filesDeleted,
+                              spec_changed=gui_model.obslog_model.spectrograph_changed,
+                              state_changed=gui_model.stateChanged)
+    gui_model.reset()
+    assert recorder.names == ['files_deleted', 'spec_changed', 'state_changed']
+    assert gui_model.state == model.ModelState.NEW
+    assert len(gui_model.obslog_model.raw_data_directories) == 0
+
+    # Re-open the saved file
+    recorder = SignalRecorder(files_added=gui_model.filesAdded,
+                              state_changed=gui_model.stateChanged)
+    gui_model.open_pypeit_file(str(saved_file))
+    assert recorder.names == ['files_added', 'state_changed']
+    assert gui_model.state == model.ModelState.UNCHANGED
+    assert gui_model.obslog_model.spec_name == "shane_kast_blue"
+    assert gui_model.obslog_model.raw_data_directories == [str(kast_blue_setup.fitstbl['directory'][0])]
+    opened_metadata = gui_model.pypeit_files['A'].metadata_model.metadata
+    assert set(opened_metadata.frame_paths(range(len(opened_metadata)))) == saved_filenames
+
+    # A failed save is reported as a RuntimeError
+    saved_file.unlink()
+    saved_file.mkdir()
+    with pytest.raises(RuntimeError, match="Failed saving setup"):
+        file_model.save()
+
+
+def test_model_new_and_remove_files(kast_blue_setup):
+    gui_model = model.PypeItSetupGUIModel()
+    seed_gui_model(gui_model, kast_blue_setup)
+    for file_model in gui_model.pypeit_files.values():
+        file_model.state = model.ModelState.UNCHANGED
+
+    recorder = SignalRecorder(files_added=gui_model.filesAdded,
+                              files_deleted=gui_model.filesDeleted,
+                              state_changed=gui_model.stateChanged)
+
+    # A new file has no rows until files are pasted into it
+    new_file = gui_model.createEmptyPypeItFile("B")
+    assert recorder.emitted == [('files_added', ([new_file],)), ('state_changed', ())]
+    assert new_file.state == model.ModelState.NEW
+    assert new_file.metadata_model.rowCount() == 0
+    assert gui_model.state == model.ModelState.CHANGED
+
+    # Copying rows in from file A changes its state
+    recorder.clear()
+    file_a = gui_model.pypeit_files['A']
+    new_file.metadata_model.pasteFrom(file_a.metadata_model.createCopyForRows([0, 1]))
+    assert new_file.state == model.ModelState.CHANGED
+    assert new_file.metadata_model.rowCount() == 2
+    assert 'state_changed' in recorder.names
+
+    recorder.clear()
+    gui_model.removeFile("B")
+    assert recorder.emitted == [('files_deleted', (['B'],))]
+    assert list(gui_model.pypeit_files.keys()) == ['A']
+    assert gui_model.state == model.ModelState.UNCHANGED
@@ -0,0 +1,371 @@
+"""
+Benchmark the automatic wavelength calibration on the arc spectra in TEST_DATA.
+
+Every longslit arc (the ``*_PYPIT.json`` files) and every order of the HIRES arcs (``HIREDUX/*_aspec.fits.gz`` with
+their ``*_lines.fits.gz`` identifications) is calibrated with:
+
+    - ``autoid``: the pattern matching of :class:`~pypeit.core.wavecal.autoid.HolyGrail`,
+    - ``reidentify``: :func:`~pypeit.core.wavecal.autoid.reidentify` against its own known solution, after shifting
+      and stretching the arc by a random amount, followed by :func:`~pypeit.core.wavecal.wv_fitting.fit_slit`.
+
+The spectra are calibrated in parallel, and for every spectrum the wall time, the number of detected lines, the number
+of candidate solutions of the pattern matching, the number of lines in the final fit, the RMS of the fit and the median
+error of the solution relative to the known solution (in pixels) are recorded. The table of results can be written to
+a file and compared with the results of an earlier run, so that every change of the algorithms in
+``pypeit.core.wavecal`` comes with a speed/accuracy scorecard.
+
+Example::
+
+    python benchmark_autoid.py --nproc 8 --outfile autoid_benchmark_main.ecsv
+    python benchmark_autoid.py --nproc 8 --outfile autoid_benchmark_pr.ecsv --compare autoid_benchmark_main.ecsv
+"""
+import time
+import zlib
+import glob
+import json
+import fnmatch
+import argparse
+import traceback
+import multiprocessing
+from pathlib import Path
+
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table, join
+
+from pypeit import msgs
+from pypeit.core import fitting
+from pypeit.core.wavecal import autoid, waveio, wv_fitting, wvutils
+from pypeit.spectrographs.util import load_spectrograph
+
+
+TEST_DATA = Path(__file__).resolve().parent / 'TEST_DATA'
+
+# HIRES orders with fewer identified lines are not used
+MIN_TRUTH_LINES = 8
+
+# Order of the Legendre polynomial fitted to the identified lines of the HIRES orders to get their known solution
+TRUTH_ORDER = 4
+
+# A solution is correct if its median error relative to the known solution is below this number of pixels
+WAVE_TOL = 1.0
+
+# Range of the random shifts (pixels) and stretches applied to the arcs before reidentifying them
+MAX_SHIFT = 20.0
+MAX_STRETCH = 0.005
+
+PATHS = ['autoid', 'reidentify']
+
+# Spectrograph whose default wavelength calibration parameters are used, by prefix of the file names
+SPECTROGRAPHS = {'kastb': 'shane_kast_blue', 'kastr': 'shane_kast_red', 'lrisb': 'keck_lris_blue',
+                 'lrisr': 'keck_lris_red', 'hires': 'keck_hires'}
+
+
+def known_solution(pix, wave, nspec, order):
+    """
+    Known wavelength solution of an arc, from a Legendre fit to its identified lines.
+    """
+    pypeitfit = fitting.robust_fit(pix, wave, order, function='legendre', minx=0.0, maxx=nspec - 1.0)
+    return pypeitfit.eval(np.arange(nspec, dtype=float))
+
+
+def load_corpus(test_data=TEST_DATA, select=None):
+    """
+    Load the arc spectra of TEST_DATA and their known wavelength solutions.
+
+    Parameters
+    ----------
+    test_data : str or `Path`, optional
+        The TEST_DATA folder.
+    select : str, optional
+        Only load the spectra whose name matches this shell-style pattern.
+
+    Returns
+    -------
+    corpus : list
+        One dict per spectrum with the name of the file, the source ('json' or 'hiredux'), the spectrograph, the
+        order (-1 for longslit), the arc lamps, the arc spectrum and its known wavelength solution.
+    """
+    corpus = []
+    for json_file in sorted(glob.glob(str(Path(test_data) / '*_PYPIT.json'))):
+        name = Path(json_file).name
+        if select is not None and not fnmatch.fnmatch(name, select):
+            continue
+        with open(json_file, 'r') as f:
+            pypeit_fit = json.load(f)
+        # Older files have the solution of a single slit, newer ones one per slit
+        pypeit_fit = pypeit_fit.get('0', pypeit_fit)
+        spec = np.asarray(pypeit_fit['spec'], dtype=float)
+        # xfit is normalized by nspec-1, not by the stored xnorm; this puts the lines on their tcent
+        pix = np.asarray(pypeit_fit['xfit'])*(spec.size - 1)
+        wave = known_solution(pix, np.asarray(pypeit_fit['yfit']), spec.size, len(pypeit_fit['fitc']) - 1)
+        lamps = sorted(set(ion for ion in pypeit_fit['ions'] if ion != '--'))
+        corpus.append(dict(name=name, source='json', spectrograph=SPECTROGRAPHS[name.split('_')[0]], order=-1,
+                           lamps=lamps, spec=spec, wave=wave))
+
+    for aspec_file in sorted(glob.glob(str(Path(test_data) / 'HIREDUX' / '*_aspec.fits.gz'))):
+        name = Path(aspec_file).name
+        if select is not None and not fnmatch.fnmatch(name, select):
+            continue
+        arcs = fits.getdata(aspec_file).astype(float)
+        lines = fits.getdata(aspec_file.replace('aspec.fits.gz', 'lines.fits.gz'), 1)
+        for iord, spec in enumerate(arcs):
+            ids = lines['WV'][iord] != 0.0
+            if not np.any(spec != 0.0) or np.sum(ids) < MIN_TRUTH_LINES:
+                continue
+            wave = known_solution(lines['PIX'][iord][ids], lines['WV'][iord][ids], spec.size, TRUTH_ORDER)
+            corpus.append(dict(name=name, source='hiredux', spectrograph=SPECTROGRAPHS['hires'], order=iord,
+                               lamps=['ThAr'], spec=spec, wave=wave))
+    return corpus
+
+
+class CountingHolyGrail(autoid.HolyGrail):
+    """
+    :class:`~pypeit.core.wavecal.autoid.HolyGrail` that counts the candidate solutions of the pattern matching.
+    """
+    def __init__(self, *args, **kwargs):
+        self.ncandidates = 0
+        super().__init__(*args, **kwargs)
+
+    def solve_slit(self, slit, psols, msols, *args, **kwargs):
+        self.ncandidates += sum(len(sols[2]) for sols in (psols, msols) if sols is not None and sols[2] is not None)
+        return super().solve_slit(slit, psols, msols, *args, **kwargs)
+
+
+def run_autoid(spec, lamps, par):
+    """
+    Calibrate an arc with the pattern matching of :class:`~pypeit.core.wavecal.autoid.HolyGrail`.
+
+    Returns
+    -------
+    final_fit : :class:`~pypeit.core.wavecal.wv_fitting.WaveFit`
+        The final fit, None if no solution was found.
+    ndet : int
+        Number of detected lines.
+    ncand : int
+        Number of candidate solutions of the pattern matching.
+    """
+    measured_fwhm = autoid.measure_fwhm(spec, sigdetect=wvutils.parse_param(par, 'sigdetect', 0), fwhm=par['fwhm'])
+    grail = CountingHolyGrail(spec.reshape((spec.size, 1)), lamps, par=par,
+                              measured_fwhms=np.array([measured_fwhm]), nonlinear_counts=1e10)
+    _, all_final_fit = grail.get_results()
+    det = grail._det_weak.get('0', [None])[0]
+    return all_final_fit.get('0'), 0 if det is None else det.size, grail.ncandidates
+
+
+def run_reidentify(spec, wave, lamps, par, rng):
+    """
+    Calibrate an arc with :func:`~pypeit.core.wavecal.autoid.reidentify`, using the arc itself with its known solution
+    as the archive. The arc is shifted and stretched before being reidentified.
+
+    Returns
+    -------
+    final_fit : :class:`~pypeit.core.wavecal.wv_fitting.WaveFit`
+        The final fit, None if no solution was found.
+    ndet : int
+        Number of detected lines.
+    wave_shifted : `numpy.ndarray`_
+        Known wavelength solution of the shifted and stretched arc, NaN where it falls outside of the original arc.
+    """
+    nspec = spec.size
+    pix_orig = rng.uniform(1.0 - MAX_STRETCH, 1.0 + MAX_STRETCH)*np.arange(nspec) \
+        + rng.uniform(-MAX_SHIFT, MAX_SHIFT)
+    spec_shifted = np.interp(pix_orig, np.arange(nspec), spec, left=0.0, right=0.0)
+    wave_shifted = np.interp(pix_orig, np.arange(nspec), wave, left=np.nan, right=np.nan)
+
+    line_list, _, _ = waveio.load_line_lists(lamps)
+    sigdetect = wvutils.parse_param(par, 'sigdetect', 0)
+    measured_fwhm = autoid.measure_fwhm(spec_shifted, sigdetect=sigdetect, fwhm=par['fwhm'])
+    fwhm = autoid.set_fwhm(par, measured_fwhm=measured_fwhm)
+    detections, _, patt_dict = autoid.reidentify(spec_shifted, spec, wave, line_list, par['nreid_min'],
+                                                 cc_thresh=wvutils.parse_param(par, 'cc_thresh', 0),
+                                                 cc_local_thresh=par['cc_local_thresh'], nlocal_cc=par['nlocal_cc'],
+                                                 match_toler=par['match_toler'], sigdetect=sigdetect, fwhm=fwhm)
+    if not patt_dict['acceptable']:
+        return None, detections.size, wave_shifted
+    final_fit = wv_fitting.fit_slit(spec_shifted, patt_dict, detections, line_list, match_toler=par['match_toler'],
+                                    func=par['func'], n_first=par['n_first'], sigrej_first=par['sigrej_first'],
+                                    n_final=wvutils.parse_param(par, 'n_final', 0),
+                                    sigrej_final=par['sigrej_final'])
+    return final_fit, detections.size, wave_shifted
+
+
+def _benchmark_worker(path, item, seed):
+    """
+    Calibrate one arc and score the solution. This is run in the process pool of :func:`run_benchmark`.
+
+    Returns
+    -------
+    row : dict
+        One row of the table returned by :func:`run_benchmark`.
+    """
+    row = dict(name=item['name'], source=item['source'], order=item['order'], path=path, time=np.nan, ndet=0,
+               ncand=0, nlin=0, rms=np.nan, wave_err=np.nan, status='failed', error='')
+    par = load_spectrograph(item['spectrograph']).default_pypeit_par()['calibrations']['wavelengths']
+    wave = item['wave']
+    tstart = time.perf_counter()
+    try:
+        if path == 'autoid':
+            final_fit, row['ndet'], row['ncand'] = run_autoid(item['spec'], item['lamps'], par)
+        else:
+            rng = np.random.default_rng([seed, zlib.crc32(item['name'].encode()), item['order'] + 1])
+            final_fit, row['ndet'], wave = run_reidentify(item['spec'], wave, item['lamps'], par, rng)
+    except Exception:
+        row['time'] = time.perf_counter() - tstart
+        row['status'] = 'error'
+        row['error'] = traceback.format_exc().strip().split('\n')[-1]
+        return row
+    row['time'] = time.perf_counter() - tstart
+
+    if final_fit is None or final_fit['wave_soln'] is None:
+        return row
+    row['nlin'] = len(final_fit['pixel_fit'])
+    row['rms'] = final_fit['rms']
+    # Error of the solution in pixels, using the local dispersion of the known solution
+    dwave = np.abs(np.gradient(wave))
+    use = np.isfinite(wave) & (dwave > 0)
+    row['wave_err'] = np.median(np.abs(final_fit['wave_soln'][use] - wave[use])/dwave[use])
+    row['status'] = 'ok' if row['wave_err'] < WAVE_TOL else 'wrong'
+    return row
+
+
+def run_benchmark(corpus, paths=None, nproc=1, seed=1234):
+    """
+    Calibrate every arc of the corpus with every path.
+
+    Parameters
+    ----------
+    corpus : list
+        The arcs, see :func:`load_corpus`.
+    paths : list, optional
+        Calibration paths, among :data:`PATHS`. All of them by default.
+    nproc : int, optional
+        Number of processes.
+    seed : int, optional
+        Seed of the random shifts and stretches of the reidentify path. It is combined with the name and order of
+        every arc, so the shift of an arc does not depend on the other arcs in the corpus.
+
+    Returns
+    -------
+    results : `astropy.table.Table`_
+        One row per arc and path, with the wall time in seconds, the number of detected lines, the number of candidate
+        solutions of the pattern matching (autoid only), the number of lines and the RMS in pixels of the final fit, the
+        median error of the solution in pixels, and the status: 'ok', 'wrong' (error above :data:`WAVE_TOL`),
+        'failed' (no solution) or 'error' (exception, with its message).
+    """
+    paths = PATHS if paths is None else paths
+    tasks = [(path, item, seed) for path in paths for item in corpus]
+    msgs.info('Calibrating {0} arcs with {1}'.format(len(corpus), ', '.join(paths)))
+    if nproc > 1 and len(tasks) > 1:
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(processes=min(nproc, len(tasks))) as pool:
+            rows = pool.starmap(_benchmark_worker, tasks, chunksize=1)
+    else:
+        rows = [_benchmark_worker(*task) for task in tasks]
+
+    results = Table(rows=rows, names=list(rows[0].keys())) if len(rows) > 0 else Table()
+    for name, fmt in zip(['time', 'rms', 'wave_err'], ['.3f', '.4f', '.3f']):
+        if name in results.colnames:
+            results[name].format = fmt
+    return results
+
+
+def scorecard(results):
+    """
+    Summary of the benchmark results per source and path.
+
+    Returns
+    -------
+    card : `astropy.table.Table`_
+        Number of arcs, fraction of correct solutions, total and median wall time, and median number of candidates,
+        RMS and error of the correct solutions.
+    """
+    rows = []
+    for source in np.unique(results['source']):
+        for path in np.unique(results['path']):
+            these = results[(results['source'] == source) & (results['path'] == path)]
+            if len(these) == 0:
+                continue
+            ok = these['status'] == 'ok'
+            rows.append((source, path, len(these), np.mean(ok), np.sum(these['status'] == 'error'), np.sum(these['time']),
+                         np.median(these['time']), np.median(these['ncand']),
+                         np.median(these['rms'][ok]) if np.any(ok) else np.nan,
+                         np.median(these['wave_err'][ok]) if np.any(ok) else np.nan))
+    card = Table(rows=rows, names=('source', 'path', 'narc', 'frac_ok', 'nerror', 'time_total', 'time_median',
+                                   'ncand_median', 'rms_median', 'wave_err_median'))
+    for name, fmt in zip(card.colnames[3:], ['.3f', 'd', '.1f', '.3f', '.0f', '.4f', '.3f']):
+        card[name].format = fmt
+    return card
+
+
+def compare_results(old, new, rms_tol=0.05, time_ratio=2.0):
+    """
+    Compare the results of two benchmark runs.
+
+    Parameters
+    ----------
+    old, new : `astropy.table.Table`_
+        The results, see :func:`run_benchmark`.
+    rms_tol : float, optional
+        Report the arcs whose RMS changed by more than this number of pixels.
+    time_ratio : float, optional
+        Report the arcs whose wall time changed by more than this factor.
+
+    Returns
+    -------
+    changes : `astropy.table.Table`_
+        The arcs whose status changed, whose RMS changed by more than rms_tol or whose wall time changed by more than
+        time_ratio, with their old and new results.
+    """
+    keys = ['name', 'source', 'order', 'path']
+    cols = ['status', 'time', 'ncand', 'nlin', 'rms', 'wave_err']
+    both = join(old[keys + cols], new[keys + cols], keys=keys, table_names=['old', 'new'])
+    changed = both['status_old'] != both['status_new']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        changed |= np.abs(both['rms_new'] - both['rms_old']) > rms_tol
+        ratio = both['time_new']/both['time_old']
+        changed |= (ratio > time_ratio) | (ratio < 1.0/time_ratio)
+    return both[changed]
+
+
+def parse_args(options=None):
+    parser = argparse.ArgumentParser(description='Benchmark the automatic wavelength calibration on the arcs in '
+                                                 'TEST_DATA')
+    parser.add_argument('--test_data', default=str(TEST_DATA), type=str, help='Path to the TEST_DATA folder')
+    parser.add_argument('--select', default=None, type=str,
+                        help='Only use the files matching this pattern, e.g. "hires_tmpl2x1*" or "*.json"')
+    parser.add_argument('--paths', default=PATHS, nargs='+', choices=PATHS, help='Calibration paths to benchmark')
+    parser.add_argument('--nproc', default=1, type=int, help='Number of processes')
+    parser.add_argument('--seed', default=1234, type=int, help='Seed of the shifts and stretches of reidentify')
+    parser.add_argument('--outfile', default=None, type=str, help='Write the results to this file')
+    parser.add_argument('--compare', default=None, type=str,
+                        help='Compare the results with those of an earlier run written with --outfile')
+    return parser.parse_args(options)
+
+
+def main(args):
+    corpus = load_corpus(args.test_data, select=args.select)
+    if len(corpus) == 0:
+        msgs.error('No arcs found in {0}'.format(args.test_data))
+
+    results = run_benchmark(corpus, paths=args.paths, nproc=args.nproc, seed=args.seed)
+    if args.outfile is not None:
+        results.write(args.outfile, overwrite=True)
+    card = scorecard(results)
+    print('==============================================================')
+    card.pprint_all()
+
+    if args.compare is not None:
+        old = Table.read(args.compare)
+        print('==============================================================')
+        print('Scorecard of {0}'.format(args.compare))
+        scorecard(old).pprint_all()
+        changes = compare_results(old, results)
+        print('==============================================================')
+        print('{0} arcs changed'.format(len(changes)))
+        changes.pprint_all()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main(parse_args()))